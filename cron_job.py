@@ -1,116 +1,95 @@
 #!/usr/bin/python3.11
 
-import os, sys, subprocess
-import time
-from time import strftime, localtime, time
+import os, sys
+from time import strftime, localtime
 import demultiplex_script
+from demultiplex import runstate
 
 # LIMITATIONS/ASSUMPTIONS:
-#   This script cannot handle more than 1 new run
-#       if more than 1 new run exists in /data/rawdata/ the script will pick the first
-#       directory  os.listdir() will return, THERE IS NO GUARANTEE FOR LEXICOGRAPHICAL
-#       ORDER.
+#   This script handles 1 run per invocation
+#       if more than 1 run is queued, the first one in scheduler order that fits on disk and that nobody holds the lease on is picked,
+#       the rest wait for the next invocation
+#           scheduler order ( demultiplex/scheduler.py ): manual priority, then runs queued for longer than demux.queueStarvationSeconds,
+#           then shortest job first, aged by how long each run has waited. Set a priority with
+#               PYTHONPATH=/data/bin /usr/bin/python3.11 -m demultiplex.runstate priority <RunID> <priority>
+#       several invocations, on this host or on other hosts mounting /data, can run side by side: the leases in /data/log/leases
+#       ( demultiplex/lease.py ) keep them on different runs
 #
 # INPUT:
 #   none from command line
-#   the directory contents of /data/rawdata and /data/demultiplex
+#   the run-state store, /data/log/runstate.sqlite3, kept up to date from the directory contents of /data/rawdata and /data/demultiplex
 #
 # OUTPUT:
 #   Log file in /data/bin/cron_out.log, append mode, file does not get overwritten with each run
-#           "2021-09-09 10:00:01 - 24 in rawdata and 24 in demultiplex : all the runs have been demultiplexed"  
+#           "2021-09-09 10:00:01 - 0 queued, 1 waiting: all the runs have been demultiplexed"
 #       or
-#           Need to work on this: $COMMAND_TO_RUN completed
-#       or
-#           Need to work on this: $COMMAND_TO_RUN, waiting for the run to complete
+#           Will work on this RunID: $RunID ... completed
 #
 # WHAT DOES THIS SCRIPT DO:
-#       This script sets up the demultiplexing:
-#           Picks up all the existing folders within /data/rawdata/*M06578*_demultiplex in variable RunList     
-#       Initializes a new variable
-#           fills it up with the var from RunList
-#           but removes the _demultiplex part
-#               demultiplexList.append(dirName.replace('_demultiplex',''))
-#       Differentiates the new item to run by comparing with the os.listdir(DemultiplexDir)
-#           FIXME comparison needs revision, inefficient
+#       demultiplex_script.detectNewRuns( ) brings the run-state store up to date:
+#           new directories in /data/rawdata with a sequencer tag are recorded as seen
+#           runs with RTAComplete.txt and SampleSheet.csv are queued, the others wait
+#           runs that already have a _demultiplex directory are done
+#       only directories whose mtime changed since the last invocation are looked at, see demultiplex/runstate.py
+#       the queue, and how long the runs in it have waited, is written to /data/log/demultiplex_queue.prom for node_exporter
 #
-#       if there is a difference between the two lists
-#           the script starts a new run by
-#               creating the dir path to be demultiplexed
-#               checks if /data/rawdata/$NEWRUN/SampleSheet.csv exists
-#           executes /bin/python3 /data/bin/current_demultiplex_script.py
-#               with the new dir name as argument, example
-#                   /bin/python3 /data/bin/current_demultiplex_script.py 210903_NB552450_0002_AH3VYYBGXK_copy   
-#           script waits for the output of /data/bin/current_demultiplex_script.py and appends it to
-#               /data/bin/cron_out.log
-
-
-RunList = []
-print( f"==> Getting new rawdata directories started ==\n")
+#       if a run is queued, is predicted to fit on /data ( demultiplex/diskspace.py ) and its lease can be taken
+#           the state becomes running and demultiplex_script.main( ) is called with its RunID, example
+#               demultiplex_script.main( '210903_NB552450_0002_AH3VYYBGXK' )
+#           the state becomes done, or failed if main( ) exited early. A failed run is not retried on its own:
+#               PYTHONPATH=/data/bin /usr/bin/python3.11 -m demultiplex.runstate requeue <RunID>
 
-for dirName in os.listdir( demultiplex_script.demux.rawDataDir ): # add directory names from the raw generated data directory
-
-    if demultiplex_script.demux.demultiplexDirSuffix in dirName: #  ignore any _demux dirs
-        continue
-    if any( tag in dirName for tags in [ demultiplex_script.demux.nextSeq, demultiplex_script.demux.miSeq ] for tag in tags ): # only add directories that have a sequncer tag
-        RunList.append( dirName )
 
-print( f"==< Getting new rawdata directories finished ==\n")
+newlyQueued, pending, waiting = demultiplex_script.detectNewRuns( )
 
+localTime = strftime( "%Y-%m-%d %H:%M:%S", localtime( ) )
+print( f"{ localTime } - { len( pending ) } queued, { len( waiting ) } waiting: ")
 
-DemultiplexList = [] 
-print( f"==> Getting demultiplexed directories started ==\n")
-
-for dirName in os.listdir( demultiplex_script.demux.demultiplexDir ):
+if not pending:
+     print( 'all the runs have been demultiplexed\n' )
 
-    if demultiplex_script.demux.demultiplexDirSuffix not in dirName: #  demultiplexed directories must have the  _demultiplex suffix # safety in case any other dirs included in /data/demultiplex
+if waiting:
+    print( f"waiting for the run to complete: {', '.join( waiting )}" )
+
+# a run still marked running whose lease we can take was abandoned: its worker died, or its host went down
+for RunID in demultiplex_script.runningRuns( ):
+    if demultiplex_script.acquireRunLease( RunID ):
+        demultiplex_script.setRunState( RunID, runstate.FAILED, "abandoned, the worker holding the lease is gone" )
+        demultiplex_script.demux.runLease.release( )
+        print( f"{RunID} was abandoned by its worker, marked failed\n" )
+
+# take the first queued run in scheduler order that fits on disk and nobody else holds the lease on: another cron tick, or a worker on
+# another host, may be on the others. A run that does not fit stays queued, and is looked at again on the next tick.
+NewRunID = None
+for RunID in pending:
+    short = demultiplex_script.diskSpaceShortfalls( RunID ) if demultiplex_script.demux.diskSpaceCheck else [ ]
+    if short:
+        print( f"{RunID} held, not enough disk space:\n    " + '\n    '.join( short ) )
         continue
-    if any( tag in dirName for tags in [ demultiplex_script.demux.nextSeq, demultiplex_script.demux.miSeq ] for tag in tags ): # ignore directories that have no sequncer tag
-        DemultiplexList.append( dirName.replace( demultiplex_script.demux.demultiplexDirSuffix, '' ) ) # null _demultiplex so we can compare the two lists below
-
-print( f"==> Getting demultiplexed directories finished ==\n")
-
-
-# Right now the script operates on only one run at a time, but in the future we might want to run miltiple things at a time
-
-count = 0
-NewRunList = [ ]
-NewRunID = '' # turn this into an array
-for item in RunList: # iterate over RunList to see if there a new item in DemultiplexList, effectively comparing the contents of the two directories
-    if item in DemultiplexList:
-        count += 1
-    else:
-        NewRunList.append( item )
-        NewRunID = item # any RunList item that is not in the demux list, gets processed
-
-localTime = strftime( "%Y-%m-%d %H:%M:%S", localtime( ) ) 
-print( f"{ localTime } - { len( RunList ) } in rawdata and { len( DemultiplexList ) } in demultiplex: ")
-
-if count == len( RunList ): # no new items in DemultiplexList, therefore count == len( RunList )
-     print( 'all the runs have been demultiplexed\n' )
+    if demultiplex_script.acquireRunLease( RunID ):
+        NewRunID = RunID
+        break
+if pending and not NewRunID:
+    print( f"{len( pending )} queued, all of them leased by other workers or held for disk space: {', '.join( pending )}\n" )
 
 if NewRunID:
 
-    flatNewRunList = ", ".join( NewRunList )
-    print( f"{len(NewRunList)} new items to demux: {flatNewRunList}")
-
-    print( f"Will work on this RunID: {NewRunID}\n" ) # caution: if the corresponding _demux directory is somehow corrupted (wrong data in SampleSheetFilename or incomplete files), this will be printed over and over in the log file
-
-    # essential condition to process is that RTAComplete.txt and SampleSheet.csv
-    if demultiplex_script.demux.rtaCompleteFile in os.listdir( os.path.join( demultiplex_script.demux.rawDataDir, NewRunID ) ) and demultiplex_script.demux.sampleSheetFileName in os.listdir( os.path.join( demultiplex_script.demux.rawDataDir, NewRunID ) ):
-
-        # if demultiplex_script.demux.debug: 
-            # print( f"{demultiplex_script.demux.python3_bin} {demultiplex_script.demux.scriptFilePath} {NewRunID}")
+    print( f"{len( pending )} new items to demux: {', '.join( pending )}")
+    print( f"Will work on this RunID: {NewRunID}\n" )
 
-        if not os.path.exists( demultiplex_script.demux.scriptFilePath ):
-            print( f"{demultiplex_script.demux.scriptFilePath} does not exist!" )
-            exit( )
+    if not os.path.exists( demultiplex_script.demux.scriptFilePath ):
+        print( f"{demultiplex_script.demux.scriptFilePath} does not exist!" )
+        exit( )
 
-        # EXAMPLE: /bin/python3.11 /data/bin/current_demultiplex_script.py 210903_NB552450_0002_AH3VYYBGXK 
+    demultiplex_script.setRunState( NewRunID, runstate.RUNNING )
+    try:
         demultiplex_script.main( NewRunID )
+    except BaseException as err:                            # main( ) leaves with sys.exit( ) when it gives up
+        demultiplex_script.setRunState( NewRunID, runstate.FAILED, f"{type( err ).__name__} {err}".strip( ) )
+        raise
+    demultiplex_script.setRunState( NewRunID, runstate.DONE )
 
-        print( 'completed\n' )
-    else:
-        print( ', waiting for the run to complete\n' )
+    print( 'completed\n' )
 
 #
 ########################################################################
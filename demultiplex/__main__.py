@@ -5,6 +5,16 @@
 # To run this:
 #
 # PYTHONPATH=/data/bin python3.11 -m demultiplex <RunID>
+#
+# or, as a long-lived daemon ( see demultiplex/daemon.py and systemd/demultiplex.service ):
+#
+# PYTHONPATH=/data/bin python3.11 -m demultiplex --daemon
+# PYTHONPATH=/data/bin python3.11 -m demultiplex submit <RunID> [priority]
+# PYTHONPATH=/data/bin python3.11 -m demultiplex cancel <RunID>
+# PYTHONPATH=/data/bin python3.11 -m demultiplex priority <RunID> <priority>
+# PYTHONPATH=/data/bin python3.11 -m demultiplex queue
+# PYTHONPATH=/data/bin python3.11 -m demultiplex status <RunID>
+# PYTHONPATH=/data/bin python3.11 -m demultiplex watch
 ########################################################################
 
 
@@ -18,23 +28,57 @@ sys.pycache_prefix = f'/tmp/pycache/{username}'
 
 
 
+import json
 import logging
-import argparse
-from demultiplex_script import main
+from demultiplex_script import main, demux
 
 # Initialize loggers
 demuxLogger = logging.getLogger(__name__)
 demuxFailureLogger = logging.getLogger("SMTPFailureLogger")
 
+# what the daemon client takes on the command line: command -> (usage, fewest arguments, most arguments, the request it sends)
+clientCommands = {
+    'submit':   ('<RunID> [priority]', 1, 2, lambda args: {'command': 'submit', 'runId': args[0], 'priority': int(args[1]) if len(args) > 1 else None}),
+    'cancel':   ('<RunID>', 1, 1, lambda args: {'command': 'cancel', 'runId': args[0]}),
+    'priority': ('<RunID> <priority>', 2, 2, lambda args: {'command': 'prioritise', 'runId': args[0], 'priority': int(args[1])}),
+    'queue':    ('', 0, 0, lambda args: {'command': 'queue'}),
+    'status':   ('<RunID>', 1, 1, lambda args: {'command': 'status', 'runId': args[0]}),
+    'watch':    ('', 0, 0, lambda args: {'command': 'watch'}),
+}
+
 if __name__ == "__main__":
     if sys.hexversion < 50923248:  # Require Python 3.9 or newer
         sys.exit("Python 3.9 or newer is required to run this program.")
 
-    parser = argparse.ArgumentParser()
-
     if len(sys.argv) == 1:
         sys.exit("No RunID argument present. Exiting.")
 
+    if sys.argv[1] == '--daemon':
+        from demultiplex.daemon import Daemon
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+        Daemon(demux.controlSocketPath, demux.daemonWorkers, demux.daemonPollInterval).serve()
+        sys.exit()
+
+    if sys.argv[1] in clientCommands:
+        from demultiplex.daemon import client
+        usage, fewest, most, request = clientCommands[sys.argv[1]]
+        arguments = [argument.replace("/", "").replace(",", "") for argument in sys.argv[2:]]
+        if not fewest <= len(arguments) <= most:
+            sys.exit(f"Usage: python3 -m demultiplex {sys.argv[1]} {usage}")
+        try:
+            request = request(arguments)
+        except ValueError:
+            sys.exit(f"Usage: python3 -m demultiplex {sys.argv[1]} {usage}, priority is a whole number")
+        reply = {}  # the daemon may hang up, or Ctrl-C come, before the first reply
+        try:
+            for reply in client(demux.controlSocketPath, request):
+                print(json.dumps(reply, indent=None if sys.argv[1] == 'watch' else 4), flush=True)
+        except (ConnectionRefusedError, FileNotFoundError):
+            sys.exit(f"No daemon listening on {demux.controlSocketPath}. Start it with: systemctl --user start demultiplex.service")
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0 if sys.argv[1] == 'watch' or reply.get('ok') else 1)
+
     RunID = sys.argv[1]
     RunID = RunID.replace("/", "")  # Be forgiving for copy-paste issues
     RunID = RunID.replace(",", "")
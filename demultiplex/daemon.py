@@ -0,0 +1,485 @@
+# daemon: a long-lived demultiplexer, controlled over a Unix domain socket
+
+import dataclasses
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import queue
+
+import demultiplex_script
+from demultiplex import lease
+from demultiplex import runstate
+
+
+#########################################################################
+# PYTHONPATH=/data/bin python3.11 -m demultiplex --daemon
+#
+# keeps one warm interpreter: a forkserver with demultiplex_script already imported. Every run is forked from it, so starting
+# one costs a fork, not an interpreter start and an import, and the run gets a process of its own: demux is per-process state,
+# and main( ) leaves with sys.exit( ) when it gives up.
+#
+# The daemon queues runs, starts up to demux.daemonWorkers of them at a time, and every demux.daemonPollInterval seconds
+# asks detectNewRuns( ) for runs that became ready. It answers one JSON object per line on demux.controlSocketPath:
+#
+#   { "command": "submit",     "runId": ..., "priority": 0 }      queue a run, or a rerun; priority is optional
+#   { "command": "cancel",     "runId": ... }                     take it off the queue, or stop it
+#   { "command": "prioritise", "runId": ..., "priority": 5 }      higher goes first, whatever demultiplex/scheduler.py says
+#   { "command": "queue" }                                        what is queued and running
+#   { "command": "status",     "runId": ... }                     the stage a run is in, and its status.json
+#   { "command": "watch" }                                        stream every event, one JSON object per line, until disconnect
+#
+# python3.11 -m demultiplex submit|cancel|priority|queue|status|watch ... is the command line client, see client( ).
+#
+# The daemon takes a run's lease before it forks the run, and the run adopts it: between the two, no cron tick can slip in.
+# A run outlives a daemon that dies ( KillMode=process in the systemd unit ) and records its own outcome. A run that does not,
+# killed along with the host or by the OOM killer, is still running in the run-state store with a lease anyone can take:
+# reapAbandoned( ) marks those failed, at startup and on every poll, like cron_job.py does.
+#########################################################################
+
+daemonLogger = logging.getLogger( 'demultiplex.daemon' )
+stageRegex   = re.compile( r"==([<>]) (\d+)/(\d+) tasks: (.*?) (started|finished) ==" )
+ansiRegex    = re.compile( r"\x1b\[[0-9;]*m" )
+
+
+
+########################################################################
+# Job
+########################################################################
+
+@dataclasses.dataclass
+class Job:
+    """
+    A run the daemon knows about
+    """
+
+    runId:      str
+    priority:   int                 = 0
+    submitted:  float               = dataclasses.field( default_factory = time.time )
+    state:      str                 = runstate.QUEUED
+    started:    float               = None
+    stage:      str                 = None
+    process:    object              = None
+    estimate:   float               = None      # seconds, scheduler's estimate
+    held:       str                 = None      # why it is not started: not enough disk space
+    heldUntil:  float               = 0         # time.monotonic( ) of the next disk space check
+    outcome:    str                 = None      # done/failed as reported by the run, or cancelled
+    reported:   bool                = False     # the run recorded its own outcome in the run-state store
+    lease:      object              = None      # the daemon's lease.Lease on the run, handed to the run to adopt
+
+    def describe( self ):
+        return { 'runId': self.runId, 'priority': self.priority, 'state': self.state, 'submitted': self.submitted, 'started': self.started, 'stage': self.stage,
+                 'estimate': self.estimate, 'held': self.held, 'pid': self.process.pid if self.process else None }
+
+
+
+########################################################################
+# StageEventHandler
+########################################################################
+
+class StageEventHandler( logging.Handler ):
+    """
+    Inside a run: turn the "==> n/total tasks: ... started ==" lines main( ) logs anyway into events for the daemon
+    """
+
+    def __init__( self, runId, events ):
+        logging.Handler.__init__( self, level = logging.INFO )
+        self.runId  = runId
+        self.events = events
+
+    def emit( self, record ):
+        match = stageRegex.search( ansiRegex.sub( '', record.getMessage( ) ) )
+        if match:
+            self.events.put( { 'event': 'stage', 'runId': self.runId, 'task': int( match.group( 2 ) ), 'totalTasks': int( match.group( 3 ) ),
+                               'stage': match.group( 4 ), 'status': match.group( 5 ), 'time': time.time( ) } )
+
+
+
+########################################################################
+# runJob( )
+########################################################################
+
+def runJob( runId, events, leaseToken ):
+    """
+    The body of a run's process, forked from the warm forkserver: demultiplex_script.main( {runId} ), reported on {events}
+        Own process group, so cancel can stop bcl2fastq and the other children along with it; SIGTERM ends main( ) like any other sys.exit( ).
+        The daemon took the lease on the run before forking: adopt it under {leaseToken}, so acquireRunLease( ) in main( ) finds it held.
+    """
+
+    os.setpgrp( )
+    signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit( "cancelled" ) )      # unwind, so the lease is given back
+    demux    = demultiplex_script.demux
+    runLease = lease.Lease( demux.leaseDirPath, runId, heartbeat = demux.leaseHeartbeat, timeout = demux.leaseTimeout )
+    if not runLease.adopt( leaseToken ):
+        events.put( { 'event': runstate.FAILED, 'runId': runId, 'message': "the lease was taken over before the run started", 'time': time.time( ) } )
+        return
+    demux.runLease = runLease
+
+    logging.getLogger( 'demultiplex_script' ).addHandler( StageEventHandler( runId, events ) )
+    outcome, message = runstate.DONE, None
+    try:
+        demultiplex_script.main( runId )
+    except SystemExit as err:
+        outcome, message = runstate.FAILED, f"main( ) exited {err}".strip( )
+    except BaseException as err:
+        outcome, message = runstate.FAILED, f"{type( err ).__name__}: {err}"
+    lost = runLease.lost                                                # checkRunLease( ): another worker has the run now, its state is theirs
+    runLease.release( )                                                 # multiprocessing leaves with os._exit( ): no atexit
+    if lost:
+        message = f"the lease was taken over, {message or 'leaving the run to the new holder'}"
+    else:
+        demultiplex_script.setRunState( runId, outcome, message )        # here, not in the daemon: the run may outlive it
+    events.put( { 'event': outcome, 'runId': runId, 'message': message, 'time': time.time( ) } )
+
+
+
+########################################################################
+# Daemon
+########################################################################
+
+class Daemon:
+    """
+    The queue, the running jobs, the watchers, and the loop that ties them together
+    """
+
+    def __init__( self, socketPath, workers = 1, pollInterval = 60 ):
+        self.socketPath     = socketPath
+        self.workers        = workers
+        self.pollInterval   = pollInterval
+        self.jobs           = dict( )                   # { runId: Job }, queued and running
+        self.lock           = threading.RLock( )
+        self.watchers       = [ ]                       # one queue.Queue per watching client
+        self.context        = multiprocessing.get_context( 'forkserver' )
+        self.context.set_forkserver_preload( [ 'demultiplex_script', 'demultiplex.daemon' ] )
+        self.events         = self.context.Queue( )     # events from the runs
+        self.stopping       = threading.Event( )
+        self.lastPoll       = 0
+        self.ranks          = dict( )                   # { runId: place in the queue }, from demultiplex_script.scheduleRuns( )
+
+    def publish( self, event ):
+        event.setdefault( 'time', time.time( ) )
+        with self.lock:
+            job = self.jobs.get( event.get( 'runId' ) )
+            if job and event[ 'event' ] == 'stage':
+                job.stage = event[ 'stage' ]
+            for watcher in self.watchers:
+                watcher.put( event )
+        daemonLogger.info( json.dumps( event ) )
+
+    def queueOrder( self, job ):
+        """
+        Sort key of the queue: the place demultiplex_script.scheduleRuns( ) gave it, the ones it does not know about last
+        """
+        return ( self.ranks.get( job.runId, len( self.ranks ) ), job.submitted )
+
+    def rerank( self ):
+        """
+        Ask the scheduler for the queue order again: priorities changed, or runs waited long enough to move up
+        """
+        try:
+            ordered = demultiplex_script.scheduleRuns( )
+        except OSError as err:
+            daemonLogger.warning( f"scheduleRuns( ) failed: {err}" )
+            return
+        with self.lock:
+            self.ranks = { run.runId: rank for rank, run in enumerate( ordered ) }
+            for run in ordered:
+                job = self.jobs.get( run.runId )
+                if job:
+                    job.priority, job.estimate = run.priority, run.estimate
+
+    def submit( self, runId, priority = None ):
+        """
+        Queue {runId}. Without a {priority}, it keeps the one it has in the run-state store.
+        """
+        runId = runId.replace( "/", "" ).replace( ",", "" )
+        with self.lock:
+            job = self.jobs.get( runId )
+            if job:
+                return { 'ok': False, 'error': f"{runId} is already {job.state}" }
+            if not os.path.isdir( os.path.join( demultiplex_script.demux.rawDataDir, runId ) ):
+                return { 'ok': False, 'error': f"{runId} is not in {demultiplex_script.demux.rawDataDir}" }
+            self.jobs[ runId ] = job = Job( runId, priority or 0 )
+        demultiplex_script.setRunState( runId, runstate.QUEUED, "submitted to the daemon" )
+        if priority is not None:
+            demultiplex_script.setRunPriority( runId, priority )
+        self.rerank( )
+        self.publish( { 'event': 'submitted', 'runId': runId, 'priority': job.priority, 'estimate': job.estimate } )
+        return { 'ok': True, 'job': job.describe( ) }
+
+    def cancel( self, runId ):
+        with self.lock:
+            job = self.jobs.get( runId )
+            if not job:
+                return { 'ok': False, 'error': f"{runId} is not queued or running" }
+            if job.process and job.process.is_alive( ):
+                try:
+                    os.killpg( job.process.pid, signal.SIGTERM )
+                except ProcessLookupError:                              # has not called setpgrp( ) yet
+                    job.process.terminate( )
+                job.outcome = 'cancelled'
+                return { 'ok': True, 'job': job.describe( ) }
+            del self.jobs[ runId ]
+        demultiplex_script.setRunState( runId, runstate.FAILED, "cancelled before it started" )
+        self.publish( { 'event': 'cancelled', 'runId': runId } )
+        return { 'ok': True }
+
+    def prioritise( self, runId, priority ):
+        with self.lock:
+            job = self.jobs.get( runId )
+            if not job:
+                return { 'ok': False, 'error': f"{runId} is not queued or running" }
+            job.priority = priority
+        demultiplex_script.setRunPriority( runId, priority )
+        self.rerank( )
+        self.publish( { 'event': 'prioritised', 'runId': runId, 'priority': priority } )
+        return { 'ok': True, 'job': job.describe( ) }
+
+    def status( self, runId ):
+        with self.lock:
+            job = self.jobs.get( runId )
+            answer = { 'ok': True, 'job': job.describe( ) if job else None }
+        demux = demultiplex_script.demux
+        statusFilePath = os.path.join( demux.demultiplexDir, runId + demux.demultiplexDirSuffix, demux.demultiplexLogDirName, demux.statusFileName )
+        try:
+            with open( statusFilePath, encoding = demux.decodeScheme ) as statusFileHandle:
+                answer[ 'statusFile' ] = json.load( statusFileHandle )
+        except ( OSError, ValueError ):
+            answer[ 'statusFile' ] = None
+        connection = runstate.openStore( demux.runStateFilePath )
+        answer[ 'runState' ] = next( ( dict( zip( [ 'runId', 'state', 'firstSeen', 'queued', 'started', 'finished', 'attempts', 'message' ], run ) )
+                                       for run in runstate.listRuns( connection ) if run[ 0 ] == runId ), None )
+        connection.close( )
+        return answer
+
+    def handle( self, request ):
+        """
+        Answer one request from a client, anything but watch
+        """
+        command = request.get( 'command' )
+        try:
+            if command == 'submit':
+                return self.submit( request[ 'runId' ], None if request.get( 'priority' ) is None else int( request[ 'priority' ] ) )
+            if command == 'cancel':
+                return self.cancel( request[ 'runId' ] )
+            if command == 'prioritise':
+                return self.prioritise( request[ 'runId' ], int( request[ 'priority' ] ) )
+            if command == 'status':
+                return self.status( request[ 'runId' ] )
+            if command == 'queue':
+                with self.lock:
+                    jobs = sorted( self.jobs.values( ), key = lambda job: ( job.state != runstate.RUNNING, self.queueOrder( job ) ) )
+                    return { 'ok': True, 'jobs': [ job.describe( ) for job in jobs ] }
+        except ( KeyError, ValueError ) as err:
+            return { 'ok': False, 'error': f"bad request: {err}" }
+        return { 'ok': False, 'error': f"unknown command {command}" }
+
+    def start( self, job ):
+        if demultiplex_script.demux.diskSpaceCheck:
+            if time.monotonic( ) < job.heldUntil:
+                return False
+            short = demultiplex_script.diskSpaceShortfalls( job.runId )
+            if short:
+                job.heldUntil = time.monotonic( ) + demultiplex_script.demux.diskSpaceRecheck
+                if job.held != '; '.join( short ):
+                    job.held = '; '.join( short )
+                    self.publish( { 'event': 'held', 'runId': job.runId, 'message': job.held } )
+                return False
+            job.held = None
+        demux    = demultiplex_script.demux
+        runLease = lease.Lease( demux.leaseDirPath, job.runId, heartbeat = demux.leaseHeartbeat, timeout = demux.leaseTimeout )
+        if not runLease.acquire( ):                                         # a cron job or another host has it: try again later
+            return False
+        job.lease   = runLease
+        job.process = self.context.Process( target = runJob, args = ( job.runId, self.events, runLease.token ), name = job.runId )
+        job.process.start( )
+        job.state   = runstate.RUNNING
+        job.started = time.time( )
+        demultiplex_script.setRunState( job.runId, runstate.RUNNING, f"daemon pid {job.process.pid}" )
+        self.publish( { 'event': 'started', 'runId': job.runId, 'pid': job.process.pid } )
+        return True
+
+    def step( self ):
+        """
+        One pass of the loop: collect events, reap finished runs, start queued ones, look for new ones
+        """
+        try:
+            while True:
+                event = self.events.get( timeout = 0.5 )
+                with self.lock:
+                    job = self.jobs.get( event[ 'runId' ] )
+                    if job and event[ 'event' ] in [ runstate.DONE, runstate.FAILED ]:
+                        job.reported = True
+                        job.outcome  = job.outcome or event[ 'event' ]
+                self.publish( event )
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            for job in list( self.jobs.values( ) ):
+                if job.state != runstate.RUNNING or job.process.is_alive( ):
+                    continue
+                job.process.join( )
+                del self.jobs[ job.runId ]
+                lost = ( job.lease.holder( ) or { } ).get( 'token', job.lease.token ) != job.lease.token
+                job.lease.release( )                                # the run gave it back already, unless it was killed
+                if job.reported or lost:
+                    continue
+                message = job.outcome or f"killed by signal {-job.process.exitcode}"           # cancelled, or died without a word
+                demultiplex_script.setRunState( job.runId, runstate.FAILED, message )
+                self.publish( { 'event': 'cancelled' if job.outcome == 'cancelled' else runstate.FAILED, 'runId': job.runId, 'message': message } )
+
+            running = sum( job.state == runstate.RUNNING for job in self.jobs.values( ) )
+            queued  = sorted( ( job for job in self.jobs.values( ) if job.state == runstate.QUEUED ), key = self.queueOrder )
+            started = 0
+            for job in queued:
+                if running + started >= self.workers or self.stopping.is_set( ):
+                    break
+                if self.start( job ):
+                    started = started + 1
+        if started:
+            self.rerank( )                                          # the queue metrics, one run shorter
+
+        if time.monotonic( ) - self.lastPoll > self.pollInterval and not self.stopping.is_set( ):
+            self.lastPoll = time.monotonic( )
+            try:
+                newlyQueued, pending, waiting = demultiplex_script.detectNewRuns( )
+            except OSError as err:
+                daemonLogger.warning( f"detectNewRuns( ) failed: {err}" )
+                pending = [ ]
+            for runId in pending:
+                if runId not in self.jobs:
+                    self.submit( runId )
+            self.reapAbandoned( )
+            self.rerank( )                                          # waiting moves runs up the queue
+
+    def reapAbandoned( self ):
+        """
+        Mark failed every run the run-state store has as running, that is not ours, and whose lease we can take: whoever ran it is gone
+        """
+        demux = demultiplex_script.demux
+        try:
+            running = demultiplex_script.runningRuns( )
+        except OSError as err:
+            daemonLogger.warning( f"runningRuns( ) failed: {err}" )
+            return
+        for runId in running:
+            with self.lock:
+                if runId in self.jobs:
+                    continue
+            runLease = lease.Lease( demux.leaseDirPath, runId, heartbeat = demux.leaseHeartbeat, timeout = demux.leaseTimeout )
+            if not runLease.acquire( ):                                 # still being worked on: a run that outlived the last daemon, a cron job, another host
+                continue
+            try:
+                demultiplex_script.setRunState( runId, runstate.FAILED, "abandoned, the worker holding the lease is gone" )
+            finally:
+                runLease.release( )
+            self.publish( { 'event': runstate.FAILED, 'runId': runId, 'message': "abandoned, the worker holding the lease is gone" } )
+
+    def stop( self, signum, frame ):
+        """
+        First SIGTERM/SIGINT: start nothing new, let the running runs finish. Second: cancel them too.
+        """
+        if self.stopping.is_set( ):
+            with self.lock:
+                running = [ job.runId for job in self.jobs.values( ) if job.state == runstate.RUNNING ]
+            for runId in running:
+                self.cancel( runId )
+            return
+        self.stopping.set( )
+        daemonLogger.info( "stopping: no new runs, waiting for the running ones. Signal again to cancel them." )
+
+    def serve( self ):
+        """
+        Listen on the control socket and run the loop until SIGTERM, and the running runs are finished
+        """
+        daemon = self
+
+        class ControlHandler( socketserver.StreamRequestHandler ):
+            def handle( self ):
+                for line in self.rfile:
+                    try:
+                        request = json.loads( line )
+                    except ValueError:
+                        self.send( { 'ok': False, 'error': 'not JSON' } )
+                        continue
+                    if request.get( 'command' ) == 'watch':
+                        self.watch( )
+                        return
+                    self.send( daemon.handle( request ) )
+
+            def send( self, message ):
+                self.wfile.write( ( json.dumps( message ) + '\n' ).encode( ) )
+                self.wfile.flush( )
+
+            def watch( self ):
+                events = queue.Queue( )
+                with daemon.lock:
+                    daemon.watchers.append( events )
+                    self.send( { 'ok': True, 'jobs': [ job.describe( ) for job in daemon.jobs.values( ) ] } )
+                try:
+                    while True:
+                        try:
+                            self.send( events.get( timeout = 1 ) )
+                        except queue.Empty:
+                            continue
+                except OSError:                                     # the client went away
+                    pass
+                finally:
+                    with daemon.lock:
+                        daemon.watchers.remove( events )
+
+        if os.path.exists( self.socketPath ):
+            probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            try:
+                probe.connect( self.socketPath )
+                raise SystemExit( f"another daemon is listening on {self.socketPath}" )
+            except ( ConnectionRefusedError, FileNotFoundError ):
+                os.unlink( self.socketPath )                        # left behind by a daemon that died
+            finally:
+                probe.close( )
+
+        server = socketserver.ThreadingUnixStreamServer( self.socketPath, ControlHandler )
+        server.daemon_threads = True
+        os.chmod( self.socketPath, 0o660 )                          # the group can submit too
+        threading.Thread( target = server.serve_forever, name = 'control socket', daemon = True ).start( )
+        signal.signal( signal.SIGTERM, self.stop )
+        signal.signal( signal.SIGINT,  self.stop )
+        self.context.Process( target = time.sleep, args = ( 0, ) ).start( )     # start the forkserver now, not on the first submit
+        self.reapAbandoned( )                                       # runs the last daemon left behind, if they did not finish on their own
+        daemonLogger.info( f"listening on {self.socketPath}, {self.workers} workers, polling every {self.pollInterval} seconds" )
+
+        try:
+            while not self.stopping.is_set( ) or any( job.state == runstate.RUNNING for job in list( self.jobs.values( ) ) ):
+                self.step( )
+        finally:
+            server.shutdown( )
+            server.server_close( )
+            os.unlink( self.socketPath )
+
+
+
+########################################################################
+# client( )
+########################################################################
+
+def client( socketPath, request ):
+    """
+    Send {request} to the daemon on {socketPath}, yield what it answers: one reply, or for watch, events until interrupted
+    """
+
+    with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as connection:
+        connection.connect( socketPath )
+        connection.sendall( ( json.dumps( request ) + '\n' ).encode( ) )
+        with connection.makefile( 'r', encoding = 'utf-8' ) as replies:
+            for line in replies:
+                yield json.loads( line )
+                if request.get( 'command' ) != 'watch':
+                    return
@@ -0,0 +1,391 @@
+# delivery: copy the files of a run to where they are delivered, in parallel ranges, resumable, bandwidth capped and verified
+
+import concurrent.futures
+import dataclasses
+import hashlib
+import os
+import shlex
+import subprocess
+import threading
+import time
+import urllib.parse
+
+from demultiplex import rawarchive
+
+
+#########################################################################
+# Every file is cut in ranges of {rangeSize} bytes, and the ranges of all the files go through one pool of {workers} threads:
+# a few big tars are sent as many streams, many small files as many files at once. The ranges land, each at its offset, in
+# {file}.partial at the destination. Once every range of a file is there, the transport hashes the .partial where it is, and only
+# if that matches the .sha512 file next to the local file ( or the local file itself, if it has none ) is it renamed into place.
+# There is never a half-sent or a corrupted file under the final name.
+#
+# The ranges that arrived are written down in a journal, a JSON file next to the local files. An interrupted delivery resumes
+# where it stopped: the ranges in the journal are not sent again, as long as the local file is the same size and mtime and the
+# .partial is still there. A file already at the destination, and matching, is not sent at all.
+#
+# Every block sent goes through one Throttle, so all the streams together stay under the bandwidth cap.
+#
+# Where the files go is a URL, and the transport is picked by its scheme, see TRANSPORTS:
+#
+#   file:///mnt/nird/projects/NS9305K/SEQ-TECH/data_delivery                 a directory: NIRD mounted, or a stand-in to try it all offline
+#   ssh://login.nird.sigma2.no/projects/NS9305K/SEQ-TECH/data_delivery       over ssh, dd and sha512sum at the other end
+#
+# A transport is a class taking the parsed URL, with the methods of LocalTransport.
+#########################################################################
+
+partialSuffix   = '.partial'
+blockSize       = 4 * 1024 * 1024           # bytes read, throttled and sent at a time
+
+
+
+########################################################################
+# Throttle
+########################################################################
+
+class Throttle:
+    """
+    Shared by every thread sending: take( size ) before sending {size} bytes, it sleeps as long as it takes to stay under {rate} bytes/second.
+        A {rate} of 0 or None: no cap.
+    """
+
+    def __init__( self, rate ):
+        self.rate = rate
+        self.lock = threading.Lock( )
+        self.next = time.monotonic( )
+
+    def take( self, size ):
+        if not self.rate:
+            return
+        with self.lock:
+            now       = time.monotonic( )
+            start     = max( self.next, now )
+            self.next = start + size / self.rate
+        if start > now:
+            time.sleep( start - now )
+
+
+
+########################################################################
+# LocalTransport
+########################################################################
+
+class LocalTransport:
+    """
+    The destination is a directory on this host: file:///path
+    """
+
+    def __init__( self, url ):
+        self.root = url.path
+
+    def path( self, remotePath ):
+        return os.path.join( self.root, remotePath )
+
+    def size( self, remotePath ):
+        """
+        Size of {remotePath}, None if it does not exist
+        """
+        try:
+            return os.stat( self.path( remotePath ) ).st_size
+        except FileNotFoundError:
+            return None
+
+    def makedirs( self, remoteDir ):
+        os.makedirs( self.path( remoteDir ), exist_ok = True )
+
+    def writeRange( self, remotePath, offset, blocks ):
+        """
+        Write the {blocks} at {offset} in {remotePath}, creating it if needed and leaving the rest of it alone:
+            the other ranges of the same file are written at the same time
+        """
+        fileDescriptor = os.open( self.path( remotePath ), os.O_WRONLY | os.O_CREAT, 0o664 )
+        try:
+            for block in blocks:
+                os.pwrite( fileDescriptor, block, offset )
+                offset = offset + len( block )
+            os.fsync( fileDescriptor )
+        finally:
+            os.close( fileDescriptor )
+
+    def sha512( self, remotePath ):
+        sha512 = hashlib.sha512( )
+        with open( self.path( remotePath ), 'rb' ) as fileHandle:
+            for block in iter( lambda: fileHandle.read( blockSize ), b'' ):
+                sha512.update( block )
+        return sha512.hexdigest( )
+
+    def rename( self, remotePath, newRemotePath ):
+        os.replace( self.path( remotePath ), self.path( newRemotePath ) )
+
+    def remove( self, remotePath ):
+        try:
+            os.unlink( self.path( remotePath ) )
+        except FileNotFoundError:
+            pass
+
+    def close( self ):
+        pass
+
+
+
+########################################################################
+# SshTransport
+########################################################################
+
+class SshTransport( LocalTransport ):
+    """
+    The destination is a directory on another host, over ssh: ssh://[user@]host[:port]/path
+
+    One ssh connection, kept open by a ControlMaster, is shared by every range; each range is a dd at the other end,
+        reading from the pipe and writing at its offset. Nothing to install there but coreutils.
+    """
+
+    def __init__( self, url ):
+        self.root        = url.path
+        self.host        = f"{url.username}@{url.hostname}" if url.username else url.hostname
+        self.controlPath = f"/tmp/demultiplex-ssh-{os.getpid( )}-%C"
+        self.ssh         = [ 'ssh', '-o', 'BatchMode=yes', '-o', 'ControlMaster=auto', '-o', f"ControlPath={self.controlPath}", '-o', 'ControlPersist=60' ]
+        if url.port:
+            self.ssh = self.ssh + [ '-p', str( url.port ) ]
+
+    def run( self, command, check = True, stdin = None ):
+        result = subprocess.run( self.ssh + [ self.host, '--', command ], stdin = stdin, capture_output = True, text = True )
+        if check and result.returncode:
+            raise OSError( f"{self.host}: {command}: {result.stderr.strip( ) or f'exit code {result.returncode}'}" )
+        return result
+
+    def size( self, remotePath ):
+        result = self.run( f"stat -c %s {shlex.quote( self.path( remotePath ) )}", check = False )
+        return int( result.stdout ) if result.returncode == 0 else None
+
+    def makedirs( self, remoteDir ):
+        self.run( f"mkdir -p {shlex.quote( self.path( remoteDir ) )}" )
+
+    def writeRange( self, remotePath, offset, blocks ):
+        command = f"dd of={shlex.quote( self.path( remotePath ) )} bs={blockSize} seek={offset} oflag=seek_bytes conv=notrunc,fsync status=none"
+        process = subprocess.Popen( self.ssh + [ self.host, '--', command ], stdin = subprocess.PIPE, stderr = subprocess.PIPE )
+        try:
+            for block in blocks:
+                process.stdin.write( block )
+            process.stdin.close( )
+        except BrokenPipeError:
+            pass                                                                                # dd is gone, its exit code says why
+        finally:
+            error = process.stderr.read( ).decode( errors = 'replace' ).strip( )
+            process.wait( )
+        if process.returncode:
+            raise OSError( f"{self.host}: writing {remotePath} at {offset}: {error or f'exit code {process.returncode}'}" )
+
+    def sha512( self, remotePath ):
+        return self.run( f"sha512sum {shlex.quote( self.path( remotePath ) )}" ).stdout.split( ' ' )[ 0 ]
+
+    def rename( self, remotePath, newRemotePath ):
+        self.run( f"mv -f {shlex.quote( self.path( remotePath ) )} {shlex.quote( self.path( newRemotePath ) )}" )
+
+    def remove( self, remotePath ):
+        self.run( f"rm -f {shlex.quote( self.path( remotePath ) )}" )
+
+    def close( self ):
+        subprocess.run( self.ssh + [ '-O', 'exit', self.host ], capture_output = True )
+
+
+
+TRANSPORTS = { 'file': LocalTransport, 'ssh': SshTransport }
+
+
+
+########################################################################
+# openTransport( )
+########################################################################
+
+def openTransport( target ):
+    """
+    The transport for the {target} URL, see TRANSPORTS
+    """
+
+    url = urllib.parse.urlparse( target )
+    if url.scheme not in TRANSPORTS:
+        raise ValueError( f"{target}: {url.scheme} is not one of {', '.join( TRANSPORTS )}" )
+    return TRANSPORTS[ url.scheme ]( url )
+
+
+
+########################################################################
+# DeliveryFile
+########################################################################
+
+@dataclasses.dataclass
+class DeliveryFile:
+    """
+    One file to deliver, and how far it got
+    """
+
+    localPath:  str
+    remotePath: str                 # relative to the root of the transport
+    size:       int
+    ranges:     list                # [ ( offset, length ), ... ]
+    done:       set                 = dataclasses.field( default_factory = set )       # indexes of the ranges at the destination
+    error:      str                 = None
+
+
+
+########################################################################
+# expectedSha512( )
+########################################################################
+
+def expectedSha512( localPath, sha512Suffix ):
+    """
+    The sha512 the file must have at the destination: from {localPath}{sha512Suffix}, the sha512sum format, or else hashed here
+    """
+
+    if os.path.isfile( localPath + sha512Suffix ):
+        with open( localPath + sha512Suffix, encoding = 'utf-8' ) as sha512FileHandle:
+            return sha512FileHandle.read( ).split( ' ' )[ 0 ].strip( )
+    sha512 = hashlib.sha512( )
+    with open( localPath, 'rb' ) as fileHandle:
+        for block in iter( lambda: fileHandle.read( blockSize ), b'' ):
+            sha512.update( block )
+    return sha512.hexdigest( )
+
+
+
+########################################################################
+# readBlocks( )
+########################################################################
+
+def readBlocks( localPath, offset, length, throttle ):
+    """
+    The {length} bytes of {localPath} from {offset}, {blockSize} at a time, each let through by the {throttle}
+    """
+
+    with open( localPath, 'rb' ) as fileHandle:
+        fileHandle.seek( offset )
+        while length > 0:
+            block = fileHandle.read( min( blockSize, length ) )
+            if not block:
+                raise OSError( f"{localPath} is shorter than it was when the delivery started" )
+            throttle.take( len( block ) )
+            length = length - len( block )
+            yield block
+
+
+
+########################################################################
+# planDelivery( )
+########################################################################
+
+def planDelivery( files, rangeSize, journal ):
+    """
+    [ DeliveryFile, ... ] for {files}, [ ( local path, remote path ), ... ], with the ranges the {journal} has as sent already done.
+        A file whose size or mtime is not what the journal has is sent again from the start.
+    """
+
+    plan = [ ]
+    for localPath, remotePath in files:
+        status = os.stat( localPath )
+        ranges = [ ( offset, min( rangeSize, status.st_size - offset ) ) for offset in range( 0, status.st_size, rangeSize ) ] or [ ( 0, 0 ) ]
+        entry  = journal.get( remotePath )
+        done   = set( )
+        if entry and entry[ 'size' ] == status.st_size and entry[ 'mtime' ] == status.st_mtime_ns and entry[ 'rangeSize' ] == rangeSize:
+            done = set( entry[ 'done' ] )
+        plan.append( DeliveryFile( localPath, remotePath, status.st_size, ranges, done ) )
+    return plan
+
+
+
+########################################################################
+# deliverFiles( )
+########################################################################
+
+def deliverFiles( files, transport, journalFilePath, workers, rangeSize, bandwidth, sha512Suffix = '.sha512', attempts = 3, log = None ):
+    """
+    Send {files}, [ ( local path, path relative to the root of the {transport} ), ... ], see the top of this file
+
+        journalFilePath     where the ranges sent are written down, for resuming
+        bandwidth           bytes/second, all the streams together. 0: no cap
+        attempts            tries per range, and per verification, before the file counts as failed
+
+    Returns [ DeliveryFile, ... ], error set on the ones that did not make it
+    """
+
+    log      = log or ( lambda text: None )
+    throttle = Throttle( bandwidth )
+    journal  = rawarchive.readManifest( journalFilePath ) or dict( )
+    plan     = planDelivery( files, rangeSize, journal )
+    lock     = threading.Lock( )
+
+    def record( deliveryFile, complete = False ):
+        with lock:
+            journal[ deliveryFile.remotePath ] = { 'size': deliveryFile.size, 'mtime': os.stat( deliveryFile.localPath ).st_mtime_ns, 'rangeSize': rangeSize,
+                                                   'done': sorted( deliveryFile.done ), 'complete': complete }
+            rawarchive.writeManifest( journalFilePath, journal )
+
+    def retry( function, *arguments ):
+        for attempt in range( 1, attempts + 1 ):
+            try:
+                return function( *arguments )
+            except OSError as err:
+                if attempt == attempts:
+                    raise
+                log( f"{err}, trying again ( {attempt}/{attempts} )" )
+                time.sleep( 2 ** attempt )
+
+    def sendRange( deliveryFile, index ):
+        offset, length = deliveryFile.ranges[ index ]
+        retry( lambda: transport.writeRange( deliveryFile.remotePath + partialSuffix, offset, readBlocks( deliveryFile.localPath, offset, length, throttle ) ) )
+
+    def finish( deliveryFile ):
+        expected = expectedSha512( deliveryFile.localPath, sha512Suffix )
+        partial  = deliveryFile.remotePath + partialSuffix
+        if transport.size( partial ) != deliveryFile.size or retry( transport.sha512, partial ) != expected:
+            transport.remove( partial )
+            deliveryFile.done = set( )
+            record( deliveryFile )
+            raise ValueError( f"{deliveryFile.remotePath}: what arrived does not match its sha512, removed: the next delivery sends it again" )
+        retry( transport.rename, partial, deliveryFile.remotePath )
+
+    for directory in sorted( { os.path.dirname( deliveryFile.remotePath ) for deliveryFile in plan } ):
+        transport.makedirs( directory )
+
+    todo = [ ]
+    for deliveryFile in plan:
+        if journal.get( deliveryFile.remotePath, { } ).get( 'complete' ) and deliveryFile.done and transport.size( deliveryFile.remotePath ) == deliveryFile.size:
+            continue                                                                            # sent and verified by an earlier delivery
+        if not deliveryFile.done and transport.size( deliveryFile.remotePath ) == deliveryFile.size \
+           and transport.sha512( deliveryFile.remotePath ) == expectedSha512( deliveryFile.localPath, sha512Suffix ):
+            deliveryFile.done = set( range( len( deliveryFile.ranges ) ) )                      # already there, without a journal to say so
+            record( deliveryFile, complete = True )
+            continue
+        if deliveryFile.done and transport.size( deliveryFile.remotePath + partialSuffix ) is None:
+            deliveryFile.done = set( )                                                          # the .partial is gone, so are the ranges in it
+        if not deliveryFile.done:
+            transport.remove( deliveryFile.remotePath + partialSuffix )
+        todo.append( deliveryFile )
+    log( f"{len( plan ) - len( todo )} of {len( plan )} files already delivered, {sum( len( deliveryFile.done ) for deliveryFile in todo )} ranges of the rest resumed" )
+
+    with concurrent.futures.ThreadPoolExecutor( max_workers = workers ) as executor:
+        running = dict( )
+        for deliveryFile in todo:
+            for index in range( len( deliveryFile.ranges ) ):
+                if index not in deliveryFile.done:
+                    running[ executor.submit( sendRange, deliveryFile, index ) ] = ( deliveryFile, index )
+            if len( deliveryFile.done ) == len( deliveryFile.ranges ):
+                running[ executor.submit( finish, deliveryFile ) ] = ( deliveryFile, None )
+        while running:
+            finished, pending = concurrent.futures.wait( running, return_when = concurrent.futures.FIRST_COMPLETED )
+            for future in finished:
+                deliveryFile, index = running.pop( future )
+                try:
+                    future.result( )
+                except ( OSError, ValueError ) as err:
+                    deliveryFile.error = str( err )
+                    continue
+                if index is None:
+                    record( deliveryFile, complete = True )
+                    log( f"{deliveryFile.remotePath}: {deliveryFile.size / 1024**2:.0f} MiB delivered and verified" )
+                    continue
+                deliveryFile.done.add( index )
+                record( deliveryFile )
+                if len( deliveryFile.done ) == len( deliveryFile.ranges ) and not deliveryFile.error:
+                    running[ executor.submit( finish, deliveryFile ) ] = ( deliveryFile, None )
+    return plan
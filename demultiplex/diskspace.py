@@ -0,0 +1,106 @@
+# diskspace: will a run fit on disk, before it is started
+
+import os
+import shutil
+
+
+#########################################################################
+# A run writes, on top of its raw data:
+#
+#   demultiplex             the fastq.gz files                                      under /data/demultiplex/{RunID}_demultiplex
+#   qualityCheck            FastQC and MultiQC reports                              under /data/demultiplex/{RunID}_demultiplex
+#   prepareDelivery         a tar copy of every project and of the QC               under /data/for_transfer/{RunID}
+#   tarFileQualityCheck     every tar extracted once more, deleted afterwards       under /data/for_transfer/{RunID}/test_tar
+#   archive                 the raw run packed in chunks for NIRD                   under /data/archive/{RunID}, if demux.archiveRawData
+#
+# and nothing is deleted before the end, so the peak on a filesystem is the sum of the stages writing to it.
+#
+# Every stage is predicted as  bytesPerRawByte x rawBytes + bytesPerSample x samples,  rawBytes being the size of
+# Data/Intensities/BaseCalls: that grows with the cycles and the clusters of the run, and the fastq.gz files grow with them.
+# bytesPerSample is the fixed cost of a sample ( its QC reports ) and comes from the configuration. bytesPerRawByte comes from the
+# configuration too, until there are enough finished runs: then it is the {quantile} of what the last runs actually wrote.
+# Better to hold a run for an hour than to have it fail after five.
+#########################################################################
+
+STAGES              = [ 'demultiplex', 'qualityCheck', 'prepareDelivery', 'tarFileQualityCheck', 'archive' ]
+quantile            = 0.9
+calibrationMinimum  = 3         # fewer finished runs than this and the configured bytesPerRawByte is used
+
+
+
+########################################################################
+# predictStageBytes( )
+########################################################################
+
+def predictStageBytes( rawBytes, samples, history, default ):
+    """
+    Bytes one stage will write for a run with {rawBytes} of BaseCalls and {samples} samples
+
+        history     runstate.stageSizeHistory( ) of the stage: [ ( bytes, rawBytes, samples ), ... ]
+        default     ( bytesPerRawByte, bytesPerSample ) from the configuration
+    """
+
+    bytesPerRawByte, bytesPerSample = default
+    ratios = sorted( max( 0, size - bytesPerSample * ( pastSamples or 0 ) ) / pastRawBytes for size, pastRawBytes, pastSamples in history if pastRawBytes )
+    if len( ratios ) >= calibrationMinimum:
+        bytesPerRawByte = ratios[ min( len( ratios ) - 1, int( quantile * len( ratios ) ) ) ]
+    return int( bytesPerRawByte * rawBytes + bytesPerSample * ( samples or 0 ) )
+
+
+
+########################################################################
+# device( )
+########################################################################
+
+def device( directory ):
+    """
+    The filesystem {directory} is on, or would be on once created
+    """
+
+    while not os.path.exists( directory ) and os.path.dirname( directory ) != directory:
+        directory = os.path.dirname( directory )
+    return os.stat( directory ).st_dev
+
+
+
+########################################################################
+# peakBytes( )
+########################################################################
+
+def peakBytes( predictions, targets ):
+    """
+    Sum the {predictions}, { stage: bytes }, per filesystem: { device: [ a directory on it, bytes ] }
+
+        targets     { stage: the directory the stage writes in }
+    """
+
+    peaks = dict( )
+    for stage, size in predictions.items( ):
+        peak = peaks.setdefault( device( targets[ stage ] ), [ targets[ stage ], 0 ] )
+        peak[ 1 ] = peak[ 1 ] + size
+    return peaks
+
+
+
+########################################################################
+# shortfalls( )
+########################################################################
+
+def shortfalls( peaks, reserved, reserve ):
+    """
+    The filesystems that do not have room for {peaks}: [ ( directory, bytes needed, bytes free ), ... ], empty if the run fits
+
+        peaks       peakBytes( ) of the run
+        reserved    { device: bytes } still to be written by the runs already running
+        reserve     bytes to leave free on every filesystem, on top
+    """
+
+    short = [ ]
+    for deviceId, ( directory, size ) in peaks.items( ):
+        while not os.path.exists( directory ):
+            directory = os.path.dirname( directory )
+        free   = shutil.disk_usage( directory ).free
+        needed = size + reserved.get( deviceId, 0 ) + reserve
+        if needed > free:
+            short.append( ( directory, needed, free ) )
+    return short
@@ -0,0 +1,216 @@
+# leases: at most one worker, on any host, works on a run at a time
+
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+#########################################################################
+# A lease is a file, {leaseDir}/{name}.lease, created with O_CREAT | O_EXCL: whoever creates it holds the lease. That is atomic
+# on a local filesystem and on NFS, so workers on several hosts mounting /data can share one lease directory.
+#
+# The holder touches the file every {heartbeat} seconds from a background thread. A lease is stale, and may be taken over, when
+#   the holder is on this host and its pid is gone, or
+#   the file has not been touched for {timeout} seconds ( the holder is hung, or its host is down )
+# Ages are measured against the mtime of a file touched just now in the same directory, so the clocks of the hosts do not matter.
+# Takeovers happen under flock( ) on {leaseDir}/.takeover, so two workers cannot both decide to take over the same stale lease.
+#########################################################################
+
+leaseSuffix     = '.lease'
+takeoverName    = '.takeover'
+
+
+
+########################################################################
+# Lease
+########################################################################
+
+class Lease:
+    """
+    One lease, on {name} ( a RunID, or RunID.stage ) in {leaseDir}
+
+        lease = Lease( leaseDir, RunID )
+        if lease.acquire( ):
+            ...
+            lease.release( )
+
+    holder( ) tells who has it; lost is set if somebody else took it over while we were not looking.
+    """
+
+    def __init__( self, leaseDir, name, heartbeat = 30, timeout = 300 ):
+        self.leaseDir   = leaseDir
+        self.name       = name
+        self.filePath   = os.path.join( leaseDir, name + leaseSuffix )
+        self.heartbeat  = heartbeat
+        self.timeout    = timeout
+        self.token      = uuid.uuid4( ).hex
+        self.held       = False
+        self.lost       = False
+        self.stopEvent  = threading.Event( )
+        self.thread     = None
+
+    def __enter__( self ):
+        if not self.acquire( ):
+            raise BlockingIOError( f"{self.name} is leased by {self.holder( )}" )
+        return self
+
+    def __exit__( self, *exceptionInfo ):
+        self.release( )
+
+    def describe( self ):
+        return { 'name': self.name, 'host': socket.gethostname( ), 'pid': os.getpid( ), 'token': self.token, 'acquired': time.time( ) }
+
+    def holder( self ):
+        """
+        The contents of the lease file, { name, host, pid, token, acquired }, or None if there is no lease file
+        """
+        try:
+            with open( self.filePath, encoding = 'utf-8' ) as leaseFileHandle:
+                return json.load( leaseFileHandle )
+        except FileNotFoundError:
+            return None
+        except ValueError:                                              # created, not written yet: held, by somebody
+            return { }
+
+    def acquire( self ):
+        """
+        Take the lease if it is free or stale. Returns True if we hold it now.
+        """
+        os.makedirs( self.leaseDir, exist_ok = True )
+        if self.create( ):
+            return True
+        with open( os.path.join( self.leaseDir, takeoverName ), 'a' ) as takeoverFileHandle:
+            fcntl.flock( takeoverFileHandle, fcntl.LOCK_EX )
+            try:
+                if not self.isStale( ):
+                    return False
+                try:
+                    os.unlink( self.filePath )
+                except FileNotFoundError:
+                    pass
+                return self.create( )
+            finally:
+                fcntl.flock( takeoverFileHandle, fcntl.LOCK_UN )
+
+    def create( self ):
+        try:
+            fileDescriptor = os.open( self.filePath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o664 )
+        except FileExistsError:
+            return False
+        with os.fdopen( fileDescriptor, 'w', encoding = 'utf-8' ) as leaseFileHandle:
+            json.dump( self.describe( ), leaseFileHandle )
+        self.startHeartbeat( )
+        return True
+
+    def adopt( self, token ):
+        """
+        Take on the lease another process holds under {token}, and handed to us: the daemon takes the lease before it forks a run,
+            the run adopts it. The lease file gets our host and pid, so it is stale once we are gone, and the heartbeat is ours.
+            Returns True if the lease was still held under {token}.
+        """
+        if ( self.holder( ) or { } ).get( 'token' ) != token:
+            return False
+        self.token        = token
+        temporaryFilePath = f"{self.filePath}.{os.getpid( )}"
+        with open( temporaryFilePath, 'w', encoding = 'utf-8' ) as leaseFileHandle:
+            json.dump( self.describe( ), leaseFileHandle )
+        os.replace( temporaryFilePath, self.filePath )
+        self.startHeartbeat( )
+        return True
+
+    def startHeartbeat( self ):
+        self.held   = True
+        self.lost   = False
+        self.stopEvent.clear( )
+        self.thread = threading.Thread( target = self.beat, name = f"lease {self.name}", daemon = True )
+        self.thread.start( )
+
+    def isStale( self ):
+        holder = self.holder( )
+        if holder is None:
+            return True
+        if holder.get( 'host' ) == socket.gethostname( ) and holder.get( 'pid' ):
+            try:
+                os.kill( holder[ 'pid' ], 0 )
+            except ProcessLookupError:
+                return True
+            except PermissionError:                                     # alive, somebody else's
+                pass
+        try:
+            age = now( self.leaseDir ) - os.stat( self.filePath ).st_mtime
+        except FileNotFoundError:
+            return True
+        return age > self.timeout
+
+    def beat( self ):
+        """
+        The heartbeat thread: touch the lease file until release( ), notice if it was taken from us
+        """
+        while not self.stopEvent.wait( self.heartbeat ):
+            if ( self.holder( ) or { } ).get( 'token' ) != self.token:
+                self.lost = True
+                return
+            try:
+                os.utime( self.filePath )
+            except OSError:
+                pass                                                    # NFS hiccup: the next beat tries again, well within {timeout}
+
+    def release( self ):
+        """
+        Give the lease up, if it is still ours
+        """
+        if not self.held:
+            return
+        self.held = False
+        self.stopEvent.set( )
+        if ( self.holder( ) or { } ).get( 'token' ) == self.token:
+            try:
+                os.unlink( self.filePath )
+            except FileNotFoundError:
+                pass
+
+
+
+########################################################################
+# now( )
+########################################################################
+
+def now( directory ):
+    """
+    The time according to the filesystem {directory} is on: touch a scratch file there and read back its mtime
+    """
+
+    scratchFilePath = os.path.join( directory, f".now.{socket.gethostname( )}.{os.getpid( )}" )
+    with open( scratchFilePath, 'a' ):
+        os.utime( scratchFilePath )
+    mtime = os.stat( scratchFilePath ).st_mtime
+    os.unlink( scratchFilePath )
+    return mtime
+
+
+
+########################################################################
+# leases( )
+########################################################################
+
+def leases( leaseDir ):
+    """
+    Every lease in {leaseDir}: [ ( name, contents of the lease file, seconds since the last heartbeat ), ... ]
+    """
+
+    if not os.path.isdir( leaseDir ):
+        return [ ]
+    reference = now( leaseDir )
+    found     = [ ]
+    for entry in os.scandir( leaseDir ):
+        if entry.name.endswith( leaseSuffix ):
+            lease = Lease( leaseDir, entry.name[ :-len( leaseSuffix ) ] )
+            try:
+                found.append( ( lease.name, lease.holder( ) or { }, reference - entry.stat( ).st_mtime ) )
+            except FileNotFoundError:
+                continue
+    return sorted( found )
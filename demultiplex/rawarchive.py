@@ -0,0 +1,309 @@
+# rawarchive: pack a raw run into compressed, size-capped, checksummed chunks, ready to be archived
+
+import concurrent.futures
+import ctypes
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import re
+import signal
+import tarfile
+import time
+
+
+#########################################################################
+# /data/rawdata/{RunID} becomes, in {archiveDir}:
+#
+#   {RunID}.part0000.tar.xz         the files of the run, in os.walk( ) order, about {chunkSize} bytes of them per chunk
+#   {RunID}.part0000.tar.xz.md5     md5sum -c / sha512sum -c checksum files, like the delivery tar files have
+#   {RunID}.part0000.tar.xz.sha512
+#   ...
+#   {RunID}.manifest.json           what is in which chunk, its size and checksums, and whether it is done
+#
+# Every chunk is a plain tar of paths starting with {RunID}/: extract all the chunks in one directory to get the run back.
+# The chunks are compressed in a process pool, each chunk by one process, with lzma or gzip: both let go of the GIL, but tarfile
+# does not, and the pool keeps the packing off the interpreter running demultiplex_script.
+#
+# A chunk is written as .partial and renamed once complete; the manifest is rewritten after every chunk. An interrupted archival
+# picks up where it stopped: the chunks the manifest has as done, and still the same size on disk, are not packed again. If the
+# run changed since ( the plan of the chunks is different ) it starts over, and deletes every chunk of the earlier plan first:
+# whatever is in {archiveDir} gets delivered, and chunks of two plans would overlap.
+#
+# The pool runs at nice 19 and the idle I/O priority, and throttle( ) is asked before every chunk how many may be in flight:
+# demultiplex_script passes one that goes down to demux.archiveWorkersBusy while another run is being demultiplexed.
+#########################################################################
+
+COMPRESSIONS    = { 'xz': '.tar.xz', 'gz': '.tar.gz' }
+partialSuffix   = '.partial'
+manifestSuffix  = '.manifest.json'
+prSetPdeathsig  = 1                 # prctl( ) option: the signal this process gets when its parent dies
+
+
+
+########################################################################
+# HashingWriter
+########################################################################
+
+class HashingWriter:
+    """
+    A file object that md5s and sha512s everything written through it: the checksums of a chunk come for free while it is written
+    """
+
+    def __init__( self, fileHandle ):
+        self.fileHandle = fileHandle
+        self.md5        = hashlib.md5( )
+        self.sha512     = hashlib.sha512( )
+        self.size       = 0
+
+    def write( self, data ):
+        self.md5.update( data )
+        self.sha512.update( data )
+        self.size = self.size + len( data )
+        return self.fileHandle.write( data )
+
+    def flush( self ):
+        self.fileHandle.flush( )
+
+
+
+########################################################################
+# planChunks( )
+########################################################################
+
+def planChunks( runDir, chunkSize ):
+    """
+    Split the files under {runDir} in chunks of about {chunkSize} bytes, uncompressed, in os.walk( ) order, sorted so every plan
+        of the same run comes out the same. A file bigger than {chunkSize} gets a chunk of its own. Directories go with their first file.
+
+    Returns [ { 'members': [ path relative to the parent of {runDir}, ... ], 'uncompressedBytes': ... }, ... ]
+    """
+
+    parent  = os.path.dirname( os.path.abspath( runDir ) )
+    chunks  = [ ]
+    current = { 'members': [ ], 'uncompressedBytes': 0 }
+    for directory, dirNames, fileNames in os.walk( runDir ):
+        dirNames.sort( )
+        current[ 'members' ].append( os.path.relpath( directory, parent ) )
+        for fileName in sorted( fileNames ):
+            filePath = os.path.join( directory, fileName )
+            size     = os.lstat( filePath ).st_size
+            if current[ 'uncompressedBytes' ] and current[ 'uncompressedBytes' ] + size > chunkSize:
+                chunks.append( current )
+                current = { 'members': [ ], 'uncompressedBytes': 0 }
+            current[ 'members' ].append( os.path.relpath( filePath, parent ) )
+            current[ 'uncompressedBytes' ] = current[ 'uncompressedBytes' ] + size
+    if current[ 'members' ]:
+        chunks.append( current )
+    return chunks
+
+
+
+########################################################################
+# lowerPriority( )
+########################################################################
+
+def lowerPriority( ):
+    """
+    The initializer of the pool's processes: nice 19, idle I/O priority, and killed with their parent: a pool process left behind
+        by a killed demultiplex_script would go on writing a chunk nobody is waiting for
+    """
+
+    from demultiplex import retention
+
+    os.nice( 19 - os.nice( 0 ) )
+    retention.setIdleIoPriority( )
+    try:
+        ctypes.CDLL( None, use_errno = True ).prctl( prSetPdeathsig, signal.SIGKILL )
+    except ( AttributeError, OSError ):
+        pass
+
+
+
+########################################################################
+# packChunk( )
+########################################################################
+
+def packChunk( parent, members, chunkFilePath, compression, level ):
+    """
+    In a pool process: tar {members}, relative to {parent}, into {chunkFilePath}, compressed with {compression} at {level}.
+        Written as {chunkFilePath}.partial, renamed when complete.
+
+    Returns ( bytes, md5, sha512 ) of the compressed chunk
+    """
+
+    partialFilePath = chunkFilePath + partialSuffix
+    with open( partialFilePath, 'wb' ) as chunkFileHandle:
+        writer = HashingWriter( chunkFileHandle )
+        if compression == 'xz':
+            compressor = lzma.LZMAFile( writer, 'w', preset = level )
+        else:
+            compressor = gzip.GzipFile( fileobj = writer, mode = 'wb', compresslevel = level, mtime = 0 )
+        with compressor, tarfile.open( fileobj = compressor, mode = 'w|', format = tarfile.PAX_FORMAT ) as tarFileHandle:
+            for member in members:
+                tarFileHandle.add( os.path.join( parent, member ), arcname = member, recursive = False )
+        chunkFileHandle.flush( )
+        os.fsync( chunkFileHandle.fileno( ) )
+    os.rename( partialFilePath, chunkFilePath )
+    return writer.size, writer.md5.hexdigest( ), writer.sha512.hexdigest( )
+
+
+
+########################################################################
+# readManifest( )
+########################################################################
+
+def readManifest( manifestFilePath ):
+    try:
+        with open( manifestFilePath, encoding = 'utf-8' ) as manifestFileHandle:
+            return json.load( manifestFileHandle )
+    except ( OSError, ValueError ):
+        return None
+
+
+
+########################################################################
+# writeManifest( )
+########################################################################
+
+def writeManifest( manifestFilePath, manifest ):
+    temporaryFilePath = manifestFilePath + partialSuffix
+    with open( temporaryFilePath, 'w', encoding = 'utf-8' ) as manifestFileHandle:
+        json.dump( manifest, manifestFileHandle, indent = 1 )
+    os.replace( temporaryFilePath, manifestFilePath )
+
+
+
+########################################################################
+# writeChecksumFiles( )
+########################################################################
+
+def writeChecksumFiles( chunkFilePath, md5, sha512 ):
+    """
+    {chunk}.md5 and {chunk}.sha512, in the format md5sum -c and sha512sum -c read: the two spaces are mandatory
+    """
+
+    for suffix, checksum in [ ( '.md5', md5 ), ( '.sha512', sha512 ) ]:
+        with open( chunkFilePath + suffix, 'w', encoding = 'utf-8' ) as checksumFileHandle:
+            checksumFileHandle.write( f"{checksum}  {os.path.basename( chunkFilePath )}\n" )
+
+
+
+########################################################################
+# removeChunks( )
+########################################################################
+
+def removeChunks( archiveDir, runId, keep, log ):
+    """
+    Delete the chunks of {runId} in {archiveDir}, with their checksum and .partial files, except the chunks named in {keep}
+    """
+
+    chunkRegex = re.compile( re.escape( runId ) + r"\.part\d{4}(?:" + '|'.join( re.escape( suffix ) for suffix in COMPRESSIONS.values( ) ) + ")" )
+    for name in sorted( os.listdir( archiveDir ) ):
+        match = chunkRegex.match( name )
+        if match and match.group( 0 ) not in keep:
+            os.unlink( os.path.join( archiveDir, name ) )
+            log( f"{name}: deleted, not part of the current plan" )
+
+
+
+########################################################################
+# archiveRun( )
+########################################################################
+
+def archiveRun( runDir, archiveDir, chunkSize, compression, level, workers, throttle = None, log = None ):
+    """
+    Pack {runDir} into chunks in {archiveDir}, see the top of this file. Resumes an interrupted archival of the same run.
+
+        throttle    throttle( ): how many chunks may be packed at the same time right now, asked before every chunk. None: {workers}
+        log         log( text ), for progress
+
+    Returns the manifest
+    """
+
+    if compression not in COMPRESSIONS:
+        raise ValueError( f"compression {compression} is not one of {', '.join( COMPRESSIONS )}" )
+    runId            = os.path.basename( os.path.normpath( runDir ) )
+    parent           = os.path.dirname( os.path.abspath( runDir ) )
+    manifestFilePath = os.path.join( archiveDir, runId + manifestSuffix )
+    throttle         = throttle or ( lambda: workers )
+    log              = log or ( lambda text: None )
+    os.makedirs( archiveDir, exist_ok = True )
+
+    plan     = planChunks( runDir, chunkSize )
+    manifest = readManifest( manifestFilePath )
+    samePlan = manifest and manifest.get( 'compression' ) == compression and [ ( chunk[ 'members' ], chunk[ 'uncompressedBytes' ] ) for chunk in manifest[ 'chunks' ] ] == [ ( chunk[ 'members' ], chunk[ 'uncompressedBytes' ] ) for chunk in plan ]
+    if not samePlan:
+        if manifest:
+            log( f"{runId} changed since the last archival, or its settings did: starting over" )
+        removeChunks( archiveDir, runId, set( ), log )
+        manifest = { 'runId': runId, 'created': time.time( ), 'compression': compression, 'chunkSize': chunkSize, 'chunks': [ ] }
+        for index, chunk in enumerate( plan ):
+            manifest[ 'chunks' ].append( { 'index': index, 'name': f"{runId}.part{index:04d}{COMPRESSIONS[ compression ]}", **chunk, 'bytes': None, 'md5': None, 'sha512': None, 'done': False } )
+        writeManifest( manifestFilePath, manifest )
+    else:
+        removeChunks( archiveDir, runId, { chunk[ 'name' ] for chunk in manifest[ 'chunks' ] }, log )
+
+    todo = [ ]
+    for chunk in manifest[ 'chunks' ]:
+        chunkFilePath = os.path.join( archiveDir, chunk[ 'name' ] )
+        if chunk[ 'done' ] and os.path.isfile( chunkFilePath ) and os.path.getsize( chunkFilePath ) == chunk[ 'bytes' ]:
+            continue
+        chunk[ 'done' ] = False
+        if os.path.exists( chunkFilePath + partialSuffix ):
+            os.unlink( chunkFilePath + partialSuffix )                                          # left by the interruption
+        todo.append( chunk )
+    log( f"{runId}: {len( manifest[ 'chunks' ] ) - len( todo )} of {len( manifest[ 'chunks' ] )} chunks already packed" )
+
+    with concurrent.futures.ProcessPoolExecutor( max_workers = workers, initializer = lowerPriority ) as executor:
+        inFlight = dict( )
+        while todo or inFlight:
+            while todo and len( inFlight ) < max( 1, min( workers, throttle( ) ) ):
+                chunk = todo.pop( 0 )
+                future = executor.submit( packChunk, parent, chunk[ 'members' ], os.path.join( archiveDir, chunk[ 'name' ] ), compression, level )
+                inFlight[ future ] = chunk
+            finished, pending = concurrent.futures.wait( inFlight, return_when = concurrent.futures.FIRST_COMPLETED )
+            for future in finished:
+                chunk = inFlight.pop( future )
+                chunk[ 'bytes' ], chunk[ 'md5' ], chunk[ 'sha512' ] = future.result( )
+                chunk[ 'done' ] = True
+                writeChecksumFiles( os.path.join( archiveDir, chunk[ 'name' ] ), chunk[ 'md5' ], chunk[ 'sha512' ] )
+                writeManifest( manifestFilePath, manifest )
+                log( f"{chunk[ 'name' ]}: {chunk[ 'uncompressedBytes' ] / 1024**2:.0f} MiB into {chunk[ 'bytes' ] / 1024**2:.0f} MiB" )
+
+    manifest[ 'finished' ] = time.time( )
+    writeManifest( manifestFilePath, manifest )
+    return manifest
+
+
+
+########################################################################
+# verifyArchive( )
+########################################################################
+
+def verifyArchive( manifestFilePath ):
+    """
+    Check every chunk in the manifest against its size and sha512. Returns the list of what is wrong, empty if nothing is.
+    """
+
+    manifest = readManifest( manifestFilePath )
+    if manifest is None:
+        return [ f"{manifestFilePath} is missing or not valid JSON" ]
+    problems = [ ]
+    for chunk in manifest[ 'chunks' ]:
+        chunkFilePath = os.path.join( os.path.dirname( manifestFilePath ), chunk[ 'name' ] )
+        if not chunk[ 'done' ]:
+            problems.append( f"{chunk[ 'name' ]}: not packed yet" )
+            continue
+        sha512 = hashlib.sha512( )
+        try:
+            with open( chunkFilePath, 'rb' ) as chunkFileHandle:
+                for block in iter( lambda: chunkFileHandle.read( 16 * 1024 * 1024 ), b'' ):
+                    sha512.update( block )
+        except OSError as err:
+            problems.append( f"{chunk[ 'name' ]}: {err}" )
+            continue
+        if os.path.getsize( chunkFilePath ) != chunk[ 'bytes' ] or sha512.hexdigest( ) != chunk[ 'sha512' ]:
+            problems.append( f"{chunk[ 'name' ]}: size or sha512 does not match the manifest" )
+    return problems
@@ -0,0 +1,222 @@
+# retention: delete what has been kept long enough, to make room for the next runs
+
+import concurrent.futures
+import ctypes
+import dataclasses
+import os
+import platform
+import shutil
+import time
+
+
+#########################################################################
+# A rule is ( directory, kind, days ), see demux.retentionRules:
+#
+#   ( '/data/rawdata/bad_runs', 'age', 90 )           everything in the directory not modified for 90 days
+#   ( '/data/for_transfer',     'delivered', 7 )      every run in the directory delivered, and verified, more than 7 days ago
+#
+# Each entry of a rule's directory is one run: {RunID}, or {RunID}_demultiplex. Entries that are themselves the directory of another
+# rule ( /data/rawdata/bad_runs inside /data/rawdata ) and hidden entries are left alone. So is every run isProtected( ) says is in
+# progress, whatever its age.
+#
+# Deleting is parallel, over the entries and over the top level of each entry, in threads running at the idle I/O priority
+# ( ionice -c 3 ): the demultiplexing going on next to it gets the disks first.
+#########################################################################
+
+AGE             = 'age'
+DELIVERED       = 'delivered'
+KINDS           = [ AGE, DELIVERED ]
+ioprioSetCalls  = { 'x86_64': 251, 'aarch64': 30, 'ppc64le': 273 }     # the ioprio_set( ) syscall number, there is no libc wrapper
+ioprioClassIdle = 3
+
+
+
+########################################################################
+# Candidate
+########################################################################
+
+@dataclasses.dataclass
+class Candidate:
+    """
+    An entry a rule says can go
+    """
+
+    path:       str
+    runId:      str
+    kind:       str
+    days:       int
+    age:        float               # days, since modified or since delivered
+    bytes:      int                 = 0
+
+
+
+########################################################################
+# runIdOf( )
+########################################################################
+
+def runIdOf( name, suffixes ):
+    """
+    {name} without whichever of {suffixes} it ends in: /data/demultiplex/{RunID}_demultiplex is {RunID}
+    """
+
+    for suffix in suffixes:
+        if suffix and name.endswith( suffix ):
+            return name[ :-len( suffix ) ]
+    return name
+
+
+
+########################################################################
+# findCandidates( )
+########################################################################
+
+def findCandidates( rules, isProtected, delivered, suffixes, now = None ):
+    """
+    Everything the {rules} say can be deleted, as [ Candidate, ... ], sizes filled in
+
+        isProtected     isProtected( runId ): True for a run that is in progress, never deleted
+        delivered       { runId: time it was delivered and verified }, runstate.deliveredRuns( )
+        suffixes        what to strip off an entry name to get the RunID, [ '_demultiplex' ]
+    """
+
+    now         = now or time.time( )
+    directories = { os.path.normpath( directory ) for directory, kind, days in rules }
+    candidates  = [ ]
+    for directory, kind, days in rules:
+        if kind not in KINDS:
+            raise ValueError( f"retention rule for {directory}: {kind} is not one of {', '.join( KINDS )}" )
+        if not os.path.isdir( directory ):
+            continue
+        for entry in os.scandir( directory ):
+            if entry.name.startswith( '.' ) or os.path.normpath( entry.path ) in directories:
+                continue
+            runId = runIdOf( entry.name, suffixes )
+            if isProtected( runId ):
+                continue
+            if kind == AGE:
+                since = entry.stat( follow_symlinks = False ).st_mtime
+            else:
+                since = delivered.get( runId )
+                if since is None:
+                    continue
+            age = ( now - since ) / 86400
+            if age >= days:
+                candidates.append( Candidate( entry.path, runId, kind, days, age, treeSize( entry.path ) ) )
+    return candidates
+
+
+
+########################################################################
+# treeSize( )
+########################################################################
+
+def treeSize( path ):
+    """
+    The bytes deleting {path} gives back: allocated blocks, not file sizes, so sparse files and small files count for what they take
+    """
+
+    status = os.lstat( path )
+    if not os.path.isdir( path ) or os.path.islink( path ):
+        return status.st_blocks * 512
+    size  = status.st_blocks * 512
+    stack = [ path ]
+    while stack:
+        with os.scandir( stack.pop( ) ) as iterator:
+            for entry in iterator:
+                size = size + entry.stat( follow_symlinks = False ).st_blocks * 512
+                if entry.is_dir( follow_symlinks = False ):
+                    stack.append( entry.path )
+    return size
+
+
+
+########################################################################
+# setIdleIoPriority( )
+########################################################################
+
+def setIdleIoPriority( ):
+    """
+    ionice -c 3 for the calling thread: I/O priorities are per thread on Linux. Quietly does nothing where that is not possible.
+    """
+
+    call = ioprioSetCalls.get( platform.machine( ) )
+    if call is None:
+        return
+    try:
+        ctypes.CDLL( None, use_errno = True ).syscall( call, 1, 0, ioprioClassIdle << 13 )      # IOPRIO_WHO_PROCESS, 0: this thread
+    except ( AttributeError, OSError ):
+        pass
+
+
+
+########################################################################
+# removePath( )
+########################################################################
+
+def removePath( path ):
+    if os.path.isdir( path ) and not os.path.islink( path ):
+        shutil.rmtree( path )
+    else:
+        os.unlink( path )
+
+
+
+########################################################################
+# deleteCandidates( )
+########################################################################
+
+def deleteCandidates( candidates, workers ):
+    """
+    Delete the {candidates}, {workers} threads at the idle I/O priority. Returns ( bytes freed, [ ( path, error ), ... ] )
+
+    The top level of every candidate is spread over the threads, so one big run does not end up on a single thread;
+        the candidate directories themselves go once they are empty.
+    """
+
+    errors = [ ]
+    freed  = 0
+    with concurrent.futures.ThreadPoolExecutor( max_workers = workers, initializer = setIdleIoPriority ) as executor:
+        pieces = dict( )
+        for candidate in candidates:
+            if os.path.isdir( candidate.path ) and not os.path.islink( candidate.path ):
+                for entry in os.scandir( candidate.path ):
+                    pieces[ executor.submit( removePath, entry.path ) ] = ( candidate, entry.path )
+            else:
+                pieces[ executor.submit( removePath, candidate.path ) ] = ( candidate, candidate.path )
+        failed = set( )
+        for future in concurrent.futures.as_completed( pieces ):
+            candidate, path = pieces[ future ]
+            try:
+                future.result( )
+            except OSError as err:
+                errors.append( ( path, err ) )
+                failed.add( candidate.path )
+
+    for candidate in candidates:
+        if candidate.path in failed:
+            continue
+        try:
+            if os.path.isdir( candidate.path ) and not os.path.islink( candidate.path ):
+                os.rmdir( candidate.path )
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            errors.append( ( candidate.path, err ) )
+            continue
+        freed = freed + candidate.bytes
+    return freed, errors
+
+
+
+########################################################################
+# report( )
+########################################################################
+
+def report( candidates, dryRun ):
+    """
+    What was, or with {dryRun} would be, deleted and why, one line per candidate and a total
+    """
+
+    lines = [ f"{candidate.bytes / 1024**3:10.1f} GiB  {candidate.path}  ( {candidate.kind} {candidate.age:.0f} days, kept for {candidate.days} )" for candidate in candidates ]
+    lines.append( f"{sum( candidate.bytes for candidate in candidates ) / 1024**3:10.1f} GiB  in {len( candidates )} entries" + ( ", dry run: nothing deleted" if dryRun else '' ) )
+    return '\n'.join( lines )
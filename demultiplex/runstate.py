@@ -0,0 +1,350 @@
+# run-state store: which runs exist, and what has been done about them
+
+import os
+import sqlite3
+import time
+
+
+#########################################################################
+# One row per run in /data/rawdata, in /data/log/runstate.sqlite3:
+#
+#   seen        the directory appeared in /data/rawdata
+#   waiting     no RTAComplete.txt or SampleSheet.csv yet, the sequencer is still writing
+#   queued      ready to demultiplex, pendingRuns( ) hands it to the scheduler
+#   running     demultiplex_script.main( ) is working on it
+#   failed      main( ) did not finish; stays failed until requeued by hand
+#   done        demultiplexed, by us or ( {RunID}_demultiplex already there ) by somebody else
+#
+# A run done by us also gets a delivered time, once its tar files were verified and delivered: what retention.py counts from.
+#
+# detectRuns( ) only lists a directory when its mtime has changed since the last pass, and only looks inside the run
+# directories that are waiting and whose own mtime has changed: creating RTAComplete.txt changes it. A tick with nothing
+# new is a handful of stat( )s, however many years of runs there are.
+#########################################################################
+
+SEEN        = 'seen'
+WAITING     = 'waiting'
+QUEUED      = 'queued'
+RUNNING     = 'running'
+FAILED      = 'failed'
+DONE        = 'done'
+STATES      = [ SEEN, WAITING, QUEUED, RUNNING, FAILED, DONE ]
+
+schema = """
+    CREATE TABLE IF NOT EXISTS runs (
+        runId       TEXT PRIMARY KEY,
+        state       TEXT NOT NULL,
+        dirMtime    REAL,
+        firstSeen   REAL,
+        updated     REAL,
+        queued      REAL,
+        started     REAL,
+        finished    REAL,
+        attempts    INTEGER NOT NULL DEFAULT 0,
+        message     TEXT,
+        priority    INTEGER NOT NULL DEFAULT 0,
+        instrument  TEXT,
+        workUnits   REAL,
+        rawBytes    INTEGER,
+        samples     INTEGER,
+        delivered   REAL
+    );
+    CREATE TABLE IF NOT EXISTS stageSizes (
+        runId       TEXT,
+        stage       TEXT,
+        bytes       INTEGER,
+        rawBytes    INTEGER,
+        samples     INTEGER,
+        recorded    REAL,
+        PRIMARY KEY ( runId, stage )
+    );
+    CREATE TABLE IF NOT EXISTS directories (
+        path        TEXT PRIMARY KEY,
+        mtime       REAL
+    );
+    CREATE INDEX IF NOT EXISTS runsState ON runs( state );
+"""
+
+
+
+########################################################################
+# openStore( )
+########################################################################
+
+def openStore( databasePath ):
+    """
+    Open ( and create, the first time ) the run-state store at {databasePath}
+    """
+
+    connection = sqlite3.connect( databasePath, timeout = 60 )
+    connection.execute( "PRAGMA journal_mode = WAL" )
+    connection.executescript( schema )
+    return connection
+
+
+
+########################################################################
+# changedDirectory( )
+########################################################################
+
+def changedDirectory( connection, path ):
+    """
+    Return the mtime of {path} if it changed since the last call for {path}, None if it did not.
+        The new mtime is recorded, but only committed with the rest of the pass.
+    """
+
+    mtime = os.stat( path ).st_mtime
+    row   = connection.execute( "SELECT mtime FROM directories WHERE path = ?", ( path, ) ).fetchone( )
+    if row and row[ 0 ] == mtime:
+        return None
+    connection.execute( "INSERT OR REPLACE INTO directories VALUES ( ?, ? )", ( path, mtime ) )
+    return mtime
+
+
+
+########################################################################
+# setState( )
+########################################################################
+
+def setState( connection, runId, state, message = None ):
+    """
+    Move {runId} to {state}, stamping the matching timestamp, and commit
+    """
+
+    now     = time.time( )
+    stamp   = { QUEUED: 'queued', RUNNING: 'started', FAILED: 'finished', DONE: 'finished' }.get( state )
+    columns = f", {stamp} = :now" if stamp else ''
+    if state == RUNNING:
+        columns = columns + ", attempts = attempts + 1"
+    connection.execute( "INSERT OR IGNORE INTO runs ( runId, state, firstSeen, updated ) VALUES ( :runId, :state, :now, :now )", { 'runId': runId, 'state': state, 'now': now } )
+    connection.execute( f"UPDATE runs SET state = :state, updated = :now, message = :message{columns} WHERE runId = :runId", { 'runId': runId, 'state': state, 'now': now, 'message': message } )
+    connection.commit( )
+
+
+
+########################################################################
+# setPriority( )
+########################################################################
+
+def setPriority( connection, runId, priority ):
+    """
+    The manual override: runs with a higher {priority} go first, whatever their size or age. 0 is the default.
+    """
+
+    connection.execute( "UPDATE runs SET priority = ? WHERE runId = ?", ( priority, runId ) )
+    connection.commit( )
+
+
+
+########################################################################
+# setEstimate( )
+########################################################################
+
+def setEstimate( connection, runId, instrument, workUnits, rawBytes = None, samples = None ):
+    """
+    Record how big {runId} is, see scheduler.workUnits( ), and the size of its BaseCalls and its number of samples, for diskspace.py,
+        so it is worked out once per run and not on every tick
+    """
+
+    connection.execute( "UPDATE runs SET instrument = ?, workUnits = ?, rawBytes = ?, samples = ? WHERE runId = ?", ( instrument, workUnits, rawBytes, samples, runId ) )
+    connection.commit( )
+
+
+
+########################################################################
+# setDelivered( )
+########################################################################
+
+def setDelivered( connection, runId ):
+    """
+    {runId} was delivered, and its tar files verified, just now
+    """
+
+    connection.execute( "UPDATE runs SET delivered = ? WHERE runId = ?", ( time.time( ), runId ) )
+    connection.commit( )
+
+
+
+########################################################################
+# deliveredRuns( )
+########################################################################
+
+def deliveredRuns( connection ):
+    """
+    { runId: time it was delivered }
+    """
+
+    return dict( connection.execute( "SELECT runId, delivered FROM runs WHERE delivered IS NOT NULL" ).fetchall( ) )
+
+
+
+########################################################################
+# runEstimate( )
+########################################################################
+
+def runEstimate( connection, runId ):
+    """
+    What setEstimate( ) recorded for {runId}: ( instrument, workUnits, rawBytes, samples ), or None if the run is not in the store
+    """
+
+    return connection.execute( "SELECT instrument, workUnits, rawBytes, samples FROM runs WHERE runId = ?", ( runId, ) ).fetchone( )
+
+
+
+########################################################################
+# recordStageSize( )
+########################################################################
+
+def recordStageSize( connection, runId, stage, size, rawBytes, samples ):
+    """
+    How many bytes {stage} of {runId} wrote, next to the raw size and sample count it was predicted from: the history diskspace.py learns from
+    """
+
+    connection.execute( "INSERT OR REPLACE INTO stageSizes VALUES ( ?, ?, ?, ?, ?, ? )", ( runId, stage, size, rawBytes, samples, time.time( ) ) )
+    connection.commit( )
+
+
+
+########################################################################
+# stageSizeHistory( )
+########################################################################
+
+def stageSizeHistory( connection, stage, limit = 50 ):
+    """
+    The last {limit} sizes recorded for {stage}: [ ( bytes, rawBytes, samples ), ... ], newest first
+    """
+
+    return connection.execute( "SELECT bytes, rawBytes, samples FROM stageSizes WHERE stage = ? AND rawBytes > 0 ORDER BY recorded DESC LIMIT ?", ( stage, limit ) ).fetchall( )
+
+
+
+########################################################################
+# detectRuns( )
+########################################################################
+
+def detectRuns( connection, rawDataDir, demultiplexDir, instruments, demultiplexDirSuffix, requiredFiles ):
+    """
+    One detection pass. Returns the list of RunIDs that became queued in this pass.
+
+        rawDataDir, demultiplexDir      /data/rawdata, /data/demultiplex
+        instruments                     serial numbers of our sequencers: a run directory is {date}_{serial}_{number}_{flowcell}
+        demultiplexDirSuffix            '_demultiplex'
+        requiredFiles                   [ 'RTAComplete.txt', 'SampleSheet.csv' ], what a run needs before it can be queued
+    """
+
+    now         = time.time( )
+    instruments = set( instruments )
+    known       = dict( connection.execute( "SELECT runId, state FROM runs" ).fetchall( ) )
+
+    if changedDirectory( connection, rawDataDir ) is not None:
+        for entry in os.scandir( rawDataDir ):
+            parts = entry.name.split( '_' )
+            if entry.name not in known and len( parts ) > 1 and parts[ 1 ] in instruments and entry.is_dir( ):
+                connection.execute( "INSERT INTO runs ( runId, state, firstSeen, updated ) VALUES ( ?, ?, ?, ? )", ( entry.name, SEEN, now, now ) )
+                known[ entry.name ] = SEEN
+
+    if changedDirectory( connection, demultiplexDir ) is not None:            # demultiplexed by hand, or before the store existed
+        for entry in os.scandir( demultiplexDir ):
+            runId = entry.name[ :-len( demultiplexDirSuffix ) ]
+            if entry.name.endswith( demultiplexDirSuffix ) and known.get( runId ) in [ SEEN, WAITING, QUEUED ]:
+                connection.execute( "UPDATE runs SET state = ?, updated = ?, finished = ?, message = ? WHERE runId = ?", ( DONE, now, now, f"{entry.name} already exists", runId ) )
+                known[ runId ] = DONE
+
+    queued = [ ]
+    for runId, dirMtime in connection.execute( "SELECT runId, dirMtime FROM runs WHERE state IN ( ?, ? )", ( SEEN, WAITING ) ).fetchall( ):
+        runDir = os.path.join( rawDataDir, runId )
+        try:
+            mtime = os.stat( runDir ).st_mtime
+        except FileNotFoundError:                                               # deleted before it was ever demultiplexed
+            connection.execute( "DELETE FROM runs WHERE runId = ?", ( runId, ) )
+            continue
+        if mtime == dirMtime:
+            continue
+        ready = all( os.path.exists( os.path.join( runDir, fileName ) ) for fileName in requiredFiles )
+        connection.execute( "UPDATE runs SET state = ?, dirMtime = ?, updated = ?, queued = ? WHERE runId = ?", ( QUEUED if ready else WAITING, mtime, now, now if ready else None, runId ) )
+        if ready:
+            queued.append( runId )
+
+    connection.commit( )
+    return queued
+
+
+
+########################################################################
+# pendingRuns( )
+########################################################################
+
+def pendingRuns( connection ):
+    """
+    The queued RunIDs, oldest first
+    """
+
+    return [ runId for runId, in connection.execute( "SELECT runId FROM runs WHERE state = ? ORDER BY queued, runId", ( QUEUED, ) ) ]
+
+
+
+########################################################################
+# queuedRuns( )
+########################################################################
+
+def queuedRuns( connection ):
+    """
+    What the scheduler needs to know about the queued runs: [ ( runId, priority, queued, instrument, workUnits ), ... ]
+    """
+
+    return connection.execute( "SELECT runId, priority, queued, instrument, workUnits FROM runs WHERE state = ? ORDER BY queued, runId", ( QUEUED, ) ).fetchall( )
+
+
+
+########################################################################
+# finishedRuns( )
+########################################################################
+
+def finishedRuns( connection, limit = 200 ):
+    """
+    The last {limit} runs that went from queued to done: [ ( runId, instrument, workUnits, queued, started, finished ), ... ], newest first
+    """
+
+    return connection.execute( "SELECT runId, instrument, workUnits, queued, started, finished FROM runs WHERE state = ? AND started >= queued AND finished >= started "
+                               "ORDER BY finished DESC LIMIT ?", ( DONE, limit ) ).fetchall( )
+
+
+
+########################################################################
+# listRuns( )
+########################################################################
+
+def listRuns( connection, states = None ):
+    """
+    Return [ ( runId, state, firstSeen, queued, started, finished, attempts, message ), ... ], only in {states} if given
+    """
+
+    states = states or STATES
+    query  = f"SELECT runId, state, firstSeen, queued, started, finished, attempts, message FROM runs WHERE state IN ( {', '.join( '?' * len( states ) )} ) ORDER BY runId"
+    return connection.execute( query, states ).fetchall( )
+
+
+
+if __name__ == '__main__':
+
+    # PYTHONPATH=/data/bin /usr/bin/python3.11 -m demultiplex.runstate list [state ...]
+    # PYTHONPATH=/data/bin /usr/bin/python3.11 -m demultiplex.runstate requeue <RunID>     # after fixing what made it fail, and moving its _demultiplex directory out of the way
+    # PYTHONPATH=/data/bin /usr/bin/python3.11 -m demultiplex.runstate priority <RunID> <priority>   # higher goes first, 0 is the default
+
+    import sys
+    import demultiplex_script
+
+    usage = ( len( sys.argv ) < 2 or sys.argv[ 1 ] not in [ 'list', 'requeue', 'priority' ] or ( sys.argv[ 1 ] == 'requeue' and len( sys.argv ) != 3 )
+              or ( sys.argv[ 1 ] == 'priority' and ( len( sys.argv ) != 4 or not sys.argv[ 3 ].lstrip( '-' ).isdigit( ) ) ) )
+    if usage:
+        sys.exit( "Usage: python3 -m demultiplex.runstate list [state ...] | requeue <RunID> | priority <RunID> <priority>" )
+
+    connection = openStore( demultiplex_script.demux.runStateFilePath )
+    if sys.argv[ 1 ] == 'requeue':
+        setState( connection, sys.argv[ 2 ].replace( "/", "" ), QUEUED, "requeued by hand" )
+    if sys.argv[ 1 ] == 'priority':
+        setPriority( connection, sys.argv[ 2 ].replace( "/", "" ), int( sys.argv[ 3 ] ) )
+    for runId, state, firstSeen, queued, started, finished, attempts, message in listRuns( connection, sys.argv[ 2: ] if sys.argv[ 1 ] == 'list' else None ):
+        stamps = '  '.join( time.strftime( '%Y-%m-%d %H:%M', time.localtime( stamp ) ) if stamp else '-' for stamp in [ firstSeen, queued, started, finished ] )
+        print( f"{runId:45} {state:8} {stamps}  {attempts}  {message or ''}" )
+    connection.close( )
@@ -1 +1,3 @@
 # init function
+
+from .samplesheet import Sample, SampleSheet, clean, load
@@ -1 +1,26 @@
 # main function
+#
+# Print what demultiplex_script.py will make of a SampleSheet, without running anything:
+#
+# PYTHONPATH=/data/bin python3.11 -m demultiplex.samplesheet /data/rawdata/<RunID>/SampleSheet.csv
+
+import sys
+
+from .samplesheet import load
+
+if __name__ == '__main__':
+
+    if len( sys.argv ) == 1:
+        sys.exit( "No SampleSheet.csv argument present. Exiting." )
+
+    sampleSheet = load( sys.argv[1] )
+    print( f"{sampleSheet.filePath}  sha256 {sampleSheet.sha256}" )
+    print( f"reads: {sampleSheet.reads}  samples: {len( sampleSheet.uniqueSamples )}  projects: {len( sampleSheet.projects )}" )
+    for project, paths in sampleSheet.expectedOutput( ).items( ):
+        print( f"\n{project}" )
+        for path in paths:
+            print( f"    {path}" )
+    for lineNumber in sampleSheet.undecodableLines:
+        print( f"line {lineNumber}: not UTF-8" )
+    for lineNumber in sampleSheet.emptyDataLines:
+        print( f"line {lineNumber}: empty row of commas" )
@@ -0,0 +1,204 @@
+# index of the archived SampleSheets
+
+import os
+import re
+import sqlite3
+
+from .samplesheet import SampleSheet
+
+
+#########################################################################
+# archiveSampleSheet( ) in demultiplex_script.py copies every SampleSheet.csv to /data/samplesheets/{RunID}.csv and adds it to
+# /data/samplesheets/samplesheets.sqlite3 with indexSampleSheet( ). updateIndex( ) walks a whole directory tree, for sheets that
+# were archived before the index existed, or copied in by hand.
+#
+# Questions are answered out of the index, not by re-reading the .csv files:
+#   projectsPerYear( ), runsPerProject( ), whereWasSampleSequenced( )
+# demultiplex/tools/samplesheet_index.py is the command line for all of them.
+#########################################################################
+
+runIdRegex = re.compile( r"^(\d{6})_([A-Za-z0-9-]+)_(\d+)_" )         # 220314_M06578_0091_000000000-K6NYY: date, instrument, run number
+
+schema = """
+    CREATE TABLE IF NOT EXISTS sheets (
+        path        TEXT PRIMARY KEY,
+        runId       TEXT NOT NULL,
+        instrument  TEXT,
+        runDate     TEXT,
+        year        INTEGER,
+        sha256      TEXT,
+        mtime       REAL,
+        size        INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS samples (
+        path        TEXT NOT NULL REFERENCES sheets( path ) ON DELETE CASCADE,
+        sampleId    TEXT,
+        sampleName  TEXT,
+        project     TEXT,
+        index1      TEXT,
+        index2      TEXT,
+        lane        INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS sheetsRunId      ON sheets( runId );
+    CREATE INDEX IF NOT EXISTS sheetsYear       ON sheets( year );
+    CREATE INDEX IF NOT EXISTS samplesPath      ON samples( path );
+    CREATE INDEX IF NOT EXISTS samplesProject   ON samples( project );
+    CREATE INDEX IF NOT EXISTS samplesSampleId  ON samples( sampleId );
+    CREATE INDEX IF NOT EXISTS samplesName      ON samples( sampleName );
+"""
+
+
+
+########################################################################
+# openIndex( )
+########################################################################
+
+def openIndex( databasePath ):
+    """
+    Open ( and create, the first time ) the SQLite index at {databasePath}.
+        WAL, so a query from the command line does not wait for a demultiplex run that is adding its sheet.
+    """
+
+    connection = sqlite3.connect( databasePath, timeout = 60 )
+    connection.execute( "PRAGMA journal_mode = WAL" )
+    connection.execute( "PRAGMA foreign_keys = ON" )
+    connection.executescript( schema )
+    return connection
+
+
+
+########################################################################
+# describeRun( )
+########################################################################
+
+def describeRun( filePath, sampleSheet ):
+    """
+    Return ( runId, instrument, runDate, year ) for an archived sheet.
+        The RunID comes from the file name, /data/samplesheets/{RunID}.csv, or the directory, /data/rawdata/{RunID}/SampleSheet.csv;
+        failing both, the [Header] Date of the sheet gives the date and the file name stands in for the RunID.
+    """
+
+    for candidate in [ os.path.basename( filePath ), os.path.basename( os.path.dirname( filePath ) ) ]:
+        match = runIdRegex.match( candidate )
+        if match:
+            runId   = candidate.split( '.csv' )[ 0 ]
+            yymmdd  = match.group( 1 )
+            return runId, match.group( 2 ), f"20{yymmdd[ 0:2 ]}-{yymmdd[ 2:4 ]}-{yymmdd[ 4:6 ]}", 2000 + int( yymmdd[ 0:2 ] )
+
+    runId = os.path.splitext( os.path.basename( filePath ) )[ 0 ]
+    date  = re.match( r"^(\d{4})-(\d{1,2})-(\d{1,2})$|^(\d{1,2})/(\d{1,2})/(\d{4})$", sampleSheet.header.get( 'Date', '' ) )   # IEM writes 2022-03-14 or 3/14/2022
+    if not date:
+        return runId, None, None, None
+    year, month, day = date.group( 1, 2, 3 ) if date.group( 1 ) else ( date.group( 6 ), date.group( 4 ), date.group( 5 ) )
+    return runId, None, f"{year}-{int( month ):02d}-{int( day ):02d}", int( year )
+
+
+
+########################################################################
+# indexSampleSheet( )
+########################################################################
+
+def indexSampleSheet( connection, filePath, content = None ):
+    """
+    Add {filePath} to the index, or replace what the index had for it. Does not commit.
+        {content} are the bytes of the file, if the caller has already read them.
+    """
+
+    if content is None:
+        with open( filePath, 'rb' ) as sampleSheetFileHandle:
+            content = sampleSheetFileHandle.read( )
+    fileStat    = os.stat( filePath )
+    sampleSheet = SampleSheet( filePath, content )              # not samplesheet.load( ): thousands of sheets would stay in its cache
+    filePath    = os.path.abspath( filePath )
+
+    connection.execute( "DELETE FROM sheets WHERE path = ?", ( filePath, ) )
+    connection.execute( "INSERT INTO sheets VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )", ( filePath, *describeRun( filePath, sampleSheet ), sampleSheet.sha256, fileStat.st_mtime, fileStat.st_size ) )
+    connection.executemany( "INSERT INTO samples VALUES ( ?, ?, ?, ?, ?, ?, ? )",
+                            [ ( filePath, sample.sampleId, sample.sampleName, sample.project, sample.index, sample.index2, sample.lane ) for sample in sampleSheet.samples ] )
+
+
+
+########################################################################
+# updateIndex( )
+########################################################################
+
+def updateIndex( connection, sampleSheetDirPath ):
+    """
+    Bring the index up to date with every .csv file under {sampleSheetDirPath}, at any depth.
+        Files whose size and modification time have not changed since they were indexed are skipped without being opened,
+        files that are gone are dropped. Sheets with _ori in the name are the untouched originals of edited sheets, and are skipped.
+
+    Returns ( indexed, removed ), the number of sheets added or refreshed and the number dropped.
+    """
+
+    known   = { path: ( mtime, size ) for path, mtime, size in connection.execute( "SELECT path, mtime, size FROM sheets" ) }
+    present = set( )
+    indexed = 0
+    for dirPath, dirNames, fileNames in os.walk( os.path.abspath( sampleSheetDirPath ) ):
+        for fileName in fileNames:
+            if not fileName.endswith( '.csv' ) or '_ori' in fileName:
+                continue
+            filePath = os.path.join( dirPath, fileName )
+            try:
+                fileStat = os.stat( filePath )
+            except OSError:
+                continue
+            present.add( filePath )
+            if known.get( filePath ) == ( fileStat.st_mtime, fileStat.st_size ):
+                continue
+            try:
+                indexSampleSheet( connection, filePath )
+            except ( OSError, IndexError, ValueError ):
+                continue
+            indexed = indexed + 1
+
+    removed = [ ( path, ) for path in known if path not in present and path.startswith( os.path.abspath( sampleSheetDirPath ) + os.sep ) ]
+    connection.executemany( "DELETE FROM sheets WHERE path = ?", removed )
+    connection.commit( )
+    return indexed, len( removed )
+
+
+
+########################################################################
+# projectsPerYear( )
+########################################################################
+
+def projectsPerYear( connection, year = None ):
+    """
+    Return [ ( year, project, number of runs ), ... ], for every year or only {year}
+    """
+
+    query = """SELECT sheets.year, samples.project, COUNT( DISTINCT sheets.runId ) FROM samples JOIN sheets USING ( path )
+               WHERE samples.project != '' AND ( ? IS NULL OR sheets.year = ? ) GROUP BY sheets.year, samples.project ORDER BY sheets.year, samples.project"""
+    return connection.execute( query, ( year, year ) ).fetchall( )
+
+
+
+########################################################################
+# runsPerProject( )
+########################################################################
+
+def runsPerProject( connection, project ):
+    """
+    Return [ ( runId, instrument, runDate, number of samples ), ... ] of every run {project} was on. {project} may hold SQL LIKE wildcards, % and _
+    """
+
+    query = """SELECT sheets.runId, sheets.instrument, sheets.runDate, COUNT( DISTINCT samples.sampleId ) FROM samples JOIN sheets USING ( path )
+               WHERE samples.project LIKE ? GROUP BY sheets.runId ORDER BY sheets.runDate, sheets.runId"""
+    return connection.execute( query, ( project, ) ).fetchall( )
+
+
+
+########################################################################
+# whereWasSampleSequenced( )
+########################################################################
+
+def whereWasSampleSequenced( connection, sample ):
+    """
+    Return [ ( runId, instrument, runDate, project, sampleId, sampleName, index1, index2, lane ), ... ] for every run
+        with a Sample_ID or Sample_Name of {sample}. {sample} may hold SQL LIKE wildcards, % and _
+    """
+
+    query = """SELECT DISTINCT sheets.runId, sheets.instrument, sheets.runDate, samples.project, samples.sampleId, samples.sampleName, samples.index1, samples.index2, samples.lane
+               FROM samples JOIN sheets USING ( path ) WHERE samples.sampleId LIKE ? OR samples.sampleName LIKE ? ORDER BY sheets.runDate, sheets.runId"""
+    return connection.execute( query, ( sample, sample ) ).fetchall( )
@@ -1 +1,284 @@
 # samplesheet object and operations to it
+
+import csv
+import dataclasses
+import hashlib
+import typing
+
+
+#########################################################################
+# Illumina SampleSheet.csv, version 1 ( bcl2fastq ) layout:
+#
+#   [Header]
+#   IEMFileVersion,5
+#   Investigator Name,...
+#   [Reads]
+#   151
+#   151
+#   [Settings]
+#   Adapter,CTGTCTCTTATACACATCT
+#   [Data]
+#   Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,I5_Index_ID,index2,Sample_Project,Description,Analysis
+#   ...
+#
+# load( ) parses a sheet once per content: the result is cached on the sha256 of the file, so every stage of demultiplex_script.py
+# can ask for it again without re-reading and re-parsing, and an edited sheet is picked up straight away.
+#
+# expectedOutput( ) and expectedLaneFiles( ) say which fastq.gz files bcl2fastq writes for the sheet, and where:
+#
+#   {Sample_Project}/{Sample_Name}_S1_R1_001.fastq.gz                  Sample_Name the same as Sample_ID, or empty
+#   {Sample_Project}/{Sample_ID}/{Sample_Name}_S1_R1_001.fastq.gz      Sample_Name different from Sample_ID: one more directory
+#   ..._S1_L001_R1_001.fastq.gz                                       without --no-lane-splitting, one per lane the sample is in
+#
+# planRenames( ) and mergeLaneFiles( ) in demultiplex_script.py plan their work out of them, instead of looking at what is on disk.
+#########################################################################
+
+SAMPLE_ID       = 'Sample_ID'
+SAMPLE_NAME     = 'Sample_Name'
+SAMPLE_PROJECT  = 'Sample_Project'
+INDEX           = 'index'
+INDEX2          = 'index2'
+LANE            = 'Lane'
+DATA            = 'Data'
+ENCODING        = 'utf-8'
+UNDETERMINED    = 'Undetermined'                # the reads that match no sample, Undetermined_S0_R1_001.fastq.gz at the top of the output
+
+parsedSampleSheets = dict( )                    # { sha256: SampleSheet }
+
+
+
+########################################################################
+# Sample
+########################################################################
+
+@dataclasses.dataclass
+class Sample:
+    """
+    One row of the [Data] section.
+        The typed attributes have quotes and surrounding spaces stripped; {fields} has every column exactly as it was written,
+        for checks that care about stray spaces.
+    """
+
+    sampleId:   str
+    sampleName: str
+    project:    str
+    index:      str                     = ''
+    index2:     str                     = ''
+    lane:       typing.Optional[ int ]  = None
+    number:     int                     = 0     # bcl2fastq's _S number: Sample_IDs are numbered 1, 2, ... in order of first appearance
+    lineNumber: int                     = 0
+    fields:     dict                    = dataclasses.field( default_factory = dict )
+
+    @property
+    def fileName( self ):
+        """
+        bcl2fastq names the fastq.gz files after Sample_Name, and falls back to Sample_ID
+        """
+        return self.sampleName or self.sampleId
+
+    @property
+    def subdirectory( self ):
+        """
+        The Sample_ID directory bcl2fastq puts the files in when Sample_Name is set and is not the same as Sample_ID, '' otherwise
+        """
+        return self.sampleId if self.sampleName and self.sampleName != self.sampleId else ''
+
+    def fastqPrefix( self, prefix = '' ):
+        """
+        {prefix}{fileName}_S{number}, what every fastq.gz file of this sample starts with
+        """
+        return f"{prefix}{self.fileName}_S{self.number}"
+
+    def expectedFastqFiles( self, readNumbers, prefix = '', lanes = None ):
+        """
+        The fastq.gz files bcl2fastq writes for this sample, relative to the output directory:
+            {prefix}{project}/[{prefix}{sampleId}/]{prefix}{fileName}_S{number}[_L00{lane}]_R{read}_001.fastq.gz
+        {lanes} is the list of lanes when bcl2fastq splits by lane, None with --no-lane-splitting
+        """
+        directory = f"{prefix}{self.project}/" if self.project else ''
+        if self.subdirectory:
+            directory = f"{directory}{prefix}{self.subdirectory}/"
+        laneParts = [ f"_L{lane:03d}" for lane in lanes ] if lanes else [ '' ]
+        return [ f"{directory}{self.fastqPrefix( prefix )}{lanePart}_R{read}_001.fastq.gz" for lanePart in laneParts for read in readNumbers ]
+
+
+
+########################################################################
+# SampleSheet
+########################################################################
+
+class SampleSheet:
+    """
+    A parsed SampleSheet.csv
+
+        filePath            where it was read from
+        sha256              hash of the contents, the cache key
+        lines               the lines of the file, decoded
+        sections            { 'Header': [ [ field, ... ], ... ], 'Reads': ..., 'Settings': ..., 'Data': ... }, every section as csv rows
+        header, settings    { key: value } out of [Header] and [Settings]
+        reads               cycles per read out of [Reads], example: [ 151, 151 ]
+        dataColumns         the column headings of [Data]
+        dataHeaderLine      index in {lines} of the [Data] column headings, -1 if there is no [Data]
+        samples             [ Sample, ... ] one per non-empty [Data] row, in file order
+        emptyDataLines      line numbers of [Data] rows that are nothing but commas
+        undecodableLines    line numbers that are not valid UTF-8 ( decoded as Latin-1 instead )
+    """
+
+    def __init__( self, filePath, content, sha256 = None ):
+        self.filePath         = filePath
+        self.sha256           = sha256 or hashlib.sha256( content ).hexdigest( )
+        self.lines            = [ ]
+        self.sections         = dict( )
+        self.header           = dict( )
+        self.settings         = dict( )
+        self.reads            = [ ]
+        self.dataColumns      = [ ]
+        self.dataHeaderLine   = -1
+        self.samples          = [ ]
+        self.emptyDataLines   = [ ]
+        self.undecodableLines = [ ]
+        self.parse( content )
+
+    def parse( self, content ):
+        if content.startswith( b'\xef\xbb\xbf' ):                      # Excel's UTF-8 byte order mark
+            content = content[ 3: ]
+        for lineNumber, rawLine in enumerate( content.splitlines( ), start = 1 ):
+            try:
+                self.lines.append( rawLine.decode( ENCODING ) )
+            except UnicodeDecodeError:
+                self.undecodableLines.append( lineNumber )
+                self.lines.append( rawLine.decode( 'latin-1' ) )
+
+        section = None
+        for lineNumber, row in enumerate( csv.reader( self.lines ), start = 1 ):
+            first = row[ 0 ].strip( ) if row else ''
+            if first.startswith( '[' ) and first.endswith( ']' ):
+                section = first[ 1:-1 ]
+                self.sections.setdefault( section, [ ] )
+                continue
+            if section is None:
+                continue
+
+            if not any( field.strip( ) for field in row ):
+                if section == DATA and self.dataColumns and row:
+                    self.emptyDataLines.append( lineNumber )
+                continue
+            self.sections[ section ].append( row )
+
+            if section == 'Header' or section == 'Settings':
+                target = self.header if section == 'Header' else self.settings
+                target[ first ] = row[ 1 ].strip( ) if len( row ) > 1 else ''
+            elif section == 'Reads' and first.isdigit( ):
+                self.reads.append( int( first ) )
+            elif section == DATA and not self.dataColumns:
+                self.dataColumns    = [ clean( column ) for column in row ]
+                self.dataHeaderLine = lineNumber - 1
+            elif section == DATA:
+                self.samples.append( self.makeSample( row, lineNumber ) )
+
+        numbers = dict( )
+        for sample in self.samples:
+            if sample.sampleId and sample.sampleId not in numbers:
+                numbers[ sample.sampleId ] = len( numbers ) + 1
+            sample.number = numbers.get( sample.sampleId, 0 )
+
+    def makeSample( self, row, lineNumber ):
+        fields = { column: ( row[ position ] if position < len( row ) else '' ) for position, column in enumerate( self.dataColumns ) if column }
+        lane   = clean( fields.get( LANE, '' ) )
+        return Sample(
+            sampleId   = clean( fields.get( SAMPLE_ID,      '' ) ),
+            sampleName = clean( fields.get( SAMPLE_NAME,    '' ) ),
+            project    = clean( fields.get( SAMPLE_PROJECT, '' ) ),
+            index      = clean( fields.get( INDEX,          '' ) ).upper( ),
+            index2     = clean( fields.get( INDEX2,         '' ) ).upper( ),
+            lane       = int( lane ) if lane.isdigit( ) else None,
+            lineNumber = lineNumber,
+            fields     = fields,
+        )
+
+    @property
+    def projects( self ):
+        """
+        Sample_Project values, in order of first appearance
+        """
+        return list( dict.fromkeys( sample.project for sample in self.samples if sample.project ) )
+
+    @property
+    def uniqueSamples( self ):
+        """
+        One Sample per Sample_ID: a sample listed once per lane is still one sample with one set of output files
+        """
+        return list( { sample.sampleId: sample for sample in reversed( self.samples ) if sample.sampleId }.values( ) )[ ::-1 ]
+
+    @property
+    def samplesPerProject( self ):
+        """
+        { project: [ Sample, ... ] }
+        """
+        perProject = dict( )
+        for sample in self.uniqueSamples:
+            perProject.setdefault( sample.project, [ ] ).append( sample )
+        return perProject
+
+    def sampleLanes( self, sample, lanes ):
+        """
+        The lanes out of {lanes} bcl2fastq writes files for {sample} in: the ones it is listed in, every one without a Lane column
+        """
+        listed = { row.lane for row in self.samples if row.sampleId == sample.sampleId and row.lane is not None }
+        return [ lane for lane in lanes if not listed or lane in listed ]
+
+    def expectedOutput( self, prefix = '', lanes = None, readNumbers = None ):
+        """
+        { project: [ relative path of every fastq.gz bcl2fastq will write for it ] }, in sample order, then lane, then read
+        {readNumbers} default to the reads in [Reads]; without one, a single read is assumed.
+        """
+        readNumbers = readNumbers or list( range( 1, len( self.reads ) + 1 ) ) or [ 1 ]
+        return { project: [ path for sample in samples for path in sample.expectedFastqFiles( readNumbers, prefix, self.sampleLanes( sample, lanes ) if lanes else None ) ]
+                 for project, samples in self.samplesPerProject.items( ) }
+
+    def expectedLaneFiles( self, lanes, prefix = '', readNumbers = None ):
+        """
+        { per-sample file: [ its per-lane files, in lane order ] }, relative paths: what bcl2fastq writes without --no-lane-splitting,
+            and what it would have written with it. Undetermined included.
+        """
+        readNumbers  = readNumbers or list( range( 1, len( self.reads ) + 1 ) ) or [ 1 ]
+        undetermined = Sample( sampleId = UNDETERMINED, sampleName = '', project = '' )
+        laneFiles    = dict( )
+        for sample, sampleLanes in [ ( undetermined, lanes ) ] + [ ( sample, self.sampleLanes( sample, lanes ) ) for sample in self.uniqueSamples ]:
+            filePrefix = '' if sample is undetermined else prefix
+            for read in readNumbers:
+                merged = sample.expectedFastqFiles( [ read ], filePrefix )[ 0 ]
+                laneFiles[ merged ] = sample.expectedFastqFiles( [ read ], filePrefix, sampleLanes )
+        return laneFiles
+
+
+
+########################################################################
+# clean( )
+########################################################################
+
+def clean( value ):
+    """
+    Strip the spaces, non-breaking spaces and stray quotes some spreadsheet programs leave around a value
+    """
+    return value.replace( '\u00A0', ' ' ).strip( ).strip( '\'"' ).strip( )
+
+
+
+########################################################################
+# load( )
+########################################################################
+
+def load( filePath ):
+    """
+    Return the parsed SampleSheet for {filePath}.
+        The file is read every time, but only parsed if its sha256 has not been seen before
+    """
+
+    with open( filePath, 'rb' ) as sampleSheetFileHandle:
+        content = sampleSheetFileHandle.read( )
+
+    sha256 = hashlib.sha256( content ).hexdigest( )
+    if sha256 not in parsedSampleSheets:
+        parsedSampleSheets[ sha256 ] = SampleSheet( filePath, content, sha256 )
+    return parsedSampleSheets[ sha256 ]
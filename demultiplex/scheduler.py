@@ -0,0 +1,157 @@
+# scheduler: in what order the queued runs get demultiplexed
+
+import dataclasses
+import os
+import statistics
+
+
+#########################################################################
+# The queue is ordered by, in this order:
+#
+#   manual priority     higher first, see runstate.setPriority( ). 0 unless somebody set it.
+#   starvation          a run queued for longer than {starvationSeconds} goes ahead of every run that is not, oldest first
+#   response ratio      ( time waited + estimated time ) / estimated time, highest first
+#
+# The response ratio is shortest-job-first with ageing built in: a fresh 15 minute MiSeq amplicon run starts at 1 like a fresh
+# 10 hour NextSeq run, but after 15 minutes of waiting it is at 2, while the NextSeq run needs 10 hours of waiting to get there.
+# Short runs go first, and the longer a big run waits, the harder it is to overtake.
+#
+# The estimate is workUnits( ) of the run ( tiles x cycles from RunInfo.xml, weighted by the number of samples in the SampleSheet )
+# times the seconds per work unit its instrument took on the last runs that finished, or a configured default before there are any.
+#########################################################################
+
+samplesPerDoubling  = 96        # a plate of samples doubles the work: more fastq files to write and compress
+calibrationRuns     = 20        # how many finished runs of an instrument secondsPerUnit( ) looks at
+calibrationMinimum  = 3         # fewer than this and the configured default is used
+
+
+
+########################################################################
+# QueuedRun
+########################################################################
+
+@dataclasses.dataclass
+class QueuedRun:
+    """
+    A queued run, as the scheduler sees it
+    """
+
+    runId:      str
+    priority:   int
+    queued:     float
+    instrument: str
+    workUnits:  float
+    estimate:   float               = 0         # seconds
+    waited:     float               = 0         # seconds
+    starving:   bool                = False
+
+    def sortKey( self ):
+        ratio = ( self.waited + self.estimate ) / max( self.estimate, 1 )
+        return ( -self.priority, not self.starving, -self.waited if self.starving else -ratio, self.queued, self.runId )
+
+
+
+########################################################################
+# workUnits( )
+########################################################################
+
+def workUnits( tileCount, cycles, sampleCount ):
+    """
+    How big a run is, in arbitrary units: tiles x cycles is the amount of BCL data to read, the samples add the writing
+    """
+
+    return tileCount * cycles * ( 1 + sampleCount / samplesPerDoubling )
+
+
+
+########################################################################
+# secondsPerUnit( )
+########################################################################
+
+def secondsPerUnit( finished, instrument, default ):
+    """
+    The median seconds per work unit of the last {calibrationRuns} runs of {instrument} in {finished}, or {default}
+
+        finished    runstate.finishedRuns( ): [ ( runId, instrument, workUnits, queued, started, finished ), ... ], newest first
+    """
+
+    rates = [ ( end - start ) / units for runId, runInstrument, units, queued, start, end in finished if runInstrument == instrument and units ]
+    rates = rates[ :calibrationRuns ]
+    if len( rates ) < calibrationMinimum:
+        return default
+    return statistics.median( rates )
+
+
+
+########################################################################
+# orderRuns( )
+########################################################################
+
+def orderRuns( queuedRuns, now, starvationSeconds ):
+    """
+    Fill in waited and starving, and return {queuedRuns} in the order they should be started
+    """
+
+    for run in queuedRuns:
+        run.waited   = max( 0, now - ( run.queued or now ) )
+        run.starving = run.waited >= starvationSeconds
+    return sorted( queuedRuns, key = QueuedRun.sortKey )
+
+
+
+########################################################################
+# queueMetrics( )
+########################################################################
+
+def queueMetrics( orderedRuns, finished ):
+    """
+    The queue in the Prometheus text format, for node_exporter's textfile collector:
+        the length of the queue, the wait and the estimate of every queued run, and a summary of the queue wait of the runs that finished
+
+        orderedRuns     orderRuns( )
+        finished        runstate.finishedRuns( )
+    """
+
+    lines = [ "# HELP demultiplex_queue_length Runs queued, waiting for a worker",
+              "# TYPE demultiplex_queue_length gauge",
+              f"demultiplex_queue_length {len( orderedRuns )}",
+              "# HELP demultiplex_queue_starving Queued runs past the starvation limit",
+              "# TYPE demultiplex_queue_starving gauge",
+              f"demultiplex_queue_starving {sum( run.starving for run in orderedRuns )}",
+              "# HELP demultiplex_queue_oldest_wait_seconds How long the longest waiting queued run has waited",
+              "# TYPE demultiplex_queue_oldest_wait_seconds gauge",
+              f"demultiplex_queue_oldest_wait_seconds {max( ( run.waited for run in orderedRuns ), default = 0 ):.0f}",
+              "# HELP demultiplex_queued_run_wait_seconds How long a queued run has waited so far",
+              "# TYPE demultiplex_queued_run_wait_seconds gauge" ]
+    for position, run in enumerate( orderedRuns, 1 ):
+        lines.append( f'demultiplex_queued_run_wait_seconds{{run="{run.runId}",instrument="{run.instrument}",position="{position}"}} {run.waited:.0f}' )
+    lines = lines + [ "# HELP demultiplex_queued_run_estimate_seconds How long a queued run is estimated to take",
+                      "# TYPE demultiplex_queued_run_estimate_seconds gauge" ]
+    for run in orderedRuns:
+        lines.append( f'demultiplex_queued_run_estimate_seconds{{run="{run.runId}",instrument="{run.instrument}"}} {run.estimate:.0f}' )
+
+    lines = lines + [ "# HELP demultiplex_queue_wait_seconds Time from queued to started, of the runs that finished recently",
+                      "# TYPE demultiplex_queue_wait_seconds summary" ]
+    for instrument in sorted( { row[ 1 ] or 'unknown' for row in finished } ):
+        waits = sorted( start - queued for runId, runInstrument, units, queued, start, end in finished if ( runInstrument or 'unknown' ) == instrument )
+        for quantile in [ 0.5, 0.9, 0.99 ]:
+            lines.append( f'demultiplex_queue_wait_seconds{{instrument="{instrument}",quantile="{quantile}"}} {waits[ min( len( waits ) - 1, int( quantile * len( waits ) ) ) ]:.0f}' )
+        lines.append( f'demultiplex_queue_wait_seconds_sum{{instrument="{instrument}"}} {sum( waits ):.0f}' )
+        lines.append( f'demultiplex_queue_wait_seconds_count{{instrument="{instrument}"}} {len( waits )}' )
+    return '\n'.join( lines ) + '\n'
+
+
+
+########################################################################
+# writeMetrics( )
+########################################################################
+
+def writeMetrics( metricsFilePath, text ):
+    """
+    Replace {metricsFilePath} with {text} atomically: the textfile collector must never read half a file
+    """
+
+    temporaryFilePath = f"{metricsFilePath}.{os.getpid( )}.tmp"
+    with open( temporaryFilePath, 'w', encoding = 'utf-8' ) as metricsFileHandle:
+        metricsFileHandle.write( text )
+    os.replace( temporaryFilePath, metricsFilePath )
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+"""
+Stand-in for bcl2fastq and bcl-convert, so demultiplex_script.py can be run end to end without an Illumina licence, a real run or a big machine.
+
+Called through the bcl2fastq and bcl-convert symlinks next to it, it reads the same command line as the real program, then writes
+    one small fastq.gz per sample and read, named and laid out the way the real program does, Sample_ID directory included
+    Undetermined_S0_*
+    Stats/Stats.json (bcl2fastq) or Reports/Demultiplex_Stats.csv (bcl-convert)
+and prints, for the progress report, what the real program prints per tile of RunInfo.xml. For bcl2fastq that is the lines bcl2fastq
+v2.20 logs as it opens the files of a tile, timestamp and thread id included, not lines written to match demux.bcl2fastqTileRegex:
+    2024-12-02 10:12:31 [7f2c1e7fc700] Opened FILTER file '/data/rawdata/RunID/Data/Intensities/BaseCalls/L001/s_1_1101.filter' for reading
+
+Switch it on with DEMULTIPLEX_SHIMS=1 or demux.useShims = True
+"""
+
+import csv
+import datetime
+import gzip
+import json
+import os
+import re
+import sys
+import xml.etree.ElementTree
+
+READS_PER_SAMPLE = 4
+
+
+def option( argv, names, default = None ):
+    for name in names:
+        if name in argv:
+            return argv[ argv.index( name ) + 1 ]
+    return default
+
+
+def readSampleSheet( sampleSheet ):
+    """
+    [Data] section of {sampleSheet} -> [ ( Sample_ID, Sample_Name, Sample_Project, Lane or None ), ... ]
+    """
+    with open( sampleSheet, 'r', encoding = 'utf-8', newline = '' ) as sampleSheetHandle:
+        lines = sampleSheetHandle.read( ).splitlines( )
+    data = lines[ [ line.split( ',' )[ 0 ].strip( ) for line in lines ].index( '[Data]' ) + 1: ]
+    samples = [ ]
+    for row in csv.DictReader( [ line for line in data if line.strip( ',' ).strip( ) ] ):
+        if row.get( 'Sample_ID' ):
+            lane = int( row[ 'Lane' ] ) if ( row.get( 'Lane' ) or '' ).strip( ).isdigit( ) else None
+            samples.append( ( row[ 'Sample_ID' ], row.get( 'Sample_Name' ) or row[ 'Sample_ID' ], row.get( 'Sample_Project' ) or '', lane ) )
+    return samples
+
+
+def readRunInfo( runFolder ):
+    """
+    RunInfo.xml -> ( [ lane ], [ ( lane, tile ) ], number of non-index reads )
+    """
+    try:
+        root = xml.etree.ElementTree.parse( os.path.join( runFolder, 'RunInfo.xml' ) ).getroot( )
+    except ( OSError, xml.etree.ElementTree.ParseError ):
+        return [ 1 ], [ ], 1
+    layout = root.find( './/FlowcellLayout' )
+    lanes  = list( range( 1, int( layout.get( 'LaneCount', 1 ) ) + 1 ) ) if layout is not None else [ 1 ]
+    tiles  = [ ]
+    for tile in root.iter( 'Tile' ):
+        lane, number = tile.text.split( '_' )
+        tiles.append( ( int( lane ), int( number ) ) )
+    reads = sum( 1 for read in root.iter( 'Read' ) if read.get( 'IsIndexedRead' ) != 'Y' ) or 1
+    return lanes, tiles, reads
+
+
+def writeFastq( filePath, name, count ):
+    os.makedirs( os.path.dirname( filePath ), exist_ok = True )
+    with gzip.open( filePath, 'wt' ) as fastqHandle:
+        for number in range( count ):
+            fastqHandle.write( f"@{name}:{number}\nACGTACGT\n+\nIIIIIIII\n" )
+
+
+def main( ):
+    program    = os.path.basename( sys.argv[ 0 ] )
+    argv       = sys.argv[ 1: ]
+    bclConvert = program == 'bcl-convert'
+    runFolder  = option( argv, [ '--bcl-input-directory', '--runfolder-dir', '-R' ], os.getcwd( ) )
+    outputDir  = option( argv, [ '--output-directory', '--output-dir', '-o' ], os.path.join( runFolder, 'Data', 'Intensities', 'BaseCalls' ) )
+    sampleSheet = option( argv, [ '--sample-sheet' ], os.path.join( runFolder, 'SampleSheet.csv' ) )
+    if bclConvert:
+        laneSplitting = option( argv, [ '--no-lane-splitting' ], 'false' ) != 'true'
+    else:
+        laneSplitting = '--no-lane-splitting' not in argv
+
+    samples               = readSampleSheet( sampleSheet )
+    lanes, tiles, reads   = readRunInfo( runFolder )
+    tileFilter            = option( argv, [ '--tiles' ] )
+    if tileFilter:
+        tiles = [ ( lane, tile ) for lane, tile in tiles if any( re.match( item, f"s_{lane}_{tile}" ) for item in tileFilter.split( ',' ) ) ]
+
+    print( f"{program} shim: {len( samples )} samples, {len( tiles )} tiles, output in {outputDir}", flush = True )
+    if not bclConvert:
+        print( "BCL to FASTQ file converter\nbcl2fastq v2.20.0.422\nCopyright (c) 2007-2017 Illumina, Inc.\n", file = sys.stderr, flush = True )
+    for lane, tile in tiles:
+        if bclConvert:
+            print( f"Processing tile {tile} of lane {lane}", flush = True )
+            continue
+        laneDir = os.path.join( runFolder, 'Data', 'Intensities', 'BaseCalls', f"L{lane:03d}" )
+        prefix  = f"{datetime.datetime.now( ):%Y-%m-%d %H:%M:%S} [{os.getpid( ):x}]"
+        print( f"{prefix} Opened FILTER file '{laneDir}/s_{lane}_{tile}.filter' for reading", file = sys.stderr, flush = True )
+        print( f"{prefix} Opened BCL file '{laneDir}/C1.1/s_{lane}_{tile}.bcl' for reading", file = sys.stderr, flush = True )
+
+    numbers   = dict( )                                   # one _S number per Sample_ID, in order of first appearance, Undetermined is 0
+    stats     = [ ]
+    for sampleId, sampleName, project, _ in [ ( 'Undetermined', 'Undetermined', '', None ) ] + samples:
+        if sampleId in numbers:                             # listed once per lane
+            continue
+        number    = numbers.setdefault( sampleId, len( numbers ) )
+        fileName  = sampleId if bclConvert else sampleName
+        directory = os.path.join( outputDir, project )
+        if not bclConvert and sampleName != sampleId:       # bcl2fastq puts a sample whose Sample_Name is not its Sample_ID in a Sample_ID directory
+            directory = os.path.join( directory, sampleId )
+        sampleLanes = { row[ 3 ] for row in samples if row[ 0 ] == sampleId and row[ 3 ] } or lanes   # only the lanes the sample is listed in
+        laneNames   = [ f"_L{lane:03d}" for lane in lanes if lane in sampleLanes ] if laneSplitting else [ '' ]
+        for laneName in laneNames:
+            for read in range( 1, reads + 1 ):
+                writeFastq( os.path.join( directory, f"{fileName}_S{number}{laneName}_R{read}_001.fastq.gz" ), sampleId, READS_PER_SAMPLE )
+        if number:
+            stats.append( sampleId )
+
+    if bclConvert:
+        os.makedirs( os.path.join( outputDir, 'Reports' ), exist_ok = True )
+        with open( os.path.join( outputDir, 'Reports', 'Demultiplex_Stats.csv' ), 'w', encoding = 'utf-8', newline = '' ) as statsHandle:
+            writer = csv.writer( statsHandle )
+            writer.writerow( [ 'Lane', 'SampleID', 'Index', '# Reads' ] )
+            for lane in lanes:
+                for sampleId in stats:
+                    writer.writerow( [ lane, sampleId, 'ACGTACGT', READS_PER_SAMPLE ] )
+    else:
+        os.makedirs( os.path.join( outputDir, 'Stats' ), exist_ok = True )
+        results = [ { 'LaneNumber': lane, 'DemuxResults': [ { 'SampleId': sampleId, 'NumberReads': READS_PER_SAMPLE } for sampleId in stats ] } for lane in lanes ]
+        with open( os.path.join( outputDir, 'Stats', 'Stats.json' ), 'w', encoding = 'utf-8' ) as statsHandle:
+            json.dump( { 'RunId': os.path.basename( os.path.normpath( runFolder ) ), 'ConversionResults': results }, statsHandle, indent = 4 )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main( ) )
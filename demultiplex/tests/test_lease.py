@@ -0,0 +1,143 @@
+# tests for demultiplex.lease: when a lease is stale, and who may take it over
+#
+#   python3 -m pytest -q demultiplex/tests
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from demultiplex import lease
+
+
+runId = '220317_M06578_0094_000000000-W'
+
+
+
+def writeLease( leaseDir, host, pid, token = 'someone', age = 0 ):
+    """
+    A lease file for {runId} as another worker would have left it, last touched {age} seconds ago
+    """
+    filePath = os.path.join( leaseDir, runId + lease.leaseSuffix )
+    with open( filePath, 'w', encoding = 'utf-8' ) as leaseFileHandle:
+        json.dump( { 'name': runId, 'host': host, 'pid': pid, 'token': token, 'acquired': time.time( ) - age }, leaseFileHandle )
+    os.utime( filePath, ( time.time( ) - age, time.time( ) - age ) )
+    return filePath
+
+
+def deadPid( ):
+    process = subprocess.Popen( [ sys.executable, '-c', 'pass' ] )
+    process.wait( )
+    return process.pid
+
+
+@pytest.fixture
+def leaseDir( tmp_path ):
+    return str( tmp_path / 'leases' )
+
+
+
+########################################################################
+# acquire( ) and release( )
+########################################################################
+
+def testFreeLease( leaseDir ):
+    first = lease.Lease( leaseDir, runId )
+    assert first.acquire( )
+    assert first.holder( )[ 'token' ] == first.token
+    assert not lease.Lease( leaseDir, runId ).acquire( )                 # held by a live process on this host, and fresh
+    first.release( )
+    assert first.holder( ) is None
+    assert lease.Lease( leaseDir, runId ).acquire( )
+
+
+def testContextManager( leaseDir ):
+    with lease.Lease( leaseDir, runId ):
+        with pytest.raises( BlockingIOError ):
+            with lease.Lease( leaseDir, runId ):
+                pass
+    assert lease.leases( leaseDir ) == [ ]
+
+
+
+########################################################################
+# isStale( ) and takeovers
+########################################################################
+
+def testDeadHolderOnThisHost( leaseDir ):
+    os.makedirs( leaseDir )
+    writeLease( leaseDir, socket.gethostname( ), deadPid( ) )
+    taker = lease.Lease( leaseDir, runId )
+    assert taker.acquire( )
+    assert taker.holder( )[ 'token' ] == taker.token
+    taker.release( )
+
+
+def testLiveHolderOnAnotherHost( leaseDir ):
+    os.makedirs( leaseDir )
+    writeLease( leaseDir, 'another-host', 1, age = 10 )                 # its pid means nothing here, only the heartbeat counts
+    assert not lease.Lease( leaseDir, runId, timeout = 300 ).acquire( )
+
+
+def testHungHolder( leaseDir ):
+    os.makedirs( leaseDir )
+    writeLease( leaseDir, 'another-host', 1, age = 600 )
+    taker = lease.Lease( leaseDir, runId, timeout = 300 )
+    assert taker.acquire( )
+    taker.release( )
+
+
+def testLeaseBeingCreated( leaseDir ):
+    os.makedirs( leaseDir )
+    open( os.path.join( leaseDir, runId + lease.leaseSuffix ), 'w' ).close( )     # created, not written yet
+    assert lease.Lease( leaseDir, runId ).holder( ) == { }
+    assert not lease.Lease( leaseDir, runId ).acquire( )
+
+
+def testTakenOverLeaseIsLost( leaseDir ):
+    holder = lease.Lease( leaseDir, runId, heartbeat = 0.05 )
+    assert holder.acquire( )
+    writeLease( leaseDir, 'another-host', 1, token = 'taker' )          # what a takeover leaves behind
+    deadline = time.monotonic( ) + 5
+    while not holder.lost and time.monotonic( ) < deadline:
+        time.sleep( 0.05 )
+    assert holder.lost
+    holder.release( )
+    assert lease.Lease( leaseDir, runId ).holder( )[ 'token' ] == 'taker'  # not ours any more, so release( ) left it alone
+
+
+
+########################################################################
+# adopt( )
+########################################################################
+
+def testAdopt( leaseDir ):
+    daemon = lease.Lease( leaseDir, runId )
+    assert daemon.acquire( )
+    run = lease.Lease( leaseDir, runId )
+    assert not run.adopt( 'not the token' )
+    assert run.adopt( daemon.token )
+    assert run.holder( )[ 'pid' ] == os.getpid( ) and run.holder( )[ 'token' ] == daemon.token
+    daemon.held = False                                                 # the daemon handed it over, only the run releases it
+    daemon.stopEvent.set( )
+    run.release( )
+    assert run.holder( ) is None
+
+
+
+########################################################################
+# leases( )
+########################################################################
+
+def testLeases( leaseDir ):
+    assert lease.leases( leaseDir ) == [ ]
+    held = lease.Lease( leaseDir, runId )
+    assert held.acquire( )
+    [ ( name, holder, age ) ] = lease.leases( leaseDir )
+    assert ( name, holder[ 'token' ] ) == ( runId, held.token )
+    assert age < 60
+    held.release( )
@@ -0,0 +1,87 @@
+# tests for demultiplex.retention: which runs the retention rules pick for deletion
+#
+#   python3 -m pytest -q demultiplex/tests
+
+import os
+
+import pytest
+
+from demultiplex import retention
+
+
+day = 86400
+now = 1_700_000_000
+
+
+
+def makeRun( directory, name, daysOld, size = 10 ):
+    """
+    {directory}/{name}/file of {size} bytes, everything last modified {daysOld} days before {now}
+    """
+    runDir = directory / name
+    runDir.mkdir( parents = True )
+    ( runDir / 'file' ).write_bytes( b'x' * size )
+    for path in [ runDir / 'file', runDir ]:
+        os.utime( path, ( now - daysOld * day, now - daysOld * day ) )
+    return runDir
+
+
+def candidates( rules, isProtected = lambda runId: False, delivered = None ):
+    found = retention.findCandidates( rules, isProtected, delivered or { }, [ '_demultiplex' ], now )
+    return sorted( ( os.path.basename( candidate.path ), candidate.runId, candidate.kind ) for candidate in found )
+
+
+
+########################################################################
+# findCandidates( )
+########################################################################
+
+def testAge( tmp_path ):
+    makeRun( tmp_path, 'old', 91 )
+    makeRun( tmp_path, 'new', 89 )
+    assert candidates( [ ( str( tmp_path ), retention.AGE, 90 ) ] ) == [ ( 'old', 'old', retention.AGE ) ]
+
+
+def testDelivered( tmp_path ):
+    makeRun( tmp_path, 'RunA_demultiplex', 0 )
+    makeRun( tmp_path, 'RunB_demultiplex', 0 )
+    makeRun( tmp_path, 'RunC_demultiplex', 400 )                        # old, but never delivered
+    delivered = { 'RunA': now - 8 * day, 'RunB': now - 6 * day }
+    assert candidates( [ ( str( tmp_path ), retention.DELIVERED, 7 ) ], delivered = delivered ) == [ ( 'RunA_demultiplex', 'RunA', retention.DELIVERED ) ]
+
+
+def testProtectedRunsStay( tmp_path ):
+    makeRun( tmp_path, 'RunA', 100 )
+    makeRun( tmp_path, 'RunB', 100 )
+    assert candidates( [ ( str( tmp_path ), retention.AGE, 90 ) ], isProtected = lambda runId: runId == 'RunA' ) == [ ( 'RunB', 'RunB', retention.AGE ) ]
+
+
+def testNestedRuleDirectoryAndHiddenEntriesStay( tmp_path ):
+    badRuns = tmp_path / 'bad_runs'
+    badRuns.mkdir( )
+    os.utime( badRuns, ( now - 100 * day, now - 100 * day ) )
+    makeRun( badRuns, 'RunBad', 100 )
+    makeRun( tmp_path, '.hidden', 100 )
+    makeRun( tmp_path, 'RunA', 100 )
+    rules = [ ( str( tmp_path ), retention.AGE, 90 ), ( str( badRuns ), retention.AGE, 30 ) ]
+    assert candidates( rules ) == [ ( 'RunA', 'RunA', retention.AGE ), ( 'RunBad', 'RunBad', retention.AGE ) ]
+
+
+def testSizes( tmp_path ):
+    makeRun( tmp_path, 'RunA', 100, size = 1000 )
+    found = retention.findCandidates( [ ( str( tmp_path ), retention.AGE, 90 ) ], lambda runId: False, { }, [ ], now )
+    assert found[ 0 ].bytes >= 1000
+
+
+def testMissingDirectory( tmp_path ):
+    assert candidates( [ ( str( tmp_path / 'nothing' ), retention.AGE, 1 ) ] ) == [ ]
+
+
+def testUnknownKind( tmp_path ):
+    with pytest.raises( ValueError ):
+        candidates( [ ( str( tmp_path ), 'size', 1 ) ] )
+
+
+def testRunIdOf( ):
+    assert retention.runIdOf( 'RunA_demultiplex', [ '_demultiplex' ] ) == 'RunA'
+    assert retention.runIdOf( 'RunA', [ '_demultiplex', '' ] ) == 'RunA'
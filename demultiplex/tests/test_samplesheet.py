@@ -0,0 +1,129 @@
+# tests for demultiplex.samplesheet: the parser, the _S numbers and the output bcl2fastq is expected to write
+#
+#   python3 -m pytest -q demultiplex/tests
+
+from demultiplex import samplesheet
+
+
+sampleSheetContent = b"""\xef\xbb\xbf[Header]
+IEMFileVersion,4
+Experiment Name,"Run, with a comma"
+[Reads]
+151
+151
+[Settings]
+Adapter,CTGTCTCTTATACACATCT
+[Data]
+Lane,Sample_ID,Sample_Name,Sample_Project,index,index2,Description
+1,s1,s1,ProjA,acgtacgt,TTTTAAAA,"tissue, liver"
+1,"id2",name2 ,ProjA,CCCCGGGG,AAAATTTT,
+2,s3,,ProjB,GGGGCCCC,CCCCAAAA,
+2,s1,s1,ProjA,ACGTACGT,TTTTAAAA,
+,,,,,,
+"""
+
+
+
+def parse( content = sampleSheetContent ):
+    return samplesheet.SampleSheet( 'SampleSheet.csv', content )
+
+
+
+########################################################################
+# parser
+########################################################################
+
+def testSections( ):
+    sampleSheet = parse( )
+    assert sampleSheet.header[ 'IEMFileVersion' ] == '4'
+    assert sampleSheet.header[ 'Experiment Name' ] == 'Run, with a comma'
+    assert sampleSheet.settings == { 'Adapter': 'CTGTCTCTTATACACATCT' }
+    assert sampleSheet.reads == [ 151, 151 ]
+    assert sampleSheet.dataColumns == [ 'Lane', 'Sample_ID', 'Sample_Name', 'Sample_Project', 'index', 'index2', 'Description' ]
+    assert sampleSheet.lines[ sampleSheet.dataHeaderLine ].startswith( 'Lane,Sample_ID' )
+
+
+def testSamples( ):
+    sampleSheet = parse( )
+    assert [ ( sample.lane, sample.sampleId, sample.sampleName, sample.project ) for sample in sampleSheet.samples ] == [
+        ( 1, 's1', 's1', 'ProjA' ), ( 1, 'id2', 'name2', 'ProjA' ), ( 2, 's3', '', 'ProjB' ), ( 2, 's1', 's1', 'ProjA' ) ]
+    first = sampleSheet.samples[ 0 ]
+    assert first.index == 'ACGTACGT'                                    # upper case
+    assert first.fields[ 'Description' ] == 'tissue, liver'             # a quoted comma stays in its field
+    assert first.lineNumber == 11
+    assert sampleSheet.samples[ 1 ].fields[ 'Sample_Name' ] == 'name2 '  # fields keep the stray space, the typed attributes do not
+    assert sampleSheet.emptyDataLines == [ 15 ]
+    assert sampleSheet.projects == [ 'ProjA', 'ProjB' ]
+
+
+def testUndecodableLine( ):
+    sampleSheet = parse( b"[Data]\nSample_ID,Sample_Name,Sample_Project\nsm\xf8rbr\xf8d,,P\n" )
+    assert sampleSheet.undecodableLines == [ 3 ]
+    assert sampleSheet.samples[ 0 ].sampleId == 'smørbrød'
+
+
+def testClean( ):
+    assert samplesheet.clean( ' "s1" ' ) == 's1'
+    assert samplesheet.clean( "'ProjA'" ) == 'ProjA'
+
+
+def testLoadIsCachedOnContent( tmp_path ):
+    filePath = tmp_path / 'SampleSheet.csv'
+    filePath.write_bytes( sampleSheetContent )
+    assert samplesheet.load( str( filePath ) ) is samplesheet.load( str( filePath ) )
+    filePath.write_bytes( sampleSheetContent.replace( b'ProjB', b'ProjC' ) )
+    assert samplesheet.load( str( filePath ) ).projects == [ 'ProjA', 'ProjC' ]
+
+
+
+########################################################################
+# _S numbers
+########################################################################
+
+def testSampleNumbers( ):
+    sampleSheet = parse( )
+    assert [ ( sample.sampleId, sample.number ) for sample in sampleSheet.samples ] == [ ( 's1', 1 ), ( 'id2', 2 ), ( 's3', 3 ), ( 's1', 1 ) ]
+
+
+def testUniqueSamples( ):
+    sampleSheet = parse( )
+    assert sorted( sample.sampleId for sample in sampleSheet.uniqueSamples ) == [ 'id2', 's1', 's3' ]
+    assert { project: sorted( sample.number for sample in samples ) for project, samples in sampleSheet.samplesPerProject.items( ) } == { 'ProjA': [ 1, 2 ], 'ProjB': [ 3 ] }
+
+
+def testFileName( ):
+    sampleSheet = parse( )
+    assert [ sample.fastqPrefix( '230101_M1.' ) for sample in sampleSheet.samples[ :3 ] ] == [ '230101_M1.s1_S1', '230101_M1.name2_S2', '230101_M1.s3_S3' ]
+
+
+
+########################################################################
+# expected output
+########################################################################
+
+def testExpectedOutput( ):
+    expectedOutput = parse( ).expectedOutput( )
+    assert sorted( expectedOutput[ 'ProjA' ] ) == [ 'ProjA/id2/name2_S2_R1_001.fastq.gz', 'ProjA/id2/name2_S2_R2_001.fastq.gz',
+                                                    'ProjA/s1_S1_R1_001.fastq.gz', 'ProjA/s1_S1_R2_001.fastq.gz' ]
+    assert expectedOutput[ 'ProjB' ] == [ 'ProjB/s3_S3_R1_001.fastq.gz', 'ProjB/s3_S3_R2_001.fastq.gz' ]
+
+
+def testExpectedOutputPrefixedPerLane( ):
+    expectedOutput = parse( ).expectedOutput( '230101_M1.', lanes = [ 1, 2 ], readNumbers = [ 1 ] )
+    assert sorted( expectedOutput[ 'ProjA' ] ) == [ '230101_M1.ProjA/230101_M1.id2/230101_M1.name2_S2_L001_R1_001.fastq.gz',
+                                                    '230101_M1.ProjA/230101_M1.s1_S1_L001_R1_001.fastq.gz',
+                                                    '230101_M1.ProjA/230101_M1.s1_S1_L002_R1_001.fastq.gz' ]
+    assert expectedOutput[ 'ProjB' ] == [ '230101_M1.ProjB/230101_M1.s3_S3_L002_R1_001.fastq.gz' ]
+
+
+def testExpectedLaneFiles( ):
+    laneFiles = parse( ).expectedLaneFiles( [ 1, 2 ], readNumbers = [ 1 ] )
+    assert laneFiles[ 'Undetermined_S0_R1_001.fastq.gz' ] == [ 'Undetermined_S0_L001_R1_001.fastq.gz', 'Undetermined_S0_L002_R1_001.fastq.gz' ]
+    assert laneFiles[ 'ProjA/s1_S1_R1_001.fastq.gz' ] == [ 'ProjA/s1_S1_L001_R1_001.fastq.gz', 'ProjA/s1_S1_L002_R1_001.fastq.gz' ]
+    assert laneFiles[ 'ProjA/id2/name2_S2_R1_001.fastq.gz' ] == [ 'ProjA/id2/name2_S2_L001_R1_001.fastq.gz' ]
+    assert len( laneFiles ) == 4
+
+
+def testNoReadsSection( ):
+    expectedOutput = parse( b"[Data]\nSample_ID,Sample_Project\ns1,P\n" ).expectedOutput( )
+    assert expectedOutput == { 'P': [ 'P/s1_S1_R1_001.fastq.gz' ] }
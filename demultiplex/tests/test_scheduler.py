@@ -0,0 +1,80 @@
+# tests for demultiplex.scheduler: the order queued runs are started in
+#
+#   python3 -m pytest -q demultiplex/tests
+
+from demultiplex import scheduler
+
+
+hour = 3600
+now  = 1_700_000_000
+
+
+
+def queuedRun( runId, waited, estimate, priority = 0, instrument = 'M06578' ):
+    return scheduler.QueuedRun( runId, priority, now - waited, instrument, workUnits = 1, estimate = estimate )
+
+
+def order( *queuedRuns, starvationSeconds = 24 * hour ):
+    return [ run.runId for run in scheduler.orderRuns( list( queuedRuns ), now, starvationSeconds ) ]
+
+
+
+########################################################################
+# orderRuns( )
+########################################################################
+
+def testShortRunFirst( ):
+    assert order( queuedRun( 'nextseq', 0, 10 * hour ), queuedRun( 'miseq', 0, hour / 4 ) ) == [ 'miseq', 'nextseq' ]
+
+
+def testWaitingCatchesUp( ):
+    # the MiSeq run is at ( 1/4 + 1/4 ) / 1/4 = 2, the NextSeq run has waited 12 hours for 10: ( 12 + 10 ) / 10 = 2.2
+    assert order( queuedRun( 'miseq', hour / 4, hour / 4 ), queuedRun( 'nextseq', 12 * hour, 10 * hour ) ) == [ 'nextseq', 'miseq' ]
+
+
+def testPriorityFirst( ):
+    assert order( queuedRun( 'miseq', hour, hour / 4 ), queuedRun( 'nextseq', 0, 10 * hour, priority = 1 ) ) == [ 'nextseq', 'miseq' ]
+
+
+def testStarvingAheadOfEveryRunThatIsNot( ):
+    runs = [ queuedRun( 'fresh', 60, 60 ), queuedRun( 'starving', 25 * hour, 100 * hour ), queuedRun( 'older', 30 * hour, 200 * hour ) ]
+    assert order( *runs ) == [ 'older', 'starving', 'fresh' ]            # starving runs go oldest first
+    assert order( *runs, starvationSeconds = 1000 * hour ) == [ 'fresh', 'starving', 'older' ]     # response ratios 2, 1.25, 1.15
+
+
+def testStarvingStillAfterPriority( ):
+    assert order( queuedRun( 'starving', 48 * hour, hour ), queuedRun( 'urgent', 0, hour, priority = 5 ) ) == [ 'urgent', 'starving' ]
+
+
+def testTiesByQueuedThenRunId( ):
+    assert order( queuedRun( 'b', 0, hour ), queuedRun( 'a', 0, hour ) ) == [ 'a', 'b' ]
+
+
+def testWaitedAndStarvingFilledIn( ):
+    run = queuedRun( 'run', 2 * hour, hour )
+    scheduler.orderRuns( [ run ], now, hour )
+    assert ( run.waited, run.starving ) == ( 2 * hour, True )
+    notQueued = scheduler.QueuedRun( 'never', 0, None, 'M06578', 1, hour )
+    scheduler.orderRuns( [ notQueued ], now, hour )
+    assert ( notQueued.waited, notQueued.starving ) == ( 0, False )
+
+
+def testSortKeyZeroEstimate( ):
+    assert queuedRun( 'run', 0, 0 ).sortKey( )                          # no division by zero for a run without an estimate
+
+
+
+########################################################################
+# estimates
+########################################################################
+
+def testWorkUnits( ):
+    assert scheduler.workUnits( 10, 100, 0 ) == 1000
+    assert scheduler.workUnits( 10, 100, scheduler.samplesPerDoubling ) == 2000
+
+
+def testSecondsPerUnit( ):
+    finished = [ ( f"run{number}", 'M06578', 100, 0, 0, 100 * seconds ) for number, seconds in enumerate( [ 1, 2, 3 ] ) ]
+    assert scheduler.secondsPerUnit( finished, 'M06578', 9 ) == 2
+    assert scheduler.secondsPerUnit( finished[ :2 ], 'M06578', 9 ) == 9      # too few runs to go by
+    assert scheduler.secondsPerUnit( finished, 'NB552450', 9 ) == 9
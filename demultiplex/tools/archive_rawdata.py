@@ -0,0 +1,39 @@
+#!/usr/bin/python3.11
+
+import argparse
+import logging
+import os
+import sys
+
+import demultiplex_script
+from demultiplex import rawarchive
+
+# Pack a raw run into compressed, checksummed chunks in /data/archive/{RunID}, the way archiveRunRawData( ) does at the end of every run,
+# for the runs from before it did, or to resume one by hand. Or check an archive against its manifest:
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/archive_rawdata.py <RunID> [--compression gz] [--workers 4]
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/archive_rawdata.py <RunID> --verify
+
+if __name__ == '__main__':
+
+    demux  = demultiplex_script.demux
+    parser = argparse.ArgumentParser( description = "Archive a raw run into chunks, or verify an archive" )
+    parser.add_argument( 'RunID' )
+    parser.add_argument( '--verify',      action = 'store_true', help = "check the chunks against the sizes and sha512s in the manifest" )
+    parser.add_argument( '--compression', choices = list( rawarchive.COMPRESSIONS ), default = demux.archiveCompression )
+    parser.add_argument( '--level',       type = int, default = demux.archiveCompressionLevel )
+    parser.add_argument( '--workers',     type = int, default = demux.archiveWorkers )
+    args = parser.parse_args( )
+
+    RunID           = args.RunID.replace( "/", "" )
+    archiveRunIdDir = os.path.join( demux.archiveDir, RunID )
+
+    if args.verify:
+        problems = rawarchive.verifyArchive( os.path.join( archiveRunIdDir, RunID + rawarchive.manifestSuffix ) )
+        print( '\n'.join( problems ) if problems else f"{archiveRunIdDir}: every chunk matches the manifest" )
+        sys.exit( 1 if problems else 0 )
+
+    logging.basicConfig( level = logging.INFO, format = '%(asctime)s %(message)s' )
+    manifest = rawarchive.archiveRun( os.path.join( demux.rawDataDir, RunID ), archiveRunIdDir, demux.archiveChunkSize, args.compression, args.level, args.workers,
+                                      throttle = lambda: demux.archiveWorkersBusy if demultiplex_script.runningRuns( ) else args.workers, log = logging.info )
+    print( f"{len( manifest[ 'chunks' ] )} chunks in {archiveRunIdDir}" )
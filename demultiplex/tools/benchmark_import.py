@@ -0,0 +1,66 @@
+#!/usr/bin/python3.11
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Measure how long "import demultiplex_script" takes in a fresh interpreter, the way cron_job.py pays for it every 30 minutes,
+# and fail if it is over budget or if it pulled in a module that lazyImport( ) is meant to keep out of the nothing-to-do path:
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/benchmark_import.py [--budget 75] [--runs 9]
+#
+# The bytecode is cached in a throwaway directory first, so what gets measured is the import, not the compilation.
+# Exits 1 on a blown budget, so it can sit in front of a deployment.
+
+heavyModules = [ 'ast', 'pdb', 'numpy', 'subprocess', 'tarfile', 'sqlite3', 'ctypes', 'csv', 'json', 'gzip', 'hashlib', 'pathlib', 'shutil',
+                 'tempfile', 'termcolor', 'argparse', 'concurrent.futures', 'xml.etree.ElementTree', 'dataclasses', 'demultiplex.samplesheet',
+                 'demultiplex.runstate', 'demultiplex.lease', 'demultiplex.daemon', 'demultiplex.scheduler',
+                 'demultiplex.diskspace', 'demultiplex.retention', 'demultiplex.rawarchive', 'lzma', 'demultiplex.delivery', 'demultiplex.vigasp' ]
+
+probe = """
+import sys, demultiplex_script
+print( 'loaded:', ' '.join( name for name in sys.argv[ 1: ] if name in sys.modules ) )
+print( 'resolved:', ' '.join( name for name in [ 'totalTasks', 'fromAddress' ] if not isinstance( demultiplex_script.demux.__dict__[ name ], getattr( demultiplex_script, 'LazyClassAttribute', ( ) ) ) ) )
+"""
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description = "Import-time benchmark for demultiplex_script" )
+    parser.add_argument( '--budget', type = float, default = 75, help = "milliseconds, median of the runs" )
+    parser.add_argument( '--runs',   type = int,   default = 9 )
+    args = parser.parse_args( )
+
+    with tempfile.TemporaryDirectory( prefix = 'benchmark_import.' ) as pycacheDir:
+        environment = { key: value for key, value in os.environ.items( ) if key != 'PYTHONDONTWRITEBYTECODE' }
+        environment[ 'PYTHONPYCACHEPREFIX' ] = pycacheDir
+
+        warmUp = subprocess.run( [ sys.executable, '-c', probe, *heavyModules ], env = environment, capture_output = True, text = True )
+        if warmUp.returncode:
+            sys.exit( f"import demultiplex_script failed:\n{warmUp.stderr}" )
+        report = dict( line.split( ':', 1 ) for line in warmUp.stdout.splitlines( ) if ':' in line )
+
+        timings = [ ]
+        for run in range( args.runs ):
+            result = subprocess.run( [ sys.executable, '-X', 'importtime', '-c', 'import demultiplex_script' ], env = environment, capture_output = True, text = True )
+            match  = re.search( r"^import time:\s+\d+ \|\s+(\d+) \| demultiplex_script$", result.stderr, re.MULTILINE )
+            if not match:
+                sys.exit( f"no import time for demultiplex_script in:\n{result.stderr}" )
+            timings.append( int( match.group( 1 ) ) / 1000 )
+
+    median   = statistics.median( timings )
+    problems = [ ]
+    if median > args.budget:
+        problems.append( f"median {median:.1f} ms is over the {args.budget:.0f} ms budget" )
+    if report.get( 'loaded', '' ).split( ):
+        problems.append( f"imported at import time, should be lazy: {report[ 'loaded' ].strip( )}" )
+    if report.get( 'resolved', '' ).split( ):
+        problems.append( f"worked out at import time, should be lazy: demux.{', demux.'.join( report[ 'resolved' ].split( ) )}" )
+
+    print( f"import demultiplex_script: median {median:.1f} ms, min {min( timings ):.1f} ms, max {max( timings ):.1f} ms over {args.runs} runs, budget {args.budget:.0f} ms" )
+    for problem in problems:
+        print( f"FAIL: {problem}" )
+    sys.exit( 1 if problems else 0 )
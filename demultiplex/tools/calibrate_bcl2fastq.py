@@ -0,0 +1,28 @@
+#!/usr/bin/python3.11
+
+import argparse
+import logging
+import sys
+
+import demultiplex_script
+
+# Find the fastest bcl2fastq --loading-threads/--processing-threads/--writing-threads for this host and
+# record it per instrument type ( MiSeq/NextSeq ) in /data/log/bcl2fastq_calibration.json
+#
+# Run it on an idle host, against a run that is already in /data/rawdata, once per instrument type:
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/calibrate_bcl2fastq.py 241202_M06578_0219_000000000-LT29R
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/calibrate_bcl2fastq.py 241202_M06578_0219_000000000-LT29R --tiles 8
+
+if __name__ == '__main__':
+
+    demux  = demultiplex_script.demux
+    parser = argparse.ArgumentParser( description = "Time bcl2fastq thread settings on a few tiles of a run and record the fastest" )
+    parser.add_argument( 'RunID' )
+    parser.add_argument( '--tiles', type = int, default = demux.calibrationTiles, help = "tiles to demultiplex per setting, default demux.calibrationTiles" )
+    args = parser.parse_args( )
+
+    logging.basicConfig( level = logging.INFO, format = '%(asctime)s %(message)s' )
+    demux.calibrationTiles = args.tiles
+    best = demultiplex_script.calibrateBcl2fastq( args.RunID.replace( "/", "" ) )
+    sys.exit( 0 if best else 1 )
@@ -0,0 +1,33 @@
+#!/usr/bin/python3.11
+
+import argparse
+import sys
+
+import demultiplex_script
+from demultiplex import retention
+
+# Apply the retention rules, demux.retentionRules, by hand: what has been kept long enough in /data/rawdata, /data/rawdata/bad_runs,
+# /data/rawdata/control_runs, /data/demultiplex and /data/for_transfer goes. Every delivered run does the same at its end, see
+# demultiplex_script.cleanupAfterDelivery( ).
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/cleanup.py               # dry run: what would go, and how much it would free
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/cleanup.py --delete
+#
+# Runs in progress are never deleted, see demultiplex_script.applyRetention( ).
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description = "Delete what the retention rules say has been kept long enough" )
+    parser.add_argument( '--delete',  action = 'store_true', help = "delete, instead of only reporting what would be deleted" )
+    parser.add_argument( '--workers', type = int, default = demultiplex_script.demux.retentionWorkers, help = "threads deleting, at the idle I/O priority" )
+    args = parser.parse_args( )
+
+    demultiplex_script.demux.retentionWorkers = args.workers
+    candidates, freed, errors = demultiplex_script.applyRetention( dryRun = not args.delete )
+
+    print( retention.report( candidates, dryRun = not args.delete ) )
+    if args.delete:
+        print( f"{freed / 1024**3:10.1f} GiB  freed" )
+    for path, err in errors:
+        print( f"Could not delete {path}: {err}", file = sys.stderr )
+    sys.exit( 1 if errors else 0 )
@@ -0,0 +1,36 @@
+#!/usr/bin/python3.11
+
+import argparse
+import logging
+import os
+import sys
+
+import demultiplex_script
+from demultiplex import delivery
+
+# Deliver a run to NIRD by hand, the way deliverFilesToNIRD( ) does at the end of every run: to resume one that failed, or to try the
+# whole path offline against a local directory standing in for NIRD:
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/deliver_nird.py <RunID>
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/deliver_nird.py <RunID> --target file:///data/scratch/nird --bandwidth 0
+#
+# What is already at the destination, and matches its .sha512, is not sent again.
+
+if __name__ == '__main__':
+
+    demux  = demultiplex_script.demux
+    parser = argparse.ArgumentParser( description = "Deliver the files of a run to NIRD" )
+    parser.add_argument( 'RunID' )
+    parser.add_argument( '--target',    default = demux.nirdTarget, help = f"where to, one of: {', '.join( scheme + '://' for scheme in delivery.TRANSPORTS )}" )
+    parser.add_argument( '--workers',   type = int, default = demux.nirdWorkers )
+    parser.add_argument( '--bandwidth', type = float, default = demux.nirdBandwidth / 1024**2, help = "MiB/second, 0: no cap" )
+    args = parser.parse_args( )
+
+    logging.basicConfig( level = logging.DEBUG, format = '%(asctime)s %(message)s' )
+    demux.RunID               = args.RunID.replace( "/", "" )
+    demux.forTransferRunIdDir = os.path.join( demux.forTransferDir, demux.RunID )
+    demux.nirdTarget          = args.target
+    demux.nirdWorkers         = args.workers
+    demux.nirdBandwidth       = int( args.bandwidth * 1024**2 )
+    demultiplex_script.deliverFilesToNIRD( )
+    sys.exit( 0 )
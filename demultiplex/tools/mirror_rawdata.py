@@ -0,0 +1,31 @@
+#!/usr/bin/python3.11
+
+import logging
+import sys
+import time
+
+import demultiplex_script
+
+# Mirror the runs that are still sequencing from /data/rawdata to the local scratch volume, demux.scratchDir, every demux.mirrorInterval seconds.
+# Only the files that are new or changed since the last pass are copied, so when RTAComplete.txt appears and the run is picked up,
+# stageToScratch( ) only has to copy the last few cycles.
+#
+# Runs as demultiplex/systemd/demultiplex-mirror.service, or by hand:
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/mirror_rawdata.py [--once]
+
+if __name__ == '__main__':
+
+    if not demultiplex_script.demux.scratchDir:
+        sys.exit( "demux.scratchDir is not set, nothing to mirror to. Exiting." )
+
+    logging.basicConfig( level = logging.INFO, format = '%(asctime)s %(levelname)s %(message)s' )
+
+    while True:
+        try:
+            demultiplex_script.mirrorInProgressRuns( )
+        except OSError as err:                  # the share went away, scratch is full: log it and try again next pass
+            logging.error( f"Mirroring pass failed: {err}" )
+        if '--once' in sys.argv:
+            break
+        time.sleep( demultiplex_script.demux.mirrorInterval )
@@ -0,0 +1,54 @@
+#!/usr/bin/python3.11
+
+import argparse
+import sys
+
+import demultiplex_script
+from demultiplex.samplesheet import archive
+
+# Answer questions about every SampleSheet ever archived, out of the SQLite index archiveSampleSheet( ) keeps in
+# /data/samplesheets/samplesheets.sqlite3, instead of re-reading the .csv files:
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/samplesheet_index.py update [--dir /data/samplesheets]
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/samplesheet_index.py projects [--year 2022]
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/samplesheet_index.py runs SAV-amplicon-MJH
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/samplesheet_index.py sample 'N-2022-%'
+#
+# Run update once to index the sheets archived before the index existed; archiveSampleSheet( ) adds the new ones.
+# runs and sample take SQL LIKE wildcards: % for any number of characters, _ for one.
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description = "Query the index of archived SampleSheets" )
+    parser.add_argument( '--database', default = demultiplex_script.demux.sampleSheetIndexFilePath, help = "the SQLite index" )
+    commands = parser.add_subparsers( dest = 'command', required = True )
+    update   = commands.add_parser( 'update',   help = "index every .csv not indexed yet, or changed since" )
+    update.add_argument( '--dir', default = demultiplex_script.demux.sampleSheetDirPath, help = "directory to walk" )
+    projects = commands.add_parser( 'projects', help = "projects per year, and on how many runs" )
+    projects.add_argument( '--year', type = int )
+    runs     = commands.add_parser( 'runs',     help = "the runs a project was on" )
+    runs.add_argument( 'project' )
+    sample   = commands.add_parser( 'sample',   help = "where a Sample_ID or Sample_Name was sequenced" )
+    sample.add_argument( 'sample' )
+    args = parser.parse_args( )
+
+    connection = archive.openIndex( args.database )
+
+    if args.command == 'update':
+        indexed, removed = archive.updateIndex( connection, args.dir )
+        print( f"{indexed} sheets indexed, {removed} removed" )
+    elif args.command == 'projects':
+        for year, project, runCount in archive.projectsPerYear( connection, args.year ):
+            print( f"{year}\t{project}\t{runCount}" )
+    elif args.command == 'runs':
+        for runId, instrument, runDate, sampleCount in archive.runsPerProject( connection, args.project ):
+            print( f"{runDate}\t{runId}\t{instrument}\t{sampleCount} samples" )
+    elif args.command == 'sample':
+        rows = archive.whereWasSampleSequenced( connection, args.sample )
+        for runId, instrument, runDate, project, sampleId, sampleName, index1, index2, lane in rows:
+            indexes = f"{index1}+{index2}" if index2 else index1
+            print( f"{runDate}\t{runId}\t{instrument}\t{project}\t{sampleId}\t{sampleName}\t{indexes}\t{lane or ''}" )
+        if not rows:
+            sys.exit( f"{args.sample} is not in any indexed SampleSheet" )
+
+    connection.close( )
@@ -0,0 +1,33 @@
+#!/usr/bin/python3.11
+
+import argparse
+import logging
+import os
+import sys
+
+import demultiplex_script
+
+# Upload a run to VIGASP by hand, the way deliverFilesToVIGASP( ) does at the end of every run: to finish one that failed, or to try
+# it all offline against tools/vigasp_standin.py:
+#
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/upload_vigasp.py <RunID>
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/upload_vigasp.py <RunID> --url http://localhost:8000/upload
+#
+# What went through before, and has not changed since, is not uploaded again.
+
+if __name__ == '__main__':
+
+    demux  = demultiplex_script.demux
+    parser = argparse.ArgumentParser( description = "Upload the tars of a run to VIGASP" )
+    parser.add_argument( 'RunID' )
+    parser.add_argument( '--url',     default = demux.vigaspUrl, help = "where to, default demux.vigaspUrl" )
+    parser.add_argument( '--workers', type = int, default = demux.vigaspWorkers )
+    args = parser.parse_args( )
+
+    logging.basicConfig( level = logging.DEBUG, format = '%(asctime)s %(message)s' )
+    demux.RunID               = args.RunID.replace( "/", "" )
+    demux.forTransferRunIdDir = os.path.join( demux.forTransferDir, demux.RunID )
+    demux.vigaspUrl           = args.url
+    demux.vigaspWorkers       = args.workers
+    demultiplex_script.deliverFilesToVIGASP( )
+    sys.exit( 0 )
@@ -0,0 +1,78 @@
+#!/usr/bin/python3.11
+
+import argparse
+import base64
+import hashlib
+import http.server
+import os
+import random
+import urllib.parse
+
+# A stand-in for VIGASP, to try the uploading offline: takes the PUTs deliverFilesToVIGASP( ) sends, checks them against their
+# Content-MD5 and X-Checksum-SHA512 and writes them under a directory. Keeps connections alive like the real one.
+#
+# /usr/bin/python3.11 /data/bin/demultiplex/tools/vigasp_standin.py /data/scratch/vigasp --port 8000 [--fail-rate 0.2]
+# PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/upload_vigasp.py <RunID> --url http://localhost:8000/upload
+#
+# --fail-rate answers that share of the uploads with 503 and Retry-After: 1, to see the retries at work.
+
+
+class StandInHandler( http.server.BaseHTTPRequestHandler ):
+
+    protocol_version = 'HTTP/1.1'                                           # keep-alive
+    rootDir          = '.'
+    failRate         = 0
+
+    def answer( self, status, text ):
+        body = f"{text}\n".encode( )
+        self.send_response( status )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        if status == 503:
+            self.send_header( 'Retry-After', '1' )
+        self.end_headers( )
+        self.wfile.write( body )
+
+    def do_PUT( self ):
+        name   = os.path.normpath( urllib.parse.unquote( urllib.parse.urlsplit( self.path ).path ) ).lstrip( '/' )
+        length = int( self.headers.get( 'Content-Length', 0 ) )
+        md5    = hashlib.md5( )
+        sha512 = hashlib.sha512( )
+        data   = [ ]
+        while length > 0:                                                   # always read the whole body, or the connection is out of step
+            block = self.rfile.read( min( length, 1024 * 1024 ) )
+            if not block:
+                break
+            md5.update( block )
+            sha512.update( block )
+            data.append( block )
+            length = length - len( block )
+
+        if name.startswith( '..' ):
+            return self.answer( 403, f"{name}: outside of the upload directory" )
+        if random.random( ) < self.failRate:
+            return self.answer( 503, "busy, try again" )
+        if self.headers.get( 'Content-MD5' ) and self.headers[ 'Content-MD5' ] != base64.b64encode( md5.digest( ) ).decode( ):
+            return self.answer( 422, f"{name}: Content-MD5 does not match" )
+        if self.headers.get( 'X-Checksum-SHA512' ) and self.headers[ 'X-Checksum-SHA512' ] != sha512.hexdigest( ):
+            return self.answer( 422, f"{name}: X-Checksum-SHA512 does not match" )
+
+        filePath = os.path.join( self.rootDir, name )
+        os.makedirs( os.path.dirname( filePath ), exist_ok = True )
+        with open( filePath, 'wb' ) as fileHandle:
+            fileHandle.writelines( data )
+        self.answer( 201, f"{name}: stored" )
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description = "A local stand-in for the VIGASP upload endpoint" )
+    parser.add_argument( 'directory', help = "where the uploads are written" )
+    parser.add_argument( '--port',      type = int, default = 8000 )
+    parser.add_argument( '--fail-rate', type = float, default = 0, help = "share of uploads answered with 503" )
+    args = parser.parse_args( )
+
+    StandInHandler.rootDir  = args.directory
+    StandInHandler.failRate = args.fail_rate
+    server = http.server.ThreadingHTTPServer( ( 'localhost', args.port ), StandInHandler )
+    print( f"Taking uploads on http://localhost:{args.port}/, into {args.directory}" )
+    server.serve_forever( )
@@ -0,0 +1,274 @@
+# vigasp: upload the project tars of a run to VIGASP over HTTP, several at a time, on kept-alive connections, skipping what is already there
+
+import base64
+import concurrent.futures
+import dataclasses
+import glob
+import http.client
+import os
+import queue
+import random
+import threading
+import time
+import urllib.parse
+
+from demultiplex import rawarchive
+
+
+#########################################################################
+# Every file goes as  PUT {url}/{RunID}/{file name}, with its md5 in Content-MD5 and its sha512 in X-Checksum-SHA512, both taken
+# from the .md5 and .sha512 files calcFileHash( ) wrote next to it, so VIGASP can check what it got. The files are:
+#
+#   {RunID}/{project}.tar, .tar.md5, .tar.sha512          every project tar, and the QC tar, in {forTransferRunIdDir}
+#   {RunID}/{RunID}.vigasp.json                           the uploader file, last: what the run is made of, see buildManifest( )
+#
+# VIGASP starts on a run once its uploader file is there, so the uploader file only goes once every other file went through.
+#
+# The uploads share a ConnectionPool, one HTTP/1.1 connection per upload thread, kept alive from one file to the next: no new
+# TCP and TLS handshake per file. A connection that fails is dropped, and the next request opens a fresh one.
+#
+# Timeouts, dropped connections, 429 and 5xx are tried again after a backoff that doubles every time ( and follows Retry-After
+# when the server sends one ); any other 4xx is not going to get better, and fails the file straight away.
+#
+# What went through is written down in a status file next to the files: the next upload of the same run skips every file that
+# went through and has not changed since.
+#########################################################################
+
+manifestSuffix  = '.vigasp.json'
+blockSize       = 1024 * 1024               # bytes http.client sends at a time
+retryStatuses   = { 408, 429, 500, 502, 503, 504 }
+
+
+
+########################################################################
+# UploadFile
+########################################################################
+
+@dataclasses.dataclass
+class UploadFile:
+    """
+    One file to upload, and how it went
+    """
+
+    localPath:  str
+    name:       str                 # {RunID}/{file name}, appended to the url
+    size:       int
+    md5:        str                 = None
+    sha512:     str                 = None
+    skipped:    bool                = False     # went through on an earlier upload
+    attempts:   int                 = 0
+    error:      str                 = None
+
+
+
+########################################################################
+# readChecksum( )
+########################################################################
+
+def readChecksum( checksumFilePath ):
+    """
+    The checksum in an md5sum/sha512sum format file, None if there is no such file
+    """
+
+    if not os.path.isfile( checksumFilePath ):
+        return None
+    with open( checksumFilePath, encoding = 'utf-8' ) as checksumFileHandle:
+        return checksumFileHandle.read( ).split( ' ' )[ 0 ].strip( )
+
+
+
+########################################################################
+# buildManifest( )
+########################################################################
+
+def buildManifest( runId, forTransferRunIdDir, tarSuffix, md5Suffix, sha512Suffix ):
+    """
+    The uploader file of {runId}: every tar in {forTransferRunIdDir}, with its size and checksums
+
+    Returns ( { 'runId': ..., 'created': ..., 'files': [ { 'name', 'size', 'md5', 'sha512' }, ... ] }, [ UploadFile, ... ] ),
+        the UploadFiles being the tars and their checksum files, in upload order: biggest first, so the long uploads start early
+    """
+
+    manifest = { 'runId': runId, 'created': time.time( ), 'files': [ ] }
+    uploads  = [ ]
+    for tarFilePath in sorted( glob.glob( os.path.join( glob.escape( forTransferRunIdDir ), '*' + tarSuffix ) ) ):
+        md5    = readChecksum( tarFilePath + md5Suffix )
+        sha512 = readChecksum( tarFilePath + sha512Suffix )
+        if not md5 or not sha512:
+            raise ValueError( f"{tarFilePath} has no {md5Suffix} or no {sha512Suffix} file next to it" )
+        size = os.path.getsize( tarFilePath )
+        manifest[ 'files' ].append( { 'name': os.path.basename( tarFilePath ), 'size': size, 'md5': md5, 'sha512': sha512 } )
+        uploads.append( UploadFile( tarFilePath, f"{runId}/{os.path.basename( tarFilePath )}", size, md5, sha512 ) )
+        for suffix in [ md5Suffix, sha512Suffix ]:
+            uploads.append( UploadFile( tarFilePath + suffix, f"{runId}/{os.path.basename( tarFilePath )}{suffix}", os.path.getsize( tarFilePath + suffix ) ) )
+    if not uploads:
+        raise ValueError( f"no {tarSuffix} files in {forTransferRunIdDir}" )
+    uploads.sort( key = lambda upload: -upload.size )
+    return manifest, uploads
+
+
+
+########################################################################
+# ConnectionPool
+########################################################################
+
+class ConnectionPool:
+    """
+    Kept-alive HTTP/1.1 connections to the host of {url}, handed out one per request and put back once the response is read
+    """
+
+    def __init__( self, url, timeout ):
+        url                  = urllib.parse.urlsplit( url )
+        self.connectionClass = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host            = url.netloc
+        self.prefix          = url.path.rstrip( '/' )
+        self.timeout         = timeout
+        self.idle            = queue.LifoQueue( )
+        self.lock            = threading.Lock( )
+        self.opened          = 0                # connections opened so far, for the log
+
+    def request( self, method, path, body = None, headers = None ):
+        """
+        Returns ( status, headers, body ) of the response. Raises OSError or http.client.HTTPException if there was none
+        """
+        try:
+            connection = self.idle.get_nowait( )
+        except queue.Empty:
+            connection = self.connectionClass( self.host, timeout = self.timeout, blocksize = blockSize )
+            with self.lock:
+                self.opened = self.opened + 1
+        try:
+            connection.request( method, self.prefix + path, body = body, headers = headers or { } )
+            response = connection.getresponse( )
+            data     = response.read( )
+        except ( OSError, http.client.HTTPException ):
+            connection.close( )
+            raise
+        if response.will_close:
+            connection.close( )
+        else:
+            self.idle.put( connection )
+        return response.status, response.headers, data
+
+    def close( self ):
+        while not self.idle.empty( ):
+            self.idle.get_nowait( ).close( )
+
+
+
+########################################################################
+# UploadError
+########################################################################
+
+class UploadError( Exception ):
+    """
+    A file that did not go through: the server turned it down, or it failed every attempt
+    """
+
+
+
+########################################################################
+# putFile( )
+########################################################################
+
+def putFile( pool, upload, token, attempts, backoff, log ):
+    """
+    PUT {upload} to the pool's url, trying {attempts} times, sleeping {backoff} seconds before the second, doubling after that
+    """
+
+    headers = { 'Content-Length': str( upload.size ), 'Content-Type': 'application/octet-stream' }
+    if upload.md5:
+        headers[ 'Content-MD5' ] = base64.b64encode( bytes.fromhex( upload.md5 ) ).decode( )
+    if upload.sha512:
+        headers[ 'X-Checksum-SHA512' ] = upload.sha512
+    if token:
+        headers[ 'Authorization' ] = f"Bearer {token}"
+    path = '/' + urllib.parse.quote( upload.name )
+
+    for attempt in range( 1, attempts + 1 ):
+        upload.attempts = attempt
+        retryAfter      = None
+        try:
+            with open( upload.localPath, 'rb' ) as fileHandle:
+                status, responseHeaders, data = pool.request( 'PUT', path, body = fileHandle, headers = headers )
+        except ( OSError, http.client.HTTPException ) as err:
+            problem = f"{type( err ).__name__}: {err}"
+        else:
+            if 200 <= status < 300:
+                return
+            problem = f"HTTP {status} {data[ :200 ].decode( errors = 'replace' ).strip( )}"
+            if status not in retryStatuses:
+                raise UploadError( problem )
+            retryAfter = responseHeaders.get( 'Retry-After' )
+        if attempt == attempts:
+            raise UploadError( f"{problem}, after {attempts} attempts" )
+        delay = float( retryAfter ) if retryAfter and retryAfter.isdigit( ) else backoff * 2 ** ( attempt - 1 ) * random.uniform( 0.75, 1.25 )
+        log( f"{upload.name}: {problem}, trying again in {delay:.0f} seconds ( {attempt}/{attempts} )" )
+        time.sleep( delay )
+
+
+
+########################################################################
+# uploadRun( )
+########################################################################
+
+def uploadRun( runId, manifest, uploads, url, statusFilePath, workers, attempts, backoff, timeout, token = None, log = None ):
+    """
+    Upload {uploads} to {url}, {workers} at a time, then the uploader file {manifest} as {runId}/{runId}.vigasp.json. See the top of this file.
+
+        statusFilePath      where what went through is written down, for the next time
+        token               sent as a Bearer token, if not None
+
+    Returns [ UploadFile, ... ], the uploader file last, error set on the ones that did not go through
+    """
+
+    log      = log or ( lambda text: None )
+    status   = rawarchive.readManifest( statusFilePath ) or dict( )
+    lock     = threading.Lock( )
+    pool     = ConnectionPool( url, timeout )
+
+    def record( upload ):
+        with lock:
+            status[ upload.name ] = { 'size': upload.size, 'mtime': os.stat( upload.localPath ).st_mtime_ns, 'sha512': upload.sha512, 'uploaded': time.time( ), 'attempts': upload.attempts }
+            rawarchive.writeManifest( statusFilePath, status )
+
+    def unchanged( upload ):
+        entry = status.get( upload.name )
+        return entry is not None and entry[ 'size' ] == upload.size and entry[ 'mtime' ] == os.stat( upload.localPath ).st_mtime_ns and entry[ 'sha512' ] == upload.sha512
+
+    for upload in uploads:
+        upload.skipped = unchanged( upload )
+    log( f"{sum( upload.skipped for upload in uploads )} of {len( uploads )} files already uploaded" )
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor( max_workers = workers ) as executor:
+            running = { executor.submit( putFile, pool, upload, token, attempts, backoff, log ): upload for upload in uploads if not upload.skipped }
+            for future in concurrent.futures.as_completed( running ):
+                upload = running[ future ]
+                try:
+                    future.result( )
+                except UploadError as err:
+                    upload.error = str( err )
+                    continue
+                record( upload )
+                log( f"{upload.name}: {upload.size / 1024**2:.0f} MiB uploaded, {upload.attempts} attempt(s)" )
+
+        manifestFilePath = os.path.join( os.path.dirname( statusFilePath ), runId + manifestSuffix )
+        previous         = rawarchive.readManifest( manifestFilePath )
+        if not previous or previous.get( 'files' ) != manifest[ 'files' ]:                     # left alone if the same: it was uploaded already, then
+            rawarchive.writeManifest( manifestFilePath, manifest )
+        manifestUpload = UploadFile( manifestFilePath, f"{runId}/{runId}{manifestSuffix}", os.path.getsize( manifestFilePath ) )
+        manifestUpload.skipped = unchanged( manifestUpload )
+        if any( upload.error for upload in uploads ):
+            manifestUpload.error = "not uploaded: not every file went through"
+        elif not manifestUpload.skipped:
+            try:
+                putFile( pool, manifestUpload, token, attempts, backoff, log )
+            except UploadError as err:
+                manifestUpload.error = str( err )
+            else:
+                record( manifestUpload )
+        log( f"{pool.opened} connections opened for {sum( not upload.skipped for upload in uploads + [ manifestUpload ] )} uploads" )
+    finally:
+        pool.close( )
+    return uploads + [ manifestUpload ]
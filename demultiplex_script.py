@@ -1,30 +1,139 @@
 #!/usr/bin/python3.11
 
-import argparse
-import ast
-import pdb
+import abc
+import atexit
+import collections
+import datetime
+import errno
+import fnmatch
 import glob
-import hashlib
-import inspect
 import grp
+import importlib
+import importlib.util
 import logging
 import logging.handlers
 import os
-import pathlib
 import re
 import resource
-import shutil
-import socket
+import shlex
 import stat
 import string
-import subprocess
+import struct
 import sys
 import syslog
-import tarfile
-import termcolor
+import time
+import types
+import zlib
 
-from concurrent.futures import ProcessPoolExecutor
-from inspect import currentframe, getframeinfo
+
+
+########################################################################
+# LazyModule
+########################################################################
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is used, then imports it and hands the attribute over.
+        importlib.import_module( ) takes the import lock, so threads and processes that reach for the module at the same time
+        all get the complete module, which is not true of importlib.util.LazyLoader on 3.11.
+    """
+
+    def __init__( self, name ):
+        self.__dict__[ 'moduleName' ] = name
+
+    def __getattr__( self, attribute ):
+        value = getattr( importlib.import_module( self.moduleName ), attribute )
+        self.__dict__[ attribute ] = value                  # next time, no __getattr__( )
+        return value
+
+    def __repr__( self ):
+        return f"<lazy module '{self.moduleName}'>"
+
+
+
+########################################################################
+# lazyImport( )
+########################################################################
+
+def lazyImport( name ):
+    """
+    Import {name} the first time one of its attributes is used, not now. Returns None if {name} is not installed.
+
+    cron_job.py imports this module every 30 minutes only to find out there is nothing to do: the modules a run needs
+        ( subprocess, tarfile, NumPy, ... ) cost it nothing until a run actually starts.
+        demultiplex/tools/benchmark_import.py keeps an eye on how long the import takes.
+    """
+
+    if name in sys.modules:
+        return sys.modules[ name ]
+    if importlib.util.find_spec( name ) is None:
+        return None
+    return LazyModule( name )
+
+
+argparse                = lazyImport( 'argparse' )
+csv                     = lazyImport( 'csv' )
+ctypes                  = lazyImport( 'ctypes' )
+hashlib                 = lazyImport( 'hashlib' )
+inspect                 = lazyImport( 'inspect' )
+json                    = lazyImport( 'json' )
+gzip                    = lazyImport( 'gzip' )
+pathlib                 = lazyImport( 'pathlib' )
+shutil                  = lazyImport( 'shutil' )
+socket                  = lazyImport( 'socket' )
+sqlite3                 = lazyImport( 'sqlite3' )
+subprocess              = lazyImport( 'subprocess' )
+tarfile                 = lazyImport( 'tarfile' )
+tempfile                = lazyImport( 'tempfile' )
+termcolor               = lazyImport( 'termcolor' )
+ElementTree             = lazyImport( 'xml.etree.ElementTree' )
+futures                 = lazyImport( 'concurrent.futures' )
+numpy                   = lazyImport( 'numpy' )                  # optional, only prescanIndexes( ) and findIndexCollisions( ) use it
+samplesheet             = lazyImport( 'demultiplex.samplesheet' )
+runstate                = lazyImport( 'demultiplex.runstate' )
+lease                   = lazyImport( 'demultiplex.lease' )
+scheduler               = lazyImport( 'demultiplex.scheduler' )
+diskspace               = lazyImport( 'demultiplex.diskspace' )
+retention               = lazyImport( 'demultiplex.retention' )
+rawarchive              = lazyImport( 'demultiplex.rawarchive' )
+delivery                = lazyImport( 'demultiplex.delivery' )
+vigasp                  = lazyImport( 'demultiplex.vigasp' )
+
+
+
+########################################################################
+# LazyClassAttribute
+########################################################################
+
+class LazyClassAttribute:
+    """
+    A demux attribute worked out the first time it is read, then stored on the class like any other.
+        For values that are slow to get and that the nothing-to-do path of cron_job.py never reads, like the FQDN of the host.
+    """
+
+    def __init__( self, function ):
+        self.function = function
+
+    def __set_name__( self, owner, name ):
+        self.name = name
+
+    def __get__( self, instance, owner ):
+        value = self.function( )
+        setattr( owner, self.name, value )
+        return value
+
+
+
+########################################################################
+# countTasks( )
+########################################################################
+
+def countTasks( ):
+    """
+    Count the functions in this script, for the "n/totalTasks tasks" of the progress lines
+    """
+
+    return sum( isinstance( value, types.FunctionType ) and value.__module__ == __name__ for value in list( globals( ).values( ) ) ) + 2 # + 2 adjust as needed
 
 
 """
@@ -66,8 +175,16 @@ WHY DOES THIS PROGRAM EXIST
     So, essentially, this script is an attempt at automation workflow:
         sequencing -> demultiplexing -> quality checking -> delivering the results of the demultiplexing and the QC to the appropriate places, in the case of NVI, VIGASP and NIRD
 
+WHICH DEMULTIPLEXER
+    bcl2fastq by default, or Illumina's BCL Convert: see getDemultiplexBackend( ) for how to pick one per run, per instrument or for
+    all runs. Both are wrapped in a DemultiplexBackend, which also turns BCL Convert's output into the layout bcl2fastq writes.
+    DEMULTIPLEX_SHIMS=1 swaps the real programs for the stand-ins in demultiplex/tests/shims, for testing without a real run.
+
 WHERE DO PROJECTS GET THEIR NEW {RunIDShort}.{project} NAME?
     In demux.getProjectName( ) . We are building the project names there, might as well put the compliance as well. (This might change)
+    If demux.bcl2fastqWritesFinalNames is set, writePrefixedSampleSheet( ) hands bcl2fastq a SampleSheet that already carries the
+    {RunIDShort}. prefix and bcl2fastq writes the final names itself; renameFilesAndDirectories( ) then has nothing to rename.
+    BCL Convert does not take a '.' in Sample_ID, so checkSampleSheetForMistakes( ) refuses the prefixed sheet with that backend.
 
 WHAT DO THE FASTQ.GZ FILES CONTAIN
     The .fastq.gz contain all the fastq files from the blc2fastq demultiplexing
@@ -185,16 +302,49 @@ class demux:
     demultiplexDir                  = os.path.join( dataRootDirPath, demultiplexDirName )
     forTransferDirName              = 'for_transfer'
     forTransferDir                  = os.path.join( dataRootDirPath, forTransferDirName )
+    archiveDirName                  = 'archive'
+    archiveDir                      = os.path.join( dataRootDirPath, archiveDirName )   # /data/archive/{RunID}/{RunID}.part0000.tar.xz ..., see archiveRunRawData( )
     sampleSheetDirName              = 'samplesheets'
     sampleSheetDirPath              = os.path.join( dataRootDirPath, sampleSheetDirName )
+    sampleSheetIndexFileName        = 'samplesheets.sqlite3'     # SQLite index of every archived SampleSheet, see demultiplex/samplesheet/archive.py
+    sampleSheetIndexFilePath        = os.path.join( sampleSheetDirPath, sampleSheetIndexFileName )
     logDirName                      = "log"
     logDirPath                      = os.path.join( dataRootDirPath, logDirName )
+    calibrationFileName             = 'bcl2fastq_calibration.json'
+    calibrationFilePath             = os.path.join( logDirPath, calibrationFileName )
+    runStateFileName                = 'runstate.sqlite3'        # state of every run in /data/rawdata, see demultiplex/runstate.py
+    runStateFilePath                = os.path.join( logDirPath, runStateFileName )
+    leaseDirName                    = 'leases'                  # one {RunID}.lease per run being worked on, by any worker on any host, see demultiplex/lease.py
+    leaseDirPath                    = os.path.join( logDirPath, leaseDirName )
+    leaseHeartbeat                  = 30                        # seconds between touches of our lease file
+    leaseTimeout                    = 300                       # seconds without a touch before a lease held on another host counts as abandoned
+    runLease                        = None                      # the Lease this process holds on demux.RunID
+    queueStarvationSeconds          = 12 * 60 * 60              # a run queued this long goes ahead of every run that has not waited as long, see demultiplex/scheduler.py
+    secondsPerWorkUnit              = { 'MiSeq': 0.05, 'NextSeq': 0.2, 'unknown': 0.2 }   # until there are finished runs to calibrate on
+    defaultRunSeconds               = 60 * 60                   # estimate for a run whose RunInfo.xml or SampleSheet.csv cannot be read
+    queueMetricsFileName            = 'demultiplex_queue.prom'  # queue length and waits, for node_exporter --collector.textfile.directory
+    queueMetricsFilePath            = os.path.join( logDirPath, queueMetricsFileName )
+    controlSocketPath               = os.path.join( os.environ.get( 'XDG_RUNTIME_DIR', '/tmp' ), 'demultiplex.sock' )   # the daemon listens here, see demultiplex/daemon.py
+    daemonWorkers                   = 1                         # runs the daemon demultiplexes at the same time
+    daemonPollInterval              = 60                        # seconds between the daemon's detectNewRuns( ) passes
     ######################################################
     commonEgid = 'sambagroup'
+    commonGid                       = None                      # numerical gid of commonEgid, looked up once in getCommonGid( )
+    umask                           = 0o002                     # files 664, directories 775 at creation time
+    filePermissions                 = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH                                               # rw-rw-r-- / 664
+    directoryPermissions            = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH  # rwxrwxr-x / 775
+    permissionsWorkers              = 16                        # threads changePermissions( ) uses for chmod/chgrp
     ######################################################
     compressedFastqSuffix           = '.fastq.gz' 
     csvSuffix                       = '.csv'
     demultiplexDirSuffix            = '_demultiplex'
+    shardsDirName                   = 'shards'
+    statsDirName                    = 'Stats'
+    statsFileName                   = 'Stats.json'
+    reportsDirName                  = 'Reports'
+    bclConvertStatsFileName         = 'Demultiplex_Stats.csv'
+    statsIdentifierKeys             = [ 'LaneNumber', 'SampleId', 'ReadNumber', 'IndexSequence', 'Lane', 'Number' ]
+    statsNotSummedKeys              = statsIdentifierKeys + [ 'RunNumber', 'NumCycles' ]
     multiqc_data                    = 'multiqc_data'
     md5Suffix                       = '.md5'
     md5Length                       = 16  # 128 bits
@@ -208,15 +358,26 @@ class demux:
     logSuffix                       = '.log'
     ######################################################
     bcl2fastq_bin                   = f"/usr/local//bin/bcl2fastq"
+    bclconvert_bin                  = f"/usr/local/bin/bcl-convert"
+    demultiplexBackend              = 'bcl2fastq'               # 'bcl2fastq' or 'bcl-convert', see getDemultiplexBackend( )
+    backendPerInstrument            = { }                       # example: { 'NextSeq': 'bcl-convert' }
+    backendPerRun                   = { }                       # example: { '241202_M06578_0219_000000000-LT29R': 'bcl-convert' }
+    backendEnvironmentVariable      = 'DEMULTIPLEX_BACKEND'     # overrides all of the above
+    useShims                        = os.environ.get( 'DEMULTIPLEX_SHIMS' ) == '1' # test mode: run the stand-in scripts in shimDirPath instead of the real demultiplexers
+    shimDirPath                     = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'demultiplex', 'tests', 'shims' )
     fastqc_bin                      = f"/usr/local/bin/fastqc"
     mutliqc_bin                     = f"/usr/local/bin/multiqc"
     python3_bin                     = f"/usr/bin/python3.11" # Switching over to python3.11 for speed gains
+    bcl2fastqWritesFinalNames       = False                     # feed bcl2fastq a {RunIDShort}. prefixed SampleSheet, so it writes the final names and there is nothing to rename. bcl2fastq only
     scriptFilePath                  = __file__
     ######################################################
     rtaCompleteFile                 = 'RTAComplete.txt'
+    runInfoFileName                 = 'RunInfo.xml'
     sampleSheetFileName             = 'SampleSheet.csv'
     testProject                     = 'FOO-blahblah-BAR'
     Sample_Project                  = 'Sample_Project'
+    Sample_ID                       = 'Sample_ID'
+    Sample_Name                     = 'Sample_Name'
     demultiplexCompleteFile         = 'DemultiplexComplete.txt'
     vannControlNegativReport        = 'Negativ'
     forTransferRunIdDirTestName     = 'test_tar'
@@ -226,7 +387,7 @@ class demux:
     decodeScheme                    = "utf-8"
     footarfile                      = f"foo{tarSuffix}"      # class variable shared by all instances
     barzipfile                      = f"zip{zipSuffix}"
-    totalTasks                      = 0
+    totalTasks                      = LazyClassAttribute( countTasks )
     tabSpace                        = 8 
     spacing1                        = 40
     spacing2                        = spacing1 + tabSpace
@@ -253,8 +414,17 @@ class demux:
     projectList                     = [ ]
     newProjectNameList              = [ ]
     newProjectFileList              = [ ]
+    samplesPerProject               = dict( )                   # { project: [ ( sampleNumber, sampleName ), ... ] }, filled in by getProjectName( )
+    sampleIdsByNumber               = dict( )                   # { sampleNumber: Sample_ID }, filled in by getProjectName( )
+    laneFileNameRegex               = re.compile( r"^(.+_S\d+)_L(\d{3})_([RI]\d_001\.fastq\.gz)$" ) # lane split bcl2fastq output: {sampleName}_S{sampleNumber}_L00{lane}_R{read}_001.fastq.gz
+    ######################################################
+    renameat2                       = None                      # libc renameat2( ), looked up once in renameNoReplace( )
+    AT_FDCWD                        = -100
+    RENAME_NOREPLACE                = 1
     controlProjectsFoundList        = [ ]
     tarFilesToTransferList          = [ ]
+    originalNames                   = dict( )                   # { prefixed name: original SampleSheet name }, filled in by writePrefixedSampleSheet( )
+    runInfo                         = dict( )                   # parsed RunInfo.xml, filled in by getRunInfo( )
     globalDictionary                = dict( )
     ######################################################
     controlProjects                 = [ "Negativ" ]
@@ -266,12 +436,22 @@ class demux:
     demultiplexLogDirName           = 'demultiplex_log'
     scriptRunLogFileName            = '00_script.log'
     bcl2FastqLogFileName            = '01_demultiplex.log'
+    renameJournalFileName           = 'renames.journal'
+    prefixedSampleSheetFileName     = 'SampleSheet.prefixed.csv'
+    originalNamesFileName           = 'originalNames.tsv'
+    statusFileName                  = 'status.json'
+    readCountsFileName              = 'readCounts.tsv'
     fastqcLogFileName               = '02_fastqcLogFile.log'
     multiqcLogFileName              = '03_multiqcLogFile.log'
     loggingLevel                    = logging.DEBUG
     ######################################################
     demuxCumulativeLogFilePath      = ""
     bcl2FastqLogFile                = ""
+    renameJournalFilePath           = ""
+    prefixedSampleSheetFilePath     = ""
+    originalNamesFilePath           = ""
+    statusFilePath                  = ""
+    readCountsFilePath              = ""
     fastQCLogFilePath               = ""
     logFilePath                     = ""
     multiQCLogFilePath              = ""
@@ -280,7 +460,7 @@ class demux:
     ######################################################
     # mailhost                        = 'seqtech00.vetinst.no'
     mailhost                        = 'localhost'
-    fromAddress                     = f"demultiplex@{ socket.getfqdn( ) }"
+    fromAddress                     = LazyClassAttribute( lambda: f"demultiplex@{ socket.getfqdn( ) }" )   # getfqdn( ) is a DNS lookup, do it only when the email handlers are set up
     toAddress                       = 'gmarselis@localhost'
     subjectFailure                  = 'Demultiplexing has failed'
     subjectSuccess                  = 'Demultiplexing has finished successfuly'
@@ -288,11 +468,92 @@ class demux:
     httpsHandlerHost                = 'veterinaerinstituttet307.workplace.com'
     httpsHandlerUrl                 = 'https://veterinaerinstituttet307.workplace.com/chat/t/4997584600311554'
     ######################################################
-    threadsToUse                    = 12                        # the amount of threads FastQC and other programs can utilize
+    threadsToUse                    = 12                        # the most threads FastQC and other programs can utilize, capped by the cpus we have, see fastQC( )
+    slotsGranted                    = None                      # cpus the scheduler granted this run. None: all cpus in our affinity mask
+    slotsEnvironmentVariable        = 'DEMULTIPLEX_SLOTS'       # or set the granted cpus from the environment
+    pinToNumaNode                   = False                     # pin bcl2fastq to the cpus of a single NUMA node
+    minimumPinnedCpus               = 8                         # do not pin to a NUMA node with less cpus than this
+    numaNodeCpulistGlob             = '/sys/devices/system/node/node[0-9]*/cpulist'
+    maximumLoadingThreads           = 4                         # Illumina's recommendation for bcl2fastq --loading-threads
+    maximumWritingThreads           = 4                         # Illumina's recommendation for bcl2fastq --writing-threads
+    calibrationTiles                = 4                         # tiles calibrateBcl2fastq( ) demultiplexes per setting
+    laneSplitting                   = False                     # let bcl2fastq write one file per lane and merge them in mergeLaneFiles( )
+    bcl2fastqShards                 = 1                         # more than 1: split the run by tiles and run that many bcl2fastq in parallel, see demultiplexSharded( )
+    shardHosts                      = [ ]                       # hosts, mounting /data at the same path, to ssh the shards to. Empty: run the shards locally
+    mergeWorkers                    = 8                         # threads concatenating shard outputs
+    copyBufferSize                  = 16 * 1024 * 1024          # bytes, when copy_file_range( ) is not available
+    scratchDir                      = None                      # example: '/scratch/demultiplex' on local NVMe. None: do all the work on /data
+    scratchRawData                  = True                      # copy the raw run to scratch as well, so bcl2fastq does not read the BCL files off the array
+    scratchRawDataIgnore            = [ 'Thumbnail_Images' ]    # not needed for demultiplexing
+    scratchOutputFactor             = 1.5                       # expected size of the demultiplexed output and QC, as a multiple of the raw run size
+    scratchReserve                  = 20 * 1024**3              # bytes to leave free on scratch
+    scratchCleanup                  = True                      # delete the scratch copies once the results are safely back on /data
+    stagingWorkers                  = 8
+    preflightCheck                  = True                      # checkRawDataIntegrity( ) before creating anything under demultiplexDir
+    preflightCrc                    = False                     # also decompress every .bcl.gz/.bcl.bgzf to check its CRC. Takes minutes, not seconds, on a NextSeq run: turn on by hand for a run you suspect
+    preflightWorkers                = 32
+    preflightMinimumSizeFraction    = 0.5                       # a compressed BCL file under half the median size of its tile's other cycles is taken for truncated
+    preflightReportLines            = 50
+    diskSpaceCheck                  = True                      # hold runs that would not fit on disk, see demultiplex/diskspace.py
+    diskSpaceReserve                = 100 * 1024**3             # bytes to leave free on /data, on top of what the runs need
+    diskSpaceRecheck                = 300                       # seconds the daemon waits before it looks again at a run held for space
+    diskStageFactors                = { 'demultiplex':          ( 1.2, 0 ),                 # ( bytes per byte of BaseCalls, bytes per sample ), until there are
+                                        'qualityCheck':         ( 0.0, 8 * 1024**2 ),       #     enough finished runs to calibrate on
+                                        'prepareDelivery':      ( 1.2, 8 * 1024**2 ),
+                                        'tarFileQualityCheck':  ( 1.2, 8 * 1024**2 ),
+                                        'archive':              ( 1.0, 0 ) }                # BCL files hardly compress any further
+    testTarSize                     = 0                         # bytes tarFileQualityCheck( ) extracted, for recordDiskUsage( )
+    retentionRules                  = [ ( os.path.join( rawDataDir, 'bad_runs' ),     'age',       90 ),    # ( directory, 'age' or 'delivered', days ), see demultiplex/retention.py
+                                        ( os.path.join( rawDataDir, 'control_runs' ), 'age',       90 ),
+                                        ( rawDataDir,                                 'delivered', 30 ),
+                                        ( demultiplexDir,                             'delivered', 180 ),
+                                        ( forTransferDir,                             'delivered', 7 ),
+                                        ( archiveDir,                                 'delivered', 7 ) ]     # NIRD has it by then
+    retentionWorkers                = 8                         # threads deleting, at the idle I/O priority
+    retentionAfterDelivery          = True                      # apply the retention rules once a run is delivered, see cleanupAfterDelivery( )
+    archiveRawData                  = True                      # pack the raw run into chunks for NIRD before delivering, see demultiplex/rawarchive.py
+    archiveChunkSize                = 4 * 1024**3               # bytes of raw data per chunk, before compression
+    archiveCompression              = 'xz'                      # 'xz' ( lzma ) or 'gz'
+    archiveCompressionLevel         = 3                         # xz -3 packs BCL files nearly as well as -6, in a third of the time
+    archiveWorkers                  = 8                         # chunks packed at the same time
+    archiveWorkersBusy              = 2                         # ... while another run is being demultiplexed
+    nirdTarget                      = 'ssh://login.nird.sigma2.no/projects/NS9305K/SEQ-TECH/data_delivery'  # file:///some/dir to deliver to a local directory instead, see demultiplex/delivery.py
+    nirdRawDataDirName              = 'rawdata'                 # the raw run chunks go in {nirdTarget}/{RunID}/rawdata
+    nirdWorkers                     = 8                         # ranges sent at the same time
+    nirdRangeSize                   = 512 * 1024**2             # bytes: the tars are sent in ranges of this, in parallel
+    nirdBandwidth                   = 100 * 1024**2             # bytes/second, all the ranges together. 0: no cap
+    nirdAttempts                    = 3                         # tries per range before the file counts as failed
+    nirdJournalFileName             = '.nird_delivery.json'     # in {forTransferRunIdDir}: the ranges sent so far, an interrupted delivery resumes from it
+    vigaspUrl                       = ''                        # https://host/path the tars are PUT under, as {RunID}/{file}, see demultiplex/vigasp.py. Empty: no uploading to VIGASP
+    vigaspTokenFilePath             = os.path.expanduser( '~/.vigasp_token' )   # the Bearer token, if the file exists
+    vigaspWorkers                   = 4                         # files uploaded at the same time, each on its own kept-alive connection
+    vigaspAttempts                  = 5                         # tries per file
+    vigaspBackoff                   = 10                        # seconds before the second try, doubling after that
+    vigaspTimeout                   = 300                       # seconds without a byte moving before a connection counts as dead
+    vigaspStatusFileName            = '.vigasp_upload.json'     # in {forTransferRunIdDir}: what went through, skipped the next time
+    prescanIndexReads               = True                      # prescanIndexes( ) before demultiplex( ), needs NumPy
+    prescanTiles                    = 4
+    prescanClustersPerTile          = 200000
+    prescanTopUnmatched             = 10
+    prescanMinimumSampleShare       = 0.001                     # warn about samples getting less than this share of the reads
+    prescanOrientationMargin        = 0.2                       # warn if another index orientation matches this much more of the reads
+    prescanFailBelow                = None                      # example: 0.5, stop the run if less than half the reads match a sample
+    barcodeMismatches               = 1                         # bcl2fastq's --barcode-mismatches default
+    dataSectionName                 = '[Data]'
+    analysisColumn                  = 'Analysis'
+    complementTable                 = str.maketrans( 'ACGTN', 'TGCAN' )
+    prescanFileName                 = 'index_prescan.json'
+    prescanFilePath                 = ''
+    mirrorSettleSeconds             = 120                       # files younger than this may still be written by the sequencer, mirrorInProgressRuns( ) leaves them for the next pass
+    mirrorInterval                  = 300                       # seconds between passes of demultiplex/tools/mirror_rawdata.py
+    stagingSuffix                   = '.staging'                # copies in flight, renamed into place once verified
+    stagedPaths                     = dict( )                   # the /data paths stageToScratch( ) swapped out, put back by unstageFromScratch( )
+    progressInterval                = 60                        # seconds between bcl2fastq progress reports
+    bcl2fastqTailLines              = 50                        # lines of bcl2fastq output to put in the failure report
+    bcl2fastqFileTileRegex          = re.compile( r"[/'\s]s_(\d+)_(\d+)\.(?:bcl|filter|locs|clocs)\b" )   # bcl2fastq logs every per-tile file it opens: Opened FILTER file '.../L001/s_1_1101.filter' for reading
+    bcl2fastqTileRegex              = re.compile( r"lane\s*#?(\d+)\D{0,10}?tile\s*#?(\d+)", re.IGNORECASE )
+    tileLaneRegex                   = re.compile( r"tile\s*#?(\d+)\D{0,10}?lane\s*#?(\d+)", re.IGNORECASE )   # bcl-convert puts the tile first
     ######################################################
-    with open( __file__ ) as f:     # little trick from openstack: read the current script and count the functions and initialize totalTasks to it
-        tree = ast.parse( f.read( ) )
-        totalTasks = sum( isinstance( exp, ast.FunctionDef ) for exp in tree.body ) + 2 # + 2 adjust as needed
     n = 0 # counter for keeping track of the number of the current task
 
 
@@ -322,14 +583,10 @@ class demux:
             List of included Sample Projects. 
                 Example of returned projectList:     {'SAV-amplicon-MJH'}
 
-        Parsing is simple:
-            go line-by-line
-            ignore all the we do not need until
-                we hit the line that contains 'Sample_Project'
-                if 'Sample_Project' found
-                    split the line and 
-                        save the value of 'Sample_Project'
-            return an set of the values of all values of 'Sample_Project' and 'Analysis'
+        Parsing is done by demultiplex.samplesheet:
+            the [Data] section is read with the csv module, quotes and stray spaces stripped off every value
+            the values of 'Sample_Project', in order of first appearance, are the projects
+            the parsed sheet is cached on its sha256, so the later stages do not parse it again
 
         # DO NOT change Sample_Project to sampleProject. The relevant heading column in the .csv is litereally named 'Sample_Project'
         """
@@ -340,81 +597,37 @@ class demux:
         else:
             print( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Get project name from {demux.sampleSheetFilePath} started ==\n", color="green", attrs=["bold"] ) )
 
-        projectLineCheck            = False
-        projectIndex                = 0
-        sampleSheetContents         = [ ]
         projectList                 = [ ]
         newProjectNameList          = [ ]
         controlProjectsFoundList    = [ ]
         tarFilesToTransferList      = [ ]
         loggerName                  = 'demuxLogger'
 
-        sampleSheetFileHandle = open( demux.sampleSheetFilePath, 'r', encoding= demux.decodeScheme )
-        sampleSheetContent    = sampleSheetFileHandle.read( )     # read the contents of the SampleSheet here
+        sampleSheet = getSampleSheet( )     # parsed once, every later stage gets the same object back
 
         if demux.verbosity == 3:
+            sampleSheetContent = '\n'.join( sampleSheet.lines )
             if loggerName in logging.Logger.manager.loggerDict.keys():
                 demuxLogger.debug( f"sampleSheetContent:\n{sampleSheetContent }" ) # logging.debug it
             else:
                 print( f"sampleSheetContent:\n{sampleSheetContent }" )
 
-#---------- Parse the contets of SampleSheet.csv ----------------------
-
-        sampleSheetContents   = sampleSheetContent.split( '\n' )  # then split it in lines
-        for line in sampleSheetContents:
-
-            # When you edit files in CSV format, some software saves the values surrounded by quotes
-            # and some do not. So, precautionary strip single and double quotes
-            # 
-            line = line.replace( '\'', '' )
-            line = line.replace( "\"", '' )
-            # Remove norwegian chars and other signs
-            line = line.replace('Â ', ' ').replace('ã€€', ' ')
-            # remove any &nbsp
-            line = line.replace('\u00A0', ' ')
+#---------- Collect the projects out of the parsed SampleSheet.csv ----------------------
 
-            if demux.verbosity == 3:
-                text = f"procesing line '{line}'"
+        # samplesheet.clean( ) already stripped the quotes, non-breaking spaces and trailing spaces spreadsheet programs leave behind
+        for item in sampleSheet.projects:
+            if demux.verbosity == 2:
+                text = f"{'item:':{demux.spacing1}}{item}"
                 if loggerName in logging.Logger.manager.loggerDict.keys():
                     demuxLogger.debug( text )
                 else:
                     print( text )
 
-            if any( line ): # line != '' is not the same as 'not line'
-                line = line.rstrip()
-                if demux.verbosity == 3:
-                    text = f"projectIndex: {projectIndex}" 
-                    if loggerName in logging.Logger.manager.loggerDict.keys():
-                        demuxLogger.debug( text )
-                    else:
-                        print( text )
-                item = line.split(',')[projectIndex]
-            else:
-                continue
+            projectList.append( item )                                 # + '.' + line.split(',')[analysis_index]) # this is the part where .x shows up. Removed.
+            newProjectNameList.append( f"{demux.RunIDShort}.{item}" )  #  since we are here, we might construct the new name list.
 
-            if projectLineCheck == True and item not in projectList:
-                if demux.verbosity == 2:
-                    text = f"{'item:':{demux.spacing1}}{item}"
-                    if loggerName in logging.Logger.manager.loggerDict.keys():
-                        demuxLogger.debug( text )
-                    else:
-                        print( text )
-                    
-                projectList.append( item )                                 # + '.' + line.split(',')[analysis_index]) # this is the part where .x shows up. Removed.
-                newProjectNameList.append( f"{demux.RunIDShort}.{item}" )  #  since we are here, we might construct the new name list.
-
-            elif demux.Sample_Project in line: ### DO NOT change Sample_Project to sampleProject. The relevant heading column in the .csv is litereally named 'Sample_Project'
-
-                projectIndex     = line.split(',').index( demux.Sample_Project ) # DO NOT change Sample_Project to sampleProject. The relevant heading column in the .csv is litereally named 'Sample_Project'
-                if demux.verbosity == 2:
-                    text = f"{'projectIndex:':{demux.spacing1}}{projectIndex}"
-                    if loggerName in logging.Logger.manager.loggerDict.keys():
-                        demuxLogger.debug( text )
-                    else:
-                        print( text )
-                projectLineCheck = True
-            else:
-                continue
+        # collect the samples of each project, the demultiplexer backends and the sizing estimates use them
+        samplesPerProject = { project: [ ( sample.number, sample.fileName ) for sample in samples ] for project, samples in sampleSheet.samplesPerProject.items( ) }
 
         text = "\n"
         if loggerName in logging.Logger.manager.loggerDict.keys():
@@ -436,7 +649,7 @@ class demux:
 #---------- Let's make sure that demux.projectList and demux.newProjectNameList are not empty ----------------------
 
         if not any( projectList ):
-            text = f"line {getframeinfo( currentframe( ) ).lineno} demux.projectList is empty! Exiting!"
+            text = f"line {inspect.getframeinfo( inspect.currentframe( ) ).lineno} demux.projectList is empty! Exiting!"
             if loggerName in logging.Logger.manager.loggerDict.keys():
                 demuxFailureLogger.critical( text  )
                 demuxLogger.critical( text )
@@ -445,7 +658,7 @@ class demux:
                 print( text )
             sys.exit( )
         elif not any( newProjectNameList ):
-            text = f"line {getframeinfo( currentframe( ) ).lineno}: demux.newProjectNameList is empty! Exiting!"
+            text = f"line {inspect.getframeinfo( inspect.currentframe( ) ).lineno}: demux.newProjectNameList is empty! Exiting!"
             if loggerName in logging.Logger.manager.loggerDict.keys():
                 demuxFailureLogger.critical( text  )
                 demuxLogger.critical( text )
@@ -466,6 +679,8 @@ class demux:
         demux.newProjectNameList        = newProjectNameList
         demux.controlProjectsFoundList  = controlProjectsFoundList
         demux.tarFilesToTransferList    = tarFilesToTransferList
+        demux.samplesPerProject         = samplesPerProject
+        demux.sampleIdsByNumber         = { sample.number: sample.sampleId for sample in sampleSheet.uniqueSamples }
 
         text = termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Get project name from {demux.sampleSheetFilePath} finished ==\n", color="red", attrs=["bold"] )
         if loggerName in logging.Logger.manager.loggerDict.keys():
@@ -551,11 +766,102 @@ class demux:
             4.       Forget to put ekstra column called “Analysis” and set an “x” in that column for all samples (I don’t know if we will keep this feature for the future)
             5.       . in sample names
 
-        point any mistakes out to log
+        on top of those
+            6.       the same Sample_ID twice, an index with something other than ACGT in it, indexes of different lengths in the same lane
+            7.       index collisions: two samples in the same lane whose indexes are so close that bcl2fastq, allowing demux.barcodeMismatches
+                         mismatches per index, cannot tell them apart. bcl2fastq only finds out after setup, we find out here.
+                         findIndexCollisions( ) uses NumPy if it is installed.
+            8.       demux.bcl2fastqWritesFinalNames with BCL Convert: the {RunIDShort}. prefix puts a '.' in every Sample_ID, see 5., and
+                         BCL Convert turns those down. Refused here, not after setup.
+
+        The sheet is parsed once, by getSampleSheet( ); point any mistakes out to log, and exit if there are any, before anything gets created under demux.demultiplexDir
         """
         demux.n = demux.n + 1
         demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Check SampleSheet.csv for common human mistakes started ==\n", color="green", attrs=["bold"] ) )
 
+        backendName = getDemultiplexBackend( ).name
+        if demux.bcl2fastqWritesFinalNames and backendName != Bcl2fastqBackend.name:                       # 8.
+            text = [    f"demux.bcl2fastqWritesFinalNames is set, but {RunID} is demultiplexed with {backendName}:",
+                        f"the {demux.RunIDShort}. prefixed Sample_IDs of writePrefixedSampleSheet( ) have a '.' in them, which {backendName} does not accept.",
+                        f"Turn demux.bcl2fastqWritesFinalNames off, or demultiplex {RunID} with {Bcl2fastqBackend.name}. Exiting."
+                     ]
+            text = '\n'.join( text )
+            demuxFailureLogger.critical( text )
+            demuxLogger.critical( text )
+            logging.shutdown( )
+            sys.exit( )
+
+        mistakes    = [ ]
+        warnings    = [ ]
+        sampleSheet = getSampleSheet( )
+
+        for lineNumber in sampleSheet.undecodableLines:                                                     # 2. Æ, Ø, Å saved as Latin-1 by Excel
+            mistakes.append( f"line {lineNumber}: not {demux.decodeScheme}, saved as Latin-1 by Excel? {sampleSheet.lines[ lineNumber - 1 ].strip( )}" )
+
+        if sampleSheet.dataHeaderLine < 0:
+            mistakes.append( f"no {demux.dataSectionName} section" )
+        for lineNumber in sampleSheet.emptyDataLines:                                                       # 3. rows of nothing but commas
+            mistakes.append( f"line {lineNumber}: empty row of commas in the {demux.dataSectionName} section, delete it" )
+
+        samples = sampleSheet.samples
+        if samples and demux.analysisColumn not in sampleSheet.dataColumns:                                 # 4.
+            mistakes.append( f"no {demux.analysisColumn} column" )
+        elif samples and any( samplesheet.clean( sample.fields.get( demux.analysisColumn, '' ) ).lower( ) != 'x' for sample in samples ):
+            warnings.append( f"{demux.analysisColumn} is not 'x' for every sample" )
+
+        seen = set( )                                                                                       # ( Sample_ID, Lane ) pairs
+        for sample in samples:
+            sampleId = sample.sampleId
+            for column in [ demux.Sample_ID, demux.Sample_Name, demux.Sample_Project ]:
+                value = sample.fields.get( column, '' ).replace( '\'', '' ).replace( '"', '' )             # quotes are harmless, spaces are not
+                if ' ' in value or '\u00A0' in value:                                                      # 1.
+                    mistakes.append( f"{sampleId}: space in {column} '{value}'" )
+                if any( ord( character ) > 127 for character in value ):                                    # 2.
+                    mistakes.append( f"{sampleId}: non-ASCII character in {column} '{value}'" )
+                if column != demux.Sample_Project and '.' in value:                                         # 5.
+                    mistakes.append( f"{sampleId}: '.' in {column} '{value}'" )
+            if not sampleId:
+                mistakes.append( f"line {sample.lineNumber}: sample without a {demux.Sample_ID}: {','.join( sample.fields.values( ) )}" )
+            elif ( sampleId, sample.lane ) in seen:                                                          # 6.
+                mistakes.append( f"{sampleId}: {demux.Sample_ID} appears more than once" )
+            seen.add( ( sampleId, sample.lane ) )
+            for column, index in [ ( 'index', sample.index ), ( 'index2', sample.index2 ) ]:
+                if set( index ) - set( 'ACGTN' ):
+                    mistakes.append( f"{sampleId}: {column} '{index}' has something other than ACGTN in it" )
+
+        lanes = collections.defaultdict( list )                                                             # 7. collisions are per lane
+        for sample in samples:
+            if sample.sampleId and sample.index:
+                lanes[ sample.lane ].append( sample )
+        for lane, laneSamples in lanes.items( ):
+            laneText   = f"lane {lane}: " if lane else ''
+            indexReads = [ [ sample.index for sample in laneSamples ], [ sample.index2 for sample in laneSamples ] ]
+            indexReads = [ indexes for indexes in indexReads if any( indexes ) ]
+            lengths    = [ sorted( set( len( index ) for index in indexes ) ) for indexes in indexReads ]
+            if any( len( length ) > 1 for length in lengths ):
+                mistakes.append( f"{laneText}indexes of different lengths in the same index read: {lengths}" )
+                continue
+            for first, second in findIndexCollisions( indexReads, demux.barcodeMismatches ):
+                pair = [ f"{sample.sampleId} ({sample.index}{'+' + sample.index2 if sample.index2 else ''})" for sample in ( laneSamples[ first ], laneSamples[ second ] ) ]
+                mistakes.append( f"{laneText}index collision between {pair[ 0 ]} and {pair[ 1 ]} with --barcode-mismatches {demux.barcodeMismatches}" )
+
+        for warning in warnings:
+            demuxLogger.warning( f"{demux.sampleSheetFileName}: {warning}" )
+
+        if mistakes:
+            shown = mistakes[ :demux.preflightReportLines ]
+            if len( mistakes ) > len( shown ):
+                shown.append( f"... and {len( mistakes ) - len( shown )} more" )
+            text = [    f"{demux.sampleSheetFilePath} has mistakes, fix them and run again:",
+                        *shown,
+                        f"Exiting."
+                     ]
+            text = '\n'.join( text )
+            demuxFailureLogger.critical( text )
+            demuxLogger.critical( text )
+            logging.shutdown( )
+            sys.exit( )
+
         demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Check SampleSheet.csv for common human mistakes finished ==\n", color="red", attrs=["bold"] ) )
 
 
@@ -647,6 +953,10 @@ def createDemultiplexDirectoryStructure(  ):
         os.chmod( demux.demultiplexLogDirPath,          stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH ) # rwxrwxr-x / 775 / read-write-execute owner, read-write-execute group, read-execute others 
         os.chmod( demux.demuxQCDirectoryFullPath,       stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH ) # rwxrwxr-x / 775 / read-write-execute owner, read-write-execute group, read-execute others 
 
+        setCommonGroup( demux.demultiplexRunIdDir )    # everything created under the run directory inherits sambagroup
+        setCommonGroup( demux.demultiplexLogDirPath )
+        setCommonGroup( demux.demuxQCDirectoryFullPath )
+
     except FileExistsError as err:
         demuxFailureLogger.critical( f"File already exists! Exiting!\n{err}" )
         demuxLogger.critical( f"File already exists! Exiting!\n{err}" )
@@ -688,6 +998,7 @@ def prepareForTransferDirectoryStructure( ):
     try:
         os.mkdir( demux.forTransferRunIdDir )       # try to create the demux.forTransferRunIdDir directory ( /data/for_transfer/220603_M06578_0105_000000000-KB7MY )
         os.chmod( demux.forTransferRunIdDir, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH ) # rwxrwxr-x / 775 / read-write-execute owner, read-write-execute group, read-execute others 
+        setCommonGroup( demux.forTransferRunIdDir )     # tar and checksum files inherit sambagroup
     except Exception as err:
         text = f"{demux.forTransferRunIdDir} cannot be created: { str( err ) }\nExiting!"
         demuxFailureLogger.critical( f"{ text }" )
@@ -700,335 +1011,2368 @@ def prepareForTransferDirectoryStructure( ):
 
 
 ########################################################################
-# demultiplex
+# getRunInfo( )
 ########################################################################
 
-def demultiplex( ):
+def getRunInfo( ):
+    """
+    Parse {demux.rawDataRunIDdir}/RunInfo.xml once and cache the result in demux.runInfo, see parseRunInfo( )
     """
-    Use Illumina's blc2fastq linux command-line tool to demultiplex each lane into an appropriate fastq file
 
-    bcl2fastq is available here https://emea.support.illumina.com/sequencing/sequencing_software/bcl2fastq-conversion-software/downloads.html
-        and you will have to have an account with Illumina to download it.
-        Account is setup automatically, but needs manual approval from representative in Illumina, which means you need a contract with Illumina
-        in order to access the software.
+    if not demux.runInfo:
+        demux.runInfo = parseRunInfo( os.path.join( demux.rawDataRunIDdir, demux.runInfoFileName ) )
+    return demux.runInfo
 
-    CAREFUL: when trying to execute this array, please break all arguments that include a space into their own array element. Otherwise it will execute as '--runfolder-dir {SequenceRunOriginDir}'
-         the space will be considered part of the argument: While you will scratch your head that you are passing argument and option, subprocess.run() will report that as a single
-         argument with no options
 
-        blc2fastq accepts just *fine* absolute paths when run from the command-line
-        example: /data/bin/bcl2fastq --no-lane-splitting --runfolder-dir /data/rawdata/220314_M06578_0091_000000000-DFM6K --output-dir /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex
 
-    CAREFUL: if you run blc2fastq with only --runfolder-dir {demux.RawDataRunIDdir} , bcl2fastq will create all the files within the {demux.RawDataRunIDdir} rawdata directory
+########################################################################
+# parseRunInfo( )
+########################################################################
 
+def parseRunInfo( runInfoFilePath ):
     """
+    Parse the RunInfo.xml at {runInfoFilePath}, of any run, not only the current one
 
-    demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Demultiplexing started ==\n", color="green", attrs=["bold"] ) )
-
-    # increase the file descriptor limit to 65535:
-    #       241202_M06578_0219_000000000-LT29R has over 350 sampless, when executing it, bcl2fastq threw this error:
-    #       bcl2fastq::common::Exception: 2024-Dec-05 22:59:50: Too many open files (24): /TeamCityBuildAgent/work/556afd631a5b66d8/src/cxx/include/io/FileBufWithReopen.hpp(48): Throw in function bcl2fastq::io::BasicFileBufWithReopen<CharT, Traits>::BasicFileBufWithReopen(std::ios_base::openmode) [with CharT = char; Traits = std::char_traits<char>; std::ios_base::openmode = std::_Ios_Openmode]
-    #       Dynamic exception type: boost::exception_detail::clone_impl<bcl2fastq::common::IoError>
-    #       std::exception::what: Failed to allocate a file handle
-    # raising the file descriptor , seems to fix the issue
-    # command line equiv: ulimit -n 65535
-    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-    resource.setrlimit(resource.RLIMIT_NOFILE, (65535, hard))
+    Returns a dictionary:
+        'instrument':   serial number of the sequencer, example: M06578
+        'flowcell':     flowcell id
+        'lanes':        number of lanes
+        'tiles':        list of tile names, in the lane_tile format bcl2fastq --tiles understands, example: [ '1_1101', '1_1102', ... ]
+        'reads':        list of ( readNumber, numberOfCycles, isIndexedRead )
+        'cycles':       total number of cycles
 
-    argv = [ demux.bcl2fastq_bin,
-         "--no-lane-splitting",
-         "--runfolder-dir",
-        f"{demux.rawDataRunIDdir}",
-         "--output-dir",
-        f"{demux.demultiplexRunIdDir}"
-    ]
-
-    text = f"Command to execute:"
-    demuxLogger.debug( f"{text:{demux.spacing2}}" + "ulimit -n 65535; " + " ".join( argv ) )
+    Older RunInfo.xml files ( MiSeq ) do not list the tiles, so we build the list out of FlowcellLayout.
+    """
 
-    try:
-        # EXAMPLE: /usr/local/bin/bcl2fastq --no-lane-splitting --runfolder-dir ' + demux.rawDataRunIDdir + ' --output-dir ' + demux.demultiplexDir + ' 2> ' + demux.demultiplexDir + '/demultiplex_log/02_demultiplex.log'
-        result =  subprocess.run( argv, capture_output = True, cwd = demux.rawDataRunIDdir, check = True, encoding = demux.decodeScheme )
-    except ChildProcessError as err: 
-        text = [    f"Caught exception!",
-                    f"Command: {err.cmd}", # interpolated strings
-                    f"Return code: {err.returncode}"
-                    f"Process output: {err.stdout}",
-                    f"Process error:  {err.stderr}",
-                    f"Exiting."
-                 ]
-        text = '\n'.join( text )
-        demuxFailureLogger.critical( text )
-        demuxLogger.critical( f"{ text }" )
-        logging.shutdown( )
-        sys.exit( )
+    root   = ElementTree.parse( runInfoFilePath ).getroot( )
+    run    = root.find( 'Run' )
+    layout = run.find( 'FlowcellLayout' )
+
+    lanes  = int( layout.get( 'LaneCount' ) )
+    tiles  = [ tile.text.strip( ) for tile in layout.iter( 'Tile' ) ]
+    if not tiles:
+        surfaces        = int( layout.get( 'SurfaceCount', 1 ) )
+        swaths          = int( layout.get( 'SwathCount',   1 ) )
+        tilesPerSwath   = int( layout.get( 'TileCount',    1 ) )
+        sections        = int( layout.get( 'SectionPerLane', 1 ) )
+        fiveDigit       = layout.find( 'TileSet' ) is not None and layout.find( 'TileSet' ).get( 'TileNamingConvention' ) == 'FiveDigit'
+        for lane in range( 1, lanes + 1 ):
+            for surface in range( 1, surfaces + 1 ):
+                for swath in range( 1, swaths + 1 ):
+                    for section in range( 1, sections + 1 ):
+                        for tile in range( 1, tilesPerSwath + 1 ):
+                            if fiveDigit:
+                                tiles.append( f"{lane}_{surface}{swath}{section}{tile:02d}" )
+                            else:
+                                tiles.append( f"{lane}_{surface}{swath}{tile:02d}" )
+
+    reads = [ ( int( read.get( 'Number' ) ), int( read.get( 'NumCycles' ) ), read.get( 'IsIndexedRead' ) == 'Y' ) for read in run.find( 'Reads' ).iter( 'Read' ) ]
+
+    return {
+        'instrument':   run.findtext( 'Instrument', default = '' ),
+        'flowcell':     run.findtext( 'Flowcell',   default = '' ),
+        'lanes':        lanes,
+        'tiles':        tiles,
+        'reads':        reads,
+        'cycles':       sum( cycles for number, cycles, isIndexed in reads ),
+    }
 
-    if not result.stderr:
-        demuxLogger.critical( f"result.stderr has zero lenth. exiting at {inspect.currentframe().f_code.co_name}()" )
-        demuxFailureLogger.critical( f"result.stderr has zero lenth. exiting at {inspect.currentframe().f_code.co_name}()" )
-        logging.shutdown( )
-        sys.exit( )
 
-    try: 
-        file = open( demux.bcl2FastqLogFile, "w" )
-        file.write( result.stderr )
-        file.close( )
-    except OSError as err:
-        text = [    f"Caught exception!",
-                    f"Command: {err.cmd}", # interpolated strings
-                    f"Return code: {err.returncode}"
-                    f"Process output: {err.stdout}",
-                    f"Process error:  {err.stderr}",
-                    f"Exiting."
-                 ]
-        text = '\n'.join( text )
-        demuxFailureLogger.critical( text )
-        demuxLogger.critical( f"{ text }" )
-        logging.shutdown( )
-        sys.exit( )
 
+########################################################################
+# writeStatusFile( )
+########################################################################
 
-    if not os.path.isfile( demux.bcl2FastqLogFile ):
-        demuxFailureLogger.critical( f"{demux.bcl2FastqLogFile} did not get written to disk. Exiting." )
-        demuxLogger.critical( f"{demux.bcl2FastqLogFile} did not get written to disk. Exiting." )
-        logging.shutdown( )
-        sys.exit( )
-    else:
-        filesize = os.path.getsize( demux.bcl2FastqLogFile )
-        text = "bcl2FastqLogFile:"
-        demuxLogger.debug( f"{text:{demux.spacing2}}" + f"{demux.bcl2FastqLogFile} is {filesize} bytes.\n")
+def writeStatusFile( stage, **fields ):
+    """
+    Write {demux.statusFilePath}, a small json file with the stage the run is in and how far along it is,
+        so anybody can `cat` it ( or a monitoring script can read it ) without wading through the logs.
 
-    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Demultiplexing finished ==\n", color="red", attrs=["bold"] ) )
+    The file is replaced atomically, readers never see half a file.
+    """
 
+    status = { 'RunID': demux.RunID, 'stage': stage, 'updated': datetime.datetime.now( ).isoformat( timespec = 'seconds' ), **fields }
+    temporaryFilePath = demux.statusFilePath + '.tmp'
+    try:
+        with open( temporaryFilePath, 'w', encoding = demux.decodeScheme ) as statusFileHandle:
+            json.dump( status, statusFileHandle, indent = 4 )
+        os.replace( temporaryFilePath, demux.statusFilePath )
+    except OSError as err:
+        demuxLogger.warning( f"Cannot write status file {demux.statusFilePath}: {err}" )    # a status file is nice to have, not worth failing the run over
 
 
 
 ########################################################################
-# renameDirectories( )
+# scanRunDirectory( )
 ########################################################################
 
-def renameDirectories( ):
+def scanRunDirectory( directory ):
     """
-        For each project directory in demux.projectList
-            rename the project directory  to conform from the {demux.demultiplexRunIdDir}/{project} pattern to the {demux.demultiplexRunIdDir}/{demux.RunIDShort}.{project}
-
-        Why you ask?
-            That's how the original script does it (TRADITION!)
-
-            One good reason is, of course to keep track of the file, if something goes wrong.
+    Return ( directory, { name: size } ) for the files directly under {directory}, or ( directory, None ) if {directory} does not exist
     """
 
-    demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Renaming project directories from project_name to RunIDShort.project_name ==\n", color="green", attrs=["bold"] ) )
-
-
-    for index, item in enumerate( demux.projectList ):
-        text = f"demux.projectList[{index}]:"
-        demuxLogger.debug( f"{text:{demux.spacing3}}" + item) # make sure the debugging output is all lined up.
-
-    for project in demux.projectList: # rename the project directories
+    try:
+        with os.scandir( directory ) as iterator:
+            return directory, { entry.name: entry.stat( ).st_size for entry in iterator if entry.is_file( ) }
+    except FileNotFoundError:
+        return directory, None
 
-        oldname = os.path.join( demux.demultiplexRunIdDir, project )
-        newname = os.path.join( demux.demultiplexRunIdDir, demux.RunIDShort + '.' + project )
-        olddirExists = os.path.isdir( oldname )
-        newdirExists = os.path.isdir( newname )
 
-        # make sure oldname dir exists
-        # make sure newname dir name does not exist
-        if olddirExists and not newdirExists: # rename directory
 
-            try: 
-                os.rename( oldname, newname )
-            except FileNotFoundError as err:
-                text = [    f"Error during renaming {oldname}:", 
-                            f"oldname: {oldname}",
-                            f"oldfileExists: {oldfileExists}",
-                            f"newfile: {newname}",
-                            f"newfileExists: {newfileExists}",
-                            f"err.filename:  {err.filename}",
-                            f"err.filename2: {err.filename2}",
-                            f"Exiting!"
-                        ]
-                text = '\n'.join( text )
-                demuxFailureLogger.critical( f"{ text }" )
-                demuxLogger.critical( f"{ text }" )
-                logging.shutdown( )
-                sys.exit( )
+########################################################################
+# checkGzipCrc( )
+########################################################################
 
-            demuxLogger.debug( f"Renaming " + termcolor.colored(  f"{oldname:92}", color="cyan", attrs=["reverse"] ) + " to " + termcolor.colored(  f"{newname:106}", color="yellow", attrs=["reverse"] ) )
+def checkGzipCrc( filepath ):
+    """
+    Decompress {filepath} to the end, which makes the gzip module check the CRC32 and length of every member.
+        Works for .bcl.gz and for the BGZF .bcl.bgzf files, which are a series of gzip members.
 
-    for index, item in enumerate( demux.newProjectFileList ):
-        text = f"demux.newProjectFileList[{index}]:"
-        demuxLogger.debug( f"{text:{demux.spacing3}}" + item) # make sure the debugging output is all lined up.
+    Returns ( filepath, None ) if the file is fine, ( filepath, what is wrong ) if not
+    """
 
-    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Renaming project directories from project_name to RunIDShort.project_name ==\n", color="red", attrs=["bold"] ) )
+    try:
+        with gzip.open( filepath, 'rb' ) as gzipFileHandle:
+            while gzipFileHandle.read( demux.copyBufferSize ):
+                pass
+    except ( OSError, EOFError, zlib.error ) as err:
+        return filepath, str( err ) or type( err ).__name__
+    return filepath, None
 
 
 
+########################################################################
+# checkRawDataIntegrity( )
+########################################################################
 
-def renameFiles( ):
+def checkRawDataIntegrity( ):
     """
-    Rename the files within each {project} to conform to the {RunIDShort}.{filename}.fastq.gz pattern
-
-    Why? see above? it's always been done that way.
+    Pre-flight check of {demux.rawDataRunIDdir}, before anything is created under {demux.demultiplexDir}:
+        a run with a missing or truncated BCL, .filter or .locs file otherwise fails hours into demultiplex( ).
+
+    RunInfo.xml says which lanes, tiles and cycles to expect. Every directory that should hold them is listed once, in parallel, and then
+        per cycle, every tile has a BCL file:
+            MiSeq                   Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl ( or .bcl.gz )
+            NextSeq 500/550         Data/Intensities/BaseCalls/L001/0001.bcl.bgzf, one file per cycle for all the tiles of the lane
+            NextSeq 1000/2000       Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl, one file per cycle per surface
+        every tile has a .filter file in Data/Intensities/BaseCalls/L001, or on the NextSeq 500/550 one s_1.filter for the whole lane, next to s_1.bci
+        every tile has cluster locations: Data/Intensities/L001/s_1_1101.locs or .clocs, or one s_1.locs per lane, or one s.locs per run
+        no file is empty, uncompressed BCL files have the same size in every cycle and compressed ones are not much smaller than usual for their tile
+        .bcl.gz and .bcl.bgzf files pass their gzip CRC check, only if demux.preflightCrc is set: it reads every byte of the run
+
+    Exits with the list of what is missing or wrong.
     """
 
     demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Rename files ==\n", color="green" ) )
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Check the integrity of {demux.rawDataRunIDdir} started ==", color="green", attrs=["bold"] ) )
 
-    oldname            = ""
-    newname            = ""
-    for project in demux.projectList: # rename files in each project directory
-
-        if any( var in project for var in demux.controlProjects ):      # if the project name includes a control project name, ignore it
-            demuxLogger.warning( termcolor.colored( f"\"{project}\" control project name found in projects. Skipping, it will be handled in controlProjectsQC( ).\n", color="magenta" ) )
-            continue
-        elif project == demux.testProject:                              # ignore the test project
-            demuxLogger.debug( f"Test project '{demux.testProject}' detected. Skipping." )
-            continue
+    startTime = time.monotonic( )
+    try:
+        runInfo = getRunInfo( )
+    except ( OSError, AttributeError, TypeError, ValueError, ElementTree.ParseError ) as err:
+        text = f"Cannot read {demux.runInfoFileName} in {demux.rawDataRunIDdir}: {err}. Exiting."
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
 
-        compressedFastQfilesDir = os.path.join( demux.demultiplexRunIdDir, project )
-        # text1 = termcolor.colored( "Now working on project:", color="cyan", attrs=["reverse"] )
-        text1 = "Now working on project:"
-        text2 = "compressedFastQfilesDir:"
-        demuxLogger.debug( termcolor.colored( f"{text1:{demux.spacing2 - 1}}", color="cyan", attrs=["reverse"] ) + " " + termcolor.colored( f"{project}", color="cyan", attrs=["reverse"] ) )
-        demuxLogger.debug( f"{text2:{demux.spacing2}}{compressedFastQfilesDir}")
+    intensitiesDir = os.path.join( demux.rawDataRunIDdir, 'Data', 'Intensities' )
+    baseCallsDir   = os.path.join( intensitiesDir, 'BaseCalls' )
+    lanes          = range( 1, runInfo[ 'lanes' ] + 1 )
+    cycles         = range( 1, runInfo[ 'cycles' ] + 1 )
+    tilesPerLane   = { lane: [ tile.split( '_' )[ 1 ] for tile in runInfo[ 'tiles' ] if tile.split( '_' )[ 0 ] == str( lane ) ] for lane in lanes }
+
+    directories = [ intensitiesDir ]
+    for lane in lanes:
+        directories.append( os.path.join( baseCallsDir,   f"L{lane:03d}" ) )
+        directories.append( os.path.join( intensitiesDir, f"L{lane:03d}" ) )
+        directories.extend( os.path.join( baseCallsDir, f"L{lane:03d}", f"C{cycle}.1" ) for cycle in cycles )
+    with futures.ThreadPoolExecutor( max_workers = demux.preflightWorkers ) as executor:
+        listing = dict( executor.map( scanRunDirectory, directories ) )
+
+    problems   = [ ]                            # what is missing or wrong, one line each
+    toCrcCheck = [ ]
+    for lane in lanes:
+        laneDir      = os.path.join( baseCallsDir, f"L{lane:03d}" )
+        laneListing  = listing[ laneDir ] or dict( )
+        firstCycle   = listing[ os.path.join( laneDir, "C1.1" ) ] or dict( )
+        tiles        = tilesPerLane[ lane ]
+
+        # which files to expect per cycle: { group: fileName }, a group being the set of clusters the file covers: a tile, a surface or the lane
+        exactSize    = False                    # uncompressed BCL files are 4 bytes plus one byte per cluster, the same size in every cycle
+        if f"{1:04d}.bcl.bgzf" in laneListing:
+            perCycle = lambda cycle: { f"L{lane:03d}": ( laneDir, f"{cycle:04d}.bcl.bgzf" ) }
+        elif any( name.endswith( '.cbcl' ) for name in firstCycle ):
+            surfaces = sorted( set( tile[ 0 ] for tile in tiles ) )
+            perCycle = lambda cycle: { f"surface {surface}": ( os.path.join( laneDir, f"C{cycle}.1" ), f"L{lane:03d}_{surface}.cbcl" ) for surface in surfaces }
+        else:
+            gzipped  = any( name.endswith( '.bcl.gz' ) for name in firstCycle )
+            suffix   = '.bcl.gz' if gzipped else '.bcl'
+            exactSize = not gzipped
+            perCycle = lambda cycle: { f"tile {tile}": ( os.path.join( laneDir, f"C{cycle}.1" ), f"s_{lane}_{tile}{suffix}" ) for tile in tiles }
+
+        missing = collections.defaultdict( list )   # cycle: [ groups ]
+        sizes   = collections.defaultdict( dict )   # group: { cycle: size }
+        for cycle in cycles:
+            for group, ( directory, name ) in perCycle( cycle ).items( ):
+                size = ( listing[ directory ] or dict( ) ).get( name )
+                if size is None:
+                    missing[ cycle ].append( group )
+                elif size == 0:
+                    problems.append( f"lane {lane} cycle {cycle}: {name} is empty" )
+                else:
+                    sizes[ group ][ cycle ] = size
+                    if name.endswith( ( '.bcl.gz', '.bcl.bgzf' ) ):
+                        toCrcCheck.append( os.path.join( directory, name ) )
+
+        groupCount = len( perCycle( 1 ) )
+        for cycle, groups in sorted( missing.items( ) ):
+            if len( groups ) == groupCount:
+                problems.append( f"lane {lane} cycle {cycle}: all {groupCount} BCL files missing" )
+            else:
+                problems.append( f"lane {lane} cycle {cycle}: BCL files missing for {', '.join( groups )}" )
 
-        filesToSearchFor     = os.path.join( compressedFastQfilesDir, '*' + demux.compressedFastqSuffix )
-        compressedFastQfiles = glob.glob( filesToSearchFor )            # example: /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/220314_M06578.SAV-amplicon-MJH/sample*fastq.gz
+        for group, sizePerCycle in sorted( sizes.items( ) ):
+            usual = sorted( sizePerCycle.values( ) )[ len( sizePerCycle ) // 2 ]    # the median, a few truncated files do not move it
+            for cycle, size in sorted( sizePerCycle.items( ) ):
+                if ( size != usual ) if exactSize else ( size < usual * demux.preflightMinimumSizeFraction ):
+                    problems.append( f"lane {lane} cycle {cycle} {group}: {size} bytes, the other cycles are around {usual} bytes. Truncated?" )
 
-        if not any( compressedFastQfiles ): # if array is empty
-            text = f"\n\nProject {project} does not contain any .fastq.gz entries"
-            text = f"{text} | method {inspect.stack()[0][3]}() ]"
-            text = f"{text}\n\n"
+        # .filter: 12 byte header, then one byte per cluster. One per lane next to the .bcl.bgzf files, one per tile otherwise
+        if f"{1:04d}.bcl.bgzf" in laneListing:
+            filterFiles = { f"lane {lane}": f"s_{lane}.filter" }
+        else:
+            filterFiles = { f"lane {lane} tile {tile}": f"s_{lane}_{tile}.filter" for tile in tiles }
+        for group, name in filterFiles.items( ):
+            if name not in laneListing:
+                problems.append( f"{group}: {name} missing" )
+            elif laneListing[ name ] <= 12:
+                problems.append( f"{group}: {name} has no clusters, {laneListing[ name ]} bytes" )
+
+        # cluster locations
+        locsListing = listing[ os.path.join( intensitiesDir, f"L{lane:03d}" ) ] or dict( )
+        if f"s_{lane}.locs" in locsListing or 's.locs' in ( listing[ intensitiesDir ] or dict( ) ):
+            continue
+        for tile in tiles:
+            if not any( locsListing.get( f"s_{lane}_{tile}{locsSuffix}" ) for locsSuffix in [ '.locs', '.clocs' ] ):
+                problems.append( f"lane {lane} tile {tile}: s_{lane}_{tile}.locs/.clocs missing or empty" )
+
+    text = "files listed:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{sum( len( files ) for files in listing.values( ) if files )} in {len( directories )} directories, {time.monotonic( ) - startTime:.1f} seconds" )
+
+    if not problems and demux.preflightCrc and toCrcCheck:
+        with futures.ThreadPoolExecutor( max_workers = demux.preflightWorkers ) as executor:      # zlib lets go of the GIL while decompressing
+            problems = [ f"{os.path.relpath( filepath, demux.rawDataRunIDdir )}: {err}" for filepath, err in executor.map( checkGzipCrc, toCrcCheck ) if err ]
+        text = "gzip CRC checked:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}{len( toCrcCheck )} files, {time.monotonic( ) - startTime:.1f} seconds" )
+
+    if problems:
+        shown = problems[ :demux.preflightReportLines ]
+        if len( problems ) > len( shown ):
+            shown.append( f"... and {len( problems ) - len( shown )} more" )
+        text = [    f"{demux.RunID} is not complete or is damaged, not demultiplexing it:",
+                    *shown,
+                    f"Exiting."
+                 ]
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
 
-            demuxFailureLogger.critical( text )
-            demuxLogger.critical( text )
-            sys.exit( )
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Check the integrity of {demux.rawDataRunIDdir} finished ==\n", color="red", attrs=["bold"] ) )
 
-        text = "fastq files for '" + project + "':"
-        demuxLogger.debug( f"{text:{demux.spacing2}}{filesToSearchFor}" )
 
-        for index, item in enumerate( compressedFastQfiles ):
-            text1 = "compressedFastQfiles[" + str(index) + "]:"
-            demuxLogger.debug( f"{text1:{demux.spacing3}}{item}" )
 
+########################################################################
+# getSampleSheet( )
+########################################################################
 
-        demuxLogger.debug( "-----------------")
-        demuxLogger.debug( f"Move commands to execute:" )
-        for file in compressedFastQfiles: # compressedFastQfiles is already in absolute path format
-    
-            # get the base filename. We picked up sample*.{CompressedFastqSuffix} and we have to rename it to {demux.RunIDShort}sample*.{CompressedFastqSuffix}
-            baseFileName = os.path.basename( file )
-
-            oldname     = file
-            newname     = os.path.join( demux.demultiplexRunIdDir, project, demux.RunIDShort + '.' + baseFileName )
-            renamedFile = os.path.join( demux.demultiplexRunIdDir, demux.RunIDShort + '.' + project, demux.RunIDShort + '.' + baseFileName ) # saving this var to use later when renaming directories
-                                # The idea here is that the format of the new path is the fully renamed directory + fully renamed file
-                                #
-                                # DO NOT REMOVE THE DOTS. Look at https://github.com/NorwegianVeterinaryInstitute/DemultiplexRawSequenceData/issues/86#issuecomment-2527335084
-                                # if you want some documentation as to 'why'
-
-            if renamedFile not in demux.newProjectFileList:
-                demux.newProjectFileList.append( renamedFile )  # demux.newProjectFileList is used in fastQC( )
-                                                                # We are saving here in order to not have to read in the
-                                                                # filenames, again
-
-            text  = f"/usr/bin/mv {oldname} {newname}"
-            demuxLogger.debug( " "*demux.spacing1 + text )
-            
-            # make sure oldname files exist
-            # make sure newname files do not exist
-            oldfileExists = os.path.isfile( oldname )
-            newfileExists = os.path.isfile( newname )
-
-            if oldfileExists and not newfileExists:
-                try: 
-                    os.rename( oldname, newname )
-                except FileNotFoundError as err:
-                    text = [    f"Error during renaming {oldname}:",
-                                f"oldname: {oldname}\noldfileExists: {oldfileExists}",
-                                f"newname: {newname}\nnewfileExists: {newfileExists}",
-                                f"err.filename:  {err.filename}",
-                                f"err.filename2: {err.filename2}",
-                                f"Exiting!"
-                         ]
-                    text = '\n'.join( text )
-                    demuxFailureLogger.critical( f"{ text }" )
-                    demuxLogger.critical( f"{ text }" )
-                    logging.shutdown( )
-                    sys.exit( )
-        demuxLogger.debug( "-----------------")
+def getSampleSheet( ):
+    """
+    Return demux.sampleSheetFilePath parsed by demultiplex.samplesheet.
+        The parse is cached on the sha256 of the file: the stages that need the sheet all get the same object back, until somebody edits the sheet.
+    """
 
-    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Copy {demux.sampleSheetFilePath} to {demux.demultiplexRunIdDir} ==\n", color="red" ) )
+    return samplesheet.load( demux.sampleSheetFilePath )
 
 
 
 ########################################################################
-# renameFilesAndDirectories( )
+# getExpectedOutput( )
 ########################################################################
 
-def renameFilesAndDirectories( ):
+def getExpectedOutput( prefix = '' ):
+    """
+    getSampleSheet( ).expectedOutput( ) for this run: { project: [ fastq.gz path relative to {demux.demultiplexRunIdDir}, ... ] }
+        One file per lane with demux.laneSplitting, one R number per read of RunInfo.xml that is not an index read.
     """
-    Rename any [sample-1_S1_R1_001.fastq.gz, .. , sample-1_S1_Rn_001.fastq.gz ] files inside 
-        {demux.demultiplexRunIdDir}/{demux.RunIDShort}/[ { projectList[0] }, .. , { projectList[n] } ] to match the pattern
-        {demux.RunIDShort}.[sample-1_S1_R1_001.fastq.gz, .. , sample-1_S1_Rn_001.fastq.gz ]
-    
-    Then rename the 
-        {demux.demultiplexRunIdDir}/{demux.RunIDShort}/[ { projectList[0] }, .. , { projectList[n] } ] to match the pattern
-        {demux.demultiplexRunIdDir}/{demux.RunIDShort}/{demux.RunIDShort}.[ {projectList[0] }, .. , { projectList[n] } ] to match the pattern
-        
-    Examples:
-    
-        demultiplexRunIdDir: /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/
-        Sample_Project:      SAV-amplicon-MJH              ### DO NOT change Sample_Project to sampleProject. The relevant heading column in the .csv is litereally named 'Sample_Project'
-        demux.RunIDShort:    220314_M06578
 
-        1. Rename the files:
-            /bin/mv /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/sample-1_S1_R1_001.fastq.gz /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/220314_M06578.sample-1_S1_R1_001.fastq.gz
-            /bin/mv /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/sample-1_S1_R2_001.fastq.gz /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/220314_M06578.sample-1_S1_R2_001.fastq.gz
+    return getSampleSheet( ).expectedOutput( prefix, getOutputLanes( ), getReadNumbers( ) )
 
-        2. Rename the base directory, for each project:
-            /bin/mv /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/220314_M06578.SAV-amplicon-MJH
 
+
+########################################################################
+# getOutputLanes( )
+########################################################################
+
+def getOutputLanes( ):
+    """
+    The lanes bcl2fastq writes a file per sample for: every lane of RunInfo.xml with demux.laneSplitting, None with --no-lane-splitting
     """
 
-    demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Renaming started ==", color="green", attrs=["bold"] ) )
+    if not demux.laneSplitting:
+        return None
+    return list( range( 1, getRunInfo( )[ 'lanes' ] + 1 ) )
 
 
-    text = f"demultiplexRunIdDir:"
-    demuxLogger.debug( f"{text:{demux.spacing2}}" + demux.demultiplexRunIdDir )    # tabulation error
-    text = f"RunIDShort:"
-    demuxLogger.debug( f"{text:{demux.spacing2}}" + demux.RunIDShort )
-    if demux.verbosity == 2:
-        text = "demux.projectList:"
-        demuxLogger.debug( f"{text:{demux.spacing2}}" + f"{demux.projectList}" )
 
-    renameFiles( )  # CHECK IF FILES ARE RENAMED CORRECTLY:
-                    #
-                    #  /data/for_transfer/201218_M06578_0041_000000000-JF7TM/MHC-amplicon-UG/201218_M06578.*tar.gz
-    renameDirectories( )
+########################################################################
+# getReadNumbers( )
+########################################################################
 
-    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Renaming finished ==", color="red", attrs=["bold"] ) )
+def getReadNumbers( ):
+    """
+    The R numbers of the fastq.gz files: 1, 2, ... one per read of RunInfo.xml that is not an index read
+    """
+
+    return list( range( 1, sum( 1 for readNumber, cycles, isIndexedRead in getRunInfo( )[ 'reads' ] if not isIndexedRead ) + 1 ) )
 
 
 
 ########################################################################
-# fastQC
+# reverseComplement( )
 ########################################################################
 
-def fastQC( ):
+def reverseComplement( sequence ):
     """
-    fastQC: Run /data/bin/fastqc (which is a symlink to the real qc)
+    ACGTN -> NACGT
     """
 
-    demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: fastQC started ==", color="yellow" ) )
+    return sequence.translate( demux.complementTable )[ ::-1 ]
 
-    command             = demux.fastqc_bin
-    argv                = [ command, '-t', str(demux.threadsToUse), *demux.newProjectFileList ]  # the * operator on a list/array "splats" (flattens) the values in the array, breaking them down to individual arguemtns
+
+
+########################################################################
+# findIndexCollisions( )
+########################################################################
+
+def findIndexCollisions( indexReads, mismatches ):
+    """
+    {indexReads} is one list of indexes per index read ( i7, then i5 if there is one ), all of the same length within a read, one entry per sample.
+    Two samples collide if, in every index read, their indexes are within 2 x {mismatches} of each other: a read can then be
+        {mismatches} away from both and bcl2fastq cannot tell which sample it belongs to.
+
+    Returns the colliding pairs as ( first, second ) sample positions, first < second.
+        With NumPy the pairwise Hamming distances are one vectorised comparison per index read: 384 samples is 73,536 pairs in a few milliseconds
+    """
+
+    if numpy is not None:
+        collide = None
+        for indexes in indexReads:
+            encoded   = numpy.frombuffer( ''.join( indexes ).encode( 'ascii', errors = 'replace' ), dtype = numpy.uint8 ).reshape( len( indexes ), -1 )
+            distances = ( encoded[ :, None, : ] != encoded[ None, :, : ] ).sum( axis = 2 )
+            collide   = distances <= 2 * mismatches if collide is None else collide & ( distances <= 2 * mismatches )
+        return [ ( int( first ), int( second ) ) for first, second in numpy.argwhere( numpy.triu( collide, k = 1 ) ) ]
+
+    count = len( indexReads[ 0 ] )
+    return [ ( first, second ) for first in range( count ) for second in range( first + 1, count )
+             if all( sum( a != b for a, b in zip( indexes[ first ], indexes[ second ] ) ) <= 2 * mismatches for indexes in indexReads ) ]
+
+
+
+########################################################################
+# readTileIndex( )
+########################################################################
+
+def readTileIndex( bciFilePath ):
+    """
+    The s_{lane}.bci of a NextSeq lane: [ ( tile, clusters ), ... ] of every tile in the .bcl.bgzf files of the lane, in file order.
+        8 bytes a tile, uint32 tile number and uint32 cluster count, no header
+    """
+
+    with open( bciFilePath, 'rb' ) as bciFileHandle:
+        data = bciFileHandle.read( )
+    return [ ( str( tile ), clusters ) for tile, clusters in struct.iter_unpack( '<II', data[ :len( data ) // 8 * 8 ] ) ]
+
+
+
+########################################################################
+# readFilter( )
+########################################################################
+
+def readFilter( filterFilePath, offset, clusters, limit ):
+    """
+    The pass filter flags of {clusters} clusters in a .filter file, {offset} clusters in: s_{lane}_{tile}.filter has one tile,
+        the s_{lane}.filter of a NextSeq 500/550 lane all its tiles one after the other, in s_{lane}.bci order.
+        12 byte header, uint32 0, uint32 version and uint32 cluster count, then one byte per cluster, bit 0 set if it passed filter
+
+    Returns ( a numpy bool array for the first {limit} of those clusters, how many of all {clusters} passed filter )
+    """
+
+    with open( filterFilePath, 'rb' ) as filterFileHandle:
+        filterFileHandle.seek( 12 + offset )
+        flags = numpy.frombuffer( filterFileHandle.read( clusters ), dtype = numpy.uint8 ) & 1
+    return flags[ :limit ].astype( bool ), int( flags.sum( ) )
+
+
+
+########################################################################
+# readBclBases( )
+########################################################################
+
+def readBclBases( args ):
+    """
+    Read the base calls of the first {limit} clusters of one tile for one cycle. A .bcl.bgzf {tile} of None: of the lane, from its start.
+
+    Returns ( a numpy uint8 array, 0/1/2/3 for A/C/G/T and 4 for no call, the clusters in the whole tile or lane,
+        True if the file only has the clusters that passed filter ). Understands:
+        .bcl/.bcl.gz:  uint32 cluster count, then one byte per cluster, bits 0-1 the base, bits 2-7 the quality. 0 is a no call
+        .bcl.bgzf:     the same, for all the tiles of the lane one after the other. s_{lane}.bci in the lane directory has the tiles
+                           and their cluster counts, {cycle}.bcl.bgzf.bci the virtual offset ( compressed block << 16 | offset in the block )
+                           where each tile starts. Without the second, the stream is decompressed up to the tile
+        .cbcl:         a header listing the tiles in the file and their gzip-compressed blocks, 4 bits per cluster:
+                           bits 0-1 the base, bits 2-3 the quality bin. Bin 0 is a no call. The header ends in a flag, set if
+                           the clusters that did not pass filter were left out of the file
+    """
+
+    filepath, tile, limit = args
+
+    if filepath.endswith( '.cbcl' ):
+        with open( filepath, 'rb' ) as cbclFileHandle:
+            version, headerSize, bitsPerBase, bitsPerQuality, binCount = struct.unpack( '<HIBBI', cbclFileHandle.read( 12 ) )
+            cbclFileHandle.seek( 12 + binCount * 8 )
+            tileCount   = struct.unpack( '<I', cbclFileHandle.read( 4 ) )[ 0 ]
+            tileRecords = list( struct.iter_unpack( '<IIII', cbclFileHandle.read( 16 * tileCount ) ) )
+            pfOnly      = cbclFileHandle.read( 1 ) == b'\x01'
+            offset      = headerSize
+            for tileNumber, clusters, uncompressedSize, compressedSize in tileRecords:
+                if str( tileNumber ) == tile:
+                    break
+                offset = offset + compressedSize
+            else:
+                return numpy.zeros( 0, dtype = numpy.uint8 ), 0, pfOnly
+            cbclFileHandle.seek( offset )
+            packed = numpy.frombuffer( zlib.decompress( cbclFileHandle.read( compressedSize ), 16 + zlib.MAX_WBITS ), dtype = numpy.uint8 )
+        nibbles = numpy.empty( packed.size * 2, dtype = numpy.uint8 )
+        nibbles[ 0::2 ] = packed & 0x0F
+        nibbles[ 1::2 ] = packed >> 4
+        nibbles = nibbles[ :min( clusters, limit ) ]
+        return numpy.where( ( nibbles >> 2 ) == 0, 4, nibbles & 3 ).astype( numpy.uint8 ), clusters, pfOnly
+
+    if filepath.endswith( '.bgzf' ) and tile is not None:
+        laneDir    = os.path.dirname( filepath )
+        lane       = int( os.path.basename( laneDir )[ 1: ] )
+        tileIndex  = readTileIndex( os.path.join( laneDir, f"s_{lane}.bci" ) )
+        position   = [ tileNumber for tileNumber, tileClusters in tileIndex ].index( tile )
+        clusters   = tileIndex[ position ][ 1 ]
+        with open( filepath, 'rb' ) as rawFileHandle:
+            if os.path.isfile( filepath + '.bci' ):
+                with open( filepath + '.bci', 'rb' ) as bciFileHandle:
+                    version, tileCount = struct.unpack( '<II', bciFileHandle.read( 8 ) )
+                    bciFileHandle.seek( 8 + position * 8 )
+                    virtualOffset = struct.unpack( '<Q', bciFileHandle.read( 8 ) )[ 0 ]
+                rawFileHandle.seek( virtualOffset >> 16 )                                   # the bgzf block the tile starts in
+                bclFileHandle = gzip.GzipFile( fileobj = rawFileHandle )
+                bclFileHandle.read( virtualOffset & 0xFFFF )
+            else:
+                bclFileHandle = gzip.GzipFile( fileobj = rawFileHandle )
+                bclFileHandle.seek( 4 + sum( tileClusters for tileNumber, tileClusters in tileIndex[ :position ] ) )
+            calls = numpy.frombuffer( bclFileHandle.read( min( clusters, limit ) ), dtype = numpy.uint8 )
+        return numpy.where( calls == 0, 4, calls & 3 ).astype( numpy.uint8 ), clusters, False
+
+    opener = gzip.open if filepath.endswith( ( '.gz', '.bgzf' ) ) else open
+    with opener( filepath, 'rb' ) as bclFileHandle:
+        clusters = struct.unpack( '<I', bclFileHandle.read( 4 ) )[ 0 ]
+        calls    = numpy.frombuffer( bclFileHandle.read( min( clusters, limit ) ), dtype = numpy.uint8 )
+    return numpy.where( calls == 0, 4, calls & 3 ).astype( numpy.uint8 ), clusters, False
+
+
+
+########################################################################
+# readIndexReads( )
+########################################################################
+
+def readIndexReads( ):
+    """
+    Read the index cycles of a sample of the tiles of the run: demux.prescanTiles tiles spread over the flowcell,
+        the first demux.prescanClustersPerTile clusters of each. A NextSeq lane without the s_{lane}.bci tile index cannot be
+        read tile by tile: it is sampled once, from its start, instead.
+        Only the clusters that passed filter count, as only those end up in the fastq files: the .filter of every sampled tile,
+        or the s_{lane}.filter of a NextSeq 500/550 lane, masks out the rest. Without a .filter, every cluster counts.
+
+    Returns ( [ i7 calls, i5 calls ], totalClusters ):
+        one clusters x cycles numpy uint8 matrix per index read, 0/1/2/3/4 for A/C/G/T/N, pass filter clusters only
+        totalClusters is an estimate of the pass filter clusters in the whole run: those of the sampled tiles, counted over the
+            whole tile, times the tiles in the run over the tiles sampled
+    """
+
+    runInfo      = getRunInfo( )
+    baseCallsDir = os.path.join( demux.rawDataRunIDdir, 'Data', 'Intensities', 'BaseCalls' )
+    tiles        = runInfo[ 'tiles' ]
+    step         = max( 1, len( tiles ) // demux.prescanTiles )
+    sampled      = tiles[ ::step ][ :demux.prescanTiles ]
+
+    indexCycles  = [ ]
+    firstCycle   = 1
+    for number, cycles, isIndexed in runInfo[ 'reads' ]:
+        if isIndexed:
+            indexCycles.append( range( firstCycle, firstCycle + cycles ) )
+        firstCycle = firstCycle + cycles
+
+    units   = [ ]                               # ( lane, tile or None for a whole lane, tiles it stands for )
+    filters = [ ]                               # ( .filter file, clusters before the unit in it ), one per unit
+    for laneTile in sampled:
+        lane, tile = laneTile.split( '_' )
+        laneDir    = os.path.join( baseCallsDir, f"L{int( lane ):03d}" )
+        bgzf       = bool( indexCycles ) and os.path.isfile( os.path.join( laneDir, f"{indexCycles[ 0 ][ 0 ]:04d}.bcl.bgzf" ) )
+        if bgzf and not os.path.isfile( os.path.join( laneDir, f"s_{lane}.bci" ) ):
+            if not any( unitLane == lane for unitLane, unitTile, covered in units ):
+                demuxLogger.warning( f"{laneDir} has no s_{lane}.bci tile index: sampling lane {lane} once, from its start, instead of tile by tile" )
+                units.append( ( lane, None, sum( laneTile.split( '_' )[ 0 ] == lane for laneTile in tiles ) ) )
+                filters.append( ( os.path.join( laneDir, f"s_{lane}.filter" ), 0 ) )
+            continue
+        units.append( ( lane, tile, 1 ) )
+        if bgzf:
+            tileIndex = readTileIndex( os.path.join( laneDir, f"s_{lane}.bci" ) )
+            position  = [ tileNumber for tileNumber, tileClusters in tileIndex ].index( tile )
+            filters.append( ( os.path.join( laneDir, f"s_{lane}.filter" ), sum( tileClusters for tileNumber, tileClusters in tileIndex[ :position ] ) ) )
+        else:
+            filters.append( ( os.path.join( laneDir, f"s_{lane}_{tile}.filter" ), 0 ) )
+
+    jobs = [ ]                                  # ( filepath, tile, limit ) for every sampled unit and index cycle, in read, unit, cycle order
+    for cycles in indexCycles:
+        for lane, tile, covered in units:
+            laneDir = os.path.join( baseCallsDir, f"L{int( lane ):03d}" )
+            for cycle in cycles:
+                cycleDir = os.path.join( laneDir, f"C{cycle}.1" )
+                if os.path.isfile( os.path.join( laneDir, f"{cycle:04d}.bcl.bgzf" ) ):
+                    jobs.append( ( os.path.join( laneDir, f"{cycle:04d}.bcl.bgzf" ), tile, demux.prescanClustersPerTile ) )
+                elif os.path.isfile( os.path.join( cycleDir, f"L{int( lane ):03d}_{tile[ 0 ]}.cbcl" ) ):
+                    jobs.append( ( os.path.join( cycleDir, f"L{int( lane ):03d}_{tile[ 0 ]}.cbcl" ), tile, demux.prescanClustersPerTile ) )
+                elif os.path.isfile( os.path.join( cycleDir, f"s_{lane}_{tile}.bcl.gz" ) ):
+                    jobs.append( ( os.path.join( cycleDir, f"s_{lane}_{tile}.bcl.gz" ), tile, demux.prescanClustersPerTile ) )
+                else:
+                    jobs.append( ( os.path.join( cycleDir, f"s_{lane}_{tile}.bcl" ), tile, demux.prescanClustersPerTile ) )
+
+    with futures.ThreadPoolExecutor( max_workers = demux.preflightWorkers ) as executor:    # zlib lets go of the GIL while decompressing
+        results = list( executor.map( readBclBases, jobs ) )
+
+    reads      = [ ]
+    masks      = [ ]                            # pass filter flags of the clusters read from each sampled unit, from the first index read
+    pfClusters = [ ]                            # pass filter clusters in each sampled unit
+    position   = 0
+    for cycles in indexCycles:
+        perUnit = [ ]
+        for unitNumber, unit in enumerate( units ):
+            unitResults = results[ position:position + len( cycles ) ]
+            position    = position + len( cycles )
+            clusters    = min( len( cycleCalls ) for cycleCalls, unitClusters, pfOnly in unitResults )
+            calls       = numpy.stack( [ cycleCalls[ :clusters ] for cycleCalls, unitClusters, pfOnly in unitResults ], axis = 1 )
+            if not reads:
+                unitClusters            = max( unitClusters for cycleCalls, unitClusters, pfOnly in unitResults )
+                filterFilePath, offset  = filters[ unitNumber ]
+                if any( pfOnly for cycleCalls, unitClusters, pfOnly in unitResults ):                # the .cbcl left the others out already
+                    mask, passed = numpy.ones( clusters, dtype = bool ), unitClusters
+                elif not os.path.isfile( filterFilePath ):
+                    demuxLogger.warning( f"No {filterFilePath}: counting every cluster of it in the pre-scan, not only the ones that passed filter" )
+                    mask, passed = numpy.ones( clusters, dtype = bool ), unitClusters
+                else:
+                    mask, passed = readFilter( filterFilePath, offset, unitClusters, clusters )
+                masks.append( mask )
+                pfClusters.append( passed )
+            kept = min( clusters, len( masks[ unitNumber ] ) )
+            perUnit.append( calls[ :kept ][ masks[ unitNumber ][ :kept ] ] )
+        reads.append( numpy.concatenate( perUnit, axis = 0 ) )
+
+    tilesCovered  = sum( covered for lane, tile, covered in units )
+    totalClusters = sum( pfClusters ) * len( tiles ) // max( 1, tilesCovered )
+    return reads, totalClusters
+
+
+
+########################################################################
+# prescanIndexes( )
+########################################################################
+
+def prescanIndexes( ):
+    """
+    Predict how demultiplexing will go, in a minute instead of after hours of bcl2fastq: read the index cycles of the pass filter clusters of a few tiles with readIndexReads( ),
+        tally the barcodes seen and match them against the indexes in SampleSheet.csv, allowing demux.barcodeMismatches mismatches like bcl2fastq does.
+
+    Logs, and writes to {demux.prescanFilePath}:
+        the expected share of reads, and number of reads, per sample. A sample close to zero has the wrong index
+        the most common barcodes that match no sample, and whether they would match a sample
+            with the i7 reverse-complemented, the i5 reverse-complemented ( the usual i5 orientation mistake ) or i7 and i5 swapped
+
+    Needs NumPy; without it, say so and move on. Fails the run only if demux.prescanFailBelow is set and less than that share of reads matches.
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Pre-scan the index reads started ==", color="green", attrs=["bold"] ) )
+
+    if numpy is None:
+        demuxLogger.warning( "NumPy is not installed, skipping the index pre-scan" )
+        demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Pre-scan the index reads finished ==\n", color="red", attrs=["bold"] ) )
+        return
+
+    startTime = time.monotonic( )
+    samples   = [ ( sample.sampleId, sample.index, sample.index2 ) for sample in getSampleSheet( ).uniqueSamples if sample.index ]
+    try:
+        reads, totalClusters = readIndexReads( )
+    except ( OSError, ValueError, EOFError, struct.error, zlib.error, ElementTree.ParseError ) as err:
+        demuxLogger.warning( f"Cannot read the index cycles, skipping the index pre-scan: {err}" )
+        reads = [ ]
+    if not samples or not reads or not reads[ 0 ].size:
+        demuxLogger.warning( "No indexes in the SampleSheet or no index reads in the run, nothing to pre-scan" )
+        demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Pre-scan the index reads finished ==\n", color="red", attrs=["bold"] ) )
+        return
+
+    # the SampleSheet decides how many index cycles count, like bcl2fastq does
+    i7Length  = min( reads[ 0 ].shape[ 1 ], max( len( index ) for sampleId, index, index2 in samples ) )
+    i5Length  = min( reads[ 1 ].shape[ 1 ], max( len( index2 ) for sampleId, index, index2 in samples ) ) if len( reads ) > 1 else 0
+    observed  = reads[ 0 ][ :, :i7Length ]
+    if i5Length:
+        observed = numpy.concatenate( [ observed, reads[ 1 ][ :, :i5Length ] ], axis = 1 )
+    barcodes, counts = numpy.unique( observed, axis = 0, return_counts = True )
+    sampled   = observed.shape[ 0 ]
+
+    encode = lambda sequence, length: [ 'ACGTN'.find( base ) if base in 'ACGT' else 5 for base in sequence[ :length ].ljust( length, 'N' ) ]  # 5 matches nothing, not even a no call
+    decode = lambda barcode: ''.join( 'ACGTN'[ base ] for base in barcode[ :i7Length ] ) + ( '+' + ''.join( 'ACGTN'[ base ] for base in barcode[ i7Length: ] ) if i5Length else '' )
+
+    def match( expected ):
+        """ index of the sample each observed barcode belongs to, -1 for none: within demux.barcodeMismatches and closer to it than to any other sample """
+        distances = ( barcodes[ :, None, : ] != numpy.array( expected, dtype = numpy.uint8 )[ None, :, : ] ).sum( axis = 2 )
+        best      = distances.argmin( axis = 1 )
+        bestCount = ( distances == distances.min( axis = 1, keepdims = True ) ).sum( axis = 1 )
+        return numpy.where( ( distances.min( axis = 1 ) <= demux.barcodeMismatches ) & ( bestCount == 1 ), best, -1 )
+
+    orientations = {
+        'as in the SampleSheet':    [ encode( index, i7Length ) + encode( index2, i5Length ) for sampleId, index, index2 in samples ],
+        'i7 reverse-complemented':  [ encode( reverseComplement( index ), i7Length ) + encode( index2, i5Length ) for sampleId, index, index2 in samples ],
+        'i5 reverse-complemented':  [ encode( index, i7Length ) + encode( reverseComplement( index2 ), i5Length ) for sampleId, index, index2 in samples ],
+        'i7 and i5 swapped':        [ encode( index2, i7Length ) + encode( index, i5Length ) for sampleId, index, index2 in samples ],
+    }
+    if not i5Length:
+        orientations = { name: expected for name, expected in orientations.items( ) if 'i5' not in name }
+    matches = { name: match( expected ) for name, expected in orientations.items( ) }
+
+    assigned = matches[ 'as in the SampleSheet' ]
+    report   = { 'RunID': demux.RunID, 'sampledClusters': int( sampled ), 'estimatedClusters': int( totalClusters ), 'samples': { }, 'unmatched': [ ], 'orientations': { } }
+    for number, ( sampleId, index, index2 ) in enumerate( samples ):
+        share = counts[ assigned == number ].sum( ) / sampled
+        report[ 'samples' ][ sampleId ] = { 'index': index, 'index2': index2, 'share': round( float( share ), 4 ), 'expectedReads': int( share * totalClusters ) }
+        text = f"{sampleId}:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}{100 * share:5.1f}%  ~{int( share * totalClusters )} reads  {index}{'+' + index2 if index2 else ''}" )
+        if share < demux.prescanMinimumSampleShare:
+            demuxLogger.warning( f"Sample {sampleId} gets {100 * share:.2f}% of the reads in the pre-scan. Check its index {index}{'+' + index2 if index2 else ''}" )
+
+    matchedShare = counts[ assigned >= 0 ].sum( ) / sampled
+    for name, sampleOf in matches.items( ):
+        report[ 'orientations' ][ name ] = round( float( counts[ sampleOf >= 0 ].sum( ) / sampled ), 4 )
+    text = "matched:"
+    demuxLogger.info( f"{text:{demux.spacing2}}{100 * matchedShare:.1f}% of {sampled} pass filter clusters sampled from {demux.prescanTiles} tiles" )
+
+    for position in numpy.argsort( -counts ):
+        if len( report[ 'unmatched' ] ) == demux.prescanTopUnmatched:
+            break
+        if assigned[ position ] >= 0:
+            continue
+        hits = [ f"{samples[ matches[ name ][ position ] ][ 0 ]} if {name}" for name in matches if name != 'as in the SampleSheet' and matches[ name ][ position ] >= 0 ]
+        report[ 'unmatched' ].append( { 'barcode': decode( barcodes[ position ] ), 'share': round( float( counts[ position ] / sampled ), 4 ), 'matches': hits } )
+        demuxLogger.info( f"unmatched {decode( barcodes[ position ] )}  {100 * counts[ position ] / sampled:5.2f}%  {', '.join( hits )}" )
+
+    best = max( report[ 'orientations' ], key = report[ 'orientations' ].get )
+    if best != 'as in the SampleSheet' and report[ 'orientations' ][ best ] > matchedShare + demux.prescanOrientationMargin:
+        demuxLogger.warning( f"{100 * report[ 'orientations' ][ best ]:.1f}% of the reads would match with the {best}, against {100 * matchedShare:.1f}% as the SampleSheet is. Check the SampleSheet." )
+
+    with open( demux.prescanFilePath, 'w', encoding = demux.decodeScheme ) as prescanFileHandle:
+        json.dump( report, prescanFileHandle, indent = 4 )
+    text = "pre-scan took:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{time.monotonic( ) - startTime:.1f} seconds, report in {demux.prescanFilePath}" )
+
+    if demux.prescanFailBelow is not None and matchedShare < demux.prescanFailBelow:
+        text = f"Only {100 * matchedShare:.1f}% of the reads match a sample in the pre-scan, less than the {100 * demux.prescanFailBelow:.0f}% required. Fix {demux.sampleSheetFilePath} and run again. Exiting."
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Pre-scan the index reads finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# getInstrumentType( )
+########################################################################
+
+def getInstrumentType( RunID ):
+    """
+    Return 'MiSeq' or 'NextSeq' depending on which of demux.miSeq/demux.nextSeq serial numbers is in {RunID}, 'unknown' otherwise
+    """
+
+    serial = RunID.split( '_' )[1] if RunID.count( '_' ) else ''
+    if serial in demux.miSeq:
+        return 'MiSeq'
+    if serial in demux.nextSeq:
+        return 'NextSeq'
+    return 'unknown'
+
+
+
+########################################################################
+# getAvailableCpus( )
+########################################################################
+
+def getAvailableCpus( ):
+    """
+    Return the sorted list of cpus this process may run on and has been granted.
+
+    The cpus come from the affinity mask ( so taskset/cgroup limits are honoured ) and are cut down to
+        demux.slotsGranted, or the DEMULTIPLEX_SLOTS environment variable, if either is set.
+    """
+
+    cpus  = sorted( os.sched_getaffinity( 0 ) )
+    slots = demux.slotsGranted or int( os.environ.get( demux.slotsEnvironmentVariable, 0 ) or 0 )
+    if slots and slots < len( cpus ):
+        cpus = cpus[ :slots ]
+    return cpus
+
+
+
+########################################################################
+# getNumaNodes( )
+########################################################################
+
+def getNumaNodes( ):
+    """
+    Return a list with one set of cpus per NUMA node, as listed in /sys/devices/system/node/node*/cpulist
+        Returns an empty list on single-node hosts or if /sys is not there
+    """
+
+    nodes = [ ]
+    for cpulistFilePath in sorted( glob.glob( demux.numaNodeCpulistGlob ) ):
+        cpus = set( )
+        with open( cpulistFilePath ) as cpulistFileHandle:
+            for cpuRange in cpulistFileHandle.read( ).strip( ).split( ',' ):
+                if not cpuRange:
+                    continue
+                first, _, last = cpuRange.partition( '-' )
+                cpus.update( range( int( first ), int( last or first ) + 1 ) )
+        nodes.append( cpus )
+    return nodes if len( nodes ) > 1 else [ ]
+
+
+
+########################################################################
+# getBcl2fastqCpus( )
+########################################################################
+
+def getBcl2fastqCpus( ):
+    """
+    Decide which cpus bcl2fastq gets.
+
+    Without demux.pinToNumaNode, all cpus from getAvailableCpus( ).
+    With demux.pinToNumaNode, the available cpus of a single NUMA node, the one with the most available cpus, so that bcl2fastq's
+        threads and ( by first touch ) its memory stay on one socket. If that leaves too few cpus, do not pin.
+    """
+
+    cpus = getAvailableCpus( )
+    if not demux.pinToNumaNode:
+        return cpus
+
+    nodeCpus = [ sorted( node.intersection( cpus ) ) for node in getNumaNodes( ) ]
+    nodeCpus = sorted( nodeCpus, key = len, reverse = True )
+    if nodeCpus and len( nodeCpus[0] ) >= demux.minimumPinnedCpus:
+        return nodeCpus[0]
+    return cpus
+
+
+
+########################################################################
+# readCalibration( )
+########################################################################
+
+def readCalibration( ):
+    """
+    Return the best bcl2fastq thread settings recorded by calibrateBcl2fastq( ) per instrument type, as a dictionary
+        { 'MiSeq': { 'loading': 4, 'processing': 20, 'writing': 4, 'seconds': 41.2, 'cpus': 24 }, ... }
+    """
+
+    try:
+        with open( demux.calibrationFilePath, 'r', encoding = demux.decodeScheme ) as calibrationFileHandle:
+            return json.load( calibrationFileHandle )
+    except ( OSError, ValueError ):
+        return dict( )
+
+
+
+########################################################################
+# getBcl2fastqThreads( )
+########################################################################
+
+def getBcl2fastqThreads( cpuCount, tileCount, sampleCount, instrumentType ):
+    """
+    Work out bcl2fastq's --loading-threads, --processing-threads and --writing-threads
+
+        loading:    reading BCL files, I/O bound. Illumina recommends 4, no point in more threads than tiles
+        writing:    compressing and writing fastq.gz. bcl2fastq refuses more writing threads than samples
+        processing: everything else, the cpus left over
+
+    If calibrateBcl2fastq( ) has recorded settings for this instrument type on a host with the same number of cpus or less,
+        use those instead.
+
+    Returns ( loading, processing, writing )
+    """
+
+    calibrated = readCalibration( ).get( instrumentType )
+    if calibrated and calibrated.get( 'cpus', 0 ) <= cpuCount:
+        return calibrated[ 'loading' ], calibrated[ 'processing' ], calibrated[ 'writing' ]
+
+    loading    = max( 1, min( demux.maximumLoadingThreads, cpuCount // 8, tileCount or demux.maximumLoadingThreads ) )
+    writing    = max( 1, min( demux.maximumWritingThreads, cpuCount // 8, sampleCount or 1 ) )
+    processing = max( 1, cpuCount - writing )
+    return loading, processing, writing
+
+
+
+########################################################################
+# demultiplexThreads( )
+########################################################################
+
+def demultiplexThreads( ):
+    """
+    Return the loading/processing/writing thread counts for the current run and the cpus to pin the demultiplexer to, as ( threads, cpus )
+        cpus is None if there is no pinning to do
+    """
+
+    cpus = getBcl2fastqCpus( )
+    try:
+        tileCount = len( getRunInfo( )[ 'tiles' ] )
+    except ( OSError, AttributeError, TypeError, ValueError, ElementTree.ParseError ):
+        tileCount = 0
+    sampleCount = sum( len( samples ) for samples in demux.samplesPerProject.values( ) )
+
+    loading, processing, writing = getBcl2fastqThreads( len( cpus ), tileCount, sampleCount, getInstrumentType( demux.RunID ) )
+
+    text = "demultiplexer threads:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}loading {loading}, processing {processing}, writing {writing} on {len( cpus )} cpus" )
+
+    if demux.pinToNumaNode or len( cpus ) < os.cpu_count( ):
+        return ( loading, processing, writing ), cpus
+    return ( loading, processing, writing ), None
+
+
+
+########################################################################
+# calibrateBcl2fastq( )
+########################################################################
+
+def calibrateBcl2fastq( RunID, settings = None ):
+    """
+    Run bcl2fastq over a few tiles of {RunID} with different thread settings, time each run and record the fastest setting for this
+        instrument type in {demux.calibrationFilePath}. getBcl2fastqThreads( ) picks it up from there.
+
+    Run it by hand, on an idle host, once per instrument type and again after a hardware change:
+        PYTHONPATH=/data/bin /usr/bin/python3.11 /data/bin/demultiplex/tools/calibrate_bcl2fastq.py <RunID>
+
+    {settings} is a list of ( loading, processing, writing ); by default a small grid around the computed default.
+    Every timing goes to demuxLogger, which the caller configures: see the tool.
+    Output goes to a temporary directory under {demux.demultiplexDir} and is deleted afterwards.
+    """
+
+    demux.RunID           = RunID
+    demux.rawDataRunIDdir = os.path.join( demux.rawDataDir, RunID )
+    demux.runInfo         = dict( )
+    runInfo               = getRunInfo( )
+    cpuCount              = len( getBcl2fastqCpus( ) )
+    instrumentType        = getInstrumentType( RunID )
+    tiles                 = runInfo[ 'tiles' ][ :demux.calibrationTiles ]
+    tilesRegex            = '|'.join( f"s_{tile}" for tile in tiles )
+
+    if not settings:
+        settings = set( )
+        for loading in [ 1, 2, 4 ]:
+            for writing in [ 1, 2, 4, 8 ]:
+                settings.add( ( loading, max( 1, cpuCount - writing ), writing ) )
+                settings.add( ( loading, cpuCount, writing ) )
+        settings = sorted( settings )
+
+    results = [ ]
+    for loading, processing, writing in settings:
+        outputDir = tempfile.mkdtemp( prefix = f"{RunID}_calibration_", dir = demux.demultiplexDir )
+        argv = [ Bcl2fastqBackend( ).executable( ), "--no-lane-splitting", "--runfolder-dir", demux.rawDataRunIDdir, "--output-dir", outputDir, "--tiles", tilesRegex,
+                 "--loading-threads", str( loading ), "--processing-threads", str( processing ), "--writing-threads", str( writing ) ]
+        startTime = time.monotonic( )
+        result    = subprocess.run( argv, capture_output = True, cwd = demux.rawDataRunIDdir )
+        seconds   = time.monotonic( ) - startTime
+        shutil.rmtree( outputDir, ignore_errors = True )
+        if result.returncode != 0:
+            demuxLogger.warning( f"loading {loading:2} processing {processing:3} writing {writing:2}: failed with return code {result.returncode}" )
+            continue
+        demuxLogger.info( f"loading {loading:2} processing {processing:3} writing {writing:2}: {seconds:8.2f} seconds" )
+        results.append( ( seconds, loading, processing, writing ) )
+
+    if not results:
+        demuxLogger.error( "No bcl2fastq run succeeded, nothing recorded." )
+        return None
+
+    seconds, loading, processing, writing = min( results )
+    calibration = readCalibration( )
+    calibration[ instrumentType ] = { 'loading': loading, 'processing': processing, 'writing': writing, 'seconds': round( seconds, 2 ), 'cpus': cpuCount, 'RunID': RunID, 'tiles': len( tiles ) }
+    with open( demux.calibrationFilePath, 'w', encoding = demux.decodeScheme ) as calibrationFileHandle:
+        json.dump( calibration, calibrationFileHandle, indent = 4 )
+
+    demuxLogger.info( f"{instrumentType}: best is loading {loading} processing {processing} writing {writing}, recorded in {demux.calibrationFilePath}" )
+    return calibration[ instrumentType ]
+
+
+
+########################################################################
+# splitTiles( )
+########################################################################
+
+def splitTiles( tiles, shards ):
+    """
+    Split the list of tiles in {shards} contiguous groups of ( almost ) equal size, keeping the RunInfo.xml order so that
+        concatenating the shard outputs in shard order keeps the reads in tile order
+    """
+
+    shards = max( 1, min( shards, len( tiles ) ) )
+    size, remainder = divmod( len( tiles ), shards )
+    groups = [ ]
+    start  = 0
+    for shard in range( shards ):
+        end = start + size + ( 1 if shard < remainder else 0 )
+        groups.append( tiles[ start:end ] )
+        start = end
+    return groups
+
+
+
+########################################################################
+# appendFile( )
+########################################################################
+
+def appendFile( sourceFilePath, destinationFileHandle ):
+    """
+    Append the contents of {sourceFilePath} to the open {destinationFileHandle}.
+        Uses copy_file_range( ), so the data does not pass through user space ( and on some filesystems is not even copied ).
+        Falls back to shutil.copyfileobj( ) where copy_file_range( ) is not available.
+
+    gzip files can be concatenated as they are: a .fastq.gz made out of several gzip members is a valid .fastq.gz, no recompression needed.
+    """
+
+    with open( sourceFilePath, 'rb' ) as sourceFileHandle:
+        remaining = os.fstat( sourceFileHandle.fileno( ) ).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range( sourceFileHandle.fileno( ), destinationFileHandle.fileno( ), remaining )
+                if copied == 0:
+                    break
+                remaining = remaining - copied
+        except ( AttributeError, OSError ) as err:
+            if isinstance( err, OSError ) and err.errno not in [ errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL ]:
+                raise
+            shutil.copyfileobj( sourceFileHandle, destinationFileHandle, demux.copyBufferSize )
+
+
+
+########################################################################
+# mergeStats( )
+########################################################################
+
+def mergeStats( merged, stats ):
+    """
+    Merge the bcl2fastq Stats.json contents {stats} of one shard into {merged}, in place, and return {merged}
+
+        numbers are added up
+        dictionaries are merged key by key
+        lists of dictionaries are matched up on their identifying key ( LaneNumber, SampleId, ReadNumber, IndexSequence, Lane, Number ) and merged
+        identifying keys, RunNumber, NumCycles and anything else keep the value of the first shard
+
+    UnknownBarcodes are the top barcodes of each shard, so the merged list is a close approximation, not exact.
+    """
+
+    for key, value in stats.items( ):
+        if key not in merged:
+            merged[ key ] = value
+        elif isinstance( value, bool ) or key in demux.statsNotSummedKeys:
+            continue
+        elif isinstance( value, ( int, float ) ) and isinstance( merged[ key ], ( int, float ) ):
+            merged[ key ] = merged[ key ] + value
+        elif isinstance( value, dict ) and isinstance( merged[ key ], dict ):
+            if key == 'Barcodes':                           # UnknownBarcodes: { barcode: count }
+                for barcode, count in value.items( ):
+                    merged[ key ][ barcode ] = merged[ key ].get( barcode, 0 ) + count
+            else:
+                mergeStats( merged[ key ], value )
+        elif isinstance( value, list ) and isinstance( merged[ key ], list ):
+            for item in value:
+                if not isinstance( item, dict ):
+                    continue
+                identifier = next( ( name for name in demux.statsIdentifierKeys if name in item ), None )
+                match      = next( ( existing for existing in merged[ key ] if identifier and existing.get( identifier ) == item.get( identifier ) ), None )
+                if match is None:
+                    merged[ key ].append( item )
+                else:
+                    mergeStats( match, item )
+    return merged
+
+
+
+########################################################################
+# mergeShardOutputs( )
+########################################################################
+
+def mergeShardOutputs( shardDirectories ):
+    """
+    Merge the output of the bcl2fastq shards into {demux.demultiplexRunIdDir}:
+        every .fastq.gz is the concatenation, in shard order, of the same file in each shard
+        Stats/Stats.json is merged with mergeStats( )
+
+    The per-shard Reports/ html is not merged. The shard directories are deleted afterwards.
+    """
+
+    relativeFastqPaths = set( )
+    for shardDirectory in shardDirectories:
+        for directoryRoot, dirnames, filenames in os.walk( shardDirectory ):
+            for file in filenames:
+                if file.endswith( demux.compressedFastqSuffix ):
+                    relativeFastqPaths.add( os.path.relpath( os.path.join( directoryRoot, file ), shardDirectory ) )
+
+    def mergeFastq( relativePath ):
+        destinationFilePath = os.path.join( demux.demultiplexRunIdDir, relativePath )
+        os.makedirs( os.path.dirname( destinationFilePath ), exist_ok = True )
+        with open( destinationFilePath, 'xb' ) as destinationFileHandle:
+            for shardDirectory in shardDirectories:
+                sourceFilePath = os.path.join( shardDirectory, relativePath )
+                if os.path.isfile( sourceFilePath ):
+                    appendFile( sourceFilePath, destinationFileHandle )
+        return relativePath
+
+    with futures.ThreadPoolExecutor( max_workers = demux.mergeWorkers ) as executor:
+        for relativePath in executor.map( mergeFastq, sorted( relativeFastqPaths ) ):
+            if demux.verbosity == 3:
+                demuxLogger.debug( f"merged {relativePath}" )
+
+    merged = dict( )
+    for shardDirectory in shardDirectories:
+        statsFilePath = os.path.join( shardDirectory, demux.statsDirName, demux.statsFileName )
+        if os.path.isfile( statsFilePath ):
+            with open( statsFilePath, 'r', encoding = demux.decodeScheme ) as statsFileHandle:
+                mergeStats( merged, json.load( statsFileHandle ) )
+    if merged:
+        os.makedirs( os.path.join( demux.demultiplexRunIdDir, demux.statsDirName ), exist_ok = True )
+        with open( os.path.join( demux.demultiplexRunIdDir, demux.statsDirName, demux.statsFileName ), 'w', encoding = demux.decodeScheme ) as statsFileHandle:
+            json.dump( merged, statsFileHandle, indent = 4 )
+
+    text = "merged:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{len( relativeFastqPaths )} fastq.gz files from {len( shardDirectories )} shards" )
+
+    shutil.rmtree( os.path.dirname( shardDirectories[0] ) )
+
+
+
+########################################################################
+# demultiplexSharded( )
+########################################################################
+
+def demultiplexSharded( backend ):
+    """
+    Run bcl2fastq as demux.bcl2fastqShards parallel processes, each over its own group of tiles ( --tiles ), then merge the outputs.
+
+    Each shard writes to {demux.demultiplexRunIdDir}/{demux.shardsDirName}/shard_NN and logs to {demux.demultiplexLogDirPath}/01_demultiplex.shard_NN.log
+    Local shards get their own slice of the cpus and are pinned to it.
+    If demux.shardHosts is not empty, the shards are started round robin on those hosts over ssh instead;
+        the hosts must mount /data at the same path.
+
+    Returns True if all shards succeeded and the outputs were merged.
+    """
+
+    tileGroups      = splitTiles( getRunInfo( )[ 'tiles' ], demux.bcl2fastqShards )
+    shardsDirectory = os.path.join( demux.demultiplexRunIdDir, demux.shardsDirName )
+    cpus            = getBcl2fastqCpus( )
+    cpusPerShard    = max( 1, len( cpus ) // len( tileGroups ) )
+    sampleCount     = sum( len( samples ) for samples in demux.samplesPerProject.values( ) )
+    loading, processing, writing = getBcl2fastqThreads( cpusPerShard, len( tileGroups[0] ), sampleCount, getInstrumentType( demux.RunID ) )
+    threadArgv      = backend.threadArguments( loading, processing, writing )
+    baseArgv        = backend.baseCommand( )
+
+    os.mkdir( shardsDirectory )
+    processes         = [ ]
+    shardDirectories  = [ ]
+    for shard, tiles in enumerate( tileGroups ):
+        shardDirectory = os.path.join( shardsDirectory, f"shard_{shard:02d}" )
+        shardLogFile   = demux.bcl2FastqLogFile.replace( demux.logSuffix, f".shard_{shard:02d}{demux.logSuffix}" )
+        tilesArgv      = [ "--tiles", ','.join( f"s_{tile}" for tile in tiles ) ]
+        argv           = [ *baseArgv, "--output-dir", shardDirectory, *tilesArgv, *threadArgv ]
+        shardDirectories.append( shardDirectory )
+
+        preexecFunction = None
+        if demux.shardHosts:
+            host = demux.shardHosts[ shard % len( demux.shardHosts ) ]
+            argv = [ "ssh", host, "--", f"ulimit -n 65535; cd {shlex.quote( demux.rawDataRunIDdir )} && {shlex.join( argv )}" ]
+        else:
+            shardCpus = cpus[ shard * cpusPerShard : ( shard + 1 ) * cpusPerShard ] or cpus
+            preexecFunction = lambda shardCpus = shardCpus: os.sched_setaffinity( 0, shardCpus )
+
+        text = f"shard {shard:02d}:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}{len( tiles )} tiles, " + " ".join( argv ) )
+        logFileHandle = open( shardLogFile, "w", encoding = demux.decodeScheme )
+        processes.append( ( subprocess.Popen( argv, stdout = logFileHandle, stderr = subprocess.STDOUT, cwd = demux.rawDataRunIDdir, preexec_fn = preexecFunction ), logFileHandle, shardLogFile ) )
+
+    failed = [ ]
+    for shard, ( process, logFileHandle, shardLogFile ) in enumerate( processes ):
+        returncode = process.wait( )
+        logFileHandle.close( )
+        writeStatusFile( 'demultiplex', shards = len( processes ), shardsFinished = shard + 1 )
+        if returncode != 0:
+            failed.append( f"shard {shard:02d} failed with return code {returncode}, see {shardLogFile}" )
+
+    if failed:
+        text = '\n'.join( [ "bcl2fastq failed!", *failed, f"Shard outputs left in {shardsDirectory}", "Exiting." ] )
+        writeStatusFile( 'demultiplex', failed = True )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    with open( demux.bcl2FastqLogFile, "w", encoding = demux.decodeScheme ) as logFileHandle: # keep 01_demultiplex.log, later stages and people look for it
+        for process, shardLogFileHandle, shardLogFile in processes:
+            with open( shardLogFile, "r", encoding = demux.decodeScheme, errors = 'replace' ) as shardLogFileHandle:
+                shutil.copyfileobj( shardLogFileHandle, logFileHandle )
+
+    mergeShardOutputs( shardDirectories )
+    return True
+
+
+
+########################################################################
+# getDirectorySize( )
+########################################################################
+
+def getDirectorySize( path ):
+    """
+    Return the size in bytes of all the files under {path}. Symlinks are not followed.
+    """
+
+    size  = 0
+    stack = [ path ]
+    while stack:
+        with os.scandir( stack.pop( ) ) as iterator:
+            for entry in iterator:
+                if entry.is_dir( follow_symlinks = False ):
+                    stack.append( entry.path )
+                elif entry.is_file( follow_symlinks = False ):
+                    size = size + entry.stat( follow_symlinks = False ).st_size
+    return size
+
+
+
+########################################################################
+# getMirrorRunIDdir( )
+########################################################################
+
+def getMirrorRunIDdir( RunID ):
+    """
+    Where the scratch copy of the raw run {RunID} lives: {demux.scratchDir}/rawdata/{RunID}
+        Written by mirrorInProgressRuns( ) while the sequencer is still running and topped up by stageToScratch( )
+    """
+
+    return os.path.join( demux.scratchDir, demux.rawDataDirName, RunID )
+
+
+
+########################################################################
+# mirrorFile( )
+########################################################################
+
+def mirrorFile( paths ):
+    """
+    Copy {source} to {destination} through {destination}{demux.stagingSuffix}, so a reader never sees a half-copied file
+        and two passes copying the same file at the same time do not get in each other's way
+    """
+
+    source, destination = paths
+    temporary = destination + demux.stagingSuffix + f".{os.getpid( )}"
+    shutil.copy2( source, temporary )           # keeps the mtime, which is how mirrorRawData( ) knows the file is up to date
+    os.replace( temporary, destination )
+
+
+
+########################################################################
+# mirrorRawData( )
+########################################################################
+
+def mirrorRawData( sourceDir, mirrorDir, settleSeconds = None, purge = False ):
+    """
+    One incremental pass of mirroring {sourceDir} to {mirrorDir}: copy only the files that are new or changed since the last pass.
+        A file has changed if its size or mtime differ from the mirror copy.
+        Files modified less than {settleSeconds} ago are probably still being written by the sequencer and are left for the next pass.
+        With {purge}, anything in {mirrorDir} that is not in {sourceDir}, half-finished copies included, is deleted.
+        Anything matching demux.scratchRawDataIgnore is left out.
+
+    Returns ( files copied, bytes copied )
+    """
+
+    if settleSeconds is None:
+        settleSeconds = demux.mirrorSettleSeconds
+
+    now    = time.time( )
+    copies = [ ]
+    size   = 0
+    seen   = set( )
+    stack  = [ '' ]
+    while stack:
+        relativeDir = stack.pop( )
+        os.makedirs( os.path.join( mirrorDir, relativeDir ), exist_ok = True )
+        with os.scandir( os.path.join( sourceDir, relativeDir ) ) as iterator:
+            for entry in iterator:
+                if any( fnmatch.fnmatch( entry.name, pattern ) for pattern in demux.scratchRawDataIgnore ):
+                    continue
+                relativePath = os.path.join( relativeDir, entry.name )
+                if entry.is_dir( follow_symlinks = False ):
+                    seen.add( relativePath )
+                    stack.append( relativePath )
+                    continue
+                if not entry.is_file( follow_symlinks = False ):
+                    continue
+                seen.add( relativePath )
+
+                sourceStat = entry.stat( follow_symlinks = False )
+                if now - sourceStat.st_mtime < settleSeconds:
+                    continue
+                try:
+                    mirrorStat = os.stat( os.path.join( mirrorDir, relativePath ) )
+                    if mirrorStat.st_size == sourceStat.st_size and int( mirrorStat.st_mtime ) == int( sourceStat.st_mtime ):
+                        continue
+                except FileNotFoundError:
+                    pass
+                copies.append( ( entry.path, os.path.join( mirrorDir, relativePath ) ) )
+                size = size + sourceStat.st_size
+
+    with futures.ThreadPoolExecutor( max_workers = demux.stagingWorkers ) as executor:
+        list( executor.map( mirrorFile, copies ) )             # list( ) so the first copy error is raised here
+
+    if purge:
+        for directoryRoot, dirnames, filenames in os.walk( mirrorDir, topdown = False ):
+            for name in filenames + dirnames:
+                path = os.path.join( directoryRoot, name )
+                if os.path.relpath( path, mirrorDir ) in seen:
+                    continue
+                if os.path.isdir( path ) and not os.path.islink( path ):
+                    shutil.rmtree( path, ignore_errors = True )
+                else:
+                    os.remove( path )
+
+    return len( copies ), size
+
+
+
+########################################################################
+# mirrorInProgressRuns( )
+########################################################################
+
+def mirrorInProgressRuns( ):
+    """
+    One pass of the raw data mirroring service, demultiplex/tools/mirror_rawdata.py:
+        mirror every run in {demux.rawDataDir} that has not been picked up for demultiplexing yet to {demux.scratchDir}/rawdata,
+            so by the time RTAComplete.txt appears most of the BCL files are already on fast local storage.
+        delete the mirrors of runs that are gone from {demux.rawDataDir} or are demultiplexed.
+
+    A run being demultiplexed is left to stageToScratch( ), which tops the mirror up one last time.
+    Returns the list of RunIDs mirrored in this pass.
+    """
+
+    mirrored  = [ ]
+    mirrorDir = os.path.join( demux.scratchDir, demux.rawDataDirName )
+    os.makedirs( mirrorDir, exist_ok = True )
+
+    for RunID in sorted( os.listdir( demux.rawDataDir ) ):
+        if not any( tag in RunID for tags in [ demux.nextSeq, demux.miSeq ] for tag in tags ):    # only directories with a sequencer tag are runs
+            continue
+        rawDataRunIDdir     = os.path.join( demux.rawDataDir, RunID )
+        demultiplexRunIdDir = os.path.join( demux.demultiplexDir, RunID + demux.demultiplexDirSuffix )
+        if not os.path.isdir( rawDataRunIDdir ) or os.path.exists( demultiplexRunIdDir ):
+            continue
+        if shutil.disk_usage( mirrorDir ).free < demux.scratchReserve:
+            demuxLogger.warning( f"Less than {demux.scratchReserve / 1024**3:.0f} GiB free on {demux.scratchDir}, not mirroring {RunID}" )
+            continue
+
+        startTime    = time.monotonic( )
+        copied, size = mirrorRawData( rawDataRunIDdir, getMirrorRunIDdir( RunID ) )
+        mirrored.append( RunID )
+        if copied:
+            demuxLogger.info( f"{RunID}: mirrored {copied} files, {size / 1024**2:.1f} MiB in {time.monotonic( ) - startTime:.1f} seconds" )
+
+    for RunID in os.listdir( mirrorDir ):
+        rawDataRunIDdir     = os.path.join( demux.rawDataDir, RunID )
+        demultiplexComplete = os.path.join( demux.demultiplexDir, RunID + demux.demultiplexDirSuffix, demux.demultiplexCompleteFile )
+        if not os.path.isdir( rawDataRunIDdir ) or os.path.isfile( demultiplexComplete ):
+            demuxLogger.info( f"{RunID}: removing the mirror, the run is gone or already demultiplexed" )
+            shutil.rmtree( getMirrorRunIDdir( RunID ), ignore_errors = True )
+
+    return mirrored
+
+
+
+########################################################################
+# stageToScratch( )
+########################################################################
+
+def stageToScratch( ):
+    """
+    Move the heavy I/O of the run off /data and onto {demux.scratchDir}, local NVMe for example:
+        copy the raw run to {demux.scratchDir}/rawdata/{RunID}, if demux.scratchRawData is set, so bcl2fastq does not read the BCL files off the array.
+            If mirrorInProgressRuns( ) has been mirroring the run while it was sequencing, only what is missing is copied
+        point demux.demultiplexRunIdDir and demux.demuxQCDirectoryFullPath to {demux.scratchDir}/{RunID}_demultiplex
+
+    so demultiplex( ), renameFilesAndDirectories( ), qualityCheck( ), calcFileHash( ) and prepareDelivery( ) all read and write on scratch.
+        unstageFromScratch( ) moves the results back to /data.
+
+    The log directory stays on /data, so the logs and the rename journal survive losing the host.
+    Whatever an earlier, failed, attempt of the same run left in the scratch run directory is deleted first.
+    If there is not enough space on scratch, stay on /data and say so.
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Stage the run to {demux.scratchDir} started ==", color="green", attrs=["bold"] ) )
+
+    scratchRunIdDir        = os.path.join( demux.scratchDir, os.path.basename( demux.demultiplexRunIdDir ) )
+    scratchRawDataRunIDdir = getMirrorRunIDdir( demux.RunID )
+    if os.path.exists( scratchRunIdDir ):
+        demuxLogger.warning( f"Deleting {scratchRunIdDir}, left over from an earlier attempt" )
+        try:
+            shutil.rmtree( scratchRunIdDir )
+        except OSError as err:
+            text = [    f"{scratchRunIdDir}, left over from an earlier attempt, cannot be deleted: {err}",
+                        f"Delete it, or set demux.scratchDir to None to work on {demux.demultiplexDir}. Exiting."
+                     ]
+            text = '\n'.join( text )
+            demuxFailureLogger.critical( text )
+            demuxLogger.critical( text )
+            logging.shutdown( )
+            sys.exit( )
+
+    rawSize      = getDirectorySize( demux.rawDataRunIDdir )
+    mirroredSize = getDirectorySize( scratchRawDataRunIDdir ) if os.path.isdir( scratchRawDataRunIDdir ) else 0
+    outputSize   = int( rawSize * demux.scratchOutputFactor )
+    needed       = outputSize + ( max( 0, rawSize - mirroredSize ) if demux.scratchRawData else 0 ) + demux.scratchReserve
+    free       = shutil.disk_usage( demux.scratchDir ).free
+    text = "scratch space:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{needed / 1024**3:.1f} GiB needed, {free / 1024**3:.1f} GiB free on {demux.scratchDir}" )
+
+    if shutil.disk_usage( demux.demultiplexDir ).free < outputSize:
+        demuxLogger.warning( f"{demux.demultiplexDir} may not have room for the {outputSize / 1024**3:.1f} GiB of results coming back from scratch" )
+    if free < needed:
+        demuxLogger.warning( f"Not enough space on {demux.scratchDir}, working on {demux.demultiplexDir} instead" )
+        demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Stage the run to {demux.scratchDir} finished ==\n", color="red", attrs=["bold"] ) )
+        return
+
+    demux.stagedPaths = { 'demultiplexRunIdDir': demux.demultiplexRunIdDir, 'demuxQCDirectoryFullPath': demux.demuxQCDirectoryFullPath }
+    demux.demultiplexRunIdDir      = scratchRunIdDir
+    demux.demuxQCDirectoryFullPath = os.path.join( scratchRunIdDir, demux.demuxQCDirectoryName )
+    try:
+        os.makedirs( demux.demuxQCDirectoryFullPath )
+        if demux.scratchRawData:
+            startTime    = time.monotonic( )
+            copied, size = mirrorRawData( demux.rawDataRunIDdir, scratchRawDataRunIDdir, settleSeconds = 0, purge = True )   # the run is complete, copy everything that is missing
+    except OSError as err:
+        text = [    f"Staging {demux.RunID} to {demux.scratchDir} failed: {err}",
+                    f"Nothing has been demultiplexed yet: re-run to try again, or set demux.scratchDir to None to work on {demux.demultiplexDir}. Exiting."
+                 ]
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    if demux.scratchRawData:
+        demux.stagedPaths[ 'rawDataRunIDdir' ] = demux.rawDataRunIDdir
+        demux.rawDataRunIDdir = scratchRawDataRunIDdir
+        text = "raw data staged:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}{size / 1024**3:.1f} GiB in {copied} files in {time.monotonic( ) - startTime:.0f} seconds to {scratchRawDataRunIDdir}, {mirroredSize / 1024**3:.1f} GiB already mirrored" )
+
+    text = "demultiplexRunIdDir:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{demux.demultiplexRunIdDir}" )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Stage the run to {demux.scratchDir} finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# releaseScratchRawData( )
+########################################################################
+
+def releaseScratchRawData( ):
+    """
+    Delete the scratch copy of the raw run once bcl2fastq is done with it, and point demux.rawDataRunIDdir back to /data
+    """
+
+    if 'rawDataRunIDdir' not in demux.stagedPaths:
+        return
+
+    scratchRawDataRunIDdir = demux.rawDataRunIDdir
+    demux.rawDataRunIDdir  = demux.stagedPaths.pop( 'rawDataRunIDdir' )
+    if demux.scratchCleanup:
+        shutil.rmtree( scratchRawDataRunIDdir, ignore_errors = True )
+
+
+
+########################################################################
+# copyAndVerify( )
+########################################################################
+
+def copyAndVerify( paths ):
+    """
+    Copy {source} to {destination}, hashing the data on the way, then read the copy back and compare.
+        The copy is written to {destination}{demux.stagingSuffix} and renamed into place only if it matches,
+        so there is never a half-written file under the final name. If {source} has a .sha512 file, the data must match that too.
+
+    Returns ( source, True|False )
+    """
+
+    source, destination = paths
+    temporary = destination + demux.stagingSuffix
+
+    sourceHash = hashlib.sha512( )
+    with open( source, 'rb' ) as sourceFileHandle, open( temporary, 'wb' ) as temporaryFileHandle:
+        while True:
+            chunk = sourceFileHandle.read( demux.copyBufferSize )
+            if not chunk:
+                break
+            sourceHash.update( chunk )
+            temporaryFileHandle.write( chunk )
+        temporaryFileHandle.flush( )
+        os.fsync( temporaryFileHandle.fileno( ) )
+    shutil.copystat( source, temporary )
+
+    copyHash = hashlib.sha512( )
+    with open( temporary, 'rb' ) as temporaryFileHandle:
+        while True:
+            chunk = temporaryFileHandle.read( demux.copyBufferSize )
+            if not chunk:
+                break
+            copyHash.update( chunk )
+
+    expected = sourceHash.hexdigest( )
+    if os.path.isfile( source + demux.sha512Suffix ):
+        with open( source + demux.sha512Suffix, 'r', encoding = demux.decodeScheme ) as sha512FileHandle:
+            expected = sha512FileHandle.read( ).split( ' ' )[ 0 ]
+
+    if copyHash.hexdigest( ) != sourceHash.hexdigest( ) or sourceHash.hexdigest( ) != expected:
+        os.remove( temporary )
+        return source, False
+
+    os.replace( temporary, destination )
+    return source, True
+
+
+
+########################################################################
+# unstageFromScratch( )
+########################################################################
+
+def unstageFromScratch( ):
+    """
+    Bring the results from scratch back to /data, undoing stageToScratch( ):
+        every file under the scratch {demux.demultiplexRunIdDir} goes to the same place under /data
+        on the same filesystem that is a rename, otherwise a copy that is checked by copyAndVerify( )
+
+    Only when every file has arrived intact are the paths pointed back to /data and the scratch copy deleted.
+        On a checksum mismatch, stop and leave the scratch copy alone for inspection.
+    """
+
+    if not demux.stagedPaths:
+        return
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Move the results from {demux.scratchDir} to {demux.demultiplexDir} started ==", color="green", attrs=["bold"] ) )
+
+    releaseScratchRawData( )
+
+    scratchRunIdDir = demux.demultiplexRunIdDir
+    finalRunIdDir   = demux.stagedPaths[ 'demultiplexRunIdDir' ]
+    sameFilesystem  = os.stat( scratchRunIdDir ).st_dev == os.stat( finalRunIdDir ).st_dev
+    startTime       = time.monotonic( )
+
+    copies = [ ]
+    size   = 0
+    try:
+        for directoryRoot, dirnames, filenames in os.walk( scratchRunIdDir ):
+            destinationRoot = os.path.join( finalRunIdDir, os.path.relpath( directoryRoot, scratchRunIdDir ) )
+            os.makedirs( destinationRoot, exist_ok = True )
+            for file in filenames:
+                source      = os.path.join( directoryRoot, file )
+                destination = os.path.join( destinationRoot, file )
+                size        = size + os.path.getsize( source )
+                if sameFilesystem:
+                    os.replace( source, destination )
+                else:
+                    copies.append( ( source, destination ) )
+
+        with futures.ThreadPoolExecutor( max_workers = demux.stagingWorkers ) as executor:
+            failed = [ source for source, verified in executor.map( copyAndVerify, copies ) if not verified ]
+    except OSError as err:
+        text = [    f"Moving the results from {scratchRunIdDir} to {finalRunIdDir} failed: {err}",
+                    f"What is not in {finalRunIdDir} yet is still in {scratchRunIdDir}. Exiting."
+                 ]
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    if failed:
+        text = [    f"Checksum mismatch copying {len( failed )} files from {scratchRunIdDir} to {finalRunIdDir}:",
+                    *failed,
+                    f"The scratch copy is left in place. Exiting."
+                 ]
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    for name, path in demux.stagedPaths.items( ):
+        setattr( demux, name, path )
+    demux.stagedPaths = dict( )
+    os.chdir( demux.demultiplexRunIdDir )       # prepareDelivery( ) left us sitting in the scratch directory
+    if demux.scratchCleanup:
+        shutil.rmtree( scratchRunIdDir, ignore_errors = True )
+
+    text = "results moved:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{size / 1024**3:.1f} GiB, {len( copies )} files verified, in {time.monotonic( ) - startTime:.0f} seconds" )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Move the results from {demux.scratchDir} to {demux.demultiplexDir} finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# DemultiplexBackend
+########################################################################
+
+class DemultiplexBackend( abc.ABC ):
+    """
+    What demultiplex( ) needs to know about the program that turns BCL files into fastq.gz files:
+        command( )          the command line to run
+        normaliseOutput( )  turn the output layout into the one bcl2fastq writes, which is what every later stage expects:
+                                {outputDir}/{Sample_Project}/{Sample_Name}_S1_R1_001.fastq.gz
+                                {outputDir}/Undetermined_S0_R1_001.fastq.gz
+        parseStats( )       reads per sample, out of the program's statistics files
+        parseProgress( )    pick the ( lane, tile ) pairs out of the program's output, for the progress report
+
+    Pick the backend with getDemultiplexBackend( ). A backend that leaves out one of the abstract methods cannot be instantiated.
+    """
+
+    name   = ''
+    binary = ''
+
+    def executable( self ):
+        if demux.useShims:                                                  # test mode: a stand-in script that writes small fake outputs
+            return os.path.join( demux.shimDirPath, self.name )
+        return self.binary
+
+    def sampleSheet( self ):
+        if demux.bcl2fastqWritesFinalNames:
+            return demux.prefixedSampleSheetFilePath                        # {RunIDShort}.{project}/{RunIDShort}.{sample}* directly
+        return demux.sampleSheetFilePath
+
+    @abc.abstractmethod
+    def baseCommand( self ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def threadArguments( self, loading, processing, writing ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def command( self, outputDir, loading, processing, writing ):
+        raise NotImplementedError
+
+    def normaliseOutput( self, outputDir ):
+        pass
+
+    @abc.abstractmethod
+    def parseStats( self, outputDir ):
+        raise NotImplementedError
+
+    def parseProgress( self, line, tilesSeen ):
+        """
+        Add the ( lane, tile ) pair of {line}, if any, to the set {tilesSeen}.
+            Returns True if this is a tile we had not seen before
+        """
+        match = demux.bcl2fastqFileTileRegex.search( line ) or demux.bcl2fastqTileRegex.search( line )
+        if match:
+            laneTile = ( int( match.group( 1 ) ), int( match.group( 2 ) ) )
+        else:
+            match = demux.tileLaneRegex.search( line )
+            if not match:
+                return False
+            laneTile = ( int( match.group( 2 ) ), int( match.group( 1 ) ) )
+        if laneTile in tilesSeen:
+            return False
+        tilesSeen.add( laneTile )
+        return True
+
+
+
+########################################################################
+# Bcl2fastqBackend
+########################################################################
+
+class Bcl2fastqBackend( DemultiplexBackend ):
+    """
+    Illumina bcl2fastq 2.20
+        example: /usr/local/bin/bcl2fastq --no-lane-splitting --runfolder-dir /data/rawdata/RunID --output-dir /data/demultiplex/RunID_demultiplex
+    """
+
+    name   = 'bcl2fastq'
+    binary = demux.bcl2fastq_bin
+
+    def baseCommand( self ):
+        argv = [ self.executable( ), "--runfolder-dir", demux.rawDataRunIDdir, "--sample-sheet", self.sampleSheet( ), "--barcode-mismatches", str( demux.barcodeMismatches ) ]
+        if not demux.laneSplitting:
+            argv.insert( 1, "--no-lane-splitting" )                         # without it one file per lane, merged back per sample in mergeLaneFiles( )
+        return argv
+
+    def threadArguments( self, loading, processing, writing ):
+        return [ "--loading-threads", str( loading ), "--processing-threads", str( processing ), "--writing-threads", str( writing ) ]
+
+    def command( self, outputDir, loading, processing, writing ):
+        return [ *self.baseCommand( ), "--output-dir", outputDir, *self.threadArguments( loading, processing, writing ) ]
+
+    def parseStats( self, outputDir ):
+        """
+        {outputDir}/Stats/Stats.json -> { SampleId: reads }, summed over the lanes
+        """
+        with open( os.path.join( outputDir, demux.statsDirName, demux.statsFileName ), 'r', encoding = demux.decodeScheme ) as statsFileHandle:
+            stats = json.load( statsFileHandle )
+        reads = dict( )
+        for lane in stats.get( 'ConversionResults', [ ] ):
+            for sample in lane.get( 'DemuxResults', [ ] ):
+                reads[ sample[ 'SampleId' ] ] = reads.get( sample[ 'SampleId' ], 0 ) + sample.get( 'NumberReads', 0 )
+        return reads
+
+
+
+########################################################################
+# BclConvertBackend
+########################################################################
+
+class BclConvertBackend( DemultiplexBackend ):
+    """
+    Illumina BCL Convert, bcl2fastq's successor
+        example: /usr/local/bin/bcl-convert --bcl-input-directory /data/rawdata/RunID --output-directory /data/demultiplex/RunID_demultiplex --force
+                    --sample-sheet /data/rawdata/RunID/SampleSheet.csv --no-lane-splitting true --bcl-sampleproject-subdirectories true
+
+    --force, because createDemultiplexDirectoryStructure( ) has already created the output directory.
+    BCL Convert names the fastq.gz files after Sample_ID; normaliseOutput( ) renames them after Sample_Name and moves them into a
+        {project}/{Sample_ID}/ directory, like bcl2fastq does for a sample whose Sample_Name is not its Sample_ID.
+    """
+
+    name   = 'bcl-convert'
+    binary = demux.bclconvert_bin
+
+    def baseCommand( self ):
+        return [ self.executable( ), "--bcl-input-directory", demux.rawDataRunIDdir, "--sample-sheet", self.sampleSheet( ), "--force",
+                 "--no-lane-splitting", "false" if demux.laneSplitting else "true", "--bcl-sampleproject-subdirectories", "true" ]
+
+    def threadArguments( self, loading, processing, writing ):
+        return [ "--bcl-num-decompression-threads", str( loading ), "--bcl-num-conversion-threads", str( processing ), "--bcl-num-compression-threads", str( writing ) ]
+
+    def command( self, outputDir, loading, processing, writing ):
+        return [ *self.baseCommand( ), "--output-directory", outputDir, *self.threadArguments( loading, processing, writing ) ]
+
+    def normaliseOutput( self, outputDir ):
+        prefix = demux.RunIDShort + '.' if demux.bcl2fastqWritesFinalNames else ''
+        for project, samples in demux.samplesPerProject.items( ):
+            projectDir = os.path.join( outputDir, prefix + project )
+            if not os.path.isdir( projectDir ):
+                continue
+            with os.scandir( projectDir ) as iterator:
+                names = [ entry.name for entry in iterator ]
+            for sampleNumber, sampleName in samples:
+                sampleId = demux.sampleIdsByNumber.get( sampleNumber, sampleName )
+                if sampleId == sampleName:
+                    continue
+                idPrefix   = f"{prefix}{sampleId}_S{sampleNumber}_"
+                namePrefix = f"{prefix}{sampleName}_S{sampleNumber}_"
+                sampleDir  = os.path.join( projectDir, prefix + sampleId )
+                for name in names:
+                    if name.startswith( idPrefix ):
+                        os.makedirs( sampleDir, exist_ok = True )
+                        renameNoReplace( os.path.join( projectDir, name ), os.path.join( sampleDir, namePrefix + name[ len( idPrefix ): ] ) )
+
+    def parseStats( self, outputDir ):
+        """
+        {outputDir}/Reports/Demultiplex_Stats.csv -> { SampleID: reads }, summed over the lanes
+        """
+        reads = dict( )
+        with open( os.path.join( outputDir, demux.reportsDirName, demux.bclConvertStatsFileName ), 'r', encoding = demux.decodeScheme, newline = '' ) as statsFileHandle:
+            for row in csv.DictReader( statsFileHandle ):
+                reads[ row[ 'SampleID' ] ] = reads.get( row[ 'SampleID' ], 0 ) + int( float( row[ '# Reads' ] ) )
+        return reads
+
+
+
+########################################################################
+# getDemultiplexBackend( )
+########################################################################
+
+def getDemultiplexBackend( ):
+    """
+    Return the DemultiplexBackend for the current run, first match wins:
+        the DEMULTIPLEX_BACKEND environment variable
+        demux.backendPerRun[ RunID ]
+        demux.backendPerInstrument[ MiSeq/NextSeq ]
+        demux.demultiplexBackend
+    """
+
+    name = os.environ.get( demux.backendEnvironmentVariable ) \
+        or demux.backendPerRun.get( demux.RunID ) \
+        or demux.backendPerInstrument.get( getInstrumentType( demux.RunID ) ) \
+        or demux.demultiplexBackend
+
+    backends = { backend.name: backend for backend in [ Bcl2fastqBackend, BclConvertBackend ] }
+    if name not in backends:
+        text = f"Unknown demultiplexer backend '{name}', pick one of {', '.join( backends )}. Exiting."
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+    return backends[ name ]( )
+
+
+
+########################################################################
+# reportDemultiplexStats( )
+########################################################################
+
+def reportDemultiplexStats( backend ):
+    """
+    Log the reads per sample out of the backend's statistics, and warn about samples that got no reads at all:
+        usually a wrong index in SampleSheet.csv
+    """
+
+    try:
+        reads = backend.parseStats( demux.demultiplexRunIdDir )
+    except ( OSError, KeyError, ValueError ) as err:
+        demuxLogger.warning( f"Cannot read the {backend.name} statistics: {err}" )
+        return
+
+    for sampleId, count in sorted( reads.items( ) ):
+        text = f"{originalName( sampleId )}:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}{count} reads" )
+        if not count:
+            demuxLogger.warning( f"Sample {originalName( sampleId )} has no reads. Check its index in {demux.sampleSheetFileName}" )
+
+    text = "total reads:"
+    demuxLogger.info( f"{text:{demux.spacing2}}{sum( reads.values( ) )} in {len( reads )} samples" )
+
+
+
+########################################################################
+# demultiplex
+########################################################################
+
+def demultiplex( ):
+    """
+    Use Illumina's blc2fastq linux command-line tool to demultiplex each lane into an appropriate fastq file
+
+    bcl2fastq is available here https://emea.support.illumina.com/sequencing/sequencing_software/bcl2fastq-conversion-software/downloads.html
+        and you will have to have an account with Illumina to download it.
+        Account is setup automatically, but needs manual approval from representative in Illumina, which means you need a contract with Illumina
+        in order to access the software.
+
+    CAREFUL: when trying to execute this array, please break all arguments that include a space into their own array element. Otherwise it will execute as '--runfolder-dir {SequenceRunOriginDir}'
+         the space will be considered part of the argument: While you will scratch your head that you are passing argument and option, subprocess.run() will report that as a single
+         argument with no options
+
+        blc2fastq accepts just *fine* absolute paths when run from the command-line
+        example: /data/bin/bcl2fastq --no-lane-splitting --runfolder-dir /data/rawdata/220314_M06578_0091_000000000-DFM6K --output-dir /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex
+
+    CAREFUL: if you run blc2fastq with only --runfolder-dir {demux.RawDataRunIDdir} , bcl2fastq will create all the files within the {demux.RawDataRunIDdir} rawdata directory
+
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Demultiplexing started ==\n", color="green", attrs=["bold"] ) )
+
+    # increase the file descriptor limit to 65535:
+    #       241202_M06578_0219_000000000-LT29R has over 350 sampless, when executing it, bcl2fastq threw this error:
+    #       bcl2fastq::common::Exception: 2024-Dec-05 22:59:50: Too many open files (24): /TeamCityBuildAgent/work/556afd631a5b66d8/src/cxx/include/io/FileBufWithReopen.hpp(48): Throw in function bcl2fastq::io::BasicFileBufWithReopen<CharT, Traits>::BasicFileBufWithReopen(std::ios_base::openmode) [with CharT = char; Traits = std::char_traits<char>; std::ios_base::openmode = std::_Ios_Openmode]
+    #       Dynamic exception type: boost::exception_detail::clone_impl<bcl2fastq::common::IoError>
+    #       std::exception::what: Failed to allocate a file handle
+    # raising the file descriptor , seems to fix the issue
+    # command line equiv: ulimit -n 65535
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (65535, hard))
+
+    backend = getDemultiplexBackend( )                                      # bcl2fastq or bcl-convert
+    text = "demultiplexer:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{backend.name}" )
+
+    if demux.bcl2fastqShards > 1 and backend.name == Bcl2fastqBackend.name:  # split the run by tiles over several bcl2fastq processes
+        demultiplexSharded( backend )
+        reportDemultiplexStats( backend )
+        demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Demultiplexing finished ==\n", color="red", attrs=["bold"] ) )
+        return
+    elif demux.bcl2fastqShards > 1:
+        demuxLogger.warning( f"Sharding is only implemented for {Bcl2fastqBackend.name}, running {backend.name} as a single process." )
+
+    threads, cpus = demultiplexThreads( )                                  # -r/-p/-w sized to the cpus we have been granted and the run
+    argv = backend.command( demux.demultiplexRunIdDir, *threads )
+    preexecFunction  = None
+    if cpus:
+        preexecFunction = lambda: os.sched_setaffinity( 0, cpus )           # runs in the child before exec, so every bcl2fastq thread inherits the mask
+        text = "demultiplexer cpus:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}{','.join( str( cpu ) for cpu in cpus )}" )
+
+    text = f"Command to execute:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}" + "ulimit -n 65535; " + " ".join( argv ) )
+
+    try:
+        totalTiles = len( getRunInfo( )[ 'tiles' ] )
+    except ( OSError, AttributeError, TypeError, ValueError, ElementTree.ParseError ) as err:
+        demuxLogger.warning( f"Cannot read {demux.runInfoFileName}, no progress reporting: {err}" )
+        totalTiles = 0
+
+    # stream the output of bcl2fastq line by line into {demux.bcl2FastqLogFile}: a NextSeq run takes hours and writes megabytes of output,
+    # no point keeping all that in memory and looking at it only after bcl2fastq has exited
+    tilesSeen     = set( )
+    lastLines     = collections.deque( maxlen = demux.bcl2fastqTailLines )   # kept to report what went wrong if bcl2fastq fails
+    countLines    = 0
+    startTime     = time.monotonic( )
+    lastReport    = startTime
+    writeStatusFile( 'demultiplex', percent = 0, tiles = 0, totalTiles = totalTiles )
+
+    try:
+        # EXAMPLE: /usr/local/bin/bcl2fastq --no-lane-splitting --runfolder-dir ' + demux.rawDataRunIDdir + ' --output-dir ' + demux.demultiplexDir + ' 2> ' + demux.demultiplexDir + '/demultiplex_log/02_demultiplex.log'
+        with open( demux.bcl2FastqLogFile, "w", encoding = demux.decodeScheme ) as logFileHandle:
+            with subprocess.Popen( argv, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, cwd = demux.rawDataRunIDdir, encoding = demux.decodeScheme, errors = 'replace', bufsize = 1, preexec_fn = preexecFunction ) as process:
+                for line in process.stdout:
+                    logFileHandle.write( line )
+                    lastLines.append( line.rstrip( ) )
+                    countLines = countLines + 1
+
+                    if not backend.parseProgress( line, tilesSeen ) or not totalTiles:
+                        continue
+                    now = time.monotonic( )
+                    if now - lastReport < demux.progressInterval:
+                        continue
+                    lastReport = now
+                    percent    = min( 100.0, 100.0 * len( tilesSeen ) / totalTiles )
+                    eta        = ( now - startTime ) * ( totalTiles - len( tilesSeen ) ) / len( tilesSeen )
+                    etaText    = str( datetime.timedelta( seconds = int( eta ) ) )
+                    demuxLogger.info( f"{backend.name}: {len( tilesSeen )}/{totalTiles} tiles, {percent:.1f}% done, ETA {etaText}" )
+                    writeStatusFile( 'demultiplex', percent = round( percent, 1 ), tiles = len( tilesSeen ), totalTiles = totalTiles, eta = etaText )
+                    logFileHandle.flush( )
+            returncode = process.returncode
+    except OSError as err:                      # bcl2fastq is missing/not executable or the log file cannot be written
+        text = [    f"Caught exception!",
+                    f"Command: {' '.join( argv )}", # interpolated strings
+                    f"Error: {err}",
+                    f"Exiting."
+                 ]
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( f"{ text }" )
+        logging.shutdown( )
+        sys.exit( )
+
+    if returncode != 0:
+        text = [    f"{backend.name} failed!",
+                    f"Command: {' '.join( argv )}", # interpolated strings
+                    f"Return code: {returncode}",
+                    f"Last {len( lastLines )} lines of output, full output in {demux.bcl2FastqLogFile}:",
+                    *lastLines,
+                    f"Exiting."
+                 ]
+        text = '\n'.join( text )
+        writeStatusFile( 'demultiplex', failed = True, returncode = returncode )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( f"{ text }" )
+        logging.shutdown( )
+        sys.exit( )
+
+    if not countLines:
+        demuxLogger.critical( f"{backend.name} output has zero lenth. exiting at {inspect.currentframe().f_code.co_name}()" )
+        demuxFailureLogger.critical( f"{backend.name} output has zero lenth. exiting at {inspect.currentframe().f_code.co_name}()" )
+        logging.shutdown( )
+        sys.exit( )
+
+    elapsed = str( datetime.timedelta( seconds = int( time.monotonic( ) - startTime ) ) )
+    writeStatusFile( 'demultiplex', percent = 100, tiles = len( tilesSeen ), totalTiles = totalTiles, elapsed = elapsed )
+
+    backend.normaliseOutput( demux.demultiplexRunIdDir )                   # make the output look like bcl2fastq's
+    reportDemultiplexStats( backend )
+
+    if not os.path.isfile( demux.bcl2FastqLogFile ):
+        demuxFailureLogger.critical( f"{demux.bcl2FastqLogFile} did not get written to disk. Exiting." )
+        demuxLogger.critical( f"{demux.bcl2FastqLogFile} did not get written to disk. Exiting." )
+        logging.shutdown( )
+        sys.exit( )
+    else:
+        filesize = os.path.getsize( demux.bcl2FastqLogFile )
+        text = "bcl2FastqLogFile:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}" + f"{demux.bcl2FastqLogFile} is {filesize} bytes, bcl2fastq took {elapsed}.\n")
+
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Demultiplexing finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+
+########################################################################
+# renameNoReplace( )
+########################################################################
+
+def renameNoReplace( oldname, newname ):
+    """
+    Rename {oldname} to {newname}, but fail with FileExistsError if {newname} already exists, instead of silently overwriting it.
+
+    Uses renameat2( RENAME_NOREPLACE ), so the check and the rename are a single atomic system call.
+    If libc or the filesystem does not support renameat2( ) ( ENOSYS/EINVAL, old glibc, some Samba/NFS mounts ), fall back to
+        check-then-rename, which is what we have always done.
+    """
+
+    if demux.renameat2 is None:                                                 # look up renameat2( ) in libc only once
+        demux.renameat2 = False
+        try:
+            libc = ctypes.CDLL( None, use_errno = True )
+            demux.renameat2          = libc.renameat2
+            demux.renameat2.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint ]
+            demux.renameat2.restype  = ctypes.c_int
+        except ( AttributeError, OSError ):
+            pass
+
+    if demux.renameat2:
+        result = demux.renameat2( demux.AT_FDCWD, os.fsencode( oldname ), demux.AT_FDCWD, os.fsencode( newname ), demux.RENAME_NOREPLACE )
+        if result == 0:
+            return
+        error = ctypes.get_errno( )
+        if error not in [ errno.ENOSYS, errno.EINVAL ]:
+            raise OSError( error, os.strerror( error ), oldname, None, newname )
+
+    if os.path.lexists( newname ):
+        raise FileExistsError( errno.EEXIST, os.strerror( errno.EEXIST ), oldname, None, newname )
+    os.rename( oldname, newname )
+
+
+
+########################################################################
+# planRenames( )
+########################################################################
+
+def planRenames( ):
+    """
+    Work out every rename renameFilesAndDirectories( ) has to do, without touching anything on disk.
+
+    The plan comes from SampleSheet.csv: getExpectedOutput( ) is the relative path of every fastq.gz bcl2fastq writes,
+        {project}/[{Sample_ID}/]{sample}_S1_R1_001.fastq.gz, and getExpectedOutput( prefix ) is where it goes. Directories are
+        listed once each, no glob( ), no stat( ) per file; the listing is only used to find the files that are already renamed,
+        the ones that are missing and the fastq.gz files the sheet does not account for. Those are renamed anyway.
+
+    The plan can be resumed: a file or directory that already carries the {demux.RunIDShort}. prefix, from a previous, interrupted,
+        run, is not planned again.
+
+    Returns
+        list of ( oldname, newname ) tuples: files first, then the Sample_ID directories, then the project directories
+        and fills in demux.newProjectFileList, which is used by fastQC( )
+    """
+
+    fileRenames        = [ ]
+    sampleRenames      = dict( )                                        # { old Sample_ID directory: new }, several files per directory
+    projectRenames     = [ ]
+    newProjectFileList = [ ]
+    prefix             = demux.RunIDShort + '.'
+    expectedOutput     = getExpectedOutput( )
+    renamedOutput      = getExpectedOutput( prefix )
+
+    for project in demux.projectList:
+
+        if any( var in project for var in demux.controlProjects ):      # if the project name includes a control project name, ignore it
+            demuxLogger.warning( termcolor.colored( f"\"{project}\" control project name found in projects. Skipping, it will be handled in controlProjectsQC( ).\n", color="magenta" ) )
+            continue
+        elif project == demux.testProject:                              # ignore the test project
+            demuxLogger.debug( f"Test project '{demux.testProject}' detected. Skipping." )
+            continue
+
+        oldDirectory = os.path.join( demux.demultiplexRunIdDir, project )
+        newDirectory = os.path.join( demux.demultiplexRunIdDir, prefix + project )
+
+        if os.path.isdir( oldDirectory ):
+            projectDirectory = oldDirectory
+            projectRenames.append( ( oldDirectory, newDirectory ) )
+        elif os.path.isdir( newDirectory ):                             # renamed in a previous, interrupted, run
+            projectDirectory = newDirectory
+        else:
+            text = f"Neither {oldDirectory} nor {newDirectory} exist. Exiting."
+            demuxFailureLogger.critical( text )
+            demuxLogger.critical( text )
+            logging.shutdown( )
+            sys.exit( )
+
+        listings     = { projectDirectory: set( os.listdir( projectDirectory ) ) }      # { directory: { name, ... } }
+        renamedTo    = { projectDirectory: newDirectory }               # { directory: where it will be once everything is renamed }
+        accounted    = set( )                                           # paths the sheet accounts for, renamed or not
+        missingFiles = [ ]
+        countFiles   = 0
+
+        for expectedPath, renamedPath in zip( expectedOutput.get( project, [ ] ), renamedOutput.get( project, [ ] ) ):
+            expectedParts = expectedPath.split( '/' )                   # project, [ Sample_ID, ] file name
+            renamedParts  = renamedPath.split( '/' )
+
+            directory = projectDirectory
+            for expectedPart, renamedPart in zip( expectedParts[ 1:-1 ], renamedParts[ 1:-1 ] ):
+                parent = directory
+                if expectedPart in listings[ parent ]:
+                    directory = os.path.join( parent, expectedPart )
+                    sampleRenames[ directory ] = os.path.join( parent, renamedPart )
+                else:
+                    directory = os.path.join( parent, renamedPart )
+                if directory not in listings:
+                    listings[ directory ]  = set( os.listdir( directory ) ) if os.path.isdir( directory ) else set( )
+                    renamedTo[ directory ] = os.path.join( renamedTo[ parent ], renamedPart )
+
+            expectedName, renamedName = expectedParts[ -1 ], renamedParts[ -1 ]
+            accounted.update( [ os.path.join( directory, expectedName ), os.path.join( directory, renamedName ) ] )
+            if expectedName in listings[ directory ]:
+                fileRenames.append( ( os.path.join( directory, expectedName ), os.path.join( directory, renamedName ) ) )
+            elif renamedName not in listings[ directory ]:
+                missingFiles.append( expectedPath )
+                continue
+
+            countFiles = countFiles + 1
+            # The idea here is that the format of the new path is the fully renamed directory + fully renamed file
+            #
+            # DO NOT REMOVE THE DOTS. Look at https://github.com/NorwegianVeterinaryInstitute/DemultiplexRawSequenceData/issues/86#issuecomment-2527335084
+            # if you want some documentation as to 'why'
+            newProjectFileList.append( os.path.join( renamedTo[ directory ], renamedName ) )
+
+        unexpectedFiles = [ os.path.join( directory, name ) for directory, names in listings.items( ) for name in sorted( names )
+                            if name.endswith( demux.compressedFastqSuffix ) and os.path.join( directory, name ) not in accounted ]
+        for filePath in unexpectedFiles:
+            demuxLogger.warning( f"{project}: {os.path.relpath( filePath, demux.demultiplexRunIdDir )} does not match any sample in {demux.sampleSheetFileName}. Renaming it anyway." )
+            directory, name = os.path.split( filePath )
+            if not name.startswith( prefix ):
+                fileRenames.append( ( filePath, os.path.join( directory, prefix + name ) ) )
+            newProjectFileList.append( os.path.join( renamedTo[ directory ], prefix + name.removeprefix( prefix ) ) )
+        countFiles = countFiles + len( unexpectedFiles )
+
+        if not countFiles:
+            text = f"\n\nProject {project} does not contain any .fastq.gz entries"
+            text = f"{text} | method {inspect.stack()[0][3]}() ]"
+            text = f"{text}\n\n"
+            demuxFailureLogger.critical( text )
+            demuxLogger.critical( text )
+            logging.shutdown( )
+            sys.exit( )
+
+        for filePath in missingFiles:
+            demuxLogger.warning( f"{project}: {filePath} listed in {demux.sampleSheetFileName} was not written by the demultiplexer" )
+
+        text = f"{project}:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}{countFiles} fastq files, {len( expectedOutput.get( project, [ ] ) ) - len( missingFiles )}/{len( expectedOutput.get( project, [ ] ) )} expected" )
+
+    demux.newProjectFileList = sorted( newProjectFileList )
+
+    return fileRenames + list( sampleRenames.items( ) ) + projectRenames
+
+
+
+########################################################################
+# executeRenames( )
+########################################################################
+
+def executeRenames( renames ):
+    """
+    Execute the ( oldname, newname ) renames planned by planRenames( ).
+
+    Every rename is written to the rename journal, {demux.renameJournalFilePath}, before it is executed, so an interrupted
+        stage can be resumed ( planRenames( ) skips what is already done ) or undone with rollbackRenames( ).
+        The journal has the paths relative to {demux.demultiplexRunIdDir}: the renames happen on scratch when the run is staged
+        there, see stageToScratch( ), and the files are under /data by the time anybody rolls them back.
+    """
+
+    demuxLogger.debug( "-----------------")
+    demuxLogger.debug( f"Move commands to execute:" )
+
+    with open( demux.renameJournalFilePath, "a", encoding = demux.decodeScheme ) as journal:
+        for oldname, newname in renames:
+
+            journal.write( f"{os.path.relpath( oldname, demux.demultiplexRunIdDir )}\t{os.path.relpath( newname, demux.demultiplexRunIdDir )}\n" )
+            journal.flush( )
+            if demux.verbosity == 3:
+                demuxLogger.debug( " "*demux.spacing1 + f"/usr/bin/mv {oldname} {newname}" )
+
+            try: 
+                renameNoReplace( oldname, newname )
+            except OSError as err:
+                text = [    f"Error during renaming {oldname}:",
+                            f"oldname: {oldname}",
+                            f"newname: {newname}",
+                            f"strerror:      {err.strerror}",
+                            f"err.filename:  {err.filename}",
+                            f"err.filename2: {err.filename2}",
+                            f"Undo with rollbackRenames( ) or re-run to resume. Rename journal: {demux.renameJournalFilePath}",
+                            f"Exiting!"
+                     ]
+                text = '\n'.join( text )
+                demuxFailureLogger.critical( f"{ text }" )
+                demuxLogger.critical( f"{ text }" )
+                logging.shutdown( )
+                sys.exit( )
+
+        os.fsync( journal.fileno( ) )
+
+    demuxLogger.debug( "-----------------")
+
+
+
+########################################################################
+# rollbackRenames( )
+########################################################################
+
+def rollbackRenames( ):
+    """
+    Undo the renames recorded in {demux.renameJournalFilePath}, newest first, then remove the journal.
+        Entries that were journaled but never executed are skipped. The entries are relative to {demux.demultiplexRunIdDir},
+        wherever it is now.
+
+    Call it after setupEnvironment( RunID ), for example:
+        python3.11 -c 'import demultiplex_script as d; d.setupEnvironment( "RunID" ); d.rollbackRenames( )'
+    """
+
+    if not os.path.isfile( demux.renameJournalFilePath ):
+        demuxLogger.warning( f"{demux.renameJournalFilePath} does not exist, nothing to roll back." )
+        return
+
+    with open( demux.renameJournalFilePath, "r", encoding = demux.decodeScheme ) as journal:
+        renames = [ [ os.path.join( demux.demultiplexRunIdDir, name ) for name in line.rstrip( '\n' ).split( '\t' ) ] for line in journal if line.strip( ) ]
+
+    rolledBack = 0
+    for oldname, newname in reversed( renames ):
+        if os.path.lexists( newname ) and not os.path.lexists( oldname ):
+            renameNoReplace( newname, oldname )
+            rolledBack = rolledBack + 1
+
+    os.remove( demux.renameJournalFilePath )
+    demuxLogger.info( f"{rolledBack} of {len( renames )} renames in {demux.renameJournalFilePath} rolled back." )
+
+
+
+########################################################################
+# renameFilesAndDirectories( )
+########################################################################
+
+def renameFilesAndDirectories( ):
+    """
+    Rename any [sample-1_S1_R1_001.fastq.gz, .. , sample-1_S1_Rn_001.fastq.gz ] files inside 
+        {demux.demultiplexRunIdDir}/{demux.RunIDShort}/[ { projectList[0] }, .. , { projectList[n] } ] to match the pattern
+        {demux.RunIDShort}.[sample-1_S1_R1_001.fastq.gz, .. , sample-1_S1_Rn_001.fastq.gz ]
+    
+    Then rename the 
+        {demux.demultiplexRunIdDir}/{demux.RunIDShort}/[ { projectList[0] }, .. , { projectList[n] } ] to match the pattern
+        {demux.demultiplexRunIdDir}/{demux.RunIDShort}/{demux.RunIDShort}.[ {projectList[0] }, .. , { projectList[n] } ] to match the pattern
+        
+    Examples:
+    
+        demultiplexRunIdDir: /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/
+        Sample_Project:      SAV-amplicon-MJH              ### DO NOT change Sample_Project to sampleProject. The relevant heading column in the .csv is litereally named 'Sample_Project'
+        demux.RunIDShort:    220314_M06578
+
+        1. Rename the files:
+            /bin/mv /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/sample-1_S1_R1_001.fastq.gz /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/220314_M06578.sample-1_S1_R1_001.fastq.gz
+            /bin/mv /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/sample-1_S1_R2_001.fastq.gz /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH/220314_M06578.sample-1_S1_R2_001.fastq.gz
+
+        2. Rename the base directory, for each project:
+            /bin/mv /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/SAV-amplicon-MJH /data/demultiplex/220314_M06578_0091_000000000-DFM6K_demultiplex/220314_M06578.SAV-amplicon-MJH
+
+        A sample whose Sample_Name is not its Sample_ID has its files in a {Sample_ID} directory inside the project; that directory
+            gets the prefix too, between 1. and 2.
+
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Renaming started ==", color="green", attrs=["bold"] ) )
+
+
+    text = f"demultiplexRunIdDir:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}" + demux.demultiplexRunIdDir )    # tabulation error
+    text = f"RunIDShort:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}" + demux.RunIDShort )
+    if demux.verbosity == 2:
+        text = "demux.projectList:"
+        demuxLogger.debug( f"{text:{demux.spacing2}}" + f"{demux.projectList}" )
+
+    startTime = time.monotonic( )
+    renames   = planRenames( )                  # files first, then the project directories. Empty if demux.bcl2fastqWritesFinalNames
+    executeRenames( renames )
+
+    for index, item in enumerate( demux.newProjectFileList ):
+        text = f"demux.newProjectFileList[{index}]:"
+        demuxLogger.debug( f"{text:{demux.spacing3}}" + item) # make sure the debugging output is all lined up.
+
+    text = "renamed:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{len( renames )} entries in {time.monotonic( ) - startTime:.3f} seconds" )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Renaming finished ==", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# countReads( )
+########################################################################
+
+def countReads( filepath ):
+    """
+    Count the reads in a .fastq.gz file: four lines per read.
+        Returns filepath, reads
+    """
+
+    lines = 0
+    with gzip.open( filepath, 'rb' ) as filehandle:
+        while True:
+            chunk = filehandle.read( demux.copyBufferSize )
+            if not chunk:
+                break
+            lines = lines + chunk.count( b'\n' )
+    return filepath, lines // 4
+
+
+
+########################################################################
+# mergeAndHashLaneFiles( )
+########################################################################
+
+def mergeAndHashLaneFiles( args ):
+    """
+    Concatenate the per-lane .fastq.gz files of one sample/read, in lane order, into the per-sample file bcl2fastq would have
+        written with --no-lane-splitting. The concatenated gzip members make a valid .fastq.gz, nothing gets recompressed.
+
+    The md5/sha512 are calculated on the way through and the .md5/.sha512 files written next to the merged file,
+        so calcFileHash( ) does not need to read the file again.
+
+    Returns the merged file path
+    """
+
+    mergedFilePath, laneFilePaths = args
+    md5sum    = hashlib.md5( )
+    sha512sum = hashlib.sha512( )
+
+    with open( mergedFilePath, 'xb' ) as mergedFileHandle:
+        for laneFilePath in laneFilePaths:
+            with open( laneFilePath, 'rb' ) as laneFileHandle:
+                while True:
+                    chunk = laneFileHandle.read( demux.copyBufferSize )
+                    if not chunk:
+                        break
+                    mergedFileHandle.write( chunk )
+                    md5sum.update( chunk )
+                    sha512sum.update( chunk )
+
+    for laneFilePath in laneFilePaths:
+        os.remove( laneFilePath )
+
+    twoMandatorySpaces = "  "
+    with open( mergedFilePath + demux.md5Suffix, "w" ) as fh:
+        fh.write( f"{md5sum.hexdigest( )}{twoMandatorySpaces}{os.path.basename( mergedFilePath )}\n" )       # the two spaces are mandatory to be re-verified after uploading via 'md5sum -c FILE'
+    with open( mergedFilePath + demux.sha512Suffix, "w" ) as fh:
+        fh.write( f"{sha512sum.hexdigest( )}{twoMandatorySpaces}{os.path.basename( mergedFilePath )}\n" )    # the two spaces are mandatory to be re-verified after uploading via 'sha512sum -c FILE'
+
+    return mergedFilePath
+
+
+
+########################################################################
+# mergeLaneFiles( )
+########################################################################
+
+def mergeLaneFiles( ):
+    """
+    Lane-aware mode ( demux.laneSplitting ): bcl2fastq ran without --no-lane-splitting, so every sample has one file per lane:
+        {RunIDShort}.{sample}_S1_L001_R1_001.fastq.gz .. {RunIDShort}.{sample}_S1_L004_R1_001.fastq.gz
+
+    bcl2fastq writes the lanes in parallel instead of funneling four lanes into one output stream per sample. Here we
+        count the reads of every lane file, in parallel, into {demux.readCountsFilePath}
+        concatenate the lane files of every sample/read, in parallel, into {RunIDShort}.{sample}_S1_R1_001.fastq.gz and
+            hash them on the way through
+
+    Delivered names are the same as without lane splitting. FastQC runs on the merged per-sample files afterwards, same as always,
+        because the reports are delivered per sample.
+
+    The lane files come from SampleSheet.csv, getSampleSheet( ).expectedLaneFiles( ), with the {RunIDShort}. prefix for the projects
+        renameFilesAndDirectories( ) renamed and without it for the control and test projects and Undetermined. Lane files the sheet
+        does not account for are left as they are, planRenames( ) has already warned about them.
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Merging per-lane fastq.gz files started ==", color="green", attrs=["bold"] ) )
+
+    startTime = time.monotonic( )
+    merges    = dict( )                                     # { mergedFilePath: [ laneFilePath, ... ] }, in lane order
+    for prefix in [ demux.RunIDShort + '.', '' ]:
+        expectedLaneFiles = getSampleSheet( ).expectedLaneFiles( getOutputLanes( ), prefix, getReadNumbers( ) )
+        for mergedFile, laneFiles in expectedLaneFiles.items( ):
+            laneFilePaths = [ os.path.join( demux.demultiplexRunIdDir, laneFile ) for laneFile in laneFiles ]
+            laneFilePaths = [ laneFilePath for laneFilePath in laneFilePaths if os.path.isfile( laneFilePath ) ]
+            if laneFilePaths:
+                merges[ os.path.join( demux.demultiplexRunIdDir, mergedFile ) ] = laneFilePaths
+
+    laneFiles  = [ laneFilePath for laneFilePaths in merges.values( ) for laneFilePath in laneFilePaths ]
+
+    text = "lane files:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{len( laneFiles )} into {len( merges )} per-sample files" )
+
+    # count the reads per lane: decompressing is cpu bound, so processes
+    with futures.ProcessPoolExecutor( max_workers = len( getAvailableCpus( ) ) ) as executor:
+        readCounts = dict( executor.map( countReads, laneFiles, chunksize = 4 ) )
+
+    with open( demux.readCountsFilePath, 'w', encoding = demux.decodeScheme ) as readCountsFileHandle:
+        readCountsFileHandle.write( "file\treads\n" )
+        for laneFilePath in laneFiles:
+            readCountsFileHandle.write( f"{os.path.relpath( laneFilePath, demux.demultiplexRunIdDir )}\t{readCounts[ laneFilePath ]}\n" )
+
+    # concatenate and hash: hashlib releases the GIL on large buffers, so threads are enough
+    with futures.ThreadPoolExecutor( max_workers = demux.mergeWorkers ) as executor:
+        for mergedFilePath in executor.map( mergeAndHashLaneFiles, merges.items( ) ):
+            if demux.verbosity == 3:
+                demuxLogger.debug( f"merged {mergedFilePath}" )
+
+    # fastQC( ) works on the merged files
+    newProjectFileList = set( )
+    for filepath in demux.newProjectFileList:
+        match = demux.laneFileNameRegex.match( os.path.basename( filepath ) )
+        if match:
+            filepath = os.path.join( os.path.dirname( filepath ), f"{match.group( 1 )}_{match.group( 3 )}" )
+        newProjectFileList.add( filepath )
+    demux.newProjectFileList = sorted( newProjectFileList )
+
+    text = "merged:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{len( merges )} files, {sum( readCounts.values( ) )} reads in {time.monotonic( ) - startTime:.1f} seconds" )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Merging per-lane fastq.gz files finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# fastQC
+########################################################################
+
+def fastQC( ):
+    """
+    fastQC: Run /data/bin/fastqc (which is a symlink to the real qc)
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: fastQC started ==", color="yellow" ) )
+
+    command             = demux.fastqc_bin
+    threads             = max( 1, min( demux.threadsToUse, len( getAvailableCpus( ) ), len( demux.newProjectFileList ) ) ) # FastQC runs one thread per file
+    argv                = [ command, '-t', str( threads ), *demux.newProjectFileList ]  # the * operator on a list/array "splats" (flattens) the values in the array, breaking them down to individual arguemtns
 
     arguments = " ".join( argv[1:] )
     text = "Command to execute:"
@@ -1037,7 +3381,7 @@ def fastQC( ):
     try:
         # EXAMPLE: /usr/local/bin/fastqc -t 4 {demux.demultiplexRunIdDir}/{project}/*fastq.gz > demultiplexRunIdDir/demultiplex_log/04_fastqc.log
         result = subprocess.run( argv, capture_output = True, cwd = demux.demultiplexRunIdDir, check = True, encoding = demux.decodeScheme )
-    except ChildProcessError as err: 
+    except subprocess.CalledProcessError as err: 
             text = [ "Caught exception!",
                      f"Command: {err.cmd}", # interpolated strings
                      f"Return code: {err.returncode}"
@@ -1232,7 +3576,7 @@ def multiQC( ):
     try:
         # EXAMPLE: /usr/local/bin/multiqc {demux.demultiplexRunIdDir} -o {demux.demultiplexRunIdDir} 2> {demux.demultiplexRunIdDir}/demultiplex_log/05_multiqc.log
         result = subprocess.run( argv, capture_output = True, cwd = demux.demultiplexRunIdDir, check = True, encoding = demux.decodeScheme )
-    except ChildProcessError as err: 
+    except subprocess.CalledProcessError as err: 
         text = [    f"Caught exception!",
                     f"Command:\t{err.cmd}", # interpolated strings
                     f"Return code:\t{err.returncode}"
@@ -1403,15 +3747,16 @@ def calcFileHash( eitherRunIdDir ):
             if not any( var in file for var in [ demux.compressedFastqSuffix, demux.zipSuffix, demux.tarSuffix ] ): # grab only .zip, .fasta.gz and .tar files
                 continue
 
-            # Check if any filenames are .md5/.sha512 files
-            if any( var in file for var in [ demux.sha512Suffix, demux.md5Suffix  ] ):
-                text = f"{filepath} is already a sha512 file!."
-                demuxFailureLogger.critical( f"{ text }" )
-                demuxLogger.critical( f"{ text }" )
+            # .md5/.sha512 files are our own checksum files, not something to hash
+            if any( file.endswith( var ) for var in [ demux.sha512Suffix, demux.md5Suffix  ] ):
                 continue
 
             filepath = os.path.join( directoryRoot, file )
 
+            # already hashed, for example by mergeAndHashLaneFiles( )
+            if os.path.isfile( filepath + demux.md5Suffix ) and os.path.isfile( filepath + demux.sha512Suffix ):
+                continue
+
             if not os.path.isfile( filepath ):
                 text = f"{filepath} is not a file. Exiting."
                 demuxFailureLogger.critical( f"{ text }" )
@@ -1426,33 +3771,167 @@ def calcFileHash( eitherRunIdDir ):
             fileList.append( filepath )
         
     # since we got 96gb of ram, read all the files in and hash them in parallel
-    with ProcessPoolExecutor( ) as executor:
+    with futures.ProcessPoolExecutor( ) as executor:
         filePathAndHashesResults = list( executor.map( hash_file, fileList ) ) # hash_file( ) returns filepath, md5sum, sha512sum
 
     # write the checksums to disk, in parallel
-    with ProcessPoolExecutor() as executor:
+    with futures.ProcessPoolExecutor() as executor:
         executor.map( write_checksum_files, filePathAndHashesResults )
 
     # make sure we are writing files in the 2kb range and not abominations
-    with ProcessPoolExecutor() as executor:
+    with futures.ProcessPoolExecutor() as executor:
         executor.map( is_file_large, filePathAndHashesResults )
 
     demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Calculating md5/sha512 sums for .tar and .gz files finished ==\n", color="red", attrs=["bold"] ) )
 
 
 
+#######################################################################
+# getCommonGid
+########################################################################
+
+def getCommonGid( ):
+    """
+    Return the numerical group id of {demux.commonEgid} ( sambagroup ) or None if the group does not exist on this host.
+        The lookup is done once and cached in demux.commonGid
+    """
+
+    if demux.commonGid is None:
+        try:
+            demux.commonGid = grp.getgrnam( demux.commonEgid ).gr_gid
+        except KeyError:
+            demux.commonGid = -1        # group does not exist, remember that so we do not look it up again
+
+    if demux.commonGid == -1:
+        return None
+    return demux.commonGid
+
+
+
+#######################################################################
+# setCommonGroup
+########################################################################
+
+def setCommonGroup( dirpath ):
+    """
+    Set the group of a freshly created directory to {demux.commonEgid} and set the setgid bit on it, so everything
+        bcl2fastq, FastQC, MultiQC and this script create under it inherits the group at creation time.
+        Together with demux.umask, this makes the changePermissions( ) walk mostly a no-op.
+
+    Not being a member of {demux.commonEgid} is not fatal: changePermissions( ) will complain about it later
+    """
+
+    gid = getCommonGid( )
+    if gid is None:
+        demuxLogger.warning( f"group {demux.commonEgid} does not exist on this host. Not setting the group of {dirpath}" )
+        return
+
+    try:
+        os.chown( dirpath, -1, gid )
+        os.chmod( dirpath, demux.directoryPermissions | stat.S_ISGID ) # rwxrwsr-x / 2775
+    except PermissionError as err:
+        demuxLogger.warning( f"Cannot set group {demux.commonEgid} on {dirpath}: {err.strerror}" )
+
+
+
+#######################################################################
+# scanPermissions
+########################################################################
+
+def scanPermissions( path, gid ):
+    """
+    Walk down from {path} with os.scandir( ) and return the number of entries scanned and the entries that need fixing, as a list of
+        ( entrypath, newMode, newGid )
+        newMode is None if the access mode is already correct, newGid is None if the group is already correct
+
+    One lstat( ) per entry: os.scandir( ) caches the stat result in the DirEntry, so we never stat the same entry twice
+    Symbolic links are left alone, chmod( ) on a symlink changes its target.
+    """
+
+    toFix = [ ]
+    stack = [ path ]
+
+    rootStat = os.lstat( path )
+    entries  = [ ( path, rootStat, True ) ]
+
+    while stack:
+        with os.scandir( stack.pop( ) ) as iterator:
+            for entry in iterator:
+                if entry.is_symlink( ):
+                    continue
+                isDir = entry.is_dir( follow_symlinks = False )
+                entries.append( ( entry.path, entry.stat( follow_symlinks = False ), isDir ) )
+                if isDir:
+                    stack.append( entry.path )
+
+    for entrypath, entryStat, isDir in entries:
+        wantedMode  = demux.directoryPermissions if isDir else demux.filePermissions
+        currentMode = stat.S_IMODE( entryStat.st_mode )
+        newMode     = None
+        newGid      = None
+
+        if currentMode & 0o777 != wantedMode:
+            newMode = ( currentMode & ~0o777 ) | wantedMode       # keep the setgid bit set by setCommonGroup( )
+        if gid is not None and entryStat.st_gid != gid:
+            newGid = gid
+
+        if newMode is not None or newGid is not None:
+            toFix.append( ( entrypath, newMode, newGid ) )
+
+    return len( entries ), toFix
+
+
+
+#######################################################################
+# fixPermissions
+########################################################################
+
+def fixPermissions( args ):
+    """
+    Worker for changePermissions( ): chgrp/chmod a single entry.
+        chgrp goes first, because chown( ) clears the setgid bit on some filesystems
+
+    Returns ( warnings, error ): a PermissionError, not being in {demux.commonEgid} or not owning the entry, is a warning, like in
+        setCommonGroup( ); any other error is the text of the error, None if there was none
+    """
+
+    entrypath, newMode, newGid = args
+    warnings = [ ]
+    try:
+        if newGid is not None:
+            os.chown( entrypath, -1, newGid )
+    except PermissionError as err:
+        warnings.append( f"chgrp {entrypath}: {err.strerror}" )
+    except OSError as err:
+        return warnings, f"chgrp {entrypath}: {err.strerror}"
+    try:
+        if newMode is not None:
+            os.chmod( entrypath, newMode )
+    except PermissionError as err:
+        warnings.append( f"chmod {entrypath}: {err.strerror}" )
+    except OSError as err:
+        return warnings, f"chmod {entrypath}: {err.strerror}"
+    return warnings, None
+
+
+
 #######################################################################
 # changePermissions
 ########################################################################
 
 def changePermissions( path ):
     """
-    changePermissions: recursively walk down from {directoryRoot} and 
-        change the owner to :sambagroup
+    changePermissions: recursively walk down from {path} and 
+        change the group to :sambagroup
         if directory
-            change permissions to 755
+            change permissions to 775
         if file
-            change permissions to 644
+            change permissions to 664
+
+        Only entries whose mode or group differ get touched; since directories are created with the
+        sambagroup setgid bit and under demux.umask, on a normal run there is next to nothing to do.
+        The chmod/chown calls are spread over demux.permissionsWorkers threads: on Samba/NFS each call
+        is a network round trip and a 100k entry tree otherwise takes minutes.
 
     INPUT
         input is a generic path rather than demux.demultiplexRunID, because we use this method more than once
@@ -1463,69 +3942,51 @@ def changePermissions( path ):
 
     demuxLogger.debug( termcolor.colored( f"= walk the file tree, {inspect.stack()[0][3]}() ======================", attrs=["bold"] ) )
 
-    for directoryRoot, dirnames, filenames, in os.walk( path, followlinks = False ):
-    
-        # change ownership and access mode of files
-        for file in filenames:
-            filepath = os.path.join( directoryRoot, file )
-            demuxLogger.debug( " "*demux.spacing2 + f"chmod 664 {filepath}" ) # print chmod 664 {dirpath}
-
-            if not os.path.isfile( filepath ):
-                text = f"{filepath} is not a file. Exiting." 
-                demuxFailureLogger.critical( f"{ text }" )
-                demuxLogger.critical( f"{ text }" )
-                logging.shutdown( )
-                sys.exit( )
-
-            try:
-                # EXAMPLE: '/bin/chmod -R g+rwX sambagroup ' + folder_or_file, demultiplex_out_file
-                os.chmod(filepath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH) # rw-rw-r-- / 664 / read-write owner, read-write group, read others
-            except FileNotFoundError as err:                # FileNotFoundError is a subclass of OSError[ errno, strerror, filename, filename2 ]
-                text = [    f"\tFileNotFoundError in {inspect.stack()[0][3]}()",
-                            f"\terrno:\t{err.errno}",
-                            f"\tstrerror:\t{err.strerror}",
-                            f"\tfilename:\t{err.filename}",
-                            f"\tfilename2:\t{err.filename2}"
-                        ]
-                text = '\n'.join( text )
-                demuxFailureLogger.critical( f"{ text }" )
-                demuxLogger.critical( f"{ text }" )
-                logging.shutdown( )
-                sys.exit( )
-
-    # change ownership and access mode of directories
-    demuxLogger.debug( termcolor.colored( f"= walk the dir tree, {inspect.stack()[0][3]}() ======================", attrs=["bold"] ) )
-    for directoryRoot, dirnames, filenames, in os.walk( path, followlinks = False ):
-
-        for name in dirnames:
-            dirpath = os.path.join( directoryRoot, name )
-
-            demuxLogger.debug( " "*demux.spacing2 + f"chmod 775 {dirpath}" ) # print chmod 755 {dirpath}
-
-            if not os.path.isdir( dirpath ):
-                text = f"{dirpath} is not a directory. Exiting."
-                demuxFailureLogger.critical( f"{ text }" )
-                demuxLogger.critical( f"{ text }" )
-                logging.shutdown( )
-                sys.exit( )
+    gid = getCommonGid( )
+    if gid is None:
+        demuxLogger.warning( f"group {demux.commonEgid} does not exist on this host. Only changing the access mode." )
 
-            try:
-                # EXAMPLE: '/bin/chmod -R g+rwX sambagroup ' + folder_or_file, demultiplex_out_file
-                os.chmod( dirpath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH ) # rwxrwxr-x / 775 / read-write-execute owner, read-write-execute group, read-execute others 
-            except FileNotFoundError as err:                # FileNotFoundError is a subclass of OSError[ errno, strerror, filename, filename2 ]
-                text = [
-                        f"\tFileNotFoundError in {inspect.stack()[0][3]}()",
-                        f"\terrno:\t{err.errno}",
-                        f"\tstrerror:\t{err.strerror}",
-                        f"\tfilename:\t{err.filename}",
-                        f"\tfilename2:\t{err.filename2}"
+    try:
+        totalEntries, toFix = scanPermissions( path, gid )
+    except FileNotFoundError as err:                # FileNotFoundError is a subclass of OSError[ errno, strerror, filename, filename2 ]
+        text = [    f"\tFileNotFoundError in {inspect.stack()[0][3]}()",
+                    f"\terrno:\t{err.errno}",
+                    f"\tstrerror:\t{err.strerror}",
+                    f"\tfilename:\t{err.filename}",
+                    f"\tfilename2:\t{err.filename2}"
                 ]
-                text = '\n'.join( text )
-                demuxFailureLogger.critical( f"{ text }" )
-                demuxLogger.critical( f"{ text }" )
-                logging.shutdown( )
-                sys.exit( )
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( f"{ text }" )
+        demuxLogger.critical( f"{ text }" )
+        logging.shutdown( )
+        sys.exit( )
 
+    text = "entries scanned:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{totalEntries}" )
+    text = "entries to fix:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{len( toFix )}" )
+    if demux.verbosity == 3:
+        for entrypath, newMode, newGid in toFix:
+            modeText = f"chmod {newMode:o}" if newMode is not None else ""
+            gidText  = f"chgrp {demux.commonEgid}" if newGid is not None else ""
+            demuxLogger.debug( " "*demux.spacing2 + f"{gidText} {modeText} {entrypath}" )
+
+    with futures.ThreadPoolExecutor( max_workers = demux.permissionsWorkers ) as executor:
+        results = list( executor.map( fixPermissions, toFix ) )
+    warnings = [ warning for entryWarnings, error in results for warning in entryWarnings ]
+    errors   = [ error for entryWarnings, error in results if error is not None ]
+
+    if warnings:                                    # somebody else's files, or we are not in the group: the run itself is fine
+        shown = warnings[ :demux.preflightReportLines ]
+        if len( warnings ) > len( shown ):
+            shown.append( f"... and {len( warnings ) - len( shown )} more" )
+        demuxLogger.warning( '\n'.join( [ f"Not allowed to change the group or mode of { len( warnings ) } entries, left as they are:", *shown ] ) )
+    if errors:
+        text = '\n'.join( [ f"Changing permissions failed for { len( errors ) } entries:", *errors ] )
+        demuxFailureLogger.critical( f"{ text }" )
+        demuxLogger.critical( f"{ text }" )
+        logging.shutdown( )
+        sys.exit( )
 
     demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Changing Permissions finished ==\n", color="red", attrs=["bold"] ) )
 
@@ -1777,215 +4238,710 @@ def prepareDelivery( ):
     createQcTarFile( )
     createMultiQcTarFile( )
 
-    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Preparing files for delivery finished ==", color="red", attrs=["bold"] ) )
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Preparing files for delivery finished ==", color="red", attrs=["bold"] ) )
+
+
+
+
+
+########################################################################
+# Water Control Negative report
+########################################################################
+
+def controlProjectsQC(  ):
+    """
+    This function creeates a report if any water 1 samples are submitted for sequence ( and subsequently, analysis )
+
+    If there are no water control samples, no report is generated.
+
+    If there are water control samples,
+        create the full report ONLY if any amplicons are found
+    Otherwise
+        just mention in green text that no results are detected (and move on)
+    """
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Control Project QC for non-standard proejcts started ==", color="green", attrs=["bold"] ) )
+
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Control Project QC for non-standard proejcts finished ==", color="red", attrs=["bold"] ) )
+
+
+
+
+########################################################################
+# Perform a sha512 comparision
+########################################################################
+
+def sha512FileQualityCheck(  ):
+    """
+    re-perform (quietly) the sha512 calculation and compare that with the result on file for the specific file.
+    """
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: sha512 files check started ==", color="green", attrs=["bold"] ) )
+
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: sha512 files check finished ==", color="red", attrs=["bold"] ) )
+
+
+
+
+
+########################################################################
+# tarFileQualityCheck: verify tar files before upload
+########################################################################
+
+def tarFileQualityCheck(  ):
+    """
+    Perform a final quality check on the tar files before uploading them.
+    If there are errors in the untarring or the sha512 check, halt.
+    If there are no errors, go ahead with the uploading
+
+
+    steps for completing this function:
+        Step 1: create a /data/for_transfer/RunID/test directory
+        Step 2: copy any tar file for relevant RunIDShort into the test directory
+        Step 3: untar files under /data/for_transfer/RunID/test
+        Step 4: recalculate sha512 hash for each file
+        compare result with hash file on disk
+            stuff result in sql database?
+        delete {demux.forTransferRunIdDir}/{demux.forTransferRunIdDirTestName} and contents
+        return True/false depending on answer
+
+    INPUT
+        Input is RunID rather than demux.RunID or some other variable because we can use this method later to check the tarFile quality of any fetched tar file from archive
+    """
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Tar files quaility check started ==", color="green", attrs=["bold"] ) )
+
+    forTransferRunIdDirTestName = os.path.join( demux.forTransferRunIdDir,demux.forTransferRunIdDirTestName )
+
+#---- Step 1: create a /data/for_transfer/RunID/test directory -------------------------------------------------------------------------------------------
+
+    # ensure that demux.forTransferDir (/data/for_transfer) exists
+    if not os. path. isdir( demux.forTransferDir ):
+        text = f"{demux.forTransferDir} does not exist! Please re-run the ansible playbook! Exiting!"
+        demuxFailureLogger.critical( f"{ text }" )
+        demuxLogger.critical( f"{ text }" )
+        logging.shutdown( )
+        sys.exit( )    
+
+    try: 
+        os.mkdir( forTransferRunIdDirTestName )
+    except Exception as err:
+        text = f"{demux.forTransferRunIdDir} cannot be created: { str( err ) }\nExiting!"
+        demuxFailureLogger.critical( f"{ text }" )
+        demuxLogger.critical( f"{ text }" )
+        logging.shutdown( )
+        sys.exit( )
+
+# there is no point in making this complicated: tar files can be easily edited, they are just a simple container and any attacker can easily alter the file insitu,
+# recalculate the hash and replace the hash again in situ
+#
+# So the only thing we can do is basically untar the file to ensure that it was packed correctly in this program,
+# then delete the test_tar directory
+
+# for file in $TARFILES; do printf '\n==== tar file: $file============================='; tar --verbose --compare --file=$file | grep -v 'Mod time differs'; done
+#---- Step 2: untar all demux.tarFilesToTransferList in {demux.forTransferRunIdDir}/{demux.forTransferRunIdDirTestName} ------------------------------------------------------------
+    for tarFile in demux.tarFilesToTransferList:
+        try:
+            text = "Now extracting tarfile:"
+            demuxLogger.debug( f"{text:{demux.spacing3}}" + tarFile )
+            tarFileHandle = tarfile.open( name = tarFile, mode = "r:" )     # Open a tar file under  demux.forTransferRunIdDir as project + demux.tarSuffix . example: /data/for_transfer/220603_M06578_0105_000000000-KB7MY/220603_M06578.42015-NORM-VET.tar
+            tarFileHandle.extractall( path = forTransferRunIdDirTestName  )
+            tarFileHandle.close( )
+        except Exception as err:
+            text = f"{forTransferRunIdDirTestName}/{tarFile} cannot be created: { str( err ) }\nExiting!"
+            demuxFailureLogger.critical( f"{ text }" )
+            demuxLogger.critical( f"{ text }" )
+            logging.shutdown( )
+            sys.exit( )
+
+#---- Step 3: delete {demux.forTransferRunIdDir}/{demux.forTransferRunIdDirTestName} and contents ------------------------------------------------------------
+    # clean up
+    text = "Cleanup up path:"
+    demuxLogger.info( f"{text:{demux.spacing2}}" + forTransferRunIdDirTestName )
+    demux.testTarSize = getDirectorySize( forTransferRunIdDirTestName )                 # for recordDiskUsage( )
+    shutil.rmtree( forTransferRunIdDirTestName )
+
+
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Tar files quaility check finished ==", color="red", attrs=["bold"] ) )
+
+
+
+
+
+########################################################################
+# script_completion_file
+########################################################################
+
+def scriptComplete(  ):
+    """
+    Create the {DemultiplexDir}/{demux.DemultiplexCompleteFile} file to signal that this script has finished
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Finishing up script ==", color="green", attrs=["bold"] ) )
+
+    try:
+        file = os.path.join( demux.demultiplexRunIdDir, demux.demultiplexCompleteFile )
+        pathlib.Path( file ).touch( mode=644, exist_ok=False)
+    except Exception as e:  
+        demuxLogger.critical( f"{file} already exists. Please delete it before running {__file__}.\n")
+        sys.exit( )
+
+    demuxLogger.debug( f"demux.demultiplexCompleteFile {file} created.")
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Finishing up script ==", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# deliverFilesToVIGASP
+########################################################################
+
+def deliverFilesToVIGASP(  ):
+    """
+    Write the uploader file needed to upload the data to VIGASP and then
+        upload the relevant files.
+
+    The uploader file, {RunID}.vigasp.json in {demux.forTransferRunIdDir}, lists every tar with its size, md5 and sha512; the tars and
+        their checksum files go first, several at a time on kept-alive connections, and the uploader file last. What went through is
+        skipped the next time: see demultiplex/vigasp.py. Nothing to do if demux.vigaspUrl is empty.
+    """
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Upload files to VIGASP started ==", color="green", attrs=["bold"] ) )
+
+    if not demux.vigaspUrl:
+        demuxLogger.info( "demux.vigaspUrl is not set, not uploading to VIGASP" )
+        demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Upload files to VIGASP finished ==\n", color="red", attrs=["bold"] ) )
+        return
+
+    token = None
+    if os.path.isfile( demux.vigaspTokenFilePath ):
+        with open( demux.vigaspTokenFilePath, encoding = demux.decodeScheme ) as tokenFileHandle:
+            token = tokenFileHandle.read( ).strip( )
+
+    try:
+        manifest, uploads = vigasp.buildManifest( demux.RunID, demux.forTransferRunIdDir, demux.tarSuffix, demux.md5Suffix, demux.sha512Suffix )
+        text = "uploading:"
+        demuxLogger.info( f"{text:{demux.spacing2}}{len( manifest[ 'files' ] )} tars, {sum( entry[ 'size' ] for entry in manifest[ 'files' ] ) / 1024**3:.1f} GiB to {demux.vigaspUrl}/{demux.RunID}" )
+        uploaded = vigasp.uploadRun( demux.RunID, manifest, uploads, demux.vigaspUrl, os.path.join( demux.forTransferRunIdDir, demux.vigaspStatusFileName ), demux.vigaspWorkers,
+                                     demux.vigaspAttempts, demux.vigaspBackoff, demux.vigaspTimeout, token = token, log = demuxLogger.debug )
+    except ( OSError, ValueError ) as err:
+        uploaded = [ vigasp.UploadFile( demux.forTransferRunIdDir, demux.RunID, 0, error = str( err ) ) ]
+
+    failed = [ upload for upload in uploaded if upload.error ]
+    if failed:
+        text = [ f"Upload of {demux.RunID} to {demux.vigaspUrl} failed:" ]
+        text = text + [ f"  {upload.localPath}: {upload.error}" for upload in failed ]
+        text.append( f"What went through is written down in {demux.vigaspStatusFileName}: run the script again to upload the rest. Exiting." )
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Upload files to VIGASP finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# archiveRunRawData( )
+########################################################################
+
+def archiveRunRawData( ):
+    """
+    Pack {demux.rawDataRunIDdir} into compressed, checksummed chunks of demux.archiveChunkSize in {demux.archiveDir}/{RunID},
+        with a manifest, for deliverFilesToNIRD( ) to archive: see demultiplex/rawarchive.py. An interrupted archival resumes.
+
+    Throttled: demux.archiveWorkers chunks at a time, demux.archiveWorkersBusy while another run is being demultiplexed.
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Archive the raw run started ==", color="green", attrs=["bold"] ) )
+
+    def throttle( ):
+        otherRuns = [ RunID for RunID in runningRuns( ) if RunID != demux.RunID ]
+        return demux.archiveWorkersBusy if otherRuns else demux.archiveWorkers
+
+    archiveRunIdDir = os.path.join( demux.archiveDir, demux.RunID )
+    try:
+        manifest = rawarchive.archiveRun( demux.rawDataRunIDdir, archiveRunIdDir, demux.archiveChunkSize, demux.archiveCompression, demux.archiveCompressionLevel,
+                                          demux.archiveWorkers, throttle = throttle, log = demuxLogger.debug )
+    except ( OSError, ValueError, tarfile.TarError, futures.BrokenExecutor ) as err:
+        text = [ f"Archiving {demux.rawDataRunIDdir} into {archiveRunIdDir} failed: {err}",
+                 f"The chunks packed so far are kept: run the script again to pick up from there. Exiting." ]
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    uncompressed = sum( chunk[ 'uncompressedBytes' ] for chunk in manifest[ 'chunks' ] )
+    compressed   = sum( chunk[ 'bytes' ] for chunk in manifest[ 'chunks' ] )
+    text = "raw run archived:"
+    demuxLogger.info( f"{text:{demux.spacing2}}{len( manifest[ 'chunks' ] )} chunks, {uncompressed / 1024**3:.1f} GiB into {compressed / 1024**3:.1f} GiB in {archiveRunIdDir}" )
+    recordStageSizes( { 'archive': compressed } )                                           # what the next prediction counts on, see predictDiskSpace( )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Archive the raw run finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# deliverFilesToNIRD
+########################################################################
+
+def deliverFilesToNIRD(  ):
+    """
+    Make connection to NIRD and upload the data
+
+    Everything in {demux.forTransferRunIdDir} goes to {demux.nirdTarget}/{RunID}, and the chunks of the raw run archiveRunRawData( ) packed
+        to {demux.nirdTarget}/{RunID}/{demux.nirdRawDataDirName}. Parallel, bandwidth capped, checked against the .sha512 files at the
+        other end and resumed if interrupted: see demultiplex/delivery.py.
+    """
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Deliver files to NIRD started ==", color="green", attrs=["bold"] ) )
+
+    files = [ ]
+    for directoryRoot, dirnames, filenames in os.walk( demux.forTransferRunIdDir ):
+        dirnames[ : ] = sorted( dirname for dirname in dirnames if dirname != demux.forTransferRunIdDirTestName and not dirname.startswith( '.' ) )
+        for filename in sorted( filenames ):
+            if not filename.startswith( '.' ) and not filename.endswith( demux.stagingSuffix ):
+                filePath = os.path.join( directoryRoot, filename )
+                files.append( ( filePath, os.path.join( demux.RunID, os.path.relpath( filePath, demux.forTransferRunIdDir ) ) ) )
+    archiveRunIdDir = os.path.join( demux.archiveDir, demux.RunID )
+    if demux.archiveRawData and os.path.isdir( archiveRunIdDir ):
+        for filename in sorted( os.listdir( archiveRunIdDir ) ):
+            if not filename.endswith( rawarchive.partialSuffix ):
+                files.append( ( os.path.join( archiveRunIdDir, filename ), os.path.join( demux.RunID, demux.nirdRawDataDirName, filename ) ) )
+
+    text = "delivering:"
+    demuxLogger.info( f"{text:{demux.spacing2}}{len( files )} files, {sum( os.path.getsize( filePath ) for filePath, remotePath in files ) / 1024**3:.1f} GiB to {demux.nirdTarget}/{demux.RunID}" )
+    transport = None
+    try:
+        transport = delivery.openTransport( demux.nirdTarget )
+        delivered = delivery.deliverFiles( files, transport, os.path.join( demux.forTransferRunIdDir, demux.nirdJournalFileName ), demux.nirdWorkers, demux.nirdRangeSize,
+                                           demux.nirdBandwidth, sha512Suffix = demux.sha512Suffix, attempts = demux.nirdAttempts, log = demuxLogger.debug )
+    except ( OSError, ValueError ) as err:
+        delivered = [ delivery.DeliveryFile( demux.forTransferRunIdDir, demux.nirdTarget, 0, [ ], error = str( err ) ) ]
+    finally:
+        if transport:
+            transport.close( )
+
+    failed = [ deliveryFile for deliveryFile in delivered if deliveryFile.error ]
+    if failed:
+        text = [ f"Delivery of {demux.RunID} to {demux.nirdTarget} failed:" ]
+        text = text + [ f"  {deliveryFile.localPath}: {deliveryFile.error}" for deliveryFile in failed ]
+        text.append( f"What arrived is kept and written down in {demux.nirdJournalFileName}: run the script again to send the rest. Exiting." )
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Deliver files to NIRD finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+
+########################################################################
+# detectNewRuns
+########################################################################
+
+def detectNewRuns( ):
+    """
+    Detect if a new run has been uploaded to /data/rawdata
+
+    Asks the run-state store, demux.runStateFilePath, instead of listing /data/rawdata and /data/demultiplex and comparing the two:
+        runstate.detectRuns( ) only looks at the directories whose mtime changed since the last call.
+
+    Returns ( the runs queued by this call, every queued run in the order scheduleRuns( ) wants them, the runs still waiting for RTAComplete.txt/SampleSheet.csv )
+    """
+
+    connection = runstate.openStore( demux.runStateFilePath )
+    with connection:
+        newlyQueued = runstate.detectRuns( connection, demux.rawDataDir, demux.demultiplexDir, demux.miSeq + demux.nextSeq, demux.demultiplexDirSuffix, [ demux.rtaCompleteFile, demux.sampleSheetFileName ] )
+        waiting     = [ run[ 0 ] for run in runstate.listRuns( connection, [ runstate.WAITING ] ) ]
+    connection.close( )
+    pending = [ run.runId for run in scheduleRuns( ) ]
+    return newlyQueued, pending, waiting
+
+
+
+########################################################################
+# estimateRun( )
+########################################################################
+
+def estimateRun( RunID ):
+    """
+    How big {RunID} is, out of its RunInfo.xml, SampleSheet.csv and Data/Intensities/BaseCalls in demux.rawDataDir:
+        ( work units, see scheduler.workUnits( ), bytes of BaseCalls, number of samples )
+
+    None if any of them cannot be read: the run gets demux.defaultRunSeconds as its estimate, and is looked at again next time.
+    """
+
+    runDir              = os.path.join( demux.rawDataDir, RunID )
+    sampleSheetFilePath = os.path.join( runDir, demux.sampleSheetFileName )
+    try:
+        runInfo     = parseRunInfo( os.path.join( runDir, demux.runInfoFileName ) )
+        with open( sampleSheetFilePath, 'rb' ) as sampleSheetFileHandle:
+            sampleSheet = samplesheet.SampleSheet( sampleSheetFilePath, sampleSheetFileHandle.read( ) )     # not samplesheet.load( ): the daemon would keep every sheet it ever estimated in its cache
+        sampleCount = len( sampleSheet.uniqueSamples )
+        rawBytes    = getDirectorySize( os.path.join( runDir, 'Data', 'Intensities', 'BaseCalls' ) )
+    except ( OSError, AttributeError, TypeError, ValueError, ElementTree.ParseError ) as err:
+        demuxLogger.debug( f"Cannot estimate the size of {RunID}: {err}" )
+        return None
+    return scheduler.workUnits( len( runInfo[ 'tiles' ] ), runInfo[ 'cycles' ], sampleCount ), rawBytes, sampleCount
+
+
+
+########################################################################
+# scheduleRuns( )
+########################################################################
+
+def scheduleRuns( ):
+    """
+    The queued runs in demux.runStateFilePath, as scheduler.QueuedRun, in the order they should be started: see demultiplex/scheduler.py
+        Runs without an estimate get one first. The queue is written out to demux.queueMetricsFilePath on the way.
+    """
+
+    connection = runstate.openStore( demux.runStateFilePath )
+    finished   = runstate.finishedRuns( connection )
+    queued     = [ ]
+    with connection:
+        for RunID, priority, queuedAt, instrument, workUnits in runstate.queuedRuns( connection ):
+            if workUnits is None:
+                instrument, estimate = getInstrumentType( RunID ), estimateRun( RunID )
+                if estimate is not None:
+                    workUnits = estimate[ 0 ]
+                    runstate.setEstimate( connection, RunID, instrument, *estimate )
+            run = scheduler.QueuedRun( RunID, priority, queuedAt, instrument, workUnits )
+            if workUnits is None:
+                run.estimate = demux.defaultRunSeconds
+            else:
+                run.estimate = workUnits * scheduler.secondsPerUnit( finished, instrument, demux.secondsPerWorkUnit.get( instrument, demux.secondsPerWorkUnit[ 'unknown' ] ) )
+            queued.append( run )
+    connection.close( )
+
+    ordered = scheduler.orderRuns( queued, time.time( ), demux.queueStarvationSeconds )
+    try:
+        scheduler.writeMetrics( demux.queueMetricsFilePath, scheduler.queueMetrics( ordered, finished ) )
+    except OSError as err:
+        demuxLogger.warning( f"Cannot write queue metrics to {demux.queueMetricsFilePath}: {err}" )     # monitoring, not worth holding the queue up for
+    return ordered
+
+
+
+########################################################################
+# predictDiskSpace( )
+########################################################################
 
+def predictDiskSpace( connection, RunID ):
+    """
+    Bytes every stage of {RunID} is predicted to write, { stage: bytes }, see diskspace.predictStageBytes( ).
+        None if the size of the run is not known and cannot be worked out.
+    """
 
+    estimate = runstate.runEstimate( connection, RunID )
+    if not estimate or estimate[ 2 ] is None:
+        worked = estimateRun( RunID )
+        if worked is None:
+            return None
+        if estimate:
+            runstate.setEstimate( connection, RunID, getInstrumentType( RunID ), *worked )
+        estimate = ( None, *worked )
+    rawBytes, samples = estimate[ 2 ], estimate[ 3 ]
+    return { stage: diskspace.predictStageBytes( rawBytes, samples, runstate.stageSizeHistory( connection, stage ), demux.diskStageFactors[ stage ] )
+             for stage in diskspace.STAGES if stage != 'archive' or demux.archiveRawData }
 
 
 
 ########################################################################
-# Water Control Negative report
+# diskSpaceTargets( )
 ########################################################################
 
-def controlProjectsQC(  ):
+def diskSpaceTargets( RunID ):
+    """
+    Where each stage of {RunID} writes, { stage: directory }, and where the run has written so far, [ directory, ... ]
     """
-    This function creeates a report if any water 1 samples are submitted for sequence ( and subsequently, analysis )
 
-    If there are no water control samples, no report is generated.
+    demultiplexRunIdDir = os.path.join( demux.demultiplexDir, RunID + demux.demultiplexDirSuffix )
+    forTransferRunIdDir = os.path.join( demux.forTransferDir, RunID )
+    archiveRunIdDir     = os.path.join( demux.archiveDir, RunID )
+    targets = { 'demultiplex': demultiplexRunIdDir, 'qualityCheck': demultiplexRunIdDir, 'prepareDelivery': forTransferRunIdDir, 'tarFileQualityCheck': forTransferRunIdDir,
+                'archive': archiveRunIdDir }
+    return targets, [ demultiplexRunIdDir, forTransferRunIdDir, archiveRunIdDir ]
 
-    If there are water control samples,
-        create the full report ONLY if any amplicons are found
-    Otherwise
-        just mention in green text that no results are detected (and move on)
+
+
+########################################################################
+# diskSpaceShortfalls( )
+########################################################################
+
+def diskSpaceShortfalls( RunID ):
     """
-    demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Control Project QC for non-standard proejcts started ==", color="green", attrs=["bold"] ) )
+    Would {RunID} fit on disk, next to the runs already running and demux.diskSpaceReserve? Returns what is short, as text, one line
+        per filesystem: an empty list means go ahead. A run whose size cannot be worked out is let through, checkRawDataIntegrity( )
+        will have more to say about it.
 
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Control Project QC for non-standard proejcts finished ==", color="red", attrs=["bold"] ) )
+    What a running run still has to write is its prediction minus what is already in its directories.
+    """
 
+    connection = runstate.openStore( demux.runStateFilePath )
+    try:
+        predictions = predictDiskSpace( connection, RunID )
+        if predictions is None:
+            return [ ]
+        targets, written = diskSpaceTargets( RunID )
+        peaks    = diskspace.peakBytes( predictions, targets )
+        reserved = dict( )
+        for runningRunID in [ run[ 0 ] for run in runstate.listRuns( connection, [ runstate.RUNNING ] ) if run[ 0 ] != RunID ]:
+            runningPredictions = predictDiskSpace( connection, runningRunID )
+            if runningPredictions is None:
+                continue
+            runningTargets, runningWritten = diskSpaceTargets( runningRunID )
+            for deviceId, ( directory, size ) in diskspace.peakBytes( runningPredictions, runningTargets ).items( ):
+                already = sum( getDirectorySize( path ) for path in runningWritten if os.path.isdir( path ) and diskspace.device( path ) == deviceId )
+                reserved[ deviceId ] = reserved.get( deviceId, 0 ) + max( 0, size - already )
+        short = diskspace.shortfalls( peaks, reserved, demux.diskSpaceReserve )
+    finally:
+        connection.close( )
+    return [ f"{directory}: {needed / 1024**3:.1f} GiB needed ( {demux.diskSpaceReserve / 1024**3:.0f} GiB reserve and the running runs included ), {free / 1024**3:.1f} GiB free"
+             for directory, needed, free in short ]
 
 
 
 ########################################################################
-# Perform a sha512 comparision
+# checkDiskSpace( )
 ########################################################################
 
-def sha512FileQualityCheck(  ):
+def checkDiskSpace( ):
     """
-    re-perform (quietly) the sha512 calculation and compare that with the result on file for the specific file.
+    Before anything is created under {demux.demultiplexDir}: is there room for everything the run will write?
+        cron_job.py and the daemon do not start a run that does not fit, this catches the runs started by hand.
     """
-    demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: sha512 files check started ==", color="green", attrs=["bold"] ) )
 
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: sha512 files check finished ==", color="red", attrs=["bold"] ) )
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Check the free disk space started ==", color="green", attrs=["bold"] ) )
 
+    short = diskSpaceShortfalls( demux.RunID )
+    if short:
+        text = [ f"Not enough disk space for {demux.RunID}:", *short, f"Make room, or set demux.diskSpaceCheck = False if you know better. Exiting." ]
+        text = '\n'.join( text )
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
 
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Check the free disk space finished ==\n", color="red", attrs=["bold"] ) )
 
 
 
 ########################################################################
-# tarFileQualityCheck: verify tar files before upload
+# recordDiskUsage( )
 ########################################################################
 
-def tarFileQualityCheck(  ):
+def recordDiskUsage( ):
+    """
+    Record what every stage of the run actually wrote, for predictDiskSpace( ) to learn from the next time.
+        archiveRunRawData( ) comes later and records its own, with recordStageSizes( ).
     """
-    Perform a final quality check on the tar files before uploading them.
-    If there are errors in the untarring or the sha512 check, halt.
-    If there are no errors, go ahead with the uploading
 
+    qcSize = getDirectorySize( demux.demuxQCDirectoryFullPath ) if os.path.isdir( demux.demuxQCDirectoryFullPath ) else 0
+    try:
+        sizes = { 'demultiplex':            getDirectorySize( demux.demultiplexRunIdDir ) - qcSize,
+                  'qualityCheck':           qcSize,
+                  'prepareDelivery':        getDirectorySize( demux.forTransferRunIdDir ),
+                  'tarFileQualityCheck':    demux.testTarSize }
+    except OSError as err:
+        demuxLogger.warning( f"Cannot record the disk usage of {demux.RunID}: {err}" )       # only the next prediction suffers
+        return
+    recordStageSizes( sizes )
 
-    steps for completing this function:
-        Step 1: create a /data/for_transfer/RunID/test directory
-        Step 2: copy any tar file for relevant RunIDShort into the test directory
-        Step 3: untar files under /data/for_transfer/RunID/test
-        Step 4: recalculate sha512 hash for each file
-        compare result with hash file on disk
-            stuff result in sql database?
-        delete {demux.forTransferRunIdDir}/{demux.forTransferRunIdDirTestName} and contents
-        return True/false depending on answer
 
-    INPUT
-        Input is RunID rather than demux.RunID or some other variable because we can use this method later to check the tarFile quality of any fetched tar file from archive
-    """
-    demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Tar files quaility check started ==", color="green", attrs=["bold"] ) )
 
-    forTransferRunIdDirTestName = os.path.join( demux.forTransferRunIdDir,demux.forTransferRunIdDirTestName )
+########################################################################
+# recordStageSizes( )
+########################################################################
 
-#---- Step 1: create a /data/for_transfer/RunID/test directory -------------------------------------------------------------------------------------------
+def recordStageSizes( sizes ):
+    """
+    Record { stage: bytes written } for the run in the run-state store, next to the size of its raw data
+    """
 
-    # ensure that demux.forTransferDir (/data/for_transfer) exists
-    if not os. path. isdir( demux.forTransferDir ):
-        text = f"{demux.forTransferDir} does not exist! Please re-run the ansible playbook! Exiting!"
-        demuxFailureLogger.critical( f"{ text }" )
-        demuxLogger.critical( f"{ text }" )
-        logging.shutdown( )
-        sys.exit( )    
+    connection = runstate.openStore( demux.runStateFilePath )
+    try:
+        estimate = runstate.runEstimate( connection, demux.RunID )
+        if not estimate or estimate[ 2 ] is None:
+            worked = estimateRun( demux.RunID )
+            if worked is None:
+                return
+            estimate = ( None, *worked )
+        for stage, size in sizes.items( ):
+            runstate.recordStageSize( connection, demux.RunID, stage, size, estimate[ 2 ], estimate[ 3 ] )
+    except ( OSError, sqlite3.Error ) as err:
+        demuxLogger.warning( f"Cannot record the disk usage of {demux.RunID}: {err}" )       # only the next prediction suffers
+    finally:
+        connection.close( )
 
-    try: 
-        os.mkdir( forTransferRunIdDirTestName )
-    except Exception as err:
-        text = f"{demux.forTransferRunIdDir} cannot be created: { str( err ) }\nExiting!"
-        demuxFailureLogger.critical( f"{ text }" )
-        demuxLogger.critical( f"{ text }" )
-        logging.shutdown( )
-        sys.exit( )
 
-# there is no point in making this complicated: tar files can be easily edited, they are just a simple container and any attacker can easily alter the file insitu,
-# recalculate the hash and replace the hash again in situ
-#
-# So the only thing we can do is basically untar the file to ensure that it was packed correctly in this program,
-# then delete the test_tar directory
 
-# for file in $TARFILES; do printf '\n==== tar file: $file============================='; tar --verbose --compare --file=$file | grep -v 'Mod time differs'; done
-#---- Step 2: untar all demux.tarFilesToTransferList in {demux.forTransferRunIdDir}/{demux.forTransferRunIdDirTestName} ------------------------------------------------------------
-    for tarFile in demux.tarFilesToTransferList:
-        try:
-            text = "Now extracting tarfile:"
-            demuxLogger.debug( f"{text:{demux.spacing3}}" + tarFile )
-            tarFileHandle = tarfile.open( name = tarFile, mode = "r:" )     # Open a tar file under  demux.forTransferRunIdDir as project + demux.tarSuffix . example: /data/for_transfer/220603_M06578_0105_000000000-KB7MY/220603_M06578.42015-NORM-VET.tar
-            tarFileHandle.extractall( path = forTransferRunIdDirTestName  )
-            tarFileHandle.close( )
-        except Exception as err:
-            text = f"{forTransferRunIdDirTestName}/{tarFile} cannot be created: { str( err ) }\nExiting!"
-            demuxFailureLogger.critical( f"{ text }" )
-            demuxLogger.critical( f"{ text }" )
-            logging.shutdown( )
-            sys.exit( )
+########################################################################
+# applyRetention( )
+########################################################################
 
-#---- Step 3: delete {demux.forTransferRunIdDir}/{demux.forTransferRunIdDirTestName} and contents ------------------------------------------------------------
-    # clean up
-    text = "Cleanup up path:"
-    demuxLogger.info( f"{text:{demux.spacing2}}" + forTransferRunIdDirTestName )
-    shutil.rmtree( forTransferRunIdDirTestName )
+def applyRetention( dryRun = False ):
+    """
+    Delete what demux.retentionRules say has been kept long enough, see demultiplex/retention.py. With {dryRun}, only say what would go.
 
+    Never touched, whatever the rules say: the run this process works on, every run the run-state store has as seen, waiting, queued or
+        running, and every run somebody holds a live lease on.
 
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Tar files quaility check finished ==", color="red", attrs=["bold"] ) )
+    Returns ( candidates, bytes freed, [ ( path, error ), ... ] )
+    """
 
+    connection = runstate.openStore( demux.runStateFilePath )
+    inProgress = { run[ 0 ] for run in runstate.listRuns( connection, [ runstate.SEEN, runstate.WAITING, runstate.QUEUED, runstate.RUNNING ] ) }
+    delivered  = runstate.deliveredRuns( connection )
+    connection.close( )
+    inProgress.update( name for name, holder, age in lease.leases( demux.leaseDirPath ) if age < demux.leaseTimeout )
+    if demux.RunID:
+        inProgress.add( demux.RunID )
 
+    candidates = retention.findCandidates( demux.retentionRules, lambda RunID: RunID in inProgress, delivered, [ demux.demultiplexDirSuffix ] )
+    if dryRun or not candidates:
+        return candidates, 0, [ ]
+    freed, errors = retention.deleteCandidates( candidates, demux.retentionWorkers )
+    return candidates, freed, errors
 
 
 
 ########################################################################
-# script_completion_file
+# cleanupAfterDelivery( )
 ########################################################################
 
-def scriptComplete(  ):
+def cleanupAfterDelivery( ):
     """
-    Create the {DemultiplexDir}/{demux.DemultiplexCompleteFile} file to signal that this script has finished
+    The run is delivered and its tar files verified: record that, it is what the 'delivered' retention rules count from,
+        and, if demux.retentionAfterDelivery, apply the retention rules: this run's turn to make room for the next one
     """
 
     demux.n = demux.n + 1
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Finishing up script ==", color="green", attrs=["bold"] ) )
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Clean up after delivery started ==", color="green", attrs=["bold"] ) )
 
-    try:
-        file = os.path.join( demux.demultiplexRunIdDir, demux.demultiplexCompleteFile )
-        pathlib.Path( file ).touch( mode=644, exist_ok=False)
-    except Exception as e:  
-        demuxLogger.critical( f"{file} already exists. Please delete it before running {__file__}.\n")
-        sys.exit( )
+    connection = runstate.openStore( demux.runStateFilePath )
+    with connection:
+        runstate.setDelivered( connection, demux.RunID )
+    connection.close( )
 
-    demuxLogger.debug( f"demux.demultiplexCompleteFile {file} created.")
-    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Finishing up script ==", color="red", attrs=["bold"] ) )
+    if demux.retentionAfterDelivery:
+        try:
+            candidates, freed, errors = applyRetention( )
+        except ( OSError, ValueError, sqlite3.Error ) as err:
+            demuxLogger.warning( f"Retention failed: {err}" )                                 # the run itself is done and delivered, the next one can try again
+        else:
+            if candidates:
+                demuxLogger.info( retention.report( candidates, dryRun = False ) )
+            text = "reclaimed:"
+            demuxLogger.info( f"{text:{demux.spacing2}}{freed / 1024**3:.1f} GiB" )
+            for path, err in errors:
+                demuxLogger.warning( f"Could not delete {path}: {err}" )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Clean up after delivery finished ==\n", color="red", attrs=["bold"] ) )
 
 
 
 ########################################################################
-# deliverFilesToVIGASP
+# setRunPriority( )
 ########################################################################
 
-def deliverFilesToVIGASP(  ):
+def setRunPriority( RunID, priority ):
     """
-    Write the uploader file needed to upload the data to VIGASP and then
-        upload the relevant files.
+    The manual override of the queue order: higher {priority} first, see runstate.setPriority( )
     """
-    demux.n = demux.n + 1
-    demuxLogger.info( f"==> {demux.n}/{demux.totalTasks} tasks: Preparing files for uploading to VIGASP started\n")
+
+    connection = runstate.openStore( demux.runStateFilePath )
+    with connection:
+        runstate.setPriority( connection, RunID, priority )
+    connection.close( )
+
 
 
-    demuxLogger.info( f"==< {demux.n}/{demux.totalTasks} tasks: Preparing files for uploading to VIGASP finished\n")
+########################################################################
+# acquireRunLease( )
+########################################################################
+
+def acquireRunLease( RunID ):
+    """
+    Take the lease on {RunID}, so no other cron tick, daemon worker, or somebody typing demultiplex_script.py {RunID} on another host
+        works on the same run at the same time. A lease whose holder died, or has not sent a heartbeat for demux.leaseTimeout seconds,
+        is taken over.
 
+    Returns True if this process holds the lease now. It is given up when the process exits.
+    """
+
+    if demux.runLease is not None and demux.runLease.name == RunID and demux.runLease.held:
+        return True
+    runLease = lease.Lease( demux.leaseDirPath, RunID, heartbeat = demux.leaseHeartbeat, timeout = demux.leaseTimeout )
+    if not runLease.acquire( ):
+        return False
+    demux.runLease = runLease
+    atexit.register( runLease.release )
+    return True
 
 
 
 ########################################################################
-# deliverFilesToNIRD
+# checkRunLease( )
 ########################################################################
 
-def deliverFilesToNIRD(  ):
+def checkRunLease( ):
     """
-    Make connection to NIRD and upload the data
+    Stop if our lease on demux.RunID was taken over: we were hung long enough for another worker to decide we were dead,
+        and it is now doing the same work
     """
-    demux.n = demux.n + 1
-    demuxLogger.info( f"==> {demux.n}/{demux.totalTasks} tasks: Preparing files for archiving to NIRD started\n")
-
 
-    demuxLogger.info( f"==< {demux.n}/{demux.totalTasks} tasks: Preparing files for archiving to NIRD finished\n")
+    if demux.runLease is None or not demux.runLease.lost:
+        return
 
+    holder = demux.runLease.holder( ) or { }
+    text   = [  f"The lease on {demux.RunID} was taken over by {holder.get( 'host' )} pid {holder.get( 'pid' )}, it is demultiplexing this run now.",
+                f"Exiting."
+              ]
+    text = '\n'.join( text )
+    demuxFailureLogger.critical( text )
+    demuxLogger.critical( text )
+    logging.shutdown( )
+    sys.exit( )
 
 
 
 ########################################################################
-# detectNewRuns
+# runningRuns( )
 ########################################################################
 
-def detectNewRuns(  ):
+def runningRuns( ):
     """
-    Detect if a new run has been uploaded to /data/rawdata
+    The RunIDs demux.runStateFilePath has as running, by any worker
     """
 
-#########
-# TODO TODO TODO
-#
-#   new feature: logging.info out all the new runs detected
-#       mention which one is being processed
-#       mention which one are remaining
-#########
-    demux.n = demux.n + 1
-    demuxLogger.info( f"==> {demux.n}/{demux.totalTasks} tasks: Detecting if new runs exist started\n")
+    connection = runstate.openStore( demux.runStateFilePath )
+    running    = [ run[ 0 ] for run in runstate.listRuns( connection, [ runstate.RUNNING ] ) ]
+    connection.close( )
+    return running
+
+
 
+########################################################################
+# setRunState( )
+########################################################################
+
+def setRunState( RunID, state, message = None ):
+    """
+    Record {state} for {RunID} in demux.runStateFilePath, for the scheduler
+    """
 
-    demuxLogger.info( f"==< {demux.n}/{demux.totalTasks} tasks: Detecting if new runs exist finished\n")
+    connection = runstate.openStore( demux.runStateFilePath )
+    with connection:
+        runstate.setState( connection, RunID, state, message )
+    connection.close( )
 
 
 
@@ -2068,6 +5024,88 @@ def copySampleSheetIntoDemultiplexRunIdDir( ):
 
 
 
+########################################################################
+# writePrefixedSampleSheet( )
+########################################################################
+
+def writePrefixedSampleSheet( ):
+    """
+    Write a copy of SampleSheet.csv under {demux.demultiplexLogDirPath} where Sample_Project, Sample_ID and Sample_Name
+        already carry the {demux.RunIDShort}. prefix, and point bcl2fastq at it with --sample-sheet.
+
+    bcl2fastq then writes
+        {demux.demultiplexRunIdDir}/{demux.RunIDShort}.{project}/{demux.RunIDShort}.{sample}_S1_R1_001.fastq.gz
+    directly, so renameFilesAndDirectories( ) has nothing left to rename.
+
+    The original names are kept in demux.originalNames ( prefixed name -> original name ) and written next to the
+        derived sheet as {demux.originalNamesFileName}, for reporting.
+
+    Only used if demux.bcl2fastqWritesFinalNames is True, with bcl2fastq: see checkSampleSheetForMistakes( ). Lines outside the [Data] rows are copied verbatim.
+        A re-run overwrites both files, like the other files derived from the sheet.
+    """
+
+    demux.n = demux.n + 1
+    demuxLogger.info( termcolor.colored( f"==> {demux.n}/{demux.totalTasks} tasks: Write {demux.RunIDShort}. prefixed SampleSheet to {demux.prefixedSampleSheetFilePath} started ==\n", color="green", attrs=["bold"] ) )
+
+    prefix        = demux.RunIDShort + '.'
+    originalNames = dict( )
+    sampleSheet   = getSampleSheet( )
+    dataRows      = dict( )                                             # { line index: [ field, ... ] }, the [Data] rows with the prefix
+    header        = next( csv.reader( [ sampleSheet.lines[ sampleSheet.dataHeaderLine ] ] ) ) if sampleSheet.dataHeaderLine >= 0 else [ ]
+    columns       = [ samplesheet.clean( column ) for column in header ]
+    prefixed      = [ columns.index( column ) for column in [ demux.Sample_Project, demux.Sample_ID, demux.Sample_Name ] if column in columns ]
+
+    for sample in sampleSheet.samples:                                  # only the [Data] rows change
+        fields = [ samplesheet.clean( field ) for field in next( csv.reader( [ sampleSheet.lines[ sample.lineNumber - 1 ] ] ) ) ]
+        for index in prefixed:
+            if index < len( fields ) and fields[ index ]:
+                original        = fields[ index ]
+                fields[ index ] = prefix + original
+                originalNames[ fields[ index ] ] = original
+        dataRows[ sample.lineNumber - 1 ] = fields
+
+    try:
+        with open( demux.prefixedSampleSheetFilePath, 'w', encoding = demux.decodeScheme, newline = '' ) as prefixedFileHandle:
+            writer = csv.writer( prefixedFileHandle, lineterminator = '\n' )     # quotes the fields that need it, a comma inside a Description included
+            for index, line in enumerate( sampleSheet.lines ):
+                if index in dataRows:
+                    writer.writerow( dataRows[ index ] )
+                else:
+                    prefixedFileHandle.write( line + '\n' )
+        with open( demux.originalNamesFilePath, 'w', encoding = demux.decodeScheme ) as originalNamesFileHandle:
+            for prefixedName, original in originalNames.items( ):
+                originalNamesFileHandle.write( f"{prefixedName}\t{original}\n" )
+    except OSError as err:
+        text = f"Writing {demux.prefixedSampleSheetFilePath} failed: {err}\nExiting."
+        demuxFailureLogger.critical( text )
+        demuxLogger.critical( text )
+        logging.shutdown( )
+        sys.exit( )
+
+    demux.originalNames = originalNames
+
+    text = "names prefixed:"
+    demuxLogger.debug( f"{text:{demux.spacing2}}{len( originalNames )}" )
+
+    demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Write {demux.RunIDShort}. prefixed SampleSheet to {demux.prefixedSampleSheetFilePath} finished ==\n", color="red", attrs=["bold"] ) )
+
+
+
+########################################################################
+# originalName( )
+########################################################################
+
+def originalName( name ):
+    """
+    Return the SampleSheet name of a {demux.RunIDShort}. prefixed project or sample name, as written by writePrefixedSampleSheet( ).
+        Names that were not prefixed by us are returned as they are.
+    """
+
+    return demux.originalNames.get( name, name )
+
+
+
+
 ########################################################################
 # archiveSampleSheet( )
 ########################################################################
@@ -2080,6 +5118,7 @@ def archiveSampleSheet( ):
     Check for validity of the filepath of the sample sheet
     then
         archive a copy
+        add the copy to the SampleSheet index, demux.sampleSheetIndexFilePath
     """
 
     demux.n = demux.n + 1
@@ -2106,7 +5145,7 @@ def archiveSampleSheet( ):
         currentPermissions = stat.S_IMODE(os.lstat( demux.sampleSheetArchiveFilePath ).st_mode )
         os.chmod( demux.sampleSheetArchiveFilePath, stat.S_IREAD | stat.S_IWRITE | stat.S_IRGRP | stat.S_IROTH ) # Set samplesheet to "o=rw,g=r,o=r"
     except Exception as err:
-        frameinfo = getframeinfo( currentframe( ) )
+        frameinfo = inspect.getframeinfo( inspect.currentframe( ) )
         text = [    f"Archiving {demux.sampleSheetFilePath} to {demux.sampleSheetArchiveFilePath} failed.",
                     str(err),
                     f" at {frameinfo.filename}:{frameinfo.lineno}."
@@ -2117,6 +5156,17 @@ def archiveSampleSheet( ):
         logging.shutdown( )
         sys.exit( )
 
+    # add the archived copy to the index, so demultiplex/tools/samplesheet_index.py can answer for it. The copy is safe either way:
+    # a locked or broken index is worth a warning, not a failed run
+    from demultiplex.samplesheet import archive                         # only needed here, see lazyImport( )
+    try:
+        connection = archive.openIndex( demux.sampleSheetIndexFilePath )
+        with connection:
+            archive.indexSampleSheet( connection, demux.sampleSheetArchiveFilePath )
+        connection.close( )
+    except ( sqlite3.Error, OSError ) as err:
+        demuxLogger.warning( f"Adding {demux.sampleSheetArchiveFilePath} to {demux.sampleSheetIndexFilePath} failed: {err}" )
+
     demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks:  Archive {demux.sampleSheetFilePath} to {demux.sampleSheetArchiveFilePath} ==\n", color="red", attrs=["bold"] ) )
 
 
@@ -2343,6 +5393,12 @@ def setupEnvironment( RunID ):
     demux.demultiplexScriptLogFilePath  = os.path.join( demux.demultiplexLogDirPath, demux.scriptRunLogFileName )
     demux.fastQCLogFilePath             = os.path.join( demux.demultiplexLogDirPath, demux.fastqcLogFileName )
     demux.mutliQCLogFilePath            = os.path.join( demux.demultiplexLogDirPath, demux.multiqcLogFileName )
+    demux.renameJournalFilePath         = os.path.join( demux.demultiplexLogDirPath, demux.renameJournalFileName )
+    demux.prefixedSampleSheetFilePath   = os.path.join( demux.demultiplexLogDirPath, demux.prefixedSampleSheetFileName )
+    demux.originalNamesFilePath         = os.path.join( demux.demultiplexLogDirPath, demux.originalNamesFileName )
+    demux.statusFilePath                = os.path.join( demux.demultiplexLogDirPath, demux.statusFileName )
+    demux.readCountsFilePath            = os.path.join( demux.demultiplexLogDirPath, demux.readCountsFileName )
+    demux.prescanFilePath               = os.path.join( demux.demultiplexLogDirPath, demux.prescanFileName )
     demux.sampleSheetArchiveFilePath    = os.path.join( demux.sampleSheetDirPath,    demux.RunID + demux.csvSuffix ) # .dot is included in csvSuffix
 
     # maintain the order added this way, so our little stateLetter trick will work
@@ -2456,116 +5512,6 @@ def checkRunningDirectoryStructure( ):
     demuxLogger.info( termcolor.colored( f"==< {demux.n}/{demux.totalTasks} tasks: Check if the runtime directory structure is ready for processing ==\n", color="red" ) )
 
 
-########################################################################
-# getRawdataDirs
-########################################################################
-
-def getRawdataDirs( ):
-    """
-    foo
-    """
-
-    demuxLogger.info( f"==> Getting new rawdata directories started ==\n" )
-
-    for dirName in os.listdir( demux.rawDataDir ): # add directory names from the raw generated data directory
-
-        if demux.demultiplexDirSuffix in dirName: #  ignore any _demux dirs
-            continue
-        if any( tag in dirName for tags in [ demux.nextSeq, demux.miSeq ] for tag in tags ): # only add directories that have a sequncer tag
-            demux.RunList.append( dirName )
-
-    demuxLogger.info( f"==< Getting new rawdata directories finished ==\n" )
-
-    return
-
-
-
-########################################################################
-# getDemultiplexedDirs
-########################################################################
-
-def getDemultiplexedDirs( ):
-    """
-    bar
-    """
-
-    demuxLogger.info( f"==> Getting demultiplexed directories started ==\n")
-
-    for dirName in os.listdir( demux.demultiplexDir ):
-
-        if demux.demultiplexDirSuffix not in dirName: #  demultiplexed directories must have the  _demultiplex suffix # safety in case any other dirs included in /data/demultiplex
-            continue
-        if any( tag in dirName for tags in [ demux.nextSeq, demux.miSeq ] for tag in tags ): # ignore directories that have no sequncer tag
-            demux.demultiplexList.append( dirName.replace( demux.demultiplexDirSuffix, '' ) ) # null _demultiplex so we can compare the two lists below
-
-    demuxLogger.info( f"==> Getting demultiplexed directories finished ==\n")
-
-    return
-
-
-########################################################################
-# getDemultiplexedDirs
-########################################################################
-
-def existsNewRun( ):
-    """
-    kot
-    """
-    count = 0
-    demux.newRunList = [ ]  # needs moving
-    NewRunID = '' # turn this into an array
-    for item in RunList: # iterate over RunList to see if there a new item in DemultiplexList, effectively comparing the contents of the two directories
-        if item in DemultiplexList:
-            count += 1
-        else:
-            NewRunList.append( item )
-            NewRunID = item # any RunList item that is not in the demux list, gets processed
-
-    localTime = strftime( "%Y-%m-%d %H:%M:%S", localtime( ) ) 
-    demuxLogger.info( f"{ localTime } - { len( RunList ) } in rawdata and { len( DemultiplexList ) } in demultiplex: ")
-
-    if count == len( RunList ): # no new items in DemultiplexList, therefore count == len( RunList )
-         demuxLogger.info( 'all the runs have been demultiplexed\n' )
-         return True
-
-    if NewRunID: # TODO this needs it's own function.
-
-        flatNewRunList = ", ".join( demux.newRunList )
-        demuxLogger.info( f"{len(NewRunList)} new items to demux: {flatNewRunList}")
-
-        demuxLogger.info( f"Will work on this RunID: {NewRunID}\n" ) # caution: if the corresponding _demux directory is somehow corrupted (wrong data in SampleSheetFilename or incomplete files), this will be printed over and over in the log file
-
-        # essential condition to process is that RTAComplete.txt and SampleSheet.csv
-        if demux.rtaCompleteFile in os.listdir( os.path.join( demux.rawDataDir, NewRunID ) ) and demux.sampleSheetFileName in os.listdir( os.path.join( demux.rawDataDir, NewRunID ) ):
-
-            if not os.path.exists( demux.scriptFilePath ):
-                demuxLogger.info( f"{demux.scriptFilePath} does not exist!" )
-                exit( )
-
-            # EXAMPLE: /bin/python3.11 /data/bin/current_demultiplex_script.py 210903_NB552450_0002_AH3VYYBGXK 
-            demultiplex_script.main( NewRunID )
-
-            demuxLogger.info( 'completed\n' )
-            return True
-        else:
-            demuxLogger.info( ', waiting for the run to complete\n' )
-            return False
-
-    return True
-
-
-
-########################################################################
-# MAIN
-########################################################################
-
-def displayNewRuns( ):
-    """
-    buzz
-    """
-    return
-
-
 ########################################################################
 # MAIN
 ########################################################################
@@ -2579,16 +5525,22 @@ def main( RunID ):
     RunID                   = RunID.replace( "/", "" ) # Just in case anybody just copy-pastes from a listing in the terminal, be forgiving
     RunID                   = RunID.replace( ",", "" ) # Just in case anybody just copy-pastes from a listing in the terminal, be forgiving
 
+    os.umask( demux.umask )                                                                             # files 664, directories 775 from the start, so changePermissions( ) has little left to do
     setupEventAndLogHandling( )                                                                         # setup the event and log handing, which we will use everywhere, sans file logging 
+    if not acquireRunLease( RunID ):                                                                    # somebody else is working on this run: leave it to them, before touching anything
+        holder = lease.Lease( demux.leaseDirPath, RunID ).holder( ) or { }
+        demuxLogger.warning( f"{RunID} is being worked on by {holder.get( 'host' )} pid {holder.get( 'pid' )}, leaving it alone. Exiting." )
+        logging.shutdown( )
+        sys.exit( )
     setupEnvironment( RunID )                                                                           # set up variables needed in the running setupEnvironment  
+    demux.checkSampleSheetForMistakes( RunID )                                                          # spaces, Æ/Ø/Å, empty rows, index collisions: fail before creating anything
     # moved inside setupEnvironment( )
     # demux.getProjectName( )                                                                             # get the list of projects in this current run
-    # getRawdataDirs( )                                                                                   # get the list of the rawdata directories
-    # getDemultiplexedDirs( )                                                                             # get the list of the already demultiplexed directories
-    # if not existsNewRun( )                                                                                     # quit if a new run does not exist
-    #     messageUser
-    #     sys.exit( 0 )
-    # displayNewRuns( )                                                                                   # show all the new runs that need demultiplexing
+    # new runs are found by detectNewRuns( ), called by cron_job.py before main( )
+    if demux.preflightCheck:
+        checkRawDataIntegrity( )                                                                        # fail in seconds, not hours into demultiplex( ), on missing or truncated BCL/filter/locs files
+    if demux.diskSpaceCheck:
+        checkDiskSpace( )                                                                               # fail now, not when /data fills up halfway through
     createDemultiplexDirectoryStructure( )                                                              # create the directory structure under {demux.demultiplexRunIdDir}
     # renameProjectListAccordingToAgreedPatttern( )                                                     # rename the contents of the projectList according to {RunIDShort}.{project}
     # #################### createDemultiplexDirectoryStructure( ) needs to be called before we start logging  ###########################################
@@ -2597,19 +5549,35 @@ def main( RunID ):
     checkRunningEnvironment( )                                                                          # check our running environment
     copySampleSheetIntoDemultiplexRunIdDir( )                                                           # copy SampleSheet.csv from {demux.sampleSheetFilePath} to {demux.demultiplexRunIdDir}
     archiveSampleSheet( )                                                                               # make a copy of the Sample Sheet for future reference
+    if demux.bcl2fastqWritesFinalNames:
+        writePrefixedSampleSheet( )                                                                     # let bcl2fastq write the {RunIDShort}.{project}/{RunIDShort}.{sample} names directly
+    if demux.prescanIndexReads:
+        prescanIndexes( )                                                                               # predict the per-sample yield from a few tiles, catches wrong or swapped indexes in a minute
+    if demux.scratchDir:
+        stageToScratch( )                                                                               # do the heavy I/O on local scratch, up to and including prepareDelivery( )
+    checkRunLease( )                                                                                    # still ours? demultiplex( ) is the expensive part
     demultiplex( )                                                                                      # use blc2fastq to convert .bcl files to fastq.gz
+    releaseScratchRawData( )                                                                            # bcl2fastq is done with the scratch copy of the raw run
     renameFilesAndDirectories( )                                                                        # rename the *.fastq.gz files and the directory project to comply to the {RunIDShort}.{project} convention
+    if demux.laneSplitting:
+        mergeLaneFiles( )                                                                               # count reads per lane, concatenate and hash the per-lane files into per-sample files
     qualityCheck( )                                                                                     # execute QC on the incoming fastq files
     calcFileHash( demux.demultiplexRunIdDir )                                                           # create .md5/.sha512 checksum files for every .fastqc.gz/.tar/.zip file under demultiplexRunIdDir
     changePermissions( demux.demultiplexRunIdDir  )                                                     # change permissions for the files about to be included in the tar files 
     prepareForTransferDirectoryStructure( )                                                             # create /data/for_transfer/RunID and any required subdirectories
     prepareDelivery( )                                                                                  # prepare the delivery files
+    unstageFromScratch( )                                                                               # move the results from scratch to {demux.demultiplexDir}, checksum-verified
     calcFileHash( demux.forTransferRunIdDir )                                                           # create .md5/.sha512 checksum files for the delivery .fastqc.gz/.tar/.zip files under demultiplexRunIdDir, but this 2nd fime do it for the new .tar files created by prepareDelivery( )
     changePermissions( demux.forTransferRunIdDir  )                                                     # change permissions for all the delivery files, including QC
     controlProjectsQC( )                                                                                # check to see if we need to create the report for any control projects present
     tarFileQualityCheck( )                                                                              # QC for tarfiles: can we untar them? does untarring them keep match the sha512 written? have they been tampered with while in storage?
+    recordDiskUsage( )                                                                                  # what every stage wrote, so the next prediction is better
+    checkRunLease( )                                                                                    # still ours? do not deliver the same run twice
     deliverFilesToVIGASP( )                                                                             # Deliver the output files to VIGASP
+    if demux.archiveRawData:
+        archiveRunRawData( )                                                                            # pack the raw run into checksummed chunks for NIRD
     deliverFilesToNIRD( )                                                                               # deliver the output files to NIRD
+    cleanupAfterDelivery( )                                                                             # mark the run delivered, apply demux.retentionRules to make room for the next
     scriptComplete( )                                                                                   # mark the script as complete
     # shutdownEventAndLoggingHandling( )                                                                # shutdown logging before exiting.
 